@@ -113,8 +113,12 @@ case "$1" in
         cd /app/project
         
         # Start Celery worker
-        echo "Starting Celery worker with 4 concurrent processes..."
-        exec celery -A project worker --loglevel=info --concurrency=4
+        # CELERY_QUEUES: 受け持つキュー（ジョブタイプ別のjobs.<type>と連続テストのcontinuous_test。タイプごとにワーカーを分けられる）
+        # -O fair: 長いジョブを実行中の子プロセスに短いジョブのタスクを先取りさせない
+        CELERY_QUEUES=${CELERY_QUEUES:-celery,continuous_test,jobs.test_execution,jobs.bug_analysis,jobs.report_generation,jobs.scenario_generation}
+        CELERY_CONCURRENCY=${CELERY_CONCURRENCY:-4}
+        echo "Starting Celery worker with $CELERY_CONCURRENCY concurrent processes on queues $CELERY_QUEUES..."
+        exec celery -A project worker --loglevel=info --concurrency=$CELERY_CONCURRENCY -Q $CELERY_QUEUES -O fair
         ;;
         
     beat)
@@ -130,6 +134,19 @@ case "$1" in
         exec celery -A project beat --loglevel=info
         ;;
         
+    dispatcher)
+        echo "Starting JobQueue dispatcher..."
+        wait_for_db
+        wait_for_redis
+        
+        # Change to project directory for Django
+        cd /app/project
+        
+        # Start the LISTEN/NOTIFY dispatcher
+        echo "Listening for JobQueue notifications..."
+        exec python manage.py run_job_dispatcher
+        ;;
+        
     flower)
         echo "Starting Flower..."
         wait_for_redis
@@ -209,10 +226,11 @@ case "$1" in
         ;;
         
     *)
-        echo "Usage: $0 {web|worker|beat|flower|prod|shell|test|websocket}"
+        echo "Usage: $0 {web|worker|beat|dispatcher|flower|prod|shell|test|websocket}"
         echo "  web       - Start Django development server"
         echo "  worker    - Start Celery worker"
         echo "  beat      - Start Celery beat scheduler"
+        echo "  dispatcher - Start JobQueue dispatcher (LISTEN/NOTIFY)"
         echo "  flower    - Start Flower monitoring"
         echo "  prod      - Start production server with Gunicorn"
         echo "  shell     - Start Django shell"
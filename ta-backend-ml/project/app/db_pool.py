@@ -0,0 +1,200 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+import psycopg2
+from psycopg2 import extensions
+
+from .db_connection import get_database_url
+
+logger = logging.getLogger(__name__)
+
+
+class PoolTimeout(Exception):
+    """DB_POOL_TIMEOUT秒待っても接続を取得できなかった"""
+
+
+class ConnectionPool:
+    """プロセス共有・スレッドセーフなpsycopg2接続プール
+
+    最大DB_POOL_MAX_SIZE本まで接続を作り、それを超える要求は空きが出るまで待つ。
+    DB_POOL_HEALTHCHECK_SECONDS秒以上使われていなかった接続は、貸し出す前に SELECT 1 で確認する。
+    fork後の子プロセスでは親の接続を使わずに新しく作り直す（Celeryのpreforkワーカー対策）。
+    """
+
+    def __init__(self, dsn: Optional[str] = None, max_size: Optional[int] = None,
+                 timeout: Optional[float] = None, healthcheck_seconds: Optional[float] = None):
+        self.dsn = dsn or get_database_url()
+        self.max_size = max_size or int(os.getenv('DB_POOL_MAX_SIZE', '10'))
+        self.timeout = timeout if timeout is not None else float(os.getenv('DB_POOL_TIMEOUT', '30'))
+        self.healthcheck_seconds = (healthcheck_seconds if healthcheck_seconds is not None
+                                    else float(os.getenv('DB_POOL_HEALTHCHECK_SECONDS', '30')))
+        self._cond = threading.Condition()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        # (接続, 返却された時刻)
+        self._idle: List[Tuple[extensions.connection, float]] = []
+        self._size = 0
+        self._stats = {
+            'checkouts': 0,
+            'wait_seconds_total': 0.0,
+            'max_wait_seconds': 0.0,
+            'timeouts': 0,
+            'connections_created': 0,
+            'connections_discarded': 0,
+            'health_check_failures': 0
+        }
+
+    def _check_fork(self):
+        if self._pid != os.getpid():
+            # 親プロセスの接続は閉じずに捨てる（closeすると親側のセッションが切れる）
+            self._reset()
+
+    def getconn(self) -> extensions.connection:
+        """接続を借りる（使い終わったらputconnで返す）"""
+        started = time.monotonic()
+        deadline = started + self.timeout
+        with self._cond:
+            self._check_fork()
+            while True:
+                if self._idle:
+                    conn, returned_at = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    conn, returned_at = None, None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise PoolTimeout(f"Timed out after {self.timeout}s waiting for a database connection "
+                                      f"(max_size={self.max_size})")
+                self._cond.wait(remaining)
+            waited = time.monotonic() - started
+            self._stats['checkouts'] += 1
+            self._stats['wait_seconds_total'] += waited
+            self._stats['max_wait_seconds'] = max(self._stats['max_wait_seconds'], waited)
+
+        try:
+            if conn is not None and not self._healthy(conn, returned_at):
+                self._close_quietly(conn)
+                conn = None
+            if conn is None:
+                conn = psycopg2.connect(self.dsn)
+                with self._cond:
+                    self._stats['connections_created'] += 1
+            return conn
+        except Exception:
+            # 作れなかった分の枠を空ける
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+    def putconn(self, conn: extensions.connection, discard: bool = False):
+        """接続を返す（未完了のトランザクションはロールバックする）"""
+        if not discard and not conn.closed:
+            try:
+                if conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except Exception:
+                discard = True
+        with self._cond:
+            if self._pid != os.getpid():
+                # fork前に借りた接続は、この子プロセスのプールには戻さない
+                return
+            if discard or conn.closed:
+                self._stats['connections_discarded'] += 1
+                self._size -= 1
+                self._close_quietly(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """with pool.connection() as conn: の形で接続を借りる
+
+        例外で抜けた場合はロールバックしてから返す。接続自体が壊れていた場合は捨てる。
+        """
+        conn = self.getconn()
+        try:
+            yield conn
+        except BaseException:
+            broken = conn.closed != 0
+            if not broken:
+                try:
+                    conn.rollback()
+                except Exception:
+                    broken = True
+            self.putconn(conn, discard=broken)
+            raise
+        else:
+            self.putconn(conn)
+
+    def _healthy(self, conn: extensions.connection, returned_at: Optional[float]) -> bool:
+        if conn.closed:
+            return False
+        if returned_at is not None and time.monotonic() - returned_at < self.healthcheck_seconds:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except Exception as e:
+            logger.warning(f"Discarding unhealthy pooled connection: {e}")
+            with self._cond:
+                self._stats['health_check_failures'] += 1
+                self._stats['connections_discarded'] += 1
+            return False
+
+    @staticmethod
+    def _close_quietly(conn: extensions.connection):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def closeall(self):
+        """プール内の空き接続を全て閉じる"""
+        with self._cond:
+            for conn, _ in self._idle:
+                self._close_quietly(conn)
+            self._size -= len(self._idle)
+            self._idle = []
+
+    def stats(self) -> Dict:
+        with self._cond:
+            stats = dict(self._stats)
+            stats['size'] = self._size
+            stats['idle'] = len(self._idle)
+            stats['in_use'] = self._size - len(self._idle)
+            stats['max_size'] = self.max_size
+        stats['wait_seconds_total'] = round(stats['wait_seconds_total'], 3)
+        stats['max_wait_seconds'] = round(stats['max_wait_seconds'], 3)
+        stats['avg_wait_ms'] = round(stats['wait_seconds_total'] * 1000 / stats['checkouts'], 2) if stats['checkouts'] else 0.0
+        return stats
+
+
+_pool: Optional[ConnectionPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    """プロセス共有の接続プールを取得"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool()
+        return _pool
+
+
+def connection():
+    """get_pool().connection() の短縮形"""
+    return get_pool().connection()
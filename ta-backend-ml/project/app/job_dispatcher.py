@@ -0,0 +1,120 @@
+"""
+JobQueueのプッシュ型ディスパッチャー
+
+JobQueueへのINSERT（とpendingへの戻し）でトリガーが発行するNOTIFYをLISTENし、
+通知が来たらすぐにジョブタイプ別のキューへprocess_job_queueタスクを送る（app.job_pools.dispatch）。切断中などに取りこぼした通知は、
+再接続時の確認とCelery beatの低頻度のポーリング（JOB_QUEUE_POLL_SECONDS）で拾う。
+"""
+import json
+import logging
+import os
+import select
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+import psycopg2
+from psycopg2 import extensions, sql
+from psycopg2.extras import RealDictCursor
+
+from app.db_connection import get_database_url
+from app import job_pools
+
+logger = logging.getLogger(__name__)
+
+# マイグレーションのトリガー（notify_job_queue）がNOTIFYするチャンネル
+CHANNEL = 'job_queue'
+
+
+class JobQueueDispatcher:
+    """NOTIFYを受けてジョブ処理タスクを起動する常駐プロセス
+
+    1回の受信でまとめて届いた通知はタイプごとに数え、タイプの同時実行数の上限までのタスクにまとめる
+    （ジョブの取得はclaim_jobsで行うので、タスクが余っても同じジョブを二重に実行することはない）。
+    """
+
+    def __init__(self, dispatch: Optional[Callable[[Dict[str, int]], int]] = None):
+        self.channel = CHANNEL
+        self.keepalive_seconds = float(os.getenv('JOB_DISPATCH_KEEPALIVE_SECONDS', '60'))
+        self.reconnect_seconds = float(os.getenv('JOB_DISPATCH_RECONNECT_SECONDS', '5'))
+        self._dispatch = dispatch or job_pools.dispatch
+        self._stop = threading.Event()
+        self._stats = {
+            'notifications': 0,
+            'tasks_sent': 0,
+            'reconnects': 0
+        }
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self) -> Dict:
+        return dict(self._stats)
+
+    def run(self):
+        """stop()が呼ばれるまでLISTENを続ける（接続が切れたら再接続する）"""
+        while not self._stop.is_set():
+            conn = None
+            try:
+                conn = psycopg2.connect(get_database_url())
+                conn.set_isolation_level(extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                with conn.cursor() as cursor:
+                    cursor.execute(sql.SQL('LISTEN {}').format(sql.Identifier(self.channel)))
+                logger.info(f"Listening for JobQueue notifications on '{self.channel}'")
+                # LISTENしていなかった間の通知は届かないので、接続のたびに保留中のジョブを確認する
+                self._dispatch_pending(conn)
+                self._listen(conn)
+            except (psycopg2.Error, OSError) as e:
+                self._stats['reconnects'] += 1
+                logger.warning(f"JobQueue dispatcher connection failed: {e}; reconnecting in {self.reconnect_seconds}s")
+                self._stop.wait(self.reconnect_seconds)
+            finally:
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+
+    def _listen(self, conn):
+        last_activity = time.monotonic()
+        while not self._stop.is_set():
+            # stop()に反応できるよう、待ちは1秒ずつに区切る
+            ready, _, _ = select.select([conn], [], [], 1.0)
+            if not ready:
+                if time.monotonic() - last_activity >= self.keepalive_seconds:
+                    # 通知がない間も接続が生きているか確認する（切れていれば例外で再接続）
+                    with conn.cursor() as cursor:
+                        cursor.execute('SELECT 1')
+                    last_activity = time.monotonic()
+                continue
+            conn.poll()
+            counts: Dict[Optional[str], int] = {}
+            for notify in conn.notifies:
+                job_type = self._job_type(notify.payload)
+                counts[job_type] = counts.get(job_type, 0) + 1
+            conn.notifies.clear()
+            last_activity = time.monotonic()
+            self._stats['notifications'] += sum(counts.values())
+            if counts.pop(None, 0):
+                # タイプの分からない通知があれば、保留中のジョブを数え直して振り分ける
+                self._dispatch_pending(conn)
+            elif counts:
+                self._send(counts)
+
+    @staticmethod
+    def _job_type(payload: str) -> Optional[str]:
+        try:
+            return json.loads(payload)['type']
+        except (ValueError, KeyError, TypeError):
+            logger.warning(f"Unexpected JobQueue notification payload: {payload!r}")
+            return None
+
+    def _dispatch_pending(self, conn):
+        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            counts = job_pools.pending_counts(cursor)
+        if counts:
+            logger.info(f"Found pending jobs: {counts}")
+            self._send(counts)
+
+    def _send(self, counts: Dict[str, int]):
+        self._stats['tasks_sent'] += self._dispatch(counts)
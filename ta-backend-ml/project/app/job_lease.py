@@ -0,0 +1,245 @@
+"""
+JobQueueのジョブの取得（クレーム）とリース
+
+複数のワーカー（Celery beatの重なったtickや複数レプリカ）が同じジョブを取らないように、
+FOR UPDATE SKIP LOCKEDで選んだ行を1文でprocessingにし、取得したワーカーIDとリースの期限を記録する。
+実行中はLeaseKeeperがハートビートとしてリースを延長し、完了・失敗の書き込みはリースを持つワーカーからのものだけを反映する。
+ワーカーが落ちてハートビートが止まったジョブは、リースが切れた後にreap_expired_jobsで回収する。
+"""
+import json
+import logging
+import os
+import socket
+import threading
+import uuid
+from typing import Dict, List, Optional, Sequence
+
+from psycopg2.extras import RealDictCursor
+
+from app.db_pool import get_pool
+
+logger = logging.getLogger(__name__)
+
+# (PID, ワーカーID)。fork後の子プロセスでは作り直す
+_worker_id: Optional[tuple] = None
+
+
+def worker_id() -> str:
+    """このプロセスのワーカーID（ホスト名:PID:乱数。JOB_WORKER_IDがあれば先頭に付ける）"""
+    global _worker_id
+    if _worker_id is None or _worker_id[0] != os.getpid():
+        prefix = os.getenv('JOB_WORKER_ID') or socket.gethostname()
+        _worker_id = (os.getpid(), f"{prefix}:{os.getpid()}:{uuid.uuid4().hex[:8]}")
+    return _worker_id[1]
+
+
+def lease_seconds() -> float:
+    """リースの秒数（ハートビートがこの秒数途絶えたジョブは回収される）"""
+    return float(os.getenv('JOB_LEASE_SECONDS', '300'))
+
+
+def claim_batch_size() -> int:
+    return int(os.getenv('JOB_CLAIM_BATCH_SIZE', '1'))
+
+
+def claim_jobs(conn, worker: str, limit: int = 1, job_types: Optional[Sequence[str]] = None,
+               lease: Optional[float] = None, max_running: Optional[int] = None) -> List[Dict]:
+    """保留中のジョブを最大limit件、このワーカーのものとしてprocessingにして返す（優先度・作成順）
+
+    他のワーカーが選択中の行はSKIP LOCKEDで飛ばすので、同じジョブを2つのワーカーが取ることはない。
+    attemptsはここで1増やす（返す行は増やした後の値）。
+    max_runningを指定すると、job_typesのprocessingの件数（全ワーカー合計）がこれを超えない分だけ取得する。
+    """
+    type_filter = 'AND type = ANY(%s)' if job_types else ''
+    params: List = [list(job_types)] if job_types else []
+    with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        if max_running is not None and job_types:
+            # 同じタイプを取得するワーカー同士はここで順番待ちにし、数えてから取得するまでの間に追い越されないようにする
+            for job_type in sorted(job_types):
+                cursor.execute('SELECT pg_advisory_xact_lock(hashtext(%s))', (f'JobQueue:{job_type}',))
+            cursor.execute("""
+                SELECT COUNT(*) AS running FROM "JobQueue"
+                WHERE status = 'processing' AND type = ANY(%s)
+            """, (list(job_types),))
+            limit = min(limit, max_running - cursor.fetchone()['running'])
+            if limit <= 0:
+                conn.commit()
+                return []
+        params += [limit, worker, lease or lease_seconds()]
+        cursor.execute(f"""
+            WITH picked AS (
+                SELECT id FROM "JobQueue"
+                WHERE status = 'pending' AND attempts < max_attempts {type_filter}
+                ORDER BY priority ASC, created_at ASC
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            UPDATE "JobQueue" AS job
+            SET status = 'processing',
+                started_at = NOW(),
+                attempts = job.attempts + 1,
+                worker_id = %s,
+                heartbeat_at = NOW(),
+                lease_expires_at = NOW() + make_interval(secs => %s),
+                updated_at = NOW()
+            FROM picked
+            WHERE job.id = picked.id
+            RETURNING job.*
+        """, params)
+        jobs = cursor.fetchall()
+    conn.commit()
+    jobs.sort(key=lambda job: (job['priority'], job['created_at']))
+    return jobs
+
+
+def renew_leases(conn, job_ids: Sequence[str], worker: str, lease: Optional[float] = None) -> List[str]:
+    """リースを延長し、延長できたジョブIDを返す（含まれないIDはリースを失っている）"""
+    if not job_ids:
+        return []
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            UPDATE "JobQueue"
+            SET heartbeat_at = NOW(), lease_expires_at = NOW() + make_interval(secs => %s), updated_at = NOW()
+            WHERE id = ANY(%s) AND worker_id = %s AND status = 'processing'
+            RETURNING id
+        """, (lease or lease_seconds(), list(job_ids), worker))
+        renewed = [row[0] for row in cursor.fetchall()]
+    conn.commit()
+    return renewed
+
+
+def renew_lease(conn, job_id: str, worker: str, lease: Optional[float] = None) -> bool:
+    """1件のリースを延長する（リースを失っていればFalse）"""
+    return bool(renew_leases(conn, [job_id], worker, lease))
+
+
+def complete_job(cursor, job_id: str, worker: str, result: Optional[Dict]) -> bool:
+    """ジョブを完了にする（コミットは呼び出し側）。リースを失っていれば何もせずFalse"""
+    cursor.execute("""
+        UPDATE "JobQueue"
+        SET status = 'completed', completed_at = NOW(), result = %s,
+            lease_expires_at = NULL, updated_at = NOW()
+        WHERE id = %s AND worker_id = %s AND status = 'processing'
+    """, (json.dumps(result) if result is not None else None, job_id, worker))
+    if cursor.rowcount == 0:
+        logger.warning(f"Job {job_id} is no longer leased by {worker}; completion was not recorded")
+        return False
+    return True
+
+
+def fail_job(cursor, job: Dict, worker: str, error: str) -> bool:
+    """失敗を記録する（コミットは呼び出し側）。試行回数が残っていればpendingに戻す"""
+    is_final = job['attempts'] >= job['max_attempts']
+    cursor.execute("""
+        UPDATE "JobQueue"
+        SET status = %s, error = %s, completed_at = CASE WHEN %s THEN NOW() END,
+            worker_id = NULL, lease_expires_at = NULL, updated_at = NOW()
+        WHERE id = %s AND worker_id = %s AND status = 'processing'
+    """, ('failed' if is_final else 'pending', error, is_final, job['id'], worker))
+    if cursor.rowcount == 0:
+        logger.warning(f"Job {job['id']} is no longer leased by {worker}; failure was not recorded")
+        return False
+    return True
+
+
+def reap_expired_jobs(cursor, limit: int = 100) -> List[Dict]:
+    """リースが切れた（ハートビートが途絶えた）processingのジョブを回収する（コミットは呼び出し側）
+
+    attemptsはクレーム時に数えてあるので、ここでは増やさない。max_attemptsに達していればfailed、
+    そうでなければpendingに戻す。リースを持たない行（リース導入前に取得された行）は
+    started_atからJOB_LEASE_SECONDS秒で切れたものとみなす。
+    回収した行を、元のワーカーIDと最後のハートビートの時刻付きで返す。
+    """
+    cursor.execute("""
+        WITH expired AS (
+            SELECT id, worker_id, heartbeat_at FROM "JobQueue"
+            WHERE status = 'processing'
+              AND COALESCE(lease_expires_at, started_at + make_interval(secs => %s),
+                           updated_at + make_interval(secs => %s)) < NOW()
+            ORDER BY priority ASC, created_at ASC
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        )
+        UPDATE "JobQueue" AS job
+        SET status = CASE WHEN job.attempts >= job.max_attempts THEN 'failed' ELSE 'pending' END,
+            completed_at = CASE WHEN job.attempts >= job.max_attempts THEN NOW() END,
+            error = 'Worker ' || COALESCE(expired.worker_id, 'unknown') || ' stopped heartbeating; job was reaped',
+            worker_id = NULL,
+            lease_expires_at = NULL,
+            updated_at = NOW()
+        FROM expired
+        WHERE job.id = expired.id
+        RETURNING job.id, job.type, job.status, job.attempts, job.max_attempts, job.payload,
+                  job.test_session_id, expired.worker_id AS lost_worker_id, expired.heartbeat_at AS last_heartbeat_at
+    """, (lease_seconds(), lease_seconds(), limit))
+    return cursor.fetchall()
+
+
+class LeaseLostError(Exception):
+    """ジョブのリースを失った（他のワーカーに回収された）ので、結果や状態を書き込まずに手放す"""
+
+
+class LeaseKeeper:
+    """このワーカーが実行中のジョブのリースを、バックグラウンドスレッドで定期的に延長する（ハートビート）
+
+    with LeaseKeeper(worker) as keeper: のブロック内でkeeper.add(job_id)したジョブを、
+    リース期間の1/3ごとにまとめて延長する。延長できなかったジョブ（他のワーカーに回収された）は
+    lost()で確認でき、check()はLeaseLostErrorを送出する。
+    """
+
+    def __init__(self, worker: str, lease: Optional[float] = None):
+        self.worker = worker
+        self.lease = lease or lease_seconds()
+        self._lock = threading.Lock()
+        self._held: set = set()
+        self._lost: set = set()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def __enter__(self) -> 'LeaseKeeper':
+        self._thread = threading.Thread(target=self._run, name='job-lease-keeper', daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+        return False
+
+    def add(self, job_id: str):
+        with self._lock:
+            self._held.add(job_id)
+
+    def discard(self, job_id: str):
+        with self._lock:
+            self._held.discard(job_id)
+            self._lost.discard(job_id)
+
+    def lost(self, job_id: str) -> bool:
+        with self._lock:
+            return job_id in self._lost
+
+    def check(self, job_id: str):
+        """リースを失っていればLeaseLostErrorを送出する（結果や状態をコミットする前に呼ぶ）"""
+        if self.lost(job_id):
+            raise LeaseLostError(f"Job {job_id} is no longer leased by {self.worker}")
+
+    def _run(self):
+        while not self._stop.wait(self.lease / 3):
+            with self._lock:
+                held = list(self._held - self._lost)
+            if not held:
+                continue
+            try:
+                with get_pool().connection() as conn:
+                    renewed = set(renew_leases(conn, held, self.worker, self.lease))
+            except Exception as e:
+                # 次の周期で再試行する（リースの残りが1/3以上あるうちに延長できればよい）
+                logger.warning(f"Failed to renew job leases for {self.worker}: {e}")
+                continue
+            lost = [job_id for job_id in held if job_id not in renewed]
+            if lost:
+                logger.warning(f"Lost the lease on jobs {lost} (worker {self.worker})")
+                with self._lock:
+                    self._lost.update(lost)
@@ -0,0 +1,149 @@
+"""
+JobQueueのジョブタイプ別のワーカープール
+
+ジョブのtypeごとに専用のCeleryキュー（jobs.<type>）と同時実行数の上限を持たせ、
+30分かかるtest_executionがreport_generationやbug_analysisの前をふさがないようにする。
+同時実行数の上限はclaim_jobs(max_running=...)でデータベース上のprocessingの件数に対してかけるので、
+ワーカーのレプリカが増えても守られる。タイプごとの待ち時間・実行時間のSLOはslo_metrics()で集計する。
+"""
+import logging
+import os
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# タイプごとの既定の同時実行数と、キューに入ってから開始されるまでの待ち時間のSLO（秒）
+# （JOB_POOL_<TYPE>_CONCURRENCY / JOB_POOL_<TYPE>_SLO_SECONDS で上書きできる）
+JOB_POOLS: Dict[str, Dict] = {
+    'test_execution': {'concurrency': 2, 'slo_wait_seconds': 120},
+    'bug_analysis': {'concurrency': 4, 'slo_wait_seconds': 30},
+    'report_generation': {'concurrency': 4, 'slo_wait_seconds': 30},
+    'scenario_generation': {'concurrency': 2, 'slo_wait_seconds': 60},
+}
+
+# プールのないタイプ（未知のタイプ）はCeleryの既定のキューで処理して失敗にする
+DEFAULT_QUEUE = 'celery'
+DEFAULT_SLO_WAIT_SECONDS = 60
+
+
+def queue_for(job_type: str) -> str:
+    """ジョブタイプの処理タスクを送るCeleryキュー"""
+    return f'jobs.{job_type}' if job_type in JOB_POOLS else DEFAULT_QUEUE
+
+
+def concurrency_for(job_type: str) -> int:
+    """ジョブタイプの同時実行数の上限（全ワーカー合計）"""
+    default = JOB_POOLS.get(job_type, {}).get('concurrency', 1)
+    return max(1, int(os.getenv(f'JOB_POOL_{job_type.upper()}_CONCURRENCY', str(default))))
+
+
+def slo_wait_seconds(job_type: str) -> float:
+    default = JOB_POOLS.get(job_type, {}).get('slo_wait_seconds', DEFAULT_SLO_WAIT_SECONDS)
+    return float(os.getenv(f'JOB_POOL_{job_type.upper()}_SLO_SECONDS', str(default)))
+
+
+def pending_counts(cursor) -> Dict[str, int]:
+    """取得可能な保留中のジョブの件数（タイプ別）"""
+    cursor.execute("""
+        SELECT type, COUNT(*) AS pending FROM "JobQueue"
+        WHERE status = 'pending' AND attempts < max_attempts
+        GROUP BY type
+    """)
+    return {row['type']: row['pending'] for row in cursor.fetchall()}
+
+
+def dispatch(counts: Dict[str, int]) -> int:
+    """タイプごとのキューにprocess_job_queueタスクを送り、送った件数を返す
+
+    1タスクは自分のタイプのジョブがなくなるまで続けて処理するので、送るのは同時実行数の上限まででよい。
+    """
+    from app.job_queue_sync import process_job_queue
+
+    sent = 0
+    for job_type, count in counts.items():
+        for _ in range(min(count, concurrency_for(job_type))):
+            process_job_queue.apply_async(kwargs={'job_type': job_type}, queue=queue_for(job_type))
+            sent += 1
+    if sent:
+        logger.info(f"Dispatched {sent} job tasks: {counts}")
+    return sent
+
+
+def slo_metrics(cursor, window_seconds: float = 3600, job_type: Optional[str] = None) -> Dict[str, Dict]:
+    """ジョブタイプ別のキューの状態とSLOの集計
+
+    直近window_seconds秒に開始されたジョブについて、待ち時間（作成から開始まで）と実行時間
+    （開始から完了・失敗まで）のパーセンタイル、待ち時間がSLO以内だった割合を返す。
+    現在の保留中・実行中の件数と、最も長く待っている保留中のジョブの待ち時間も含める。
+    """
+    types = sorted(set(JOB_POOLS) | ({job_type} if job_type else set()))
+    type_params = [job_type] if job_type else []
+
+    cursor.execute(f"""
+        SELECT job.type,
+               COUNT(*) AS started,
+               COUNT(*) FILTER (WHERE job.status = 'completed') AS completed,
+               COUNT(*) FILTER (WHERE job.status = 'failed') AS failed,
+               percentile_cont(ARRAY[0.5, 0.95, 0.99]) WITHIN GROUP (
+                   ORDER BY EXTRACT(EPOCH FROM job.started_at - job.created_at)) AS wait_seconds,
+               MAX(EXTRACT(EPOCH FROM job.started_at - job.created_at)) AS max_wait_seconds,
+               percentile_cont(ARRAY[0.5, 0.95, 0.99]) WITHIN GROUP (
+                   ORDER BY EXTRACT(EPOCH FROM job.completed_at - job.started_at)) AS run_seconds,
+               MAX(EXTRACT(EPOCH FROM job.completed_at - job.started_at)) AS max_run_seconds,
+               COUNT(*) FILTER (WHERE EXTRACT(EPOCH FROM job.started_at - job.created_at)
+                                      <= COALESCE(slo.seconds, %s)) AS within_slo
+        FROM "JobQueue" AS job
+        LEFT JOIN unnest(%s::text[], %s::float8[]) AS slo(type, seconds) ON slo.type = job.type
+        WHERE job.started_at >= NOW() - make_interval(secs => %s) {'AND job.type = %s' if job_type else ''}
+        GROUP BY job.type
+    """, [DEFAULT_SLO_WAIT_SECONDS, types, [slo_wait_seconds(t) for t in types], window_seconds] + type_params)
+    recent = {row['type']: row for row in cursor.fetchall()}
+
+    # 保留中のジョブはリトライで戻されたものもあるので、最後にpendingになった時刻（updated_at）から数える
+    cursor.execute(f"""
+        SELECT type,
+               COUNT(*) FILTER (WHERE status = 'pending' AND attempts < max_attempts) AS pending,
+               COUNT(*) FILTER (WHERE status = 'processing') AS processing,
+               EXTRACT(EPOCH FROM NOW() - MIN(updated_at) FILTER (
+                   WHERE status = 'pending' AND attempts < max_attempts)) AS oldest_pending_seconds
+        FROM "JobQueue"
+        WHERE status IN ('pending', 'processing') {'AND type = %s' if job_type else ''}
+        GROUP BY type
+    """, type_params)
+    current = {row['type']: row for row in cursor.fetchall()}
+
+    def percentiles(values, maximum) -> Dict[str, float]:
+        values = values or [None, None, None]
+        result = {name: round(float(value), 1) if value is not None else 0.0
+                  for name, value in zip(('p50', 'p95', 'p99'), values)}
+        result['max'] = round(float(maximum), 1) if maximum is not None else 0.0
+        return result
+
+    metrics = {}
+    for name in sorted(set(types) | set(recent) | set(current)):
+        if job_type and name != job_type:
+            continue
+        row = recent.get(name) or {}
+        state = current.get(name) or {}
+        slo = slo_wait_seconds(name)
+        started = int(row.get('started') or 0)
+        wait = percentiles(row.get('wait_seconds'), row.get('max_wait_seconds'))
+        oldest_pending = round(float(state['oldest_pending_seconds']), 1) if state.get('oldest_pending_seconds') else 0.0
+        metrics[name] = {
+            'queue': queue_for(name),
+            'concurrency': concurrency_for(name),
+            'pending': int(state.get('pending') or 0),
+            'processing': int(state.get('processing') or 0),
+            'oldest_pending_seconds': oldest_pending,
+            'window_seconds': window_seconds,
+            'started': started,
+            'completed': int(row.get('completed') or 0),
+            'failed': int(row.get('failed') or 0),
+            'wait_seconds': wait,
+            'run_seconds': percentiles(row.get('run_seconds'), row.get('max_run_seconds')),
+            'slo_wait_seconds': slo,
+            'slo_met_ratio': round(int(row.get('within_slo') or 0) / started, 4) if started else 1.0,
+            # p95の待ち時間か、今待っているジョブがSLOを超えていれば違反
+            'slo_breached': wait['p95'] > slo or oldest_pending > slo
+        }
+    return metrics
@@ -1,17 +1,27 @@
 """
 同期的なJobQueue処理
 Celeryワーカー内でのasyncio問題を回避
+
+ジョブの取得・完了・失敗の処理はrun_jobsの1か所にまとめ、タイプごとの処理はJOB_HANDLERSに登録する
+（Celeryのタスク、job_queue_pollerのJobQueueProcessor、simple_job_processor.pyはいずれもここを使う）。
 """
+import asyncio
 import json
 import logging
-from datetime import datetime
-from typing import Dict, Any
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Optional
 
 from celery import shared_task
-import psycopg2
+from prisma import Prisma
 from psycopg2.extras import RealDictCursor
 
-from app.workers.test_executor_enhanced import EnhancedTestExecutor
+from app.db_pool import get_pool
+from app.job_lease import (LeaseKeeper, LeaseLostError, claim_batch_size, claim_jobs, complete_job, fail_job,
+                           reap_expired_jobs, worker_id)
+from app.job_pools import concurrency_for, dispatch, pending_counts
+
+from app.workers.test_executor_pool import get_test_executor_pool
 from app.workers.bug_analyzer import BugAnalyzer
 from app.workers.report_generator import ReportGenerator
 from app.workers.scenario_generator import ScenarioGenerator
@@ -31,113 +41,252 @@ def log_to_session(cursor, session_id, log_level, message, metadata=None):
 
 
 def get_db_connection():
-    """データベース接続を取得"""
-    import os
-    db_url = os.environ.get('DATABASE_ROOT_URL', '')
-    
-    # Docker内からホストのPostgreSQLに接続する場合の処理
-    if 'host.docker.internal' in db_url:
-        pass  # そのまま使用
-    elif '127.0.0.1' in db_url or 'localhost' in db_url:
-        db_url = db_url.replace('127.0.0.1', 'host.docker.internal').replace('localhost', 'host.docker.internal')
-    
-    return psycopg2.connect(db_url)
+    """プロセス共有の接続プールから接続を借りる（with get_db_connection() as conn: の形で使う）"""
+    return get_pool().connection()
 
 
 @shared_task(name="app.job_queue_sync.process_job_queue")
-def process_job_queue():
+def process_job_queue(job_type: Optional[str] = None):
     """
     JobQueueを同期的に処理
+
+    job_typeを指定したタスク（ディスパッチャーがタイプ別のキューに送ったもの）は、そのタイプのジョブを処理する。
+    job_typeなし（beatのフォールバックのポーリング）は、保留中のジョブをタイプ別のキューに振り分けるだけで、
+    ここでは実行しない（長いtest_executionが他のタイプのジョブをふさがないように）。
     """
+    if job_type:
+        return run_jobs(job_type)
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        
-        # 保留中のジョブを取得
-        cursor.execute("""
-            SELECT * FROM "JobQueue" 
-            WHERE status = 'pending' AND attempts < 3
-            ORDER BY priority ASC, created_at ASC
-            LIMIT 10
-        """)
-        jobs = cursor.fetchall()
-        
-        logger.info(f"Found {len(jobs)} pending jobs")
-        processed_count = 0
+        with get_db_connection() as conn:
+            cursor = conn.cursor(cursor_factory=RealDictCursor)
+            counts = pending_counts(cursor)
+            cursor.close()
+        return dispatch(counts)
+    except Exception as e:
+        logger.error(f"Error in process_job_queue: {str(e)}")
+        return 0
+
+
+def run_jobs(job_type: str, max_jobs: int = 10, hand_off: bool = True) -> int:
+    """
+    job_typeのジョブを、保留中がなくなるか同時実行数の上限に達するまで（1回で最大max_jobs件）処理する
+    max_jobs件に達した場合、hand_offなら残りを同じキューの次のタスクに引き継ぐ。
+
+    ジョブはclaim_jobsでこのワーカーのリース付きで取得するので、タスクが重なったり
+    複数のワーカーで動かしたりしても同じジョブを二重に実行しない。
+    """
+    worker = worker_id()
+    handler = JOB_HANDLERS.get(job_type)
+    processed_count = 0
+    handled_count = 0
+    try:
+        with get_db_connection() as conn, LeaseKeeper(worker) as keeper:
+            cursor = conn.cursor(cursor_factory=RealDictCursor)
         
-        if jobs:
-            logger.info(f"Processing jobs: {[job['id'] for job in jobs]}")
+            # JOB_CLAIM_BATCH_SIZE件ずつ、タイプの同時実行数の上限の範囲で取得して処理する
+            while handled_count < max_jobs:
+                jobs = claim_jobs(conn, worker, limit=min(claim_batch_size(), max_jobs - handled_count),
+                                  job_types=[job_type], max_running=concurrency_for(job_type))
+                if not jobs:
+                    break
+                logger.info(f"Claimed {job_type} jobs as {worker}: {[job['id'] for job in jobs]}")
+                for job in jobs:
+                    keeper.add(job['id'])
         
-        for job in jobs:
-            try:
-                # ジョブをprocessing状態に更新
-                logger.info(f"Starting to process job {job['id']} (type: {job['type']}, attempt: {job['attempts'] + 1})")
-                cursor.execute("""
-                    UPDATE "JobQueue" 
-                    SET status = 'processing', started_at = NOW(), attempts = attempts + 1
-                    WHERE id = %s
-                """, (job['id'],))
-                conn.commit()
-                
-                # ジョブタイプに応じた処理
-                if job['type'] == 'test_execution':
-                    logger.info(f"Processing test execution job {job['id']}")
-                    process_test_execution(job, cursor, conn)
-                    processed_count += 1
-                    logger.info(f"Successfully processed job {job['id']}")
-                else:
-                    logger.warning(f"Unknown job type: {job['type']}")
+                for job in jobs:
+                    started = time.monotonic()
+                    try:
+                        wait_seconds = (job['started_at'] - job['created_at']).total_seconds()
+                        logger.info(f"Starting to process job {job['id']} (type: {job['type']}, attempt: {job['attempts']}, "
+                                    f"waited: {wait_seconds:.1f}s)")
+                        if handler is None:
+                            raise ValueError(f"Unknown job type: {job['type']}")
+                        result = handler(job, cursor, conn, keeper)
+                        # JobQueueを完了に更新（リースを失っていた場合は記録しない）
+                        keeper.check(job['id'])
+                        complete_job(cursor, job['id'], worker, result)
+                        conn.commit()
+                        processed_count += 1
+                        logger.info(f"Successfully processed job {job['id']} in {time.monotonic() - started:.1f}s")
+                    
+                    except LeaseLostError as e:
+                        # 回収されたジョブは別のワーカーが実行し直すので、結果も失敗も書き込まずに手放す
+                        logger.warning(f"Abandoning job {job['id']}: {e}")
+                        conn.rollback()
                     
-            except Exception as e:
-                logger.error(f"Error processing job {job['id']}: {str(e)}")
-                # エラーの場合、failedまたはpendingに戻す
-                is_final = job['attempts'] >= 2
-                cursor.execute("""
-                    UPDATE "JobQueue" 
-                    SET status = %s, error = %s, completed_at = %s
-                    WHERE id = %s
-                """, (
-                    'failed' if is_final else 'pending',
-                    str(e),
-                    datetime.now() if is_final else None,
-                    job['id']
-                ))
-                conn.commit()
+                    except Exception as e:
+                        logger.error(f"Error processing job {job['id']}: {str(e)}")
+                        # 失敗したトランザクションを破棄してから状態を更新
+                        conn.rollback()
+                        if keeper.lost(job['id']):
+                            logger.warning(f"Abandoning job {job['id']}: the lease was lost while it ran")
+                            continue
+                        # 試行回数が残っていればpendingに戻し、なければfailedにする
+                        fail_job(cursor, job, worker, str(e))
+                        conn.commit()
+                    finally:
+                        keeper.discard(job['id'])
+                        handled_count += 1
         
-        cursor.close()
-        conn.close()
+            cursor.close()
         
+        if hand_off and handled_count >= max_jobs:
+            # 1タスクの処理件数の上限に達した。残りは同じキューの次のタスクに引き継ぐ
+            dispatch({job_type: 1})
+        logger.info(f"Database pool stats: {get_pool().stats()}")
         return processed_count
         
     except Exception as e:
-        logger.error(f"Error in process_job_queue: {str(e)}")
+        logger.error(f"Error in run_jobs({job_type}): {str(e)}")
+        return processed_count
+
+
+def run_pending_jobs() -> int:
+    """保留中のジョブを、Celeryを介さずにこのプロセスでタイプごとに処理する（スクリプトからの実行用）"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        counts = pending_counts(cursor)
+        cursor.close()
+    return sum(run_jobs(job_type, hand_off=False) for job_type in counts)
+
+
+@shared_task(name="app.job_queue_sync.reap_stuck_jobs")
+def reap_stuck_jobs():
+    """
+    ハートビートが途絶えたprocessingのジョブを回収する
+
+    ワーカーが落ちるとジョブはprocessingのまま残るので、リースが切れたものをpendingに戻す
+    （max_attemptsに達していればfailedにしてTestSessionも失敗にする）。回収はTestSessionLogに記録する。
+    """
+    try:
+        with get_db_connection() as conn:
+            cursor = conn.cursor(cursor_factory=RealDictCursor)
+            reaped = reap_expired_jobs(cursor)
+            for job in reaped:
+                payload = job['payload'] if isinstance(job['payload'], dict) else json.loads(job['payload'] or '{}')
+                session_id = job['test_session_id'] or payload.get('sessionId') or payload.get('session_id')
+                requeued = job['status'] == 'pending'
+                logger.warning(f"Reaped job {job['id']} from worker {job['lost_worker_id']} "
+                               f"({'requeued' if requeued else 'failed'}, attempt {job['attempts']}/{job['max_attempts']})")
+                if not session_id:
+                    continue
+                last_heartbeat = job['last_heartbeat_at'].isoformat() if job['last_heartbeat_at'] else None
+                if requeued:
+                    log_to_session(cursor, session_id, 'warning', 'ワーカーの応答が途絶えたため、ジョブを再実行待ちに戻しました', {
+                        'job_id': job['id'],
+                        'worker_id': job['lost_worker_id'],
+                        'last_heartbeat_at': last_heartbeat,
+                        'attempts': job['attempts'],
+                        'max_attempts': job['max_attempts']
+                    })
+                else:
+                    log_to_session(cursor, session_id, 'error', 'ワーカーの応答が途絶え、再試行回数の上限に達したためジョブを失敗にしました', {
+                        'job_id': job['id'],
+                        'worker_id': job['lost_worker_id'],
+                        'last_heartbeat_at': last_heartbeat,
+                        'attempts': job['attempts'],
+                        'max_attempts': job['max_attempts']
+                    })
+                    cursor.execute("""
+                        UPDATE "TestSession" 
+                        SET status = 'failed', 
+                            completed_at = NOW(),
+                            error_message = %s
+                        WHERE id = %s AND status NOT IN ('completed', 'failed')
+                    """, ('ワーカーの応答が途絶えたため、テストを完了できませんでした', session_id))
+            conn.commit()
+            cursor.close()
+        return len(reaped)
+    
+    except Exception as e:
+        logger.error(f"Error in reap_stuck_jobs: {str(e)}")
         return 0
 
 
-def process_test_execution(job, cursor, conn):
-    """テスト実行ジョブを処理"""
+def job_payload(job) -> Dict[str, Any]:
+    return job['payload'] if isinstance(job['payload'], dict) else json.loads(job['payload'] or '{}')
+
+
+def resolve_test_target(cursor, payload: Dict[str, Any], session_id: str):
+    """テスト対象のURLとモードを、payload・TestConfig・Project・TestSessionの順に探す"""
+    test_config_id = payload.get('testConfigId') or payload.get('test_config_id')
+    project_id = payload.get('projectId') or payload.get('project_id')
+    url = payload.get('url')
+    mode = payload.get('mode')
+    
+    if test_config_id:
+        cursor.execute("""
+            SELECT tc.url, tc.mode, p.url AS project_url
+            FROM "TestConfig" tc
+            LEFT JOIN "Project" p ON tc.project_id = p.id
+            WHERE tc.id = %s
+        """, (test_config_id,))
+        test_config = cursor.fetchone()
+        if not test_config:
+            raise ValueError(f"TestConfig not found: {test_config_id}")
+        url = url or test_config['url'] or test_config['project_url']
+        mode = mode or test_config['mode']
+    elif not url and project_id:
+        cursor.execute("""
+            SELECT url FROM "Project" WHERE id = %s
+        """, (project_id,))
+        project = cursor.fetchone()
+        if project:
+            url = project['url']
+    
+    # それでもURLが取得できない場合は、セッションのプロジェクトから取得を試みる
+    if not url:
+        cursor.execute("""
+            SELECT p.url
+            FROM "TestSession" ts
+            JOIN "Project" p ON ts.project_id = p.id
+            WHERE ts.id = %s
+        """, (session_id,))
+        project = cursor.fetchone()
+        if project:
+            url = project['url']
+    
+    if not url:
+        raise ValueError(f"No URL found for session {session_id}")
+    return url, mode or 'omakase'
+
+
+def execute_test_with_executor(session_id, mode, url, cursor, conn):
+    """EnhancedTestExecutorでテストを実行し、結果を返す
+
+    asyncioの問題を避けるため別プロセスで実行するが、テストごとにPythonを起動するのではなく、
+    import済み・Prisma接続済みのワーカープロセスのプール（TestExecutorPool）に渡す。
+    """
+    log_to_session(cursor, session_id, 'info', 'Playwrightを起動してページをクローリング中...', {'url': url})
+    conn.commit()
+    
+    pool = get_test_executor_pool()
+    result = pool.run(session_id, mode, url)
+    logger.info(f"Test executor pool stats: {pool.stats()}")
+    
+    log_to_session(cursor, session_id, 'info', f'{result.get("pages_scanned", 0)}ページをスキャンしました',
+                   {'pages_scanned': result.get('pages_scanned', 0)})
+    conn.commit()
+    return result
+
+
+def process_test_execution(job, cursor, conn, keeper):
+    """テスト実行ジョブを処理し、JobQueueに記録する結果を返す
+
+    テスト実行中にリースを失った場合は、TestSessionの結果を書き込まずにLeaseLostErrorを送出する
+    （セッションは回収したワーカーが実行し直す）。
+    """
     logger.info(f"Processing test execution job: {job['id']}")
-    payload = job['payload'] if isinstance(job['payload'], dict) else json.loads(job['payload'])
+    payload = job_payload(job)
     logger.info(f"Job payload: {json.dumps(payload)}")
     
-    session_id = payload.get('sessionId') or payload.get('session_id')
-    test_config_id = payload.get('testConfigId') or payload.get('test_config_id')
-    logger.info(f"Session ID: {session_id}, Test Config ID: {test_config_id}")
+    session_id = payload.get('sessionId') or payload.get('session_id') or job['test_session_id']
+    logger.info(f"Session ID: {session_id}")
     
     if not session_id:
         raise ValueError("No session ID found in payload")
     
-    # TestConfigからURLを取得
-    cursor.execute("""
-        SELECT url, mode FROM "TestConfig" WHERE id = %s
-    """, (test_config_id,))
-    test_config = cursor.fetchone()
-    
-    if not test_config:
-        raise ValueError(f"TestConfig not found: {test_config_id}")
-    
-    url = payload.get('url') or test_config['url']
-    mode = payload.get('mode') or test_config['mode'] or 'omakase'
+    url, mode = resolve_test_target(cursor, payload, session_id)
     
     # TestSessionを更新
     logger.info(f"Updating TestSession {session_id} to 'running' status")
@@ -151,7 +300,6 @@ def process_test_execution(job, cursor, conn):
     # ログを記録
     log_to_session(cursor, session_id, 'info', 'テスト実行を開始します', {
         'job_id': job['id'],
-        'test_config_id': test_config_id,
         'url': url,
         'mode': mode
     })
@@ -162,52 +310,10 @@ def process_test_execution(job, cursor, conn):
         log_to_session(cursor, session_id, 'info', 'テスト環境をセットアップ中...', None)
         conn.commit()
         
-        # Prismaの代わりに直接データベース操作を使用
-        from prisma import Prisma
-        import asyncio
-        import time
-        
-        # 簡易的な同期実行
-        def run_test():
-            # 新しいプロセスでテストを実行
-            import subprocess
-            import sys
-            
-            code = f'''
-import sys
-sys.path.insert(0, "/app/project")
-from app.workers.test_executor_enhanced import EnhancedTestExecutor
-from prisma import Prisma
-import asyncio
-
-async def main():
-    prisma = Prisma()
-    await prisma.connect()
-    executor = EnhancedTestExecutor(prisma)
-    result = executor.execute("{session_id}", "{mode}", "{url}")
-    await prisma.disconnect()
-    return result
-
-result = asyncio.run(main())
-print(json.dumps(result))
-'''
-            
-            proc = subprocess.run(
-                [sys.executable, '-c', code],
-                capture_output=True,
-                text=True,
-                cwd="/app/project"
-            )
-            
-            if proc.returncode != 0:
-                raise Exception(f"Test execution failed: {proc.stderr}")
-            
-            return json.loads(proc.stdout)
-        
-        # 実際のテスト実行を有効化
-        result = run_test()
+        result = execute_test_with_executor(session_id, mode, url, cursor, conn)
         
         logger.info(f"テスト完了: {json.dumps(result)}")
+        keeper.check(job['id'])
         log_to_session(cursor, session_id, 'info', 'テストが完了しました', result)
         conn.commit()
         
@@ -230,16 +336,6 @@ print(json.dumps(result))
             session_id
         ))
         
-        # JobQueueを完了に更新
-        logger.info(f"Updating JobQueue {job['id']} to completed")
-        cursor.execute("""
-            UPDATE "JobQueue" 
-            SET status = 'completed', 
-                completed_at = NOW(),
-                result = %s
-            WHERE id = %s
-        """, (json.dumps(result), job['id']))
-        
         log_to_session(cursor, session_id, 'info', 'ジョブ処理が完了しました', {
             'job_id': job['id'],
             'result': result
@@ -247,8 +343,15 @@ print(json.dumps(result))
         conn.commit()
         
         logger.info(f"Test execution completed for session {session_id}")
+        return result
+        
+    except LeaseLostError:
+        raise
         
     except Exception as e:
+        if keeper.lost(job['id']):
+            raise LeaseLostError(f"Job {job['id']} lost its lease while running: {e}") from e
+        
         # エラーの場合
         logger.error(f"Error in test execution: {str(e)}", exc_info=True)
         
@@ -266,4 +369,93 @@ print(json.dumps(result))
             WHERE id = %s
         """, (str(e), session_id))
         conn.commit()
-        raise
\ No newline at end of file
+        raise
+
+
+class _SyncModelActions:
+    """prisma.<model>の各操作（find_uniqueなど）を、イベントループ上で完了まで実行して結果を返す"""
+
+    def __init__(self, actions, loop: asyncio.AbstractEventLoop):
+        self._actions = actions
+        self._loop = loop
+
+    def __getattr__(self, name):
+        action = getattr(self._actions, name)
+
+        def call(*args, **kwargs):
+            return self._loop.run_until_complete(action(*args, **kwargs))
+        return call
+
+
+class SyncPrisma:
+    """非同期インターフェースのPrismaクライアントを、同期的に呼び出すワーカークラス向けに包む
+
+    BugAnalyzerなどはself.prisma.<model>.<操作>(...)をawaitせずに呼ぶので、
+    prisma_client()が持つイベントループで各操作を実行する。
+    """
+
+    def __init__(self, prisma: Prisma, loop: asyncio.AbstractEventLoop):
+        self._prisma = prisma
+        self._loop = loop
+
+    def __getattr__(self, name):
+        return _SyncModelActions(getattr(self._prisma, name), self._loop)
+
+
+@contextmanager
+def prisma_client():
+    """ワーカークラス（BugAnalyzerなど）に渡すPrismaクライアント（接続・切断と各操作は専用のイベントループで実行する）"""
+    loop = asyncio.new_event_loop()
+    prisma = Prisma()
+    try:
+        loop.run_until_complete(prisma.connect())
+        try:
+            yield SyncPrisma(prisma, loop)
+        finally:
+            loop.run_until_complete(prisma.disconnect())
+    finally:
+        loop.close()
+
+
+def process_bug_analysis(job, cursor, conn, keeper):
+    """バグ分析ジョブを処理"""
+    payload = job_payload(job)
+    with prisma_client() as prisma:
+        return BugAnalyzer(prisma).analyze(
+            test_session_id=payload.get('test_session_id') or payload.get('testSessionId') or job['test_session_id'],
+            screenshot=payload.get('screenshot'),
+            page_url=payload.get('page_url') or payload.get('pageUrl'),
+            error_message=payload.get('error_message') or payload.get('errorMessage'),
+            stack_trace=payload.get('stack_trace') or payload.get('stackTrace')
+        )
+
+
+def process_report_generation(job, cursor, conn, keeper):
+    """レポート生成ジョブを処理"""
+    payload = job_payload(job)
+    with prisma_client() as prisma:
+        return ReportGenerator(prisma).generate(
+            test_session_id=payload.get('test_session_id') or payload.get('session_id') or job['test_session_id'],
+            format_type=payload.get('format', 'pdf')
+        )
+
+
+def process_scenario_generation(job, cursor, conn, keeper):
+    """シナリオ生成ジョブを処理"""
+    payload = job_payload(job)
+    with prisma_client() as prisma:
+        return ScenarioGenerator(prisma).generate(
+            project_id=payload.get('project_id') or payload.get('projectId'),
+            description=payload.get('description'),
+            url=payload.get('url')
+        )
+
+
+# ジョブタイプごとの処理（job, cursor, conn, keeper）-> JobQueueに記録する結果
+# タイプごとのCeleryキューと同時実行数はapp.job_poolsのJOB_POOLSで設定する
+JOB_HANDLERS: Dict[str, Callable] = {
+    'test_execution': process_test_execution,
+    'bug_analysis': process_bug_analysis,
+    'report_generation': process_report_generation,
+    'scenario_generation': process_scenario_generation,
+}
@@ -0,0 +1,29 @@
+import logging
+import signal
+from django.core.management.base import BaseCommand
+from app.job_dispatcher import JobQueueDispatcher
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Start jobs as soon as they are enqueued by listening for JobQueue notifications'
+
+    def handle(self, *args, **options):
+        dispatcher = JobQueueDispatcher()
+
+        # docker stopなどのSIGTERMでも、LISTENの待ちを抜けて終了する
+        signal.signal(signal.SIGTERM, lambda signum, frame: dispatcher.stop())
+
+        self.stdout.write(
+            self.style.SUCCESS(f'Starting JobQueue dispatcher on channel {dispatcher.channel}')
+        )
+
+        try:
+            dispatcher.run()
+        except KeyboardInterrupt:
+            dispatcher.stop()
+
+        self.stdout.write(
+            self.style.SUCCESS(f'JobQueue dispatcher stopped: {dispatcher.stats()}')
+        )
@@ -46,6 +46,12 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'project.project.settings')
 
 django.setup()
 
+# Dify呼び出しはLLM_TRANSPORT_MODEに応じて記録・再生・合成に切り替える（オフラインのベンチマーク用）
+from app.workers.llm_transport import wrap_dify_session
+# Dify呼び出しごとのレイテンシ・トークン数・結果をチケット単位で集計する
+from app.workers.gemini_rate_limiter import set_llm_session
+from app.workers.llm_telemetry import get_llm_telemetry
+
 # 処理ログをDBに記録するための関数
 async def append_log_entry(prisma, conversation_id, log_type, log_data):
     """
@@ -92,6 +98,20 @@ async def append_log_entry(prisma, conversation_id, log_type, log_data):
         import traceback
         traceback.print_exc()
 
+# チケット1件分のLLM呼び出しの集計をConversationProcessLogに記録する関数
+async def append_llm_telemetry(prisma, conversation_id, ticket_id):
+    """
+    チケットのLLM呼び出し（Difyワークフロー）の集計を取り出し、会話の処理ログに記録する
+
+    Args:
+        prisma: Prismaインスタンス
+        conversation_id (str): 会話ID（Noneなら記録せず集計だけ破棄する）
+        ticket_id (str): チケットID
+    """
+    summary = get_llm_telemetry().session_summary(f"ticket:{ticket_id}")
+    if conversation_id and summary['calls']:
+        await append_log_entry(prisma, conversation_id, "llm_telemetry", summary)
+
 # Dify API Keyを環境変数として設定。
 # TODO: こちら、最新の会話ではデフォルトキーは不要になったので、変数定義そのものを廃止したい。
 
@@ -145,6 +165,7 @@ async def answer_hearing_queued_tickets(prisma, max_concurrent=5):
         
         # 共有するHTTPセッション
         async with aiohttp.ClientSession() as session:
+            session = wrap_dify_session(session)
             # 各チケットの処理をタスクとして追加
             for ticket in hearing_tickets:
                 tasks.append(process_hearing_ticket_with_semaphore(prisma, session, ticket, semaphore))
@@ -174,6 +195,9 @@ async def process_hearing_ticket(prisma, session, ticket):
         session: 共有aiohttpセッション
         ticket: 処理対象のチケット
     """
+    # このチケットのDify呼び出しをチケット単位で集計する
+    set_llm_session(f"ticket:{ticket.id}")
+    conversations = []
     try:
         print(f"[HEARING] 処理中のチケット: {ticket.id}")
         
@@ -402,6 +426,7 @@ creator: {conversation.creator}
             # requestsの代わりにaiohttpを使用
             async with session.post(
                 'https://dify.p0x0q.com/v1/workflows/run',
+                prompt_name='hearing_response',
                 headers={
                     'Authorization': f'Bearer {api_key_to_use}',
                     'Content-Type': 'application/json'
@@ -603,6 +628,9 @@ creator: {conversation.creator}
         import traceback
         print(traceback.print_exc())
         print(f"[HEARING] Error in process_hearing_ticket: {str(e)}")
+    finally:
+        # LLM呼び出しの集計を最新の質問の処理ログに残す
+        await append_llm_telemetry(prisma, conversations[-1].id if conversations else None, ticket.id)
 
 async def answer_faq_queued_tickets(prisma, max_concurrent=5):
     """
@@ -634,6 +662,7 @@ async def answer_faq_queued_tickets(prisma, max_concurrent=5):
         
         # 共有するHTTPセッション
         async with aiohttp.ClientSession() as session:
+            session = wrap_dify_session(session)
             # 各チケットの処理をタスクとして追加
             for ticket in queued_tickets:
                 tasks.append(process_faq_ticket_with_semaphore(prisma, session, ticket, semaphore))
@@ -663,6 +692,9 @@ async def process_faq_ticket(prisma: Prisma, session, ticket):
         session: 共有aiohttpセッション
         ticket: 処理対象のチケット
     """
+    # このチケットのDify呼び出しをチケット単位で集計する
+    set_llm_session(f"ticket:{ticket.id}")
+    conversation_id = None
     try:
         print(f"[FAQ] 処理中のチケット: {ticket.id}")
         # 回答レコードが存在するか確認
@@ -818,6 +850,7 @@ creator: {conversation.creator}
             # requestsの代わりにaiohttpを使用
             async with session.post(
                 'https://dify.p0x0q.com/v1/workflows/run',
+                prompt_name='faq_response',
                 headers={
                     'Authorization': f'Bearer {api_key_to_use}',
                     'Content-Type': 'application/json'
@@ -998,6 +1031,7 @@ creator: {conversation.creator}
                             try:
                                 blocking_response = await session.post(
                                     'https://dify.p0x0q.com/v1/workflows/run',
+                                    prompt_name='faq_response_blocking',
                                     headers={
                                         'Authorization': f'Bearer {api_key_to_use}',
                                         'Content-Type': 'application/json'
@@ -1266,6 +1300,7 @@ creator: {conversation.creator}
                         # aiohttpを使用してタイトル生成リクエストを送信
                         async with session.post(
                             'https://dify.p0x0q.com/v1/workflows/run',
+                            prompt_name='ticket_title',
                             headers={
                                 'Authorization': f'Bearer {title_api_key_to_use}',
                                 'Content-Type': 'application/json'
@@ -1460,6 +1495,9 @@ creator: {conversation.creator}
                 'text': f"エラーが発生しました:お手数ですが再度質問を行ってください。"
             }
         )
+    finally:
+        # LLM呼び出しの集計を回答の処理ログに残す
+        await append_llm_telemetry(prisma, conversation_id, ticket.id)
 
 async def generate_search_keywords_and_filter_knowledge(prisma, query, tenant_id, ticket_id=None, user_group_id=None):
     """
@@ -1513,8 +1551,10 @@ async def generate_search_keywords_and_filter_knowledge(prisma, query, tenant_id
                     
         # Difyを使ってキーワードを生成（aiohttpを使用）
         async with aiohttp.ClientSession() as session:
+            session = wrap_dify_session(session)
             async with session.post(
                 'https://dify.p0x0q.com/v1/workflows/run',
+                prompt_name='search_keywords',
                 headers={
                     'Authorization': f'Bearer {keywords_api_key_to_use}',
                     'Content-Type': 'application/json'
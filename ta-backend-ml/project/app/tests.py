@@ -1 +1,1716 @@
-# Create your tests here.
+import asyncio
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from datetime import datetime
+from types import ModuleType, SimpleNamespace
+from unittest import mock, skipUnless
+
+from PIL import Image
+
+from django.test import RequestFactory, SimpleTestCase
+from google.api_core import exceptions as api_exceptions
+
+import psycopg2
+from psycopg2 import extensions
+from psycopg2.extras import RealDictCursor
+
+from app import job_pools, job_queue_sync, views
+from app.db_pool import ConnectionPool, PoolTimeout
+from app.job_dispatcher import JobQueueDispatcher
+from app.job_lease import (LeaseKeeper, claim_jobs, complete_job, fail_job, reap_expired_jobs, renew_lease,
+                           renew_leases)
+from app.workers.analysis_cache import AnalysisCache
+from app.workers.async_crawl_engine import AsyncCrawlEngine
+from app.workers.browser_pool import BrowserPool
+from app.workers.crawl_checkpoint import CrawlCheckpointStore
+from app.workers.crawl_frontier import CrawlFrontier
+from app.workers.dom_distiller import estimate_tokens, format_outline
+from app.workers.gemini_client import GeminiClient, GeminiTimeout, GeminiUnavailable
+from app.workers.gemini_page_analyzer import GeminiPageAnalyzer
+from app.workers.gemini_rate_limiter import GeminiRateLimiter, RateLimitTimeout, _LocalBuckets, set_llm_session
+from app.workers.llm_json import get_parse_stats, parse_llm_json
+from app.workers.llm_telemetry import LLMTelemetry, get_llm_telemetry, image_bytes_of
+from app.workers.llm_transport import LLMTransport, ReplayMiss, request_key
+from app.workers.page_load_profiles import PageLoadProfile, get_profile
+from app.workers.page_template_index import PageTemplateIndex
+from app.workers.result_writer import ResultBatchWriter
+from app.workers.screenshot_preprocessor import PayloadStats, prepare_screenshot
+from app.workers.url_canonicalizer import SeenUrlIndex, UrlCanonicalizer
+from app.workers.screenshot_store import screenshot_signature
+from app.workers.session_log_sink import SessionLogSink
+from app.workers import test_executor_pool
+from app.workers.test_executor_pool import TestExecutionError, TestExecutorPool
+
+
+class _FakeContext:
+    def new_page(self):
+        return object()
+
+    def close(self):
+        pass
+
+
+class _FakeBrowser:
+    def new_context(self, **options):
+        return _FakeContext()
+
+    def is_connected(self):
+        return True
+
+    def close(self):
+        pass
+
+
+class _FakePlaywright:
+    """sync_playwright()の代わり（ブラウザを起動せずにBrowserPoolのスレッドを動かす）"""
+
+    def __init__(self):
+        self.chromium = mock.Mock(launch=mock.Mock(side_effect=lambda **options: _FakeBrowser()))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class BrowserPoolLLMSessionTests(SimpleTestCase):
+    """BrowserPoolのスレッドで行ったLLM呼び出しが、呼び出し元のセッションに記録されること"""
+
+    def setUp(self):
+        patcher = mock.patch('app.workers.browser_pool.sync_playwright', _FakePlaywright)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.pool = BrowserPool(size=1, warmup=False)
+        self.addCleanup(self.pool.shutdown)
+
+    def test_session_summary_includes_calls_made_on_pool_thread(self):
+        def call_gemini(page):
+            get_llm_telemetry().record('gemini', 'gemini-test', 'analyze_page', 12.0, 'ok',
+                                       input_tokens=100, output_tokens=20)
+
+        set_llm_session('session-browser-pool')
+        try:
+            self.pool.run(call_gemini)
+        finally:
+            set_llm_session(None)
+
+        summary = get_llm_telemetry().session_summary('session-browser-pool')
+        self.assertEqual(summary['calls'], 1)
+        self.assertEqual(summary['total_tokens'], 120)
+
+
+class _LostDuringRunKeeper(LeaseKeeper):
+    """ハートビートのスレッドを動かさず、lose()したジョブをリースを失ったものとして扱うLeaseKeeper"""
+
+    def __enter__(self):
+        return self
+
+    def lose(self, job_id: str):
+        with self._lock:
+            self._lost.add(job_id)
+
+
+class RunJobsLeaseLostTests(SimpleTestCase):
+    """実行中にリースを失ったジョブの結果や状態を、run_jobsが書き込まないこと"""
+
+    def setUp(self):
+        self.job = {'id': 'job-1', 'type': 'test_execution', 'attempts': 1, 'max_attempts': 3,
+                    'created_at': datetime(2026, 1, 1, 0, 0, 0), 'started_at': datetime(2026, 1, 1, 0, 0, 5), 'test_session_id': 'session-1'}
+        self.conn = mock.MagicMock()
+        self.keeper = _LostDuringRunKeeper('worker-1')
+        self.complete_job = mock.Mock()
+        self.fail_job = mock.Mock()
+        patches = [
+            mock.patch.object(job_queue_sync, 'worker_id', return_value='worker-1'),
+            mock.patch.object(job_queue_sync, 'get_db_connection', return_value=self.conn),
+            mock.patch.object(job_queue_sync, 'LeaseKeeper', return_value=self.keeper),
+            mock.patch.object(job_queue_sync, 'claim_jobs', side_effect=[[self.job], []]),
+            mock.patch.object(job_queue_sync, 'concurrency_for', return_value=1),
+            mock.patch.object(job_queue_sync, 'complete_job', self.complete_job),
+            mock.patch.object(job_queue_sync, 'fail_job', self.fail_job),
+            mock.patch.object(job_queue_sync, 'get_pool'),
+        ]
+        for patcher in patches:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.conn.__enter__.return_value = self.conn
+        self.conn.commit.reset_mock()
+
+    def run_with_handler(self, handler):
+        with mock.patch.dict(job_queue_sync.JOB_HANDLERS, {'test_execution': handler}):
+            return job_queue_sync.run_jobs('test_execution', hand_off=False)
+
+    def test_result_is_not_recorded_when_lease_is_lost(self):
+        def handler(job, cursor, conn, keeper):
+            self.keeper.lose(job['id'])
+            return {'pages_scanned': 1}
+
+        self.assertEqual(self.run_with_handler(handler), 0)
+        self.complete_job.assert_not_called()
+        self.fail_job.assert_not_called()
+        self.conn.rollback.assert_called()
+        self.conn.commit.assert_not_called()
+
+    def test_failure_is_not_recorded_when_lease_is_lost(self):
+        def handler(job, cursor, conn, keeper):
+            self.keeper.lose(job['id'])
+            raise RuntimeError('browser crashed')
+
+        self.assertEqual(self.run_with_handler(handler), 0)
+        self.complete_job.assert_not_called()
+        self.fail_job.assert_not_called()
+        self.conn.commit.assert_not_called()
+
+    def test_result_is_recorded_while_lease_is_held(self):
+        self.assertEqual(self.run_with_handler(lambda job, cursor, conn, keeper: {'pages_scanned': 1}), 1)
+        self.complete_job.assert_called_once()
+        self.conn.commit.assert_called_once()
+
+
+class ScreenshotViewPermissionTests(SimpleTestCase):
+    """スクリーンショットは、組織と有効期限を署名したURLで、その組織が参照している場合だけ返すこと"""
+
+    key = f"{'a' * 64}.webp"
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.cursor = mock.Mock()
+        conn = mock.MagicMock()
+        conn.__enter__.return_value.cursor.return_value = self.cursor
+        store = mock.Mock(get=mock.Mock(return_value=b'RIFF....WEBP'))
+        patches = [
+            mock.patch.dict('os.environ', {'SCREENSHOT_URL_SECRET': 'test-secret'}),
+            mock.patch.object(views, 'get_pool', return_value=mock.Mock(connection=mock.Mock(return_value=conn))),
+            mock.patch.object(views, 'get_screenshot_store', return_value=store),
+        ]
+        for patcher in patches:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def get(self, **params):
+        return views.get_screenshot(self.factory.get(f'/api/v1/screenshots/{self.key}', params), self.key)
+
+    def signed(self, organization_id='org-1', expires=None):
+        expires = expires or int(time.time()) + 600
+        return {'organization_id': organization_id, 'expires': str(expires),
+                'signature': screenshot_signature(self.key, organization_id, expires)}
+
+    def test_requires_signed_url(self):
+        self.assertEqual(self.get().status_code, 401)
+        self.assertEqual(self.get(organization_id='org-1').status_code, 401)
+
+    def test_rejects_forged_organization(self):
+        params = self.signed('org-1')
+        params['organization_id'] = 'org-2'
+        self.assertEqual(self.get(**params).status_code, 403)
+        self.cursor.execute.assert_not_called()
+
+    def test_rejects_expired_url(self):
+        self.assertEqual(self.get(**self.signed(expires=int(time.time()) - 1)).status_code, 403)
+
+    def test_rejects_organization_that_does_not_own_screenshot(self):
+        self.cursor.fetchone.return_value = None
+        self.assertEqual(self.get(**self.signed('org-2')).status_code, 403)
+
+    def test_serves_screenshot_to_owning_organization(self):
+        self.cursor.fetchone.return_value = (1,)
+        response = self.get(**self.signed('org-1'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/webp')
+        self.assertTrue(response['Cache-Control'].startswith('private'))
+        # キーと組織の等価比較（主キー）で確認する
+        self.assertEqual(self.cursor.execute.call_args[0][1], (self.key, 'org-1'))
+
+
+class _FakeGeminiModel:
+    """genai.GenerativeModelの代わり（ページのURLを問題の説明に入れて返し、応答の順番をばらつかせる）"""
+
+    def __init__(self):
+        self.calls = 0
+
+    def generate_content(self, contents, request_options=None, **kwargs):
+        self.calls += 1
+        time.sleep(random.uniform(0, 0.02))
+        url = contents[0].split('- URL: ')[1].split()[0]
+        text = json.dumps({'issues': [{'type': 'layout', 'description': url, 'severity': 'low'}],
+                           'actions': [], 'navigation_suggestions': []})
+        return SimpleNamespace(text=text, usage_metadata=SimpleNamespace(
+            prompt_token_count=10, candidates_token_count=5, total_token_count=15))
+
+
+class LLMReplayConcurrentCrawlTests(SimpleTestCase):
+    """並列のクロールで記録したページ分析を、別の完了順のクロールでそのまま再生できること"""
+
+    urls = [f'https://example.com/page/{i}' for i in range(8)]
+
+    def setUp(self):
+        cassette_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cassette_dir.cleanup)
+        patches = [
+            mock.patch.dict('os.environ', {'LLM_CASSETTE_DIR': cassette_dir.name, 'GEMINI_HEDGE': 'false'}),
+            mock.patch('app.workers.gemini_client.get_gemini_rate_limiter'),
+        ]
+        for patcher in patches:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        buffer = io.BytesIO()
+        Image.new('RGB', (64, 64), 'white').save(buffer, format='PNG')
+        self.screenshot = buffer.getvalue()
+
+    def crawl(self, mode: str, urls):
+        with mock.patch.dict('os.environ', {'LLM_TRANSPORT_MODE': mode}), \
+                mock.patch('app.workers.gemini_client.get_llm_transport', LLMTransport):
+            client = GeminiClient('gemini-test')
+        client.model = _FakeGeminiModel()
+        analyzer = GeminiPageAnalyzer.__new__(GeminiPageAnalyzer)
+        analyzer.gemini = client
+        analyzer.cache = mock.Mock(get=mock.Mock(return_value=None))
+        analyzer.payload_stats = PayloadStats()
+
+        def visit(url):
+            return url, analyzer.analyze_page(url, self.screenshot, f'<main>{url}</main>', 'Example', 'desktop')
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = dict(executor.map(visit, urls))
+        return results, client
+
+    def test_replays_crawl_recorded_with_concurrency(self):
+        recorded, _ = self.crawl('record', self.urls)
+        replayed, client = self.crawl('replay', list(reversed(self.urls)))
+
+        self.assertEqual(recorded[self.urls[3]]['issues'][0]['description'], self.urls[3])
+        self.assertEqual(replayed, recorded)
+        self.assertEqual(client.model.calls, 0)
+        stats = client.transport.stats()
+        self.assertEqual(stats['misses'], 0)
+        self.assertEqual(stats['replayed'], len(self.urls))
+
+
+class AnalysisCacheSessionStatsTests(SimpleTestCase):
+    """並行するセッションの分析キャッシュのヒット数が、互いに混ざらないこと"""
+
+    def setUp(self):
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        with mock.patch.dict('os.environ', {'ANALYSIS_CACHE_PATH': f'{cache_dir.name}/cache.sqlite3'}):
+            self.cache = AnalysisCache('sqlite')
+        self.cache.set('shared-page', {'issues': []})
+
+    def test_stats_are_counted_per_session(self):
+        def crawl(session_id, lookups):
+            set_llm_session(session_id)
+            for key in lookups:
+                self.cache.get(key)
+
+        before = self.cache.stats('session-a')
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            executor.submit(crawl, 'session-a', ['shared-page'] * 3)
+            executor.submit(crawl, 'session-b', ['missing-page'] * 2)
+
+        session_a = self.cache.stats_since(before, 'session-a')
+        self.assertEqual((session_a['hits'], session_a['misses']), (3, 0))
+        self.assertEqual(session_a['hit_rate'], 1.0)
+        session_b = self.cache.stats('session-b')
+        self.assertEqual((session_b['hits'], session_b['misses']), (0, 2))
+        self.assertEqual(self.cache.stats()['hits'], 3)
+
+
+class AnalysisCacheKeyTests(SimpleTestCase):
+    """分析キャッシュのキーが、毎回変わる部分を無視し、内容やプロンプトのバージョンが変われば変わること"""
+
+    def key(self, content, version='page-analysis-v5', url='https://example.com/', variant='desktop'):
+        return AnalysisCache.make_key('page', version, url, content, None, variant)
+
+    def test_ignores_scripts_comments_timestamps_and_whitespace(self):
+        base = self.key('<main><h1>Title</h1><p>Updated 1700000000</p></main>')
+        noisy = self.key('<main>\n  <script>var t = Date.now();</script><!-- build 42 -->'
+                         '<h1>Title</h1>  <p>Updated   1712345678</p></main>')
+        self.assertEqual(noisy, base)
+
+    def test_changes_with_content_prompt_version_and_variant(self):
+        base = self.key('<main><h1>Title</h1></main>')
+        self.assertNotEqual(self.key('<main><h1>Other</h1></main>'), base)
+        self.assertNotEqual(self.key('<main><h1>Title</h1></main>', version='page-analysis-v4'), base)
+        self.assertNotEqual(self.key('<main><h1>Title</h1></main>', variant='mobile'), base)
+
+
+class CrawlCheckpointDispatchedTests(SimpleTestCase):
+    """チェックポイントに、処理を始めたページ数（dispatched）を保存して読み戻すこと"""
+
+    def setUp(self):
+        self.cursor = mock.Mock()
+        conn = mock.MagicMock()
+        conn.__enter__.return_value.cursor.return_value = self.cursor
+        patcher = mock.patch('app.workers.crawl_checkpoint.connection', return_value=conn)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.store = CrawlCheckpointStore()
+
+    def row(self, dispatched):
+        return {'frontier': [['https://example.com/b', 1, 0]], 'visited_urls': ['https://example.com/'],
+                'page_results': {}, 'bug_fingerprints': [], 'bugs': [], 'pages_scanned': 1,
+                'dispatched': dispatched, 'elapsed_seconds': 3.5, 'updated_at': datetime(2026, 1, 1)}
+
+    def test_save_writes_dispatched(self):
+        self.store.save('session-1', {'frontier': [], 'visited_urls': ['https://example.com/'],
+                                      'dispatched': 4, 'pages_scanned': 1})
+        sql, params = self.cursor.execute.call_args[0]
+        self.assertIn('dispatched = EXCLUDED.dispatched', sql)
+        self.assertEqual(params[8], 4)
+
+    def test_load_returns_dispatched(self):
+        self.cursor.fetchone.return_value = self.row(4)
+        self.assertEqual(self.store.load('session-1')['dispatched'], 4)
+
+    def test_load_leaves_dispatched_unset_for_rows_saved_before_the_column(self):
+        self.cursor.fetchone.return_value = self.row(None)
+        self.assertNotIn('dispatched', self.store.load('session-1'))
+
+
+class _ConstraintViolation(Exception):
+    """制約違反などの、再送しても直らないエラーの代わり"""
+
+
+class ResultBatchWriterIsolationTests(SimpleTestCase):
+    """再送しても直らないエラーでは、失敗した行だけを破棄し、同じバッチの他の行は書き込むこと"""
+
+    def setUp(self):
+        self.committed = []
+        patcher = mock.patch.object(ResultBatchWriter, '_write', autospec=True, side_effect=self.write)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.writer = ResultBatchWriter('session-1', batch_size=100, max_retries=0)
+
+    def write(self, writer, pending):
+        if any(row[0] == 'bad' for rows in pending.values() for row in rows):
+            raise _ConstraintViolation('duplicate key value violates unique constraint')
+        self.committed.extend(row[0] for rows in pending.values() for row in rows)
+        return 1
+
+    def test_only_failing_group_is_dropped(self):
+        callbacks = []
+        self.writer.add({'TestResult': [('page-1',)]}, on_commit=lambda: callbacks.append('page-1'))
+        self.writer.add({'TestResult': [('bad',)], 'BugTicket': [('bug-of-bad',)]},
+                        on_commit=lambda: callbacks.append('bad'))
+        self.writer.add({'TestResult': [('page-2',)], 'BugTicket': [('bug-2',)]})
+
+        self.assertFalse(self.writer.flush())
+        self.assertEqual(sorted(self.committed), ['bug-2', 'page-1', 'page-2'])
+        self.assertEqual(callbacks, ['page-1'])
+        stats = self.writer.stats()
+        self.assertEqual((stats['rows_written'], stats['rows_dropped'], stats['split_batches']), (3, 2, 1))
+
+    def test_batch_is_written_in_one_transaction_when_nothing_fails(self):
+        self.writer.add({'TestResult': [('page-1',)]})
+        self.writer.add({'TestResult': [('page-2',)]})
+        self.assertTrue(self.writer.flush())
+        self.assertEqual(self.writer.stats()['flushes'], 1)
+
+
+class _FakeAsyncContext:
+    async def new_page(self):
+        return object()
+
+    async def close(self):
+        pass
+
+
+class _FakeAsyncBrowser:
+    def __init__(self):
+        self.closed = False
+
+    async def new_context(self, **options):
+        return _FakeAsyncContext()
+
+    def is_connected(self):
+        return True
+
+    async def close(self):
+        self.closed = True
+
+
+class _FakeAsyncPlaywright:
+    """async_playwright()の代わり（起動したブラウザを記録する）"""
+
+    def __init__(self):
+        self.browsers = []
+
+        async def launch(**options):
+            browser = _FakeAsyncBrowser()
+            self.browsers.append(browser)
+            return browser
+
+        self.chromium = SimpleNamespace(launch=launch)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class AsyncCrawlEngineTests(SimpleTestCase):
+    """AsyncCrawlEngineが、少数のブラウザ上で並行にページを処理し、各ページを1度だけ処理すること"""
+
+    # ページ -> リンク先（/ から辿れる11ページ。/a と /b は互いにリンクしている）
+    site = {'/': ['/a', '/b'], '/a': ['/b', '/c', '/d'], '/b': ['/a', '/e', '/f'],
+            **{f'/{name}': [f'/{name}/{i}' for i in range(2)] for name in 'cd'},
+            **{f'/{name}': [] for name in 'ef'}}
+
+    def setUp(self):
+        self.playwright = _FakeAsyncPlaywright()
+        patcher = mock.patch('app.workers.async_crawl_engine.async_playwright', lambda: self.playwright)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.processed = []
+        self.running = 0
+        self.max_running = 0
+
+    async def handle(self, page, url, depth):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        await asyncio.sleep(0.01)
+        self.running -= 1
+        path = url.replace('https://example.com', '') or '/'
+        self.processed.append(path)
+        return {'processed': True, 'discovered_urls': [f'https://example.com{link}' for link in self.site.get(path, [])]}
+
+    def test_crawls_each_page_once_with_concurrency(self):
+        engine = AsyncCrawlEngine(self.handle, max_depth=5, concurrency=4, browsers=1,
+                                  max_pages_per_browser=5, max_pages=100, max_seconds=60)
+        stats = engine.run('https://example.com/')
+
+        self.assertEqual(sorted(self.processed), sorted(set(self.processed)))
+        self.assertEqual(len(self.processed), 11)
+        self.assertEqual(stats['pages_scanned'], 11)
+        self.assertGreater(self.max_running, 1)
+        # 5ページごとにブラウザを作り直し、入れ替えたブラウザは閉じる
+        self.assertGreater(stats['browser_recycles'], 0)
+        self.assertTrue(all(browser.closed for browser in self.playwright.browsers))
+
+    def test_checkpoint_snapshot_can_resume_crawl(self):
+        snapshots = []
+
+        async def checkpoint(state):
+            snapshots.append(state)
+
+        with mock.patch.dict('os.environ', {'CRAWL_CHECKPOINT_EVERY': '3'}):
+            engine = AsyncCrawlEngine(self.handle, concurrency=1, browsers=1, max_pages=4,
+                                      max_seconds=60, checkpoint_callback=checkpoint)
+        first = engine.run('https://example.com/')
+        self.assertEqual(first['frontier']['stop_reason'], 'max_pages')
+
+        state = snapshots[-1]
+        self.processed = []
+        resumed = AsyncCrawlEngine(self.handle, concurrency=2, browsers=1, max_pages=100, max_seconds=60)
+        resumed.run('https://example.com/', resume_state=state)
+        # 再開後は、チェックポイントまでに処理したページを処理し直さず、残りのページを全て処理する
+        visited = {url.replace('https://example.com', '') or '/' for url in state['visited_urls']}
+        self.assertFalse(set(self.processed) & visited)
+        self.assertEqual(set(self.processed) | visited, set(self.site) | {f'/{name}/{i}' for name in 'cd' for i in range(2)})
+
+
+class CrawlFrontierTests(SimpleTestCase):
+    """CrawlFrontierが、浅いページと提案URLを優先し、ページ数の予算を超えたURLを処理しないこと"""
+
+    def drain(self, frontier):
+        async def run():
+            urls = []
+            while not frontier.empty():
+                url, _ = await frontier.next_url()
+                frontier.task_done()
+                urls.append(url)
+            return urls
+        return asyncio.run(run())
+
+    def test_orders_by_depth_suggestion_and_template(self):
+        frontier = CrawlFrontier(max_depth=5, max_pages=100, max_seconds=60)
+        frontier.push('https://example.com/deep', 2)
+        frontier.push('https://example.com/items/1', 1)
+        frontier.push('https://example.com/items/2', 1)
+        frontier.push('https://example.com/about', 1)
+        frontier.push('https://example.com/login', 2, suggested=True)
+
+        self.assertEqual(self.drain(frontier), [
+            'https://example.com/login',    # 提案URLは1段浅いページより先
+            'https://example.com/items/1',
+            'https://example.com/about',    # 同じテンプレートの2件目より先
+            'https://example.com/items/2',
+            'https://example.com/deep',
+        ])
+
+    def test_rejects_duplicates_and_pages_beyond_max_depth(self):
+        frontier = CrawlFrontier(max_depth=1, max_pages=100, max_seconds=60)
+        self.assertTrue(frontier.push('https://example.com/a', 1))
+        self.assertFalse(frontier.push('https://example.com/a#top', 1))
+        self.assertFalse(frontier.push('https://example.com/b', 2))
+        stats = frontier.stats()
+        self.assertEqual((stats['duplicates'], stats['too_deep']), (1, 1))
+
+    def test_drops_remaining_urls_after_page_budget(self):
+        frontier = CrawlFrontier(max_depth=5, max_pages=2, max_seconds=60)
+        for i in range(5):
+            frontier.push(f'https://example.com/page-{i}', 1)
+
+        urls = self.drain(frontier)
+        self.assertEqual(len([url for url in urls if url]), 2)
+        self.assertEqual(urls[2:], [None, None, None])
+        self.assertEqual(frontier.stats()['stop_reason'], 'max_pages')
+        self.assertFalse(frontier.push('https://example.com/late', 1))
+
+    def test_restore_keeps_dispatched_page_budget(self):
+        frontier = CrawlFrontier(max_depth=5, max_pages=3, max_seconds=60)
+        frontier.restore([['https://example.com/b', 1, 10.0], ['https://example.com/c', 1, 10.0]],
+                         ['https://example.com/'], dispatched=2)
+
+        self.assertFalse(frontier.push('https://example.com/', 1))
+        self.assertEqual(len([url for url in self.drain(frontier) if url]), 1)
+
+
+class UrlCanonicalizerTests(SimpleTestCase):
+    """UrlCanonicalizerのルールごとの正規化と、SeenUrlIndexの重複判定"""
+
+    def setUp(self):
+        self.canonicalizer = UrlCanonicalizer(ignored_params=['sid'], lowercase_path=False, strip_trailing_slash=True)
+
+    def assertCanonical(self, url, expected, rules):
+        self.assertEqual(self.canonicalizer.canonicalize_with_rules(url), (expected, rules))
+
+    def test_rules(self):
+        self.assertCanonical('https://example.com/a#section', 'https://example.com/a', ['fragment'])
+        self.assertCanonical('HTTPS://Example.COM/Path', 'https://example.com/Path', ['case'])
+        self.assertCanonical('https://example.com:443/a', 'https://example.com/a', ['default_port'])
+        self.assertCanonical('https://example.com:8443/a', 'https://example.com:8443/a', [])
+        self.assertCanonical('https://example.com/a;jsessionid=ABC123', 'https://example.com/a', ['session_path_param'])
+        self.assertCanonical('https://example.com/a?utm_source=x&gclid=y&q=1', 'https://example.com/a?q=1',
+                             ['tracking_params'])
+        self.assertCanonical('https://example.com/a?sid=abc&q=1', 'https://example.com/a?q=1', ['ignored_params'])
+        self.assertCanonical('https://example.com/a?b=2&a=1', 'https://example.com/a?a=1&b=2', ['query_order'])
+        self.assertCanonical('https://example.com/a/', 'https://example.com/a', ['trailing_slash'])
+        self.assertCanonical('https://example.com/', 'https://example.com/', [])
+
+    def test_leaves_non_http_urls_alone(self):
+        for url in ('mailto:qa@example.com', 'javascript:void(0)', '/relative/path'):
+            self.assertEqual(self.canonicalizer.canonicalize(url), url)
+
+    def test_options(self):
+        lowercase = UrlCanonicalizer(ignored_params=[], lowercase_path=True, strip_trailing_slash=False)
+        self.assertEqual(lowercase.canonicalize('https://example.com/Docs/'), 'https://example.com/docs/')
+        self.assertEqual(lowercase.canonicalize('https://example.com/a?sid=1'), 'https://example.com/a?sid=1')
+
+    def test_seen_index_counts_duplicates_collapsed_by_rule(self):
+        index = SeenUrlIndex(self.canonicalizer)
+        self.assertEqual(index.add('https://example.com/a?q=1'), 'https://example.com/a?q=1')
+        self.assertIsNone(index.add('https://example.com/a?q=1&utm_campaign=spring#top'))
+        self.assertIsNone(index.add('https://example.com/a?q=1'))
+        self.assertIn('https://EXAMPLE.com/a?q=1', index)
+
+        stats = index.stats()
+        self.assertEqual((stats['unique_urls'], stats['exact_duplicates']), (1, 1))
+        self.assertEqual((stats['collapsed_by_tracking_params'], stats['collapsed_by_fragment']), (1, 1))
+
+
+class _FakeRoute:
+    def __init__(self, url, resource_type):
+        self.request = SimpleNamespace(url=url, resource_type=resource_type)
+        self.outcome = None
+
+    def abort(self):
+        self.outcome = 'aborted'
+
+    def continue_(self):
+        self.outcome = 'continued'
+
+
+class PageLoadProfileTests(SimpleTestCase):
+    """analysisプロファイルがトラッカーと重いリソースだけをブロックし、DOMの静止を待つこと"""
+
+    def route_through(self, profile_name, requests):
+        profile = PageLoadProfile(get_profile(profile_name))
+        page = mock.Mock()
+        profile.apply(page)
+        routes = [_FakeRoute(url, resource_type) for url, resource_type in requests]
+        if page.route.called:
+            handler = page.route.call_args[0][1]
+            for route in routes:
+                handler(route)
+        return profile, [route.outcome for route in routes]
+
+    def test_analysis_profile_blocks_trackers_media_and_fonts(self):
+        profile, outcomes = self.route_through('analysis', [
+            ('https://example.com/app.js', 'script'),
+            ('https://www.google-analytics.com/collect', 'xhr'),
+            ('https://stats.g.doubleclick.net/pixel', 'image'),
+            ('https://example.com/intro.mp4', 'media'),
+            ('https://example.com/font.woff2', 'font'),
+            ('https://notdoubleclick.net/app.js', 'script'),
+        ])
+        self.assertEqual(outcomes, ['continued', 'aborted', 'aborted', 'aborted', 'aborted', 'continued'])
+        self.assertEqual(profile.summary()['blocked_requests'], 4)
+
+    def test_fidelity_profile_does_not_intercept(self):
+        _, outcomes = self.route_through('fidelity', [('https://www.google-analytics.com/collect', 'xhr')])
+        self.assertEqual(outcomes, [None])
+
+    def test_unknown_profile_falls_back_to_analysis(self):
+        self.assertEqual(get_profile('unknown')['name'], 'analysis')
+
+    def test_goto_waits_for_dom_quiescence(self):
+        profile = PageLoadProfile(get_profile('analysis'))
+        page = mock.Mock()
+        page.evaluate.return_value = {'waited_ms': 620, 'quiescent': True}
+
+        profile.goto(page, 'https://example.com/')
+        self.assertEqual(page.goto.call_args[1]['wait_until'], 'domcontentloaded')
+        self.assertEqual(page.evaluate.call_args[0][1], [500, 5000])
+        self.assertTrue(profile.summary()['readiness']['quiescent'])
+
+
+class _FakeConnection:
+    """psycopg2の接続の代わり（トランザクションの状態とロールバック・クローズを記録する）"""
+
+    def __init__(self):
+        self.closed = 0
+        self.rollbacks = 0
+        self.info = SimpleNamespace(transaction_status=extensions.TRANSACTION_STATUS_IDLE)
+
+    def rollback(self):
+        self.rollbacks += 1
+        self.info.transaction_status = extensions.TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = 1
+
+
+class ConnectionPoolTests(SimpleTestCase):
+    """ConnectionPoolが接続を再利用し、上限を超えた要求を待たせ、壊れた接続を捨てること"""
+
+    def setUp(self):
+        patcher = mock.patch('app.db_pool.psycopg2.connect', side_effect=lambda dsn: _FakeConnection())
+        self.connect = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.pool = ConnectionPool('postgresql://test', max_size=2, timeout=0.1, healthcheck_seconds=60)
+
+    def test_reuses_returned_connections(self):
+        with self.pool.connection() as first:
+            pass
+        with self.pool.connection() as second:
+            pass
+        self.assertIs(first, second)
+        self.assertEqual(self.connect.call_count, 1)
+
+    def test_waits_for_free_connection_and_times_out(self):
+        held = [self.pool.getconn(), self.pool.getconn()]
+        with self.assertRaises(PoolTimeout):
+            self.pool.getconn()
+        self.assertEqual(self.pool.stats()['timeouts'], 1)
+
+        timer = threading.Timer(0.02, self.pool.putconn, args=(held[0],))
+        timer.start()
+        self.assertIs(self.pool.getconn(), held[0])
+        timer.join()
+
+    def test_rolls_back_open_transaction_on_return(self):
+        conn = self.pool.getconn()
+        conn.info.transaction_status = extensions.TRANSACTION_STATUS_INTRANS
+        self.pool.putconn(conn)
+        self.assertEqual(conn.rollbacks, 1)
+        self.assertEqual(self.pool.stats()['idle'], 1)
+
+    def test_discards_connection_broken_inside_block(self):
+        with self.assertRaises(RuntimeError):
+            with self.pool.connection() as conn:
+                conn.closed = 2
+                raise RuntimeError('server closed the connection unexpectedly')
+        stats = self.pool.stats()
+        self.assertEqual((stats['size'], stats['connections_discarded']), (0, 1))
+
+    def test_does_not_share_parent_connections_after_fork(self):
+        with self.pool.connection() as parent_conn:
+            pass
+        with mock.patch('app.db_pool.os.getpid', return_value=-1):
+            with self.pool.connection() as child_conn:
+                pass
+        self.assertIsNot(child_conn, parent_conn)
+        self.assertFalse(parent_conn.closed)
+
+
+class SessionLogSinkTests(SimpleTestCase):
+    """SessionLogSinkがログをまとめて書き込み、あふれそうなときは低いレベルから間引くこと"""
+
+    def setUp(self):
+        self.batches = []
+        self.store = mock.Mock()
+        self.store.put.side_effect = lambda data: (threading.current_thread().name, len(data))
+        patches = [
+            mock.patch('app.workers.session_log_sink.get_screenshot_store', return_value=self.store),
+            mock.patch.object(SessionLogSink, '_write', autospec=True,
+                              side_effect=lambda sink, batch: self.batches.append(batch)),
+        ]
+        for patcher in patches:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def sink(self, **options):
+        sink = SessionLogSink(**options)
+        self.addCleanup(sink.close, 1)
+        return sink
+
+    def test_writes_batches_and_stores_screenshots_on_writer_thread(self):
+        sink = self.sink(batch_size=2, flush_seconds=0.01)
+        self.assertTrue(sink.log('session-1', 'info', 'page loaded', {'url': 'https://example.com/'}, b'PNG-DATA'))
+        self.assertTrue(sink.log('session-1', 'error', 'console error'))
+        self.assertTrue(sink.flush(1))
+
+        records = [record for batch in self.batches for record in batch]
+        self.assertEqual([record[2] for record in records], ['page loaded', 'console error'])
+        # 画像はlog()の呼び出し元ではなくライタースレッドでストアに書き込み、参照に置き換える
+        self.assertEqual(records[0][4], ('session-log-sink', 8))
+        self.assertIsNone(records[1][4])
+        self.assertEqual(sink.stats()['queued_screenshot_bytes'], 0)
+
+    def test_sheds_debug_then_info_but_keeps_errors(self):
+        sink = self.sink(max_records=4, batch_size=100, flush_seconds=60)
+        admitted = [sink.log('session-1', level, f'{level}-{i}')
+                    for i, level in enumerate(['debug', 'debug', 'debug', 'info', 'info', 'info', 'error'])]
+
+        self.assertEqual(admitted, [True, True, False, True, True, False, True])
+        stats = sink.stats()
+        self.assertEqual((stats['dropped_debug'], stats['dropped_info'], stats['evicted']), (1, 1, 1))
+        self.assertTrue(sink.flush(1))
+        messages = [record[2] for batch in self.batches for record in batch]
+        self.assertNotIn('debug-0', messages)
+        self.assertIn('error-6', messages)
+
+    def test_drops_screenshots_beyond_byte_budget(self):
+        sink = self.sink(batch_size=100, flush_seconds=60, max_screenshot_bytes=10)
+        sink.log('session-1', 'info', 'first', screenshot=b'x' * 8)
+        sink.log('session-1', 'info', 'second', screenshot=b'x' * 8)
+        self.assertEqual(sink.stats()['dropped_screenshots'], 1)
+        self.assertTrue(sink.flush(1))
+        self.assertEqual([record[4] is not None for batch in self.batches for record in batch], [True, False])
+
+
+class CombinedPageAnalysisTests(SimpleTestCase):
+    """analyze_pageが、問題・アクション・ナビゲーション候補を1回のGeminiリクエストで取得すること"""
+
+    def setUp(self):
+        self.gemini = mock.Mock()
+        self.gemini.generate_json.return_value = ({
+            'issues': [{'type': 'layout', 'description': 'ボタンが重なっている', 'severity': 'medium'},
+                       {'type': 'text', 'severity': 'low'}],
+            'actions': [{'type': 'click', 'selector': '#login', 'description': 'ログイン'}, {'selector': '#x'}],
+            'navigation_suggestions': [{'url': 'https://example.com/pricing', 'reason': '料金ページ'}]
+        }, SimpleNamespace(latency_ms=850))
+        self.cache = {}
+        self.analyzer = GeminiPageAnalyzer.__new__(GeminiPageAnalyzer)
+        self.analyzer.gemini = self.gemini
+        self.analyzer.cache = mock.Mock(get=mock.Mock(side_effect=self.cache.get),
+                                        set=mock.Mock(side_effect=self.cache.__setitem__))
+        self.analyzer.payload_stats = PayloadStats()
+        buffer = io.BytesIO()
+        Image.new('RGB', (64, 64), 'white').save(buffer, format='PNG')
+        self.screenshot = buffer.getvalue()
+
+    def analyze(self):
+        return self.analyzer.analyze_page('https://example.com/', self.screenshot, '<main>outline</main>', 'Example')
+
+    def test_one_request_returns_issues_actions_and_navigation(self):
+        result = self.analyze()
+
+        self.gemini.generate_json.assert_called_once()
+        contents, schema, prompt_name = self.gemini.generate_json.call_args[0]
+        self.assertEqual(prompt_name, 'page_analysis')
+        self.assertEqual(set(schema['required']), {'issues', 'actions', 'navigation_suggestions'})
+        # プロンプトの後に画像を添える
+        self.assertIn('<main>outline</main>', contents[0])
+        self.assertTrue(contents[1:])
+        self.assertTrue(all(part['mime_type'].startswith('image/') for part in contents[1:]))
+        # 説明のない問題と種類のないアクションは除く
+        self.assertEqual([issue['type'] for issue in result['issues']], ['layout'])
+        self.assertEqual([action['selector'] for action in result['actions']], ['#login'])
+        self.assertEqual(result['navigation_suggestions'][0]['url'], 'https://example.com/pricing')
+
+    def test_second_analysis_of_same_page_uses_cache(self):
+        first = self.analyze()
+        second = self.analyze()
+        self.assertEqual(second, first)
+        self.gemini.generate_json.assert_called_once()
+
+    def test_unreadable_response_is_not_cached(self):
+        self.gemini.generate_json.return_value = (None, SimpleNamespace(latency_ms=850))
+        result = self.analyze()
+        self.assertEqual(result, {'issues': [], 'actions': [], 'navigation_suggestions': []})
+        self.assertEqual(self.cache, {})
+
+
+class PageTemplateIndexTests(SimpleTestCase):
+    """同じDOM構造のページは、テンプレートごとにサンプル数だけフル分析すること"""
+
+    @staticmethod
+    def product_page(reviews: int):
+        skeleton = ['0:>body', '1:body>header.nav', '1:body>main.product', '2:main.product>h', '2:main.product>img.hero',
+                    '2:main.product>div.price', '2:main.product>form.cart', '3:form.cart>button.btn']
+        return skeleton * 8 + ['3:ul.reviews>li.review'] * reviews
+
+    def test_samples_structurally_identical_pages(self):
+        index = PageTemplateIndex(sample_size=2, max_distance=3)
+        # レビューの件数だけが違う商品ページ
+        decisions = [index.classify(self.product_page(i + 2), f'https://example.com/items/{i}') for i in range(4)]
+
+        self.assertEqual(len({template_id for template_id, _ in decisions}), 1)
+        self.assertEqual([analyze for _, analyze in decisions], [True, True, False, False])
+        stats = index.stats()
+        self.assertEqual((stats['pages_full'], stats['pages_sampled_out'], stats['templates']), (2, 2, 1))
+
+    def test_different_structure_gets_its_own_template(self):
+        index = PageTemplateIndex(sample_size=1, max_distance=3)
+        index.classify(self.product_page(3), 'https://example.com/items/1')
+        login = ['0:>body', '1:body>form.login', '2:form.login>input', '2:form.login>input.password', '2:form.login>button']
+        _, analyze = index.classify(login * 4, 'https://example.com/login')
+        self.assertTrue(analyze)
+        self.assertEqual(index.stats()['templates'], 2)
+
+    def test_sample_size_zero_analyzes_every_page(self):
+        index = PageTemplateIndex(sample_size=0)
+        self.assertTrue(all(index.classify(self.product_page(3), f'https://example.com/items/{i}')[1] for i in range(5)))
+
+
+def _png(width: int, height: int) -> bytes:
+    """縦方向のグラデーションのPNG（知覚ハッシュが全て同じ値にならないように）"""
+    image = Image.linear_gradient('L').resize((width, height)).convert('RGB')
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+class ScreenshotPreprocessorTests(SimpleTestCase):
+    """LLMに送るスクリーンショットを縮小し、縦長のページは予算内の枚数のタイルに分けること"""
+
+    def setUp(self):
+        patcher = mock.patch.dict('os.environ', {'SCREENSHOT_LLM_MAX_WIDTH': '1280', 'SCREENSHOT_LLM_MIN_WIDTH': '768',
+                                                 'SCREENSHOT_LLM_PIXEL_BUDGET': '4000000',
+                                                 'SCREENSHOT_LLM_TILE_RATIO': '0.5625', 'SCREENSHOT_LLM_FORMAT': 'jpeg'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_viewport_screenshot_is_downscaled_into_one_tile(self):
+        prepared = prepare_screenshot(_png(1920, 1080))
+        self.assertEqual(prepared.summary['sent_size'], [1280, 720])
+        self.assertEqual(len(prepared.tiles), 1)
+        self.assertEqual(prepared.mime_type, 'image/jpeg')
+        self.assertEqual(Image.open(io.BytesIO(prepared.tiles[0])).size, (1280, 720))
+
+    def test_tall_page_is_tiled_within_pixel_budget(self):
+        prepared = prepare_screenshot(_png(1920, 20000))
+        # 予算を超えるので幅の下限768pxまで縮め、768x432のタイルを予算に収まる12枚まで上から送る
+        self.assertEqual(prepared.summary['sent_size'][0], 768)
+        self.assertEqual([Image.open(io.BytesIO(tile)).size for tile in prepared.tiles], [(768, 432)] * 12)
+        self.assertLessEqual(768 * 432 * len(prepared.tiles), 4000000)
+        self.assertTrue(prepared.summary['truncated'])
+        self.assertIn('省略', prepared.describe())
+
+    def test_perceptual_hash_ignores_reencoding(self):
+        original = _png(1280, 720)
+        reencoded = io.BytesIO()
+        Image.open(io.BytesIO(original)).save(reencoded, format='JPEG', quality=90)
+        self.assertEqual(prepare_screenshot(reencoded.getvalue()).phash, prepare_screenshot(original).phash)
+
+    def test_webp_format(self):
+        with mock.patch.dict('os.environ', {'SCREENSHOT_LLM_FORMAT': 'webp'}):
+            prepared = prepare_screenshot(_png(800, 600))
+        self.assertEqual(prepared.mime_type, 'image/webp')
+        self.assertEqual(prepared.parts()[0]['mime_type'], 'image/webp')
+
+
+class DomDistillerTests(SimpleTestCase):
+    """ページ構造のアウトラインをトークン予算内に収め、入りきらない要素は件数だけ残すこと"""
+
+    def _outline(self, links: int):
+        return {
+            'landmarks': {'items': [{'role': 'main', 'label': '', 'selector': 'main'}], 'total': 1},
+            'headings': {'items': [{'level': 'h1', 'text': 'ログイン'}], 'total': 1},
+            'forms': {'items': [{'selector': '#login', 'method': 'post', 'action': '/login', 'fields': [
+                {'tag': 'input', 'type': 'email', 'label': 'メール', 'selector': '#email', 'required': True}]}],
+                'total': 1},
+            'interactive': {'items': [{'tag': 'a', 'text': f'リンク{i}', 'href': f'/items/{i}', 'selector': f'#l{i}'}
+                                      for i in range(links)], 'total': links},
+            'text_blocks': {'items': [], 'total': 0},
+        }
+
+    def test_estimate_tokens(self):
+        self.assertEqual(estimate_tokens('abcdefgh'), 3)
+        self.assertEqual(estimate_tokens('ログイン'), 5)
+
+    def test_small_outline_is_kept_whole(self):
+        text = format_outline(self._outline(3), token_budget=1500)
+        self.assertIn('[フォーム]', text)
+        self.assertIn('input[email] "メール" (#email) 必須', text)
+        self.assertIn('-> /items/2 (#l2)', text)
+        self.assertNotIn('[省略]', text)
+
+    def test_large_outline_fits_budget_and_reports_omitted(self):
+        text = format_outline(self._outline(500), token_budget=300)
+        self.assertLessEqual(sum(estimate_tokens(line) for line in text.splitlines()), 300 + 20)
+        self.assertIn('(#l0)', text)
+        self.assertNotIn('(#l499)', text)
+        self.assertRegex(text, r'\[省略\] 操作可能な要素 \d+件')
+
+    def test_missing_outline(self):
+        self.assertEqual(format_outline(None), '（ページ構造を取得できませんでした）')
+
+
+class GeminiRateLimiterTests(SimpleTestCase):
+    """Redisがない場合のプロセス内のバケットで、RPM/TPMの枠・429後のクールダウン・セッション間の公平キューが効くこと"""
+
+    def _limiter(self, **env):
+        with mock.patch.dict('os.environ', {'GEMINI_RPM': '5', 'GEMINI_TPM': '10000', **env}), \
+                mock.patch('app.workers.gemini_rate_limiter.get_redis', side_effect=ConnectionError('no redis')):
+            limiter = GeminiRateLimiter()
+        self.assertIsNone(limiter.redis)
+        return limiter
+
+    def test_requests_per_minute(self):
+        limiter = self._limiter()
+        self.assertTrue(all(limiter.try_acquire('gemini-test', 100) for _ in range(5)))
+        self.assertFalse(limiter.try_acquire('gemini-test', 100))
+        # 別モデルのバケットは独立している
+        self.assertTrue(limiter.try_acquire('models/gemini-other', 100))
+        self.assertEqual(limiter.stats()['backend'], 'local')
+
+    def test_tokens_per_minute(self):
+        limiter = self._limiter()
+        self.assertTrue(limiter.try_acquire('gemini-test', 9000))
+        self.assertFalse(limiter.try_acquire('gemini-test', 2000))
+        self.assertTrue(limiter.try_acquire('gemini-test', 1000))
+
+    def test_model_override(self):
+        limiter = self._limiter(GEMINI_RATE_LIMITS='gemini-pro=2:32000')
+        self.assertEqual(limiter.limits_for('gemini-pro'), (2.0, 32000.0))
+        self.assertEqual(limiter.limits_for('gemini-test'), (5.0, 10000.0))
+
+    def test_throttled_backs_off_exponentially(self):
+        limiter = self._limiter()
+        self.assertEqual(limiter.report_throttled('gemini-test'), 2.0)
+        self.assertEqual(limiter.report_throttled('gemini-test'), 4.0)
+        self.assertFalse(limiter.try_acquire('gemini-test', 1))
+        self.assertEqual(limiter.stats()['throttled'], 2)
+
+    def test_acquire_times_out(self):
+        limiter = self._limiter(GEMINI_RPM='1', GEMINI_RATE_LIMIT_MAX_WAIT_SECONDS='0.5')
+        self.assertLess(limiter.acquire('gemini-test', 10, session_id='s1'), 0.1)
+        with self.assertRaises(RateLimitTimeout):
+            limiter.acquire('gemini-test', 10, session_id='s1')
+        self.assertEqual(limiter.stats()['timeouts'], 1)
+
+    def test_fair_queue_serves_least_recently_served_session(self):
+        buckets = _LocalBuckets()
+        clock = [1000.0]
+
+        def acquire(session):
+            return buckets.acquire('gemini-test', session, 1, 1, 10000, 5.0, 60.0)[0]
+
+        with mock.patch('app.workers.gemini_rate_limiter.time.time', side_effect=lambda: clock[0]):
+            self.assertTrue(acquire('busy'))
+            clock[0] += 1
+            self.assertFalse(acquire('busy'))
+            self.assertFalse(acquire('quiet'))
+            # 1リクエスト分の枠が戻るまで両方が待ち続けると、先に待っていたbusyではなく長く枠を得ていないquietが先に通る
+            for _ in range(20):
+                clock[0] += 4
+                self.assertFalse(acquire('busy'))
+                if acquire('quiet'):
+                    break
+            else:
+                self.fail('quiet was never served')
+            self.assertGreaterEqual(clock[0], 1060)
+
+
+class _ScriptedGeminiModel:
+    """呼ばれた順に、(遅延秒数, 例外または応答テキスト)の台本どおりに振る舞うgenai.GenerativeModelの代わり"""
+
+    def __init__(self, *script):
+        self.script = list(script)
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def generate_content(self, contents, request_options=None, **kwargs):
+        with self._lock:
+            delay, outcome = self.script[min(self.calls, len(self.script) - 1)]
+            self.calls += 1
+        time.sleep(delay)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return SimpleNamespace(text=outcome, usage_metadata=None)
+
+
+class GeminiClientTests(SimpleTestCase):
+    """Gemini呼び出しの期限・再試行・サーキットブレーカー・ヘッジ"""
+
+    def _client(self, model, **env):
+        with mock.patch.dict('os.environ', {'LLM_TRANSPORT_MODE': 'live', 'GEMINI_RETRY_BACKOFF_SECONDS': '0.01',
+                                            'GEMINI_HEDGE': 'false', **env}), \
+                mock.patch('app.workers.gemini_client.get_gemini_rate_limiter'), \
+                mock.patch('app.workers.gemini_client.get_llm_transport', LLMTransport):
+            client = GeminiClient('gemini-test')
+        client.model = model
+        return client
+
+    def test_transient_error_is_retried(self):
+        client = self._client(_ScriptedGeminiModel((0, api_exceptions.ServiceUnavailable('busy')), (0, '{"ok": true}')))
+        value, result = client.generate_json(['prompt'], {'type': 'object'}, 'test')
+        self.assertEqual(value, {'ok': True})
+        self.assertEqual(result.attempts, 2)
+        self.assertEqual(client.stats()['retries'], 1)
+
+    def test_prompt_error_is_not_retried(self):
+        model = _ScriptedGeminiModel((0, api_exceptions.InvalidArgument('bad prompt')))
+        client = self._client(model)
+        with self.assertRaises(api_exceptions.InvalidArgument):
+            client.generate(['prompt'])
+        self.assertEqual(model.calls, 1)
+        self.assertEqual(client.breaker.state(), 'closed')
+
+    def test_hung_attempt_times_out(self):
+        client = self._client(_ScriptedGeminiModel((1.0, 'late')), GEMINI_ATTEMPT_TIMEOUT_SECONDS='0.1',
+                              GEMINI_MAX_ATTEMPTS='1')
+        started = time.monotonic()
+        with self.assertRaises(GeminiTimeout):
+            client.generate(['prompt'])
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertEqual(client.stats()['timeouts'], 1)
+
+    def test_breaker_opens_after_consecutive_failures(self):
+        model = _ScriptedGeminiModel((0, api_exceptions.ServiceUnavailable('down')))
+        client = self._client(model, GEMINI_MAX_ATTEMPTS='1', GEMINI_BREAKER_FAILURES='2')
+        for _ in range(2):
+            with self.assertRaises(api_exceptions.ServiceUnavailable):
+                client.generate(['prompt'])
+        self.assertFalse(client.available())
+        with self.assertRaises(GeminiUnavailable):
+            client.generate(['prompt'])
+        self.assertEqual(model.calls, 2)
+        self.assertEqual(client.stats()['short_circuited'], 1)
+
+        # 開いている時間が過ぎたら1件だけ試し、成功すれば閉じる
+        client.breaker.open_seconds = 0
+        model.script = [(0, 'ok')]
+        self.assertEqual(client.generate(['prompt']).text, 'ok')
+        self.assertEqual(client.breaker.state(), 'closed')
+
+    def test_slow_call_is_hedged(self):
+        client = self._client(_ScriptedGeminiModel((1.0, 'primary'), (0, 'hedge')), GEMINI_HEDGE='true',
+                              GEMINI_HEDGE_MIN_SAMPLES='1')
+        client._latencies.append(0.05)
+        result = client.generate(['prompt'])
+        self.assertEqual(result.text, 'hedge')
+        self.assertTrue(result.hedged)
+        self.assertEqual(client.stats()['hedges_won'], 1)
+
+
+class ParseLlmJsonTests(SimpleTestCase):
+    """LLMの応答のJSONを、フェンス・前後の文章・末尾のカンマ・途中での切断があっても読むこと"""
+
+    def test_plain_json(self):
+        self.assertEqual(parse_llm_json('{"issues": []}', 'test-plain'), {'issues': []})
+        self.assertEqual(get_parse_stats().stats()['test-plain']['parsed'], 1)
+
+    def test_fenced_json_with_prose(self):
+        text = '分析結果です。\n```json\n{"issues": [{"type": "layout"}]}\n```\n以上です。'
+        self.assertEqual(parse_llm_json(text, 'test-fenced'), {'issues': [{'type': 'layout'}]})
+        self.assertEqual(get_parse_stats().stats()['test-fenced']['repaired'], 1)
+
+    def test_trailing_commas(self):
+        self.assertEqual(parse_llm_json('{"actions": [1, 2,], }', 'test-comma'), {'actions': [1, 2]})
+
+    def test_truncated_inside_string(self):
+        text = '{"issues": [{"type": "layout", "description": "ボタンが重な'
+        self.assertEqual(parse_llm_json(text, 'test-truncated'),
+                         {'issues': [{'type': 'layout', 'description': 'ボタンが重な'}]})
+
+    def test_truncated_after_key(self):
+        self.assertEqual(parse_llm_json('{"score": 3, "actions": [{"type": "click"}], "next": ', 'test-cut'),
+                         {'score': 3, 'actions': [{'type': 'click'}]})
+        self.assertEqual(parse_llm_json('[{"url": "/a"}, {"url": "/b', 'test-cut', expect=list),
+                         [{'url': '/a'}, {'url': '/b'}])
+        self.assertEqual(get_parse_stats().stats()['test-cut']['repaired'], 2)
+
+    def test_failures_are_counted(self):
+        self.assertIsNone(parse_llm_json('JSONを返せませんでした', 'test-failed'))
+        self.assertIsNone(parse_llm_json('[1, 2]', 'test-failed', expect=dict))
+        self.assertIsNone(parse_llm_json(None, 'test-failed'))
+        stats = get_parse_stats().stats()['test-failed']
+        self.assertEqual(stats['failed'], 3)
+        self.assertEqual(stats['failure_rate'], 1.0)
+
+
+class LLMTransportRequestKeyTests(SimpleTestCase):
+    """記録のキーが実行ごとに変わらず、記録した応答を同じ内容のリクエストで再生できること"""
+
+    def setUp(self):
+        cassette_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cassette_dir.cleanup)
+        self.cassette_dir = cassette_dir.name
+
+    def _transport(self, mode: str, **env) -> LLMTransport:
+        with mock.patch.dict('os.environ', {'LLM_TRANSPORT_MODE': mode, 'LLM_CASSETTE_DIR': self.cassette_dir, **env}):
+            return LLMTransport()
+
+    def test_request_key_normalization(self):
+        image = Image.new('RGB', (8, 8), 'red')
+        key = request_key('gemini', {'contents': ['prompt', image, b'\x89PNG'], 'config': {'a': 1, 'b': (2, 3)}})
+        self.assertEqual(key, request_key('gemini', {'config': {'b': [2, 3], 'a': 1},
+                                                     'contents': ['prompt', Image.new('RGB', (8, 8), 'red'), b'\x89PNG']}))
+        self.assertNotEqual(key, request_key('gemini', {'contents': ['prompt', image, b'\x89PNG!'],
+                                                        'config': {'a': 1, 'b': (2, 3)}}))
+        self.assertNotEqual(key, request_key('dify', {'contents': ['prompt', image, b'\x89PNG'],
+                                                      'config': {'a': 1, 'b': (2, 3)}}))
+
+    def test_record_then_replay(self):
+        config = {'generation_config': {'response_mime_type': 'application/json', 'temperature': 0}}
+        model = _ScriptedGeminiModel((0, '{"issues": []}'))
+        recorder = self._transport('record')
+        recorder.generate_content(model, 'gemini-test', ['prompt', b'screenshot'], {'timeout': 60}, config)
+        self.assertEqual(recorder.stats()['recorded'], 1)
+
+        # 別プロセスで同じ内容を組み立て直しても（タイムアウトなどの送信オプションが違っても）再生できる
+        replayer = self._transport('replay')
+        response = replayer.generate_content(None, 'gemini-test', ['prompt', bytearray(b'screenshot')], {'timeout': 5},
+                                             {'generation_config': {'temperature': 0,
+                                                                    'response_mime_type': 'application/json'}})
+        self.assertEqual(response.text, '{"issues": []}')
+        self.assertEqual(model.calls, 1)
+        with self.assertRaises(ReplayMiss):
+            replayer.generate_content(None, 'gemini-test', ['prompt', b'other screenshot'], {}, config)
+        self.assertEqual(replayer.stats()['replayed'], 1)
+        self.assertEqual(replayer.stats()['misses'], 1)
+
+    def test_replay_miss_can_fall_back_to_schema(self):
+        replayer = self._transport('replay', LLM_REPLAY_ON_MISS='synthetic')
+        schema = {'type': 'object', 'properties': {'issues': {'type': 'array', 'items': {'type': 'string'}}}}
+        response = replayer.generate_content(None, 'gemini-test', ['prompt'], {},
+                                             {'generation_config': {'response_schema': schema}})
+        self.assertEqual(json.loads(response.text), {'issues': ['synthetic']})
+
+
+class LLMTelemetryTests(SimpleTestCase):
+    """LLM呼び出しの記録が、並行するセッションごとにプロンプト別・パーセンタイル付きで集計されること"""
+
+    def setUp(self):
+        with mock.patch.dict('os.environ', {'LLM_TELEMETRY_MAX_SESSIONS': '3'}):
+            self.telemetry = LLMTelemetry()
+
+    def test_session_summary(self):
+        def crawl(session_id):
+            set_llm_session(session_id)
+            for i in range(1, 101):
+                self.telemetry.record('gemini', 'gemini-test', 'page_analysis', i, 'ok', input_tokens=100,
+                                      output_tokens=20, image_bytes=image_bytes_of(['prompt', {'data': b'x' * 10}]))
+            self.telemetry.record('dify', 'dify', 'answer', 500, 'timeout')
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            list(executor.map(crawl, ['session-a', 'session-b']))
+
+        summary = self.telemetry.session_summary('session-a')
+        self.assertEqual(summary['calls'], 101)
+        self.assertEqual(summary['outcomes'], {'ok': 100, 'timeout': 1})
+        analysis = summary['by_prompt']['gemini:page_analysis']
+        self.assertEqual(analysis['total_tokens'], 12000)
+        self.assertEqual(analysis['image_bytes'], 1000)
+        self.assertEqual(analysis['latency_ms'], {'p50': 51, 'p95': 96, 'p99': 100, 'max': 100})
+        self.assertEqual(summary['by_prompt']['dify:answer']['outcomes'], {'timeout': 1})
+        # 取り出したセッションの記録は破棄され、別セッションの記録は残る
+        self.assertEqual(self.telemetry.session_summary('session-a')['calls'], 0)
+        self.assertEqual(self.telemetry.session_summary('session-b', pop=False)['calls'], 101)
+        self.assertEqual(self.telemetry.stats()['calls'], 202)
+
+    def test_unclaimed_sessions_are_evicted(self):
+        for i in range(5):
+            self.telemetry.record('gemini', 'gemini-test', 'page_analysis', 10, 'ok', session_id=f'session-{i}')
+        self.assertEqual(self.telemetry.session_summary('session-0')['calls'], 0)
+        self.assertEqual(self.telemetry.session_summary('session-4')['calls'], 1)
+
+
+# JobQueueのテストで使う表（prisma/migrationsのJobQueue・TestSession・TestSessionLogのうち、ワーカーが読み書きする列）
+_JOB_QUEUE_SCHEMA = """
+CREATE TABLE "TestSession" (
+    "id" TEXT PRIMARY KEY,
+    "status" TEXT NOT NULL DEFAULT 'running',
+    "completed_at" TIMESTAMP(3),
+    "error_message" TEXT
+);
+CREATE TABLE "TestSessionLog" (
+    "id" TEXT PRIMARY KEY,
+    "test_session_id" TEXT NOT NULL,
+    "log_level" TEXT NOT NULL,
+    "message" TEXT NOT NULL,
+    "metadata" JSONB,
+    "created_at" TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE "JobQueue" (
+    "id" TEXT PRIMARY KEY,
+    "type" TEXT NOT NULL,
+    "status" TEXT NOT NULL DEFAULT 'pending',
+    "priority" INTEGER NOT NULL DEFAULT 5,
+    "payload" JSONB NOT NULL,
+    "result" JSONB,
+    "error" TEXT,
+    "attempts" INTEGER NOT NULL DEFAULT 0,
+    "max_attempts" INTEGER NOT NULL DEFAULT 3,
+    "scheduled_at" TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    "started_at" TIMESTAMP(3),
+    "completed_at" TIMESTAMP(3),
+    "created_at" TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    "updated_at" TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    "test_session_id" TEXT,
+    "lease_expires_at" TIMESTAMP(3),
+    "worker_id" TEXT,
+    "heartbeat_at" TIMESTAMP(3)
+);
+"""
+
+
+@skipUnless(os.getenv('TEST_DATABASE_URL'), 'TEST_DATABASE_URL（PostgreSQLの接続URL）が未設定')
+class JobQueueDatabaseTestCase(SimpleTestCase):
+    """TEST_DATABASE_URLのPostgreSQLに使い捨てのスキーマを作り、JobQueueを読み書きするテストの基底クラス"""
+
+    def setUp(self):
+        self.schema = f'test_job_queue_{uuid.uuid4().hex[:12]}'
+        with psycopg2.connect(os.environ['TEST_DATABASE_URL']) as conn, conn.cursor() as cursor:
+            cursor.execute(f'CREATE SCHEMA "{self.schema}"')
+            cursor.execute(f'SET search_path TO "{self.schema}"')
+            cursor.execute(_JOB_QUEUE_SCHEMA)
+        self.addCleanup(self._drop_schema)
+
+    def _drop_schema(self):
+        with psycopg2.connect(os.environ['TEST_DATABASE_URL']) as conn, conn.cursor() as cursor:
+            cursor.execute(f'DROP SCHEMA "{self.schema}" CASCADE')
+
+    def connect(self):
+        conn = psycopg2.connect(os.environ['TEST_DATABASE_URL'], options=f'-c search_path={self.schema}')
+        self.addCleanup(conn.close)
+        return conn
+
+    def add_jobs(self, count: int, job_type: str = 'test_execution', **columns):
+        with self.connect() as conn, conn.cursor() as cursor:
+            for i in range(count):
+                cursor.execute(f"""
+                    INSERT INTO "JobQueue" (id, type, payload, created_at{''.join(f', {name}' for name in columns)})
+                    VALUES (%s, %s, '{{}}', NOW() + make_interval(secs => %s){', %s' * len(columns)})
+                """, [f'{job_type}-{i}', job_type, i / 1000, *columns.values()])
+
+    def jobs(self) -> dict:
+        with self.connect() as conn, conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute('SELECT * FROM "JobQueue" ORDER BY id')
+            return {job['id']: job for job in cursor.fetchall()}
+
+
+class JobQueueClaimTests(JobQueueDatabaseTestCase):
+    """2つのワーカーが同時に取得しても同じジョブを取らず、リースを持つワーカーの書き込みだけが反映されること"""
+
+    def test_concurrent_workers_never_claim_the_same_job(self):
+        self.add_jobs(40)
+
+        def work(worker):
+            conn = self.connect()
+            claimed = []
+            while True:
+                jobs = claim_jobs(conn, worker, limit=3)
+                if not jobs:
+                    return claimed
+                claimed += [job['id'] for job in jobs]
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            first, second = executor.map(work, ['worker-1', 'worker-2'])
+
+        self.assertFalse(set(first) & set(second))
+        self.assertEqual(len(first) + len(second), 40)
+        jobs = self.jobs()
+        self.assertTrue(all(job['status'] == 'processing' and job['attempts'] == 1 for job in jobs.values()))
+        self.assertEqual({jobs[job_id]['worker_id'] for job_id in first}, {'worker-1'})
+        self.assertTrue(all(job['lease_expires_at'] > job['started_at'] for job in jobs.values()))
+
+    def test_locked_rows_are_skipped_without_waiting(self):
+        self.add_jobs(2)
+        holder = self.connect()
+        with holder.cursor() as cursor:
+            # 別のワーカーがtest_execution-0を選択中（コミット前）
+            cursor.execute('SELECT id FROM "JobQueue" WHERE id = %s FOR UPDATE', ('test_execution-0',))
+            started = time.monotonic()
+            jobs = claim_jobs(self.connect(), 'worker-2', limit=2)
+            self.assertLess(time.monotonic() - started, 1)
+        holder.rollback()
+        self.assertEqual([job['id'] for job in jobs], ['test_execution-1'])
+
+    def test_priority_and_max_running(self):
+        self.add_jobs(3)
+        self.add_jobs(1, job_type='bug_analysis', priority=1)
+        conn = self.connect()
+        self.assertEqual([job['id'] for job in claim_jobs(conn, 'worker-1', limit=2)],
+                         ['bug_analysis-0', 'test_execution-0'])
+        # test_executionは全ワーカー合計で2件まで
+        self.assertEqual(len(claim_jobs(conn, 'worker-2', limit=5, job_types=['test_execution'], max_running=2)), 1)
+        self.assertEqual(claim_jobs(conn, 'worker-2', limit=5, job_types=['test_execution'], max_running=2), [])
+
+    def test_only_the_lease_holder_can_renew_and_complete(self):
+        self.add_jobs(1)
+        conn = self.connect()
+        job = claim_jobs(conn, 'worker-1', lease=60)[0]
+        self.assertEqual(renew_leases(conn, [job['id']], 'worker-2'), [])
+        self.assertTrue(renew_lease(conn, job['id'], 'worker-1', lease=600))
+        with conn.cursor() as cursor:
+            self.assertFalse(complete_job(cursor, job['id'], 'worker-2', {'ok': True}))
+            self.assertTrue(complete_job(cursor, job['id'], 'worker-1', {'ok': True}))
+        conn.commit()
+        completed = self.jobs()[job['id']]
+        self.assertEqual((completed['status'], completed['result']), ('completed', {'ok': True}))
+        self.assertIsNone(completed['lease_expires_at'])
+
+    def test_failed_job_is_requeued_until_max_attempts(self):
+        self.add_jobs(1, max_attempts=2)
+        conn = self.connect()
+        for status in ('pending', 'failed'):
+            job = claim_jobs(conn, 'worker-1')[0]
+            with conn.cursor() as cursor:
+                self.assertTrue(fail_job(cursor, job, 'worker-1', 'browser crashed'))
+            conn.commit()
+            self.assertEqual(self.jobs()[job['id']]['status'], status)
+        self.assertEqual(claim_jobs(conn, 'worker-1'), [])
+
+
+class JobQueueReaperTests(JobQueueDatabaseTestCase):
+    """ハートビートが途絶えたジョブだけが回収され、max_attemptsに応じて再実行待ちか失敗になること"""
+
+    def expire(self, *job_ids):
+        with self.connect() as conn, conn.cursor() as cursor:
+            cursor.execute("""
+                UPDATE "JobQueue" SET lease_expires_at = NOW() - INTERVAL '1 second' WHERE id = ANY(%s)
+            """, (list(job_ids),))
+
+    def test_only_expired_leases_are_reaped_and_reclaimed(self):
+        self.add_jobs(2)
+        first = self.connect()
+        self.assertEqual(len(claim_jobs(first, 'worker-1', limit=2)), 2)
+        # worker-1はtest_execution-0のハートビートを続け、test_execution-1のハートビートは途絶えた
+        self.expire('test_execution-0', 'test_execution-1')
+        self.assertEqual(renew_leases(first, ['test_execution-0'], 'worker-1'), ['test_execution-0'])
+
+        reaper = self.connect()
+        with reaper.cursor(cursor_factory=RealDictCursor) as cursor:
+            reaped = reap_expired_jobs(cursor)
+        reaper.commit()
+        self.assertEqual([(job['id'], job['status'], job['lost_worker_id']) for job in reaped],
+                         [('test_execution-1', 'pending', 'worker-1')])
+
+        second = self.connect()
+        job = claim_jobs(second, 'worker-2')[0]
+        self.assertEqual((job['id'], job['attempts']), ('test_execution-1', 2))
+        # 回収された後に戻ってきたworker-1の延長と完了は反映されない
+        self.assertEqual(renew_leases(first, ['test_execution-1'], 'worker-1'), [])
+        with first.cursor() as cursor:
+            self.assertFalse(complete_job(cursor, 'test_execution-1', 'worker-1', None))
+        first.commit()
+        self.assertEqual(self.jobs()['test_execution-1']['worker_id'], 'worker-2')
+
+    def test_job_out_of_attempts_is_failed(self):
+        self.add_jobs(1, max_attempts=1)
+        claim_jobs(self.connect(), 'worker-1')
+        self.expire('test_execution-0')
+        with self.connect() as conn, conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            self.assertEqual(reap_expired_jobs(cursor)[0]['status'], 'failed')
+        job = self.jobs()['test_execution-0']
+        self.assertEqual(job['status'], 'failed')
+        self.assertIn('worker-1 stopped heartbeating', job['error'])
+        self.assertIsNotNone(job['completed_at'])
+
+    def test_rows_claimed_before_leases_expire_after_lease_seconds(self):
+        self.add_jobs(2, status='processing')
+        with self.connect() as conn, conn.cursor() as cursor:
+            cursor.execute("""
+                UPDATE "JobQueue" SET started_at = NOW() - INTERVAL '10 minutes', attempts = 1
+                WHERE id = 'test_execution-0'
+            """)
+            cursor.execute('UPDATE "JobQueue" SET started_at = NOW() WHERE id = \'test_execution-1\'')
+        with mock.patch.dict('os.environ', {'JOB_LEASE_SECONDS': '300'}), \
+                self.connect() as conn, conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            self.assertEqual([job['id'] for job in reap_expired_jobs(cursor)], ['test_execution-0'])
+
+    def test_reaper_task_logs_to_the_test_session(self):
+        with self.connect() as conn, conn.cursor() as cursor:
+            cursor.execute('INSERT INTO "TestSession" (id) VALUES (\'session-1\'), (\'session-2\')')
+        self.add_jobs(1, job_type='retry', test_session_id='session-1')
+        self.add_jobs(1, job_type='final', test_session_id='session-2', max_attempts=1)
+        claim_jobs(self.connect(), 'worker-1', limit=2)
+        self.expire('retry-0', 'final-0')
+
+        with mock.patch.object(job_queue_sync, 'get_db_connection', return_value=nullcontext(self.connect())):
+            self.assertEqual(job_queue_sync.reap_stuck_jobs(), 2)
+
+        with self.connect() as conn, conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute('SELECT test_session_id, log_level, metadata FROM "TestSessionLog" ORDER BY test_session_id')
+            logs = cursor.fetchall()
+            cursor.execute('SELECT id, status FROM "TestSession" ORDER BY id')
+            sessions = cursor.fetchall()
+        self.assertEqual([(log['test_session_id'], log['log_level']) for log in logs],
+                         [('session-1', 'warning'), ('session-2', 'error')])
+        self.assertEqual(logs[0]['metadata']['worker_id'], 'worker-1')
+        self.assertEqual(logs[0]['metadata']['attempts'], 1)
+        self.assertEqual([(session['id'], session['status']) for session in sessions],
+                         [('session-1', 'running'), ('session-2', 'failed')])
+
+
+# prisma/migrations/20261018120000_add_job_queue_notify_trigger と同じトリガー
+_JOB_QUEUE_NOTIFY_TRIGGER = """
+CREATE FUNCTION "notify_job_queue"() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('job_queue', json_build_object('id', NEW.id, 'type', NEW.type)::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+CREATE TRIGGER "JobQueue_notify_insert" AFTER INSERT ON "JobQueue"
+    FOR EACH ROW WHEN (NEW.status = 'pending') EXECUTE FUNCTION "notify_job_queue"();
+CREATE TRIGGER "JobQueue_notify_requeue" AFTER UPDATE OF status ON "JobQueue"
+    FOR EACH ROW WHEN (NEW.status = 'pending' AND OLD.status IS DISTINCT FROM 'pending')
+    EXECUTE FUNCTION "notify_job_queue"();
+"""
+
+
+class JobQueueDispatcherTests(JobQueueDatabaseTestCase):
+    """JobQueueへの追加と再実行待ちへの戻しのNOTIFYで、タイプ別のタスクがすぐに送られること"""
+
+    def setUp(self):
+        super().setUp()
+        with self.connect() as conn, conn.cursor() as cursor:
+            cursor.execute(_JOB_QUEUE_NOTIFY_TRIGGER)
+        self.sent = []
+        self.dispatcher = JobQueueDispatcher(dispatch=lambda counts: self.sent.append(dict(counts)) or len(counts))
+        self.dispatcher.reconnect_seconds = 0.1
+        dsn = extensions.make_dsn(os.environ['TEST_DATABASE_URL'], options=f'-c search_path={self.schema}')
+        patcher = mock.patch('app.job_dispatcher.get_database_url', return_value=dsn)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def start(self):
+        thread = threading.Thread(target=self.dispatcher.run, daemon=True)
+        thread.start()
+
+        def stop():
+            self.dispatcher.stop()
+            thread.join(5)
+        self.addCleanup(stop)
+
+    def wait_for(self, count: int):
+        deadline = time.monotonic() + 5
+        while len(self.sent) < count and time.monotonic() < deadline:
+            time.sleep(0.02)
+        self.assertEqual(len(self.sent), count, self.sent)
+
+    def test_pending_jobs_are_dispatched_on_connect_and_on_notify(self):
+        self.add_jobs(2)
+        self.start()
+        # 接続時に、LISTENする前から保留中だったジョブを振り分ける
+        self.wait_for(1)
+        self.assertEqual(self.sent[0], {'test_execution': 2})
+
+        # 1つのトランザクションで追加された3件の通知は、まとめて1回で送る
+        self.add_jobs(3, job_type='bug_analysis')
+        self.wait_for(2)
+        self.assertEqual(self.sent[1], {'bug_analysis': 3})
+
+        conn = self.connect()
+        job = claim_jobs(conn, 'worker-1', job_types=['test_execution'])[0]
+        self.assertEqual(len(self.sent), 2)
+        with conn.cursor() as cursor:
+            fail_job(cursor, job, 'worker-1', 'browser crashed')
+        conn.commit()
+        self.wait_for(3)
+        self.assertEqual(self.sent[2], {'test_execution': 1})
+        self.assertEqual(self.dispatcher.stats(), {'notifications': 4, 'tasks_sent': 3, 'reconnects': 0})
+
+    def test_unknown_payload_recounts_pending_jobs(self):
+        self.add_jobs(1)
+        self.start()
+        self.wait_for(1)
+        with self.connect() as conn, conn.cursor() as cursor:
+            cursor.execute("SELECT pg_notify('job_queue', 'not json')")
+        self.wait_for(2)
+        self.assertEqual(self.sent[1], {'test_execution': 1})
+
+
+class JobPoolsTests(SimpleTestCase):
+    """ジョブタイプごとのキューと同時実行数の上限までのタスクの振り分け"""
+
+    def test_queue_and_concurrency(self):
+        self.assertEqual(job_pools.queue_for('report_generation'), 'jobs.report_generation')
+        self.assertEqual(job_pools.queue_for('mystery'), 'celery')
+        self.assertEqual(job_pools.concurrency_for('bug_analysis'), 4)
+        self.assertEqual(job_pools.concurrency_for('mystery'), 1)
+        with mock.patch.dict('os.environ', {'JOB_POOL_TEST_EXECUTION_CONCURRENCY': '6'}):
+            self.assertEqual(job_pools.concurrency_for('test_execution'), 6)
+
+    def test_dispatch_sends_at_most_concurrency_tasks_per_type(self):
+        with mock.patch.object(job_queue_sync, 'process_job_queue') as task:
+            sent = job_pools.dispatch({'test_execution': 5, 'bug_analysis': 1, 'mystery': 3})
+        self.assertEqual(sent, 4)
+        queues = [call.kwargs['queue'] for call in task.apply_async.call_args_list]
+        self.assertEqual(queues, ['jobs.test_execution', 'jobs.test_execution', 'jobs.bug_analysis', 'celery'])
+        self.assertEqual(task.apply_async.call_args_list[2].kwargs['kwargs'], {'job_type': 'bug_analysis'})
+
+
+class JobPoolsDatabaseTests(JobQueueDatabaseTestCase):
+    """長いtest_executionが上限まで動いていても他のタイプを取得でき、タイプ別の待ち時間がSLOと比べて集計されること"""
+
+    def test_long_crawls_do_not_block_other_types(self):
+        self.add_jobs(3)
+        self.add_jobs(2, job_type='bug_analysis')
+        conn = self.connect()
+        with mock.patch.dict('os.environ', {'JOB_POOL_TEST_EXECUTION_CONCURRENCY': '2'}):
+            limit = job_pools.concurrency_for('test_execution')
+        running = [claim_jobs(conn, f'worker-{i}', job_types=['test_execution'], max_running=limit) for i in range(3)]
+        self.assertEqual([len(jobs) for jobs in running], [1, 1, 0])
+        jobs = claim_jobs(conn, 'worker-3', limit=2, job_types=['bug_analysis'],
+                          max_running=job_pools.concurrency_for('bug_analysis'))
+        self.assertEqual(len(jobs), 2)
+
+    def test_slo_metrics(self):
+        with self.connect() as conn, conn.cursor() as cursor:
+            # bug_analysis: 10秒待ちと100秒待ちで開始し、それぞれ20秒・40秒で完了した
+            for i, (wait, run) in enumerate(((10, 20), (100, 40))):
+                cursor.execute("""
+                    INSERT INTO "JobQueue" (id, type, status, payload, created_at, started_at, completed_at)
+                    VALUES (%s, 'bug_analysis', 'completed', '{}', NOW() - make_interval(secs => %s),
+                            NOW() - make_interval(secs => %s), NOW() - make_interval(secs => %s))
+                """, (f'bug_analysis-{i}', 200, 200 - wait, 200 - wait - run))
+            # test_execution: 200秒前から保留中
+            cursor.execute("""
+                INSERT INTO "JobQueue" (id, type, payload, updated_at)
+                VALUES ('test_execution-0', 'test_execution', '{}', NOW() - INTERVAL '200 seconds')
+            """)
+            with conn.cursor(cursor_factory=RealDictCursor) as dict_cursor:
+                metrics = job_pools.slo_metrics(dict_cursor, window_seconds=3600)
+
+        analysis = metrics['bug_analysis']
+        self.assertEqual((analysis['started'], analysis['completed']), (2, 2))
+        self.assertEqual(analysis['wait_seconds'], {'p50': 55.0, 'p95': 95.5, 'p99': 99.1, 'max': 100.0})
+        self.assertEqual(analysis['run_seconds']['max'], 40.0)
+        self.assertEqual(analysis['slo_met_ratio'], 0.5)
+        self.assertTrue(analysis['slo_breached'])
+
+        crawl = metrics['test_execution']
+        self.assertEqual((crawl['queue'], crawl['pending'], crawl['started']), ('jobs.test_execution', 1, 0))
+        self.assertGreaterEqual(crawl['oldest_pending_seconds'], 200)
+        self.assertTrue(crawl['slo_breached'])
+        self.assertFalse(metrics['report_generation']['slo_breached'])
+
+
+class _FakePreloadPrisma:
+    async def connect(self):
+        pass
+
+    async def disconnect(self):
+        pass
+
+
+class _FakeEnhancedTestExecutor:
+    """modeで振る舞いを選ぶEnhancedTestExecutorの代わり（ワーカープロセス内で動く）"""
+
+    def __init__(self, prisma):
+        self.prisma = prisma
+
+    def execute(self, session_id, mode, url, scenario_id):
+        if mode == 'sleep':
+            time.sleep(float(url))
+        elif mode == 'error':
+            raise ValueError('browser crashed')
+        elif mode == 'exit':
+            os._exit(1)
+        elif mode == 'large':
+            return {'session': session_id, 'pid': os.getpid(), 'html': 'x' * 100000}
+        return {'session': session_id, 'pid': os.getpid()}
+
+
+class TestExecutorPoolTests(SimpleTestCase):
+    """起動済みのワーカーを使い回し、N件ごと・タイムアウト・クラッシュ時に作り直すこと"""
+
+    def setUp(self):
+        spool_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(spool_dir.cleanup)
+        self.spool_dir = spool_dir.name
+        preload = ModuleType('app.tests_preload')
+        preload.Prisma = _FakePreloadPrisma
+        preload.EnhancedTestExecutor = _FakeEnhancedTestExecutor
+        patches = [
+            # forkで作るワーカーは、ここで登録したモジュールをそのまま引き継ぐ
+            mock.patch.dict(sys.modules, {'app.tests_preload': preload}),
+            mock.patch.object(test_executor_pool, 'PRELOAD_MODULE', 'app.tests_preload'),
+            mock.patch.dict('os.environ', {'TEST_EXECUTOR_POOL_START_METHOD': 'fork',
+                                           'TEST_EXECUTOR_POOL_SPOOL_DIR': self.spool_dir,
+                                           'TEST_EXECUTOR_POOL_START_TIMEOUT': '10'}),
+        ]
+        for patcher in patches:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def pool(self, **kwargs) -> TestExecutorPool:
+        pool = TestExecutorPool(**kwargs)
+        self.addCleanup(pool.shutdown)
+        return pool
+
+    def test_workers_are_reused_then_recycled(self):
+        pool = self.pool(size=1, max_tasks_per_worker=2, timeout=10)
+        pids = [pool.run(f'session-{i}', 'ok', 'https://example.com')['pid'] for i in range(3)]
+        self.assertEqual(pids[0], pids[1])
+        self.assertNotEqual(pids[1], pids[2])
+        self.assertNotIn(os.getpid(), pids)
+        stats = pool.stats()
+        self.assertEqual((stats['tasks'], stats['spawns'], stats['recycles'], stats['workers']), (3, 2, 1, 1))
+
+    def test_hung_test_times_out_and_worker_is_replaced(self):
+        pool = self.pool(size=1, timeout=10)
+        pid = pool.run('session-1', 'ok', '')['pid']
+        started = time.monotonic()
+        with self.assertRaises(TimeoutError):
+            pool.run('session-2', 'sleep', '30', timeout=0.3)
+        # 応答しないワーカーの終了は待たない
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertNotEqual(pool.run('session-3', 'ok', '')['pid'], pid)
+        self.assertEqual(pool.stats()['timeouts'], 1)
+
+    def test_failed_test_keeps_the_worker(self):
+        pool = self.pool(size=1, timeout=10)
+        pid = pool.run('session-1', 'ok', '')['pid']
+        with self.assertRaisesRegex(TestExecutionError, 'ValueError: browser crashed'):
+            pool.run('session-2', 'error', '')
+        self.assertEqual(pool.run('session-3', 'ok', '')['pid'], pid)
+        self.assertEqual(pool.stats()['failures'], 1)
+
+    def test_crashed_worker_is_replaced(self):
+        pool = self.pool(size=1, timeout=10)
+        with self.assertRaisesRegex(TestExecutionError, 'exited'):
+            pool.run('session-1', 'exit', '')
+        self.assertEqual(pool.run('session-2', 'ok', '')['session'], 'session-2')
+        self.assertEqual(pool.stats()['crashes'], 1)
+
+    def test_large_results_are_spooled_through_a_file(self):
+        pool = self.pool(size=1, timeout=10)
+        with mock.patch.object(pool, 'inline_bytes', 1024):
+            result = pool.run('session-1', 'large', '')
+        self.assertEqual(len(result['html']), 100000)
+        self.assertEqual(pool.stats()['spooled_results'], 1)
+        self.assertEqual(os.listdir(self.spool_dir), [])
+
+    def test_concurrent_runs_use_separate_workers(self):
+        pool = self.pool(size=2, timeout=10)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            results = list(executor.map(lambda i: pool.run(f'session-{i}', 'sleep', '0.3'), range(2)))
+        self.assertEqual(len({result['pid'] for result in results}), 2)
@@ -9,6 +9,8 @@ urlpatterns = [
     path("api/v1/bug/analyze", views.analyze_bug),
     path("api/v1/report/generate", views.generate_report),
     path("api/v1/scenario/generate", views.generate_scenario),
+    path("api/v1/screenshots/<str:key>", views.get_screenshot),
+    path("api/v1/jobs/metrics", views.get_job_metrics),
     
     # Realtime test endpoints
     path("api/v1/realtime/test/continuous/start", views.start_continuous_test),
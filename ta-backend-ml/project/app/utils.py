@@ -21,17 +21,8 @@ import sys
 sys.path.append("/app")
 
 from . import utils
+from .workers.llm_json import parse_llm_json
 
 def detect_json_str(text):
-    # jsonの範囲を検知する
-    start = text.find("{")
-    end = text.rfind("}") + 1
-    json_str = text[start:end]
-    
-    try:
-        json_obj = json.loads(json_str)
-    except json.JSONDecodeError as e:
-        # print("json decode error")
-        return None
-    
-    return json_obj
+    # LLM応答のJSON解析は共通パーサーに集約している（コードフェンス・末尾カンマ・途中で切れたJSONも読む）
+    return parse_llm_json(text, 'detect_json_str')
@@ -1,9 +1,11 @@
 import json
 import asyncio
-from django.http import JsonResponse
+import time
+from django.http import HttpResponse, JsonResponse
 from django.shortcuts import render
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
+from psycopg2.extras import RealDictCursor
 from .queue_handlers import (
     enqueue_test_execution,
     enqueue_bug_analysis,
@@ -13,6 +15,10 @@ from .queue_handlers import (
 )
 # Realtime functionality handled via Celery tasks only
 from .workers.continuous_test_celery_task import execute_continuous_test_task, execute_enhanced_test_task
+from .workers.screenshot_store import (CONTENT_TYPES, SCREENSHOT_KEY_PATTERN, get_screenshot_store,
+                                       verify_screenshot_signature)
+from .db_pool import get_pool
+from .job_pools import slo_metrics
 
 
 @require_http_methods(["GET"])
@@ -403,4 +409,72 @@ def get_session_bugs(request, session_id):
 @require_http_methods(["GET"])
 def realtime_monitor(request):
     """リアルタイムテスト監視のWebページを表示"""
-    return render(request, 'realtime_test_monitor.html')
\ No newline at end of file
+    return render(request, 'realtime_test_monitor.html')
+
+
+def screenshot_owned_by(cursor, key, organization_id):
+    """スクリーンショットを参照する行が、その組織にあるか（ScreenshotRefはscreenshot列を持つ行の書き込み時にトリガーで記録される）"""
+    cursor.execute("""
+        SELECT 1 FROM "ScreenshotRef" WHERE key = %s AND organization_id = %s
+    """, (key, organization_id))
+    return cursor.fetchone() is not None
+
+
+@require_http_methods(["GET"])
+def get_screenshot(request, key):
+    """
+    Serve a screenshot from the content-addressed screenshot store
+    Query parameters: organization_id, expires, signature
+    (signed by the API that returned the row, after checking the user's access to it)
+    """
+    if not SCREENSHOT_KEY_PATTERN.match(key):
+        return JsonResponse({"error": "Invalid screenshot key"}, status=400)
+    
+    organization_id = request.GET.get("organization_id")
+    expires = request.GET.get("expires")
+    signature = request.GET.get("signature")
+    if not organization_id or not expires or not signature:
+        return JsonResponse({"error": "A signed screenshot URL is required"}, status=401)
+    if not verify_screenshot_signature(key, organization_id, expires, signature):
+        return JsonResponse({"error": "Invalid or expired screenshot URL"}, status=403)
+    
+    try:
+        with get_pool().connection() as conn:
+            cursor = conn.cursor()
+            owned = screenshot_owned_by(cursor, key, organization_id)
+            cursor.close()
+    except Exception as e:
+        return JsonResponse({"error": str(e)}, status=500)
+    if not owned:
+        return JsonResponse({"error": "Screenshot does not belong to this organization"}, status=403)
+    
+    data = get_screenshot_store().get(key)
+    if data is None:
+        return JsonResponse({"error": "Screenshot not found"}, status=404)
+    
+    response = HttpResponse(data, content_type=CONTENT_TYPES[key.rsplit('.', 1)[1]])
+    # 内容アドレスなので中身は変わらないが、URLの有効期限までに限り、共有キャッシュには置かせない
+    max_age = max(0, int(expires) - int(time.time()))
+    response['Cache-Control'] = f'private, max-age={max_age}, immutable'
+    return response
+
+
+@require_http_methods(["GET"])
+def get_job_metrics(request):
+    """
+    Get per-job-type queue state and latency SLO metrics
+    Query parameters: window (seconds, default 3600), type (optional job type)
+    """
+    try:
+        window = float(request.GET.get("window", 3600))
+    except ValueError:
+        return JsonResponse({"error": "Invalid window"}, status=400)
+    
+    try:
+        with get_pool().connection() as conn:
+            cursor = conn.cursor(cursor_factory=RealDictCursor)
+            metrics = slo_metrics(cursor, window_seconds=window, job_type=request.GET.get("type"))
+            cursor.close()
+        return JsonResponse({"window_seconds": window, "job_types": metrics})
+    except Exception as e:
+        return JsonResponse({"error": str(e)}, status=500)
@@ -0,0 +1,237 @@
+import hashlib
+import io
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Union
+
+import PIL.Image
+
+from .gemini_rate_limiter import get_llm_session
+from .redis_client import get_redis
+from .screenshot_preprocessor import PreparedScreenshot, dhash
+
+logger = logging.getLogger(__name__)
+
+# DOMの正規化: スクリプト・スタイル・コメントと、毎回変わりがちな長い数字（タイムスタンプ・ID）を除く
+_STRIP_BLOCKS = re.compile(r'<(script|style|noscript)\b[^>]*>.*?</\1\s*>', re.IGNORECASE | re.DOTALL)
+_STRIP_COMMENTS = re.compile(r'<!--.*?-->', re.DOTALL)
+_LONG_NUMBERS = re.compile(r'\d{5,}')
+_WHITESPACE = re.compile(r'\s+')
+_BETWEEN_TAGS = re.compile(r'>\s+<')
+
+
+def dom_hash(html: str) -> str:
+    """正規化したHTMLのハッシュ"""
+    normalized = _STRIP_BLOCKS.sub('', html or '')
+    normalized = _STRIP_COMMENTS.sub('', normalized)
+    normalized = _LONG_NUMBERS.sub('0', normalized)
+    normalized = _BETWEEN_TAGS.sub('><', normalized)
+    normalized = _WHITESPACE.sub(' ', normalized).strip()
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+
+def screenshot_phash(screenshot: Union[bytes, PreparedScreenshot, None]) -> str:
+    """スクリーンショットの知覚ハッシュ（準備済みならデコード時に計算したものを使う）"""
+    if isinstance(screenshot, PreparedScreenshot):
+        return screenshot.phash
+    if not screenshot:
+        return ''
+    try:
+        return dhash(PIL.Image.open(io.BytesIO(screenshot)))
+    except Exception as e:
+        logger.warning(f"Failed to compute screenshot hash: {e}")
+        return hashlib.sha256(screenshot).hexdigest()
+
+
+class SqliteAnalysisBackend:
+    """ローカルのSQLiteファイルに保存（TTLで期限切れ、件数上限を超えたら最終アクセスが古い順に削除）"""
+
+    def __init__(self, path: Optional[str] = None, max_entries: Optional[int] = None):
+        self.path = path or os.getenv('ANALYSIS_CACHE_PATH', '/app/output/analysis_cache.sqlite3')
+        self.max_entries = max_entries or int(os.getenv('ANALYSIS_CACHE_MAX_ENTRIES', '5000'))
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self._lock = threading.Lock()
+        self._writes_since_evict = 0
+        self._pid = os.getpid()
+        self._conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+        with self._lock:
+            # 複数のワーカープロセスから同じファイルを使う
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS analysis_cache (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    expires_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+            """)
+            self._conn.execute('CREATE INDEX IF NOT EXISTS analysis_cache_accessed ON analysis_cache (accessed_at)')
+            self._conn.commit()
+
+    def _check_fork(self):
+        # fork前に開いたSQLite接続は子プロセスで使えないため開き直す
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+
+    def get(self, key: str, ttl: int) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            self._check_fork()
+            row = self._conn.execute(
+                'SELECT value FROM analysis_cache WHERE key = ? AND expires_at > ?', (key, now)
+            ).fetchone()
+            if row:
+                self._conn.execute('UPDATE analysis_cache SET accessed_at = ? WHERE key = ?', (now, key))
+                self._conn.commit()
+        return row[0] if row else None
+
+    def set(self, key: str, value: str, ttl: int):
+        now = time.time()
+        with self._lock:
+            self._check_fork()
+            self._conn.execute(
+                'INSERT OR REPLACE INTO analysis_cache (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)',
+                (key, value, now + ttl, now)
+            )
+            self._writes_since_evict += 1
+            if self._writes_since_evict >= 100:
+                self._evict(now)
+            self._conn.commit()
+
+    def _evict(self, now: float):
+        self._writes_since_evict = 0
+        self._conn.execute('DELETE FROM analysis_cache WHERE expires_at <= ?', (now,))
+        self._conn.execute("""
+            DELETE FROM analysis_cache WHERE key IN (
+                SELECT key FROM analysis_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?
+            )
+        """, (self.max_entries,))
+
+
+class RedisAnalysisBackend:
+    """Redisに保存（ワーカー間で共有、アクセスのたびにTTLを延長）"""
+
+    def __init__(self):
+        self.client = get_redis()
+        self.prefix = os.getenv('ANALYSIS_CACHE_REDIS_PREFIX', 'qa3:analysis:')
+
+    def get(self, key: str, ttl: int) -> Optional[str]:
+        value = self.client.getex(self.prefix + key, ex=ttl)
+        return value.decode('utf-8') if value is not None else None
+
+    def set(self, key: str, value: str, ttl: int):
+        self.client.set(self.prefix + key, value, ex=ttl)
+
+
+class AnalysisCache:
+    """Geminiの分析結果のキャッシュ
+
+    キーはプロンプトの種類とバージョン・URL・ページ内容（DOMアウトライン）の正規化ハッシュ・スクリーンショットの知覚ハッシュ・
+    ビューポートやループのバリエーションから作る。ANALYSIS_CACHE=sqlite（既定）/ redis / off。
+    キャッシュの障害は分析を止めないよう、全てミスとして扱う。
+    ヒット数などはプロセス全体に加え、set_llm_sessionで指定したセッションごとにも数える
+    （並行して実行中の別のセッションのヒットが混ざらないように）。
+    """
+
+    def __init__(self, backend: Optional[str] = None):
+        self.backend_name = backend or os.getenv('ANALYSIS_CACHE', 'sqlite')
+        self.ttl = int(os.getenv('ANALYSIS_CACHE_TTL_SECONDS', '604800'))
+        self.backend = None
+        try:
+            if self.backend_name == 'redis':
+                self.backend = RedisAnalysisBackend()
+            elif self.backend_name == 'sqlite':
+                self.backend = SqliteAnalysisBackend()
+        except Exception as e:
+            logger.error(f"Failed to initialize analysis cache backend '{self.backend_name}': {e}")
+        self.max_sessions = int(os.getenv('ANALYSIS_CACHE_MAX_SESSIONS', '1000'))
+        self._lock = threading.Lock()
+        self._stats = self._empty_stats()
+        self._sessions: 'OrderedDict[str, Dict[str, int]]' = OrderedDict()
+
+    @staticmethod
+    def _empty_stats() -> Dict[str, int]:
+        return {'hits': 0, 'misses': 0, 'writes': 0, 'errors': 0}
+
+    @staticmethod
+    def make_key(kind: str, prompt_version: str, url: str, content: str,
+                 screenshot: Union[bytes, PreparedScreenshot, None], variant: str = '') -> str:
+        parts = [kind, prompt_version, url, dom_hash(content), screenshot_phash(screenshot), variant]
+        return hashlib.sha256('\x1f'.join(parts).encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict]:
+        if self.backend is None:
+            return None
+        try:
+            value = self.backend.get(key, self.ttl)
+        except Exception as e:
+            logger.warning(f"Analysis cache read failed: {e}")
+            self._count('errors')
+            value = None
+        self._count('hits' if value is not None else 'misses')
+        return json.loads(value) if value is not None else None
+
+    def set(self, key: str, result: Dict):
+        if self.backend is None:
+            return
+        try:
+            self.backend.set(key, json.dumps(result, ensure_ascii=False), self.ttl)
+            self._count('writes')
+        except Exception as e:
+            logger.warning(f"Analysis cache write failed: {e}")
+            self._count('errors')
+
+    def _count(self, name: str):
+        session_id = get_llm_session()
+        with self._lock:
+            self._stats[name] += 1
+            if not session_id:
+                return
+            counts = self._sessions.get(session_id)
+            if counts is None:
+                counts = self._sessions[session_id] = self._empty_stats()
+                # 古いセッションから捨てる
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+            else:
+                self._sessions.move_to_end(session_id)
+            counts[name] += 1
+
+    def stats(self, session_id: Optional[str] = None) -> Dict:
+        """プロセス全体（session_idを指定すればそのセッション）のヒット数など"""
+        with self._lock:
+            if session_id is None:
+                stats = dict(self._stats)
+            else:
+                stats = dict(self._sessions.get(session_id) or self._empty_stats())
+        stats['backend'] = self.backend_name if self.backend else 'off'
+        return stats
+
+    def stats_since(self, before: Dict, session_id: Optional[str] = None) -> Dict:
+        """stats(session_id)のスナップショットからの増分"""
+        stats = self.stats(session_id)
+        for name in ('hits', 'misses', 'writes', 'errors'):
+            stats[name] -= before.get(name, 0)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / lookups, 3) if lookups else 0.0
+        return stats
+
+
+_cache: Optional[AnalysisCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_analysis_cache() -> AnalysisCache:
+    """プロセス共有の分析キャッシュを取得"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = AnalysisCache()
+        return _cache
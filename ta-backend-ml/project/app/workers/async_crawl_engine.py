@@ -0,0 +1,269 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from playwright.async_api import async_playwright
+
+from .crawl_frontier import CrawlFrontier
+from .url_canonicalizer import SeenUrlIndex
+
+logger = logging.getLogger(__name__)
+
+# (page, url, depth) -> {"discovered_urls": [...], "suggested_urls": [...], "processed": bool, ...}
+PageHandler = Callable[..., Awaitable[Dict]]
+# (state) -> None  stateはsnapshot()の戻り値
+CheckpointCallback = Callable[[Dict], Awaitable[None]]
+
+
+class _AsyncBrowserSlot:
+    """エンジンが保持するブラウザと、その上で処理中・処理済みのページ数"""
+
+    def __init__(self, browser):
+        self.browser = browser
+        self.pages = 0
+        self.active = 0
+        self.retired = False
+
+
+class AsyncCrawlEngine:
+    """playwright.async_api で少数のブラウザに多数のページを多重化するクロールエンジン
+
+    1つのイベントループ上でconcurrency個のワーカーコルーチンが優先度付きフロンティア（CrawlFrontier）
+    からURLを取り出し、ページごとに新しいBrowserContextを作ってpage_handlerを実行する。
+    ブラウザはNページ処理後またはクラッシュ時に作り直される。
+    checkpoint_callbackを渡すと、CRAWL_CHECKPOINT_EVERYページまたはCRAWL_CHECKPOINT_SECONDS秒ごとに
+    フロンティアと処理済みURLのスナップショットを渡す。run()/crawl()にresume_stateを渡すとそこから再開する。
+    """
+
+    def __init__(self, page_handler: PageHandler,
+                 max_depth: int = 5,
+                 concurrency: Optional[int] = None,
+                 browsers: Optional[int] = None,
+                 max_pages_per_browser: Optional[int] = None,
+                 context_options: Optional[Dict] = None,
+                 max_pages: Optional[int] = None,
+                 max_seconds: Optional[float] = None,
+                 seen_index: Optional[SeenUrlIndex] = None,
+                 checkpoint_callback: Optional[CheckpointCallback] = None):
+        self.page_handler = page_handler
+        self.max_depth = max_depth
+        self.concurrency = concurrency or int(os.getenv('CRAWL_CONCURRENCY', '16'))
+        self.browser_count = browsers or int(os.getenv('CRAWL_BROWSERS', '2'))
+        self.max_pages_per_browser = max_pages_per_browser or int(os.getenv('BROWSER_POOL_MAX_PAGES', '50'))
+        self.context_options = context_options or {}
+        self.max_pages = max_pages
+        self.max_seconds = max_seconds
+        self.seen_index = seen_index
+        self.checkpoint_callback = checkpoint_callback
+        self.checkpoint_every = int(os.getenv('CRAWL_CHECKPOINT_EVERY', '10'))
+        self.checkpoint_seconds = float(os.getenv('CRAWL_CHECKPOINT_SECONDS', '30'))
+        self.frontier: Optional[CrawlFrontier] = None
+        self._visited: Dict[str, int] = {}
+        self._in_flight: Dict[str, int] = {}
+        self._resumed_seconds = 0.0
+        self._started = 0.0
+        self._last_checkpoint_at = 0.0
+        self._pages_since_checkpoint = 0
+        self._checkpointing = False
+        self._slots: List[_AsyncBrowserSlot] = []
+        self._launch_lock: Optional[asyncio.Lock] = None
+        self._stats = {}
+
+    def run(self, start_url: str, resume_state: Optional[Dict] = None) -> Dict:
+        """同期コードからクロールを実行する
+
+        呼び出し元スレッドで既にイベントループが動いている場合（asyncio.run内から
+        execute()が呼ばれる場合など）は、専用スレッドの新しいループで実行する。
+        """
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(self.crawl(start_url, resume_state))
+
+        result = {}
+
+        def _run_in_thread():
+            try:
+                result['value'] = asyncio.run(self.crawl(start_url, resume_state))
+            except BaseException as e:
+                result['error'] = e
+
+        thread = threading.Thread(target=_run_in_thread, name='async-crawl-engine')
+        thread.start()
+        thread.join()
+        if 'error' in result:
+            raise result['error']
+        return result['value']
+
+    async def crawl(self, start_url: str, resume_state: Optional[Dict] = None) -> Dict:
+        """start_urlから再帰的にクロールし、スループットの統計を返す"""
+        started = self._started = self._last_checkpoint_at = time.time()
+        self._stats = {
+            'pages_scanned': 0,
+            'pages_failed': 0,
+            'browser_launches': 0,
+            'browser_launch_seconds': 0.0,
+            'browser_recycles': 0,
+            'browser_crashes': 0
+        }
+        frontier = self.frontier = CrawlFrontier(self.max_depth, self.max_pages, self.max_seconds, self.seen_index)
+        self._visited = {}
+        self._in_flight = {}
+        self._resumed_seconds = 0.0
+        self._pages_since_checkpoint = 0
+        resumed_pages = 0
+        if resume_state and resume_state.get('frontier'):
+            self._visited = {url: 0 for url in resume_state.get('visited_urls', [])}
+            resumed_pages = resume_state.get('pages_scanned', 0)
+            self._stats['pages_scanned'] = resumed_pages
+            self._resumed_seconds = resume_state.get('elapsed_seconds', 0.0)
+            frontier.restore(resume_state['frontier'], list(self._visited), resume_state.get('dispatched', len(self._visited)))
+        else:
+            frontier.push(start_url.strip(), 0)
+
+        async with async_playwright() as p:
+            self._slots = []
+            self._launch_lock = asyncio.Lock()
+            for _ in range(self.browser_count):
+                self._slots.append(await self._launch(p))
+
+            workers = [
+                asyncio.create_task(self._worker(p, frontier, i))
+                for i in range(self.concurrency)
+            ]
+            try:
+                await frontier.join()
+            except BaseException:
+                # 途中で中断された場合も、そこまでの状態を残しておく
+                await self._checkpoint()
+                raise
+            finally:
+                for worker in workers:
+                    worker.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+                for slot in self._slots:
+                    await self._close(slot)
+
+        elapsed = time.time() - started
+        stats = dict(self._stats)
+        stats['elapsed_seconds'] = round(elapsed, 2)
+        stats['pages_per_sec'] = round((stats['pages_scanned'] - resumed_pages) / elapsed, 3) if elapsed > 0 else 0.0
+        stats['resumed_pages'] = resumed_pages
+        stats['browser_launch_seconds'] = round(stats['browser_launch_seconds'], 2)
+        stats['concurrency'] = self.concurrency
+        stats['browsers'] = self.browser_count
+        stats['frontier'] = frontier.stats()
+        return stats
+
+    async def _worker(self, p, frontier: CrawlFrontier, index: int):
+        while True:
+            url, depth = await frontier.next_url()
+            if url is None:
+                # 予算切れ: 残りのURLは処理せずにキューから捨てる
+                frontier.task_done()
+                continue
+            self._in_flight[url] = depth
+            try:
+                result = await self._process(p, index, url, depth)
+                if result.get('processed', False):
+                    self._stats['pages_scanned'] += 1
+                # 提案URLを先に積んで、通常リンクとの重複時にブーストが効くようにする
+                for new_url in result.get('suggested_urls', []):
+                    frontier.push(new_url, depth + 1, suggested=True)
+                for new_url in result.get('discovered_urls', []):
+                    frontier.push(new_url, depth + 1)
+            except Exception as e:
+                self._stats['pages_failed'] += 1
+                logger.error(f"Error processing page {url}: {e}")
+            finally:
+                self._in_flight.pop(url, None)
+                self._visited[url] = depth
+                self._pages_since_checkpoint += 1
+                frontier.task_done()
+            await self._maybe_checkpoint()
+
+    def snapshot(self) -> Dict:
+        """再開に必要なクロール状態（処理中のページは未処理として扱う）"""
+        frontier = self.frontier
+        return {
+            'frontier': frontier.snapshot(self._in_flight),
+            'visited_urls': list(self._visited),
+            'dispatched': frontier.dispatched - len(self._in_flight),
+            'pages_scanned': self._stats.get('pages_scanned', 0),
+            'elapsed_seconds': round(self._resumed_seconds + time.time() - self._started, 2)
+        }
+
+    async def _maybe_checkpoint(self):
+        if not self.checkpoint_callback or self._checkpointing:
+            return
+        if (self._pages_since_checkpoint >= self.checkpoint_every
+                or time.time() - self._last_checkpoint_at >= self.checkpoint_seconds):
+            await self._checkpoint()
+
+    async def _checkpoint(self):
+        if not self.checkpoint_callback or self._checkpointing or not self.frontier:
+            return
+        self._checkpointing = True
+        self._pages_since_checkpoint = 0
+        self._last_checkpoint_at = time.time()
+        try:
+            await self.checkpoint_callback(self.snapshot())
+        except Exception as e:
+            logger.warning(f"Crawl checkpoint failed: {e}")
+        finally:
+            self._checkpointing = False
+
+    async def _process(self, p, index: int, url: str, depth: int) -> Dict:
+        slot = await self._acquire(p, index % len(self._slots))
+        context = None
+        try:
+            context = await slot.browser.new_context(**self.context_options)
+            page = await context.new_page()
+            return await self.page_handler(page, url, depth)
+        finally:
+            if context:
+                try:
+                    await context.close()
+                except Exception:
+                    pass
+            await self._release(slot)
+
+    async def _acquire(self, p, slot_index: int) -> _AsyncBrowserSlot:
+        async with self._launch_lock:
+            slot = self._slots[slot_index]
+            if not slot.browser.is_connected():
+                self._stats['browser_crashes'] += 1
+                logger.warning(f"Browser {slot_index} disconnected after {slot.pages} pages, relaunching")
+                slot.retired = True
+                slot = self._slots[slot_index] = await self._launch(p)
+            elif slot.pages >= self.max_pages_per_browser:
+                self._stats['browser_recycles'] += 1
+                slot.retired = True
+                if slot.active == 0:
+                    await self._close(slot)
+                slot = self._slots[slot_index] = await self._launch(p)
+            slot.pages += 1
+            slot.active += 1
+            return slot
+
+    async def _release(self, slot: _AsyncBrowserSlot):
+        slot.active -= 1
+        # 入れ替え済みのブラウザは、処理中のページがなくなった時点で閉じる
+        if slot.retired and slot.active == 0:
+            await self._close(slot)
+
+    async def _launch(self, p) -> _AsyncBrowserSlot:
+        started = time.time()
+        browser = await p.chromium.launch(headless=True)
+        self._stats['browser_launches'] += 1
+        self._stats['browser_launch_seconds'] += time.time() - started
+        return _AsyncBrowserSlot(browser)
+
+    async def _close(self, slot: _AsyncBrowserSlot):
+        try:
+            await slot.browser.close()
+        except Exception:
+            pass
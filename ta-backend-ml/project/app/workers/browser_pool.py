@@ -0,0 +1,231 @@
+import atexit
+import contextvars
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from playwright.sync_api import sync_playwright
+
+logger = logging.getLogger(__name__)
+
+
+class _BrowserSlot:
+    """ワーカースレッドが保持するブラウザと処理済みページ数"""
+
+    def __init__(self, browser):
+        self.browser = browser
+        self.pages = 0
+
+
+class BrowserPool:
+    """ワーカープロセス内で長寿命のブラウザを使い回すプール
+
+    sync APIのPlaywrightオブジェクトは生成したスレッドからしか操作できないため、
+    プールが専用スレッドを持ち、各スレッドが自分のブラウザを保持する。
+    投入された処理は新しいBrowserContextのページを受け取ってそのスレッド上で実行され、
+    ブラウザはNページ処理後またはクラッシュ時に作り直される。
+    """
+
+    def __init__(self, size: Optional[int] = None, max_pages_per_browser: Optional[int] = None,
+                 warmup: bool = True):
+        self.size = size or int(os.getenv('BROWSER_POOL_SIZE', '2'))
+        # 1にするとページごとにブラウザを起動する従来の挙動になる（比較計測用）
+        self.max_pages_per_browser = max_pages_per_browser or int(os.getenv('BROWSER_POOL_MAX_PAGES', '50'))
+        self.warmup = warmup
+        self._tasks = queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._started = False
+        self._started_at = None
+        self._stats = {
+            'pages': 0,
+            'launches': 0,
+            'recycles': 0,
+            'crashes': 0,
+            'launch_seconds': 0.0,
+            'page_seconds': 0.0
+        }
+
+    def start(self):
+        """ワーカースレッドを起動し、各スレッドでブラウザを立ち上げる"""
+        with self._lock:
+            if self._started:
+                return
+            for i in range(self.size):
+                thread = threading.Thread(target=self._worker_loop, name=f'browser-pool-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            self._started = True
+            self._started_at = time.time()
+        logger.info(f"Browser pool started (size: {self.size}, max_pages_per_browser: {self.max_pages_per_browser})")
+
+    def submit(self, fn: Callable, *args,
+               browser_type: str = 'chromium',
+               launch_options: Optional[Dict] = None,
+               context_options: Optional[Dict] = None,
+               **kwargs) -> Future:
+        """fn(page, *args, **kwargs) をプールのスレッドで実行する
+
+        呼び出し元のContextVar（set_llm_sessionのセッションなど）を引き継ぐため、fnは投入時のコンテキストのコピー上で実行する。
+        """
+        self.start()
+        future = Future()
+        caller_context = contextvars.copy_context()
+        self._tasks.put((fn, args, kwargs, browser_type, launch_options or {}, context_options or {}, caller_context, future))
+        return future
+
+    def run(self, fn: Callable, *args, **kwargs) -> Any:
+        """submitして結果を待つ（同期呼び出し用）"""
+        return self.submit(fn, *args, **kwargs).result()
+
+    def shutdown(self, wait: bool = True):
+        """全スレッドのブラウザを閉じてプールを停止"""
+        with self._lock:
+            if not self._started:
+                return
+            self._started = False
+            threads, self._threads = self._threads, []
+        for _ in threads:
+            self._tasks.put(None)
+        if wait:
+            for thread in threads:
+                thread.join(timeout=30)
+        logger.info(f"Browser pool stopped: {self.stats()}")
+
+    def stats(self) -> Dict:
+        """プールの累積メトリクス"""
+        with self._lock:
+            stats = dict(self._stats)
+            uptime = time.time() - self._started_at if self._started_at else 0.0
+        stats['size'] = self.size
+        stats['max_pages_per_browser'] = self.max_pages_per_browser
+        stats['uptime_seconds'] = round(uptime, 2)
+        stats['pages_per_sec'] = round(stats['pages'] / uptime, 3) if uptime > 0 else 0.0
+        stats['launch_seconds'] = round(stats['launch_seconds'], 2)
+        stats['page_seconds'] = round(stats['page_seconds'], 2)
+        return stats
+
+    def _worker_loop(self):
+        browsers: Dict[Tuple, _BrowserSlot] = {}
+        try:
+            with sync_playwright() as p:
+                if self.warmup:
+                    try:
+                        self._get_browser(p, browsers, 'chromium', {})
+                    except Exception as e:
+                        logger.warning(f"Browser warmup failed: {e}")
+
+                while True:
+                    task = self._tasks.get()
+                    if task is None:
+                        break
+                    self._run_task(p, browsers, task)
+
+                for slot in browsers.values():
+                    self._close_browser(slot)
+        except Exception as e:
+            # Playwright自体が起動できない場合は、このスレッドに来たタスクを失敗させ続ける
+            logger.error(f"Browser pool worker failed: {e}")
+            while True:
+                task = self._tasks.get()
+                if task is None:
+                    break
+                task[-1].set_exception(e)
+
+    def _run_task(self, p, browsers: Dict[Tuple, _BrowserSlot], task):
+        fn, args, kwargs, browser_type, launch_options, context_options, caller_context, future = task
+        if not future.set_running_or_notify_cancel():
+            return
+
+        key = self._browser_key(browser_type, launch_options)
+        started = time.time()
+        context = None
+        try:
+            slot = self._get_browser(p, browsers, browser_type, launch_options)
+            context = slot.browser.new_context(**context_options)
+            page = context.new_page()
+            future.set_result(caller_context.run(fn, page, *args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            if context:
+                try:
+                    context.close()
+                except Exception:
+                    pass
+            self._release(browsers, key, time.time() - started)
+
+    def _get_browser(self, p, browsers: Dict[Tuple, _BrowserSlot], browser_type: str, launch_options: Dict) -> _BrowserSlot:
+        key = self._browser_key(browser_type, launch_options)
+        slot = browsers.get(key)
+        if slot and slot.browser.is_connected():
+            return slot
+
+        started = time.time()
+        browser = getattr(p, browser_type).launch(**{'headless': True, **launch_options})
+        with self._lock:
+            self._stats['launches'] += 1
+            self._stats['launch_seconds'] += time.time() - started
+        slot = _BrowserSlot(browser)
+        browsers[key] = slot
+        return slot
+
+    def _release(self, browsers: Dict[Tuple, _BrowserSlot], key: Tuple, elapsed: float):
+        slot = browsers.get(key)
+        with self._lock:
+            self._stats['pages'] += 1
+            self._stats['page_seconds'] += elapsed
+        if not slot:
+            return
+
+        slot.pages += 1
+        if not slot.browser.is_connected():
+            logger.warning(f"Browser {key[0]} crashed after {slot.pages} pages, relaunching on next use")
+            browsers.pop(key, None)
+            with self._lock:
+                self._stats['crashes'] += 1
+        elif slot.pages >= self.max_pages_per_browser:
+            browsers.pop(key, None)
+            self._close_browser(slot)
+            with self._lock:
+                self._stats['recycles'] += 1
+
+    def _close_browser(self, slot: _BrowserSlot):
+        try:
+            slot.browser.close()
+        except Exception:
+            pass
+
+    @staticmethod
+    def _browser_key(browser_type: str, launch_options: Dict) -> Tuple:
+        # launch_optionsにはargsのリストやproxyのdictも入るので、ハッシュできるJSON文字列をキーにする
+        return (browser_type, json.dumps({'headless': True, **launch_options}, sort_keys=True, default=str))
+
+
+_pool: Optional[BrowserPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_browser_pool() -> BrowserPool:
+    """プロセス共有のブラウザプールを取得（初回呼び出し時に起動）"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = BrowserPool()
+            _pool.start()
+            atexit.register(_pool.shutdown)
+        return _pool
+
+
+def shutdown_browser_pool():
+    """プロセス共有のブラウザプールを停止"""
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool:
+        pool.shutdown()
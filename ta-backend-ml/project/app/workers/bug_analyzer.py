@@ -3,21 +3,34 @@ import logging
 import base64
 import os
 from typing import Dict, List, Optional
-import google.generativeai as genai
 from prisma import Prisma
 from datetime import datetime
+from .gemini_client import get_gemini_client
+from .gemini_rate_limiter import set_llm_session
 
 logger = logging.getLogger(__name__)
 
+BUG_REPORT_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'title': {'type': 'string'},
+        'description': {'type': 'string'},
+        'expected_behavior': {'type': 'string'},
+        'actual_behavior': {'type': 'string'},
+        'category': {'type': 'string', 'enum': ['functional', 'ui', 'performance', 'security', 'accessibility']},
+        'suggested_fix': {'type': 'string'}
+    },
+    'required': ['title', 'description', 'expected_behavior', 'actual_behavior', 'category']
+}
+
 
 class BugAnalyzer:
     """Analyze bugs using AI and generate detailed bug reports"""
     
     def __init__(self, prisma: Prisma):
         self.prisma = prisma
-        # Gemini APIの設定
-        genai.configure(api_key=os.getenv('GEMINI_API_KEY'))
-        self.model = genai.GenerativeModel('gemini-2.0-flash-exp')
+        # Gemini APIの設定（期限・再試行・レート制限付きの共有クライアント）
+        self.gemini = get_gemini_client()
     
     def analyze(self, test_session_id: str, screenshot: str, page_url: str, 
                 error_message: str, stack_trace: Optional[str] = None) -> Dict:
@@ -35,6 +48,7 @@ class BugAnalyzer:
             Analyzed bug information
         """
         logger.info(f"Analyzing bug for session {test_session_id}")
+        set_llm_session(test_session_id)
         
         # Get test session info
         test_session = self.prisma.testsession.find_unique(
@@ -111,18 +125,10 @@ class BugAnalyzer:
             }}
             """
             
-            response = self.model.generate_content(prompt)
-            
-            # GeminiのレスポンスからJSON部分を抽出
-            response_text = response.text
-            # JSONブロックを探す
-            import re
-            json_match = re.search(r'\{[^{}]*\}', response_text, re.DOTALL)
-            if json_match:
-                return json.loads(json_match.group())
-            else:
-                # JSONが見つからない場合は、テキストから情報を抽出
-                return self._extract_bug_info_from_text(response_text)
+            analysis, _ = self.gemini.generate_json(prompt, BUG_REPORT_SCHEMA, 'bug_report')
+            if not analysis or not all(analysis.get(key) for key in BUG_REPORT_SCHEMA['required']):
+                raise ValueError("Gemini returned an incomplete bug report")
+            return analysis
             
         except Exception as e:
             logger.error(f"AI analysis failed: {e}")
@@ -136,36 +142,6 @@ class BugAnalyzer:
                 "suggested_fix": "Investigate the error and fix the underlying issue"
             }
     
-    def _extract_bug_info_from_text(self, text: str) -> Dict:
-        """テキストレスポンスからバグ情報を抽出"""
-        # 基本的な抽出ロジック
-        lines = text.split('\n')
-        info = {
-            "title": "Bug found",
-            "description": "",
-            "expected_behavior": "",
-            "actual_behavior": "",
-            "category": "functional",
-            "suggested_fix": ""
-        }
-        
-        for line in lines:
-            line_lower = line.lower()
-            if 'タイトル' in line or 'title' in line_lower:
-                info["title"] = line.split(':', 1)[-1].strip()[:100]
-            elif '説明' in line or 'description' in line_lower:
-                info["description"] = line.split(':', 1)[-1].strip()
-            elif '期待' in line or 'expected' in line_lower:
-                info["expected_behavior"] = line.split(':', 1)[-1].strip()
-            elif '実際' in line or 'actual' in line_lower:
-                info["actual_behavior"] = line.split(':', 1)[-1].strip()
-            elif 'カテゴリ' in line or 'category' in line_lower:
-                info["category"] = line.split(':', 1)[-1].strip()
-            elif '修正' in line or 'fix' in line_lower:
-                info["suggested_fix"] = line.split(':', 1)[-1].strip()
-        
-        return info
-    
     def _determine_severity(self, analysis: Dict) -> str:
         """Determine bug severity based on analysis"""
         category = analysis.get("category", "functional")
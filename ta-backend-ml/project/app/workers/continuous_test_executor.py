@@ -4,11 +4,18 @@ import logging
 import os
 import random
 from datetime import datetime
-from typing import Dict, List, Optional
-from playwright.sync_api import sync_playwright
+from typing import Dict, List, Optional, Union
 from .test_executor_enhanced import EnhancedTestExecutor
 from .gemini_page_analyzer import GeminiPageAnalyzer, PlaywrightActionExecutor
 from .activity_logger import ActivityLogger
+from .browser_pool import get_browser_pool
+from .page_load_profiles import PageLoadProfile, get_profile
+from .screenshot_store import get_screenshot_store
+from .session_log_sink import get_session_log_sink
+from .result_writer import ResultBatchWriter, bug_ticket_row, new_id, test_result_row
+from .dom_distiller import distill_page_sync
+from .gemini_rate_limiter import set_llm_session
+from .llm_telemetry import get_llm_telemetry
 from prisma import Prisma
 
 logger = logging.getLogger(__name__)
@@ -21,6 +28,12 @@ class ContinuousTestExecutor:
         self.prisma = prisma
         self.enhanced_executor = EnhancedTestExecutor(prisma)
         self.activity_logger = ActivityLogger()
+        self.browser_pool = get_browser_pool()
+        self.load_profile = get_profile()
+        self.screenshot_store = get_screenshot_store()
+        self.log_sink = get_session_log_sink()
+        # TestResult/BugTicketの行はループごとにまとめて書き込む（project_idはセッションで1度だけ取得）
+        self.result_writer: Optional[ResultBatchWriter] = None
         
         # ループ設定
         self.default_loop_count = 20
@@ -41,6 +54,7 @@ class ContinuousTestExecutor:
         """連続的なテスト実行（10回ループ）"""
         start_time = time.time()
         loop_count = loop_count or self.default_loop_count
+        set_llm_session(session_id)
         
         logger.info(f"Starting continuous test execution: {loop_count} loops for {url}")
         
@@ -64,6 +78,7 @@ class ContinuousTestExecutor:
         total_bugs = []
         total_pages_scanned = 0
         loop_results = []
+        cache_stats_before = self.enhanced_executor.analysis_cache.stats(session_id)
         
         for loop_index in range(loop_count):
             loop_start_time = time.time()
@@ -126,14 +141,22 @@ class ContinuousTestExecutor:
             'bugs': total_bugs,
             'loop_results': loop_results,
             'coverage_percentage': min(95, total_pages_scanned * 5),  # より高いカバレッジ
-            'variations_tested': self.loop_variations[:loop_count]
+            'variations_tested': self.loop_variations[:loop_count],
+            'result_writer': self.result_writer.stats() if self.result_writer else {},
+            # セッション中のLLM呼び出しの集計（プロンプト別のトークン数・画像バイト数・レイテンシのパーセンタイル）
+            'llm': get_llm_telemetry().session_summary(session_id)
         }
         
         self._log_to_session(session_id, 'info', '連続テスト実行完了', {
             'total_duration': total_duration,
             'total_bugs_found': len(total_bugs),
             'total_pages_scanned': total_pages_scanned,
-            'successful_loops': len([r for r in loop_results if not r.get('error')])
+            'successful_loops': len([r for r in loop_results if not r.get('error')]),
+            'analysis_cache': self.enhanced_executor.analysis_cache.stats_since(cache_stats_before, session_id),
+            'llm_payload': self.enhanced_executor.payload_stats.stats(),
+            'gemini_rate_limiter': self.enhanced_executor.rate_limiter.stats(),
+            'gemini_client': self.enhanced_executor.gemini.stats(),
+            'llm': final_result['llm']
         })
         
         # テスト完了のアクティビティをログ
@@ -148,6 +171,8 @@ class ContinuousTestExecutor:
         except Exception as e:
             logger.warning(f"Failed to log continuous test completed: {e}")
         
+        # キューに残っているログを書き込んでから終了
+        self.log_sink.flush()
         return final_result
     
     def _execute_single_loop(self, session_id: str, url: str, loop_index: int, variation: str) -> Dict:
@@ -157,74 +182,81 @@ class ContinuousTestExecutor:
         # バリエーションに応じてテスト設定を調整
         test_config = self._get_test_config(variation)
         
-        with sync_playwright() as p:
-            # ブラウザとデバイスの設定
-            browser_type = getattr(p, test_config['browser'])
-            browser = browser_type.launch(
-                headless=test_config.get('headless', True),
-                slow_mo=test_config.get('slow_mo', 0)
-            )
+        launch_options = {'headless': test_config.get('headless', True)}
+        if test_config.get('slow_mo'):
+            launch_options['slow_mo'] = test_config['slow_mo']
+        
+        # ブラウザはプールのものを使い回し、ループごとに新しいコンテキストで実行
+        return self.browser_pool.run(
+            self._run_loop_on_page, session_id, url, loop_index, variation,
+            browser_type=test_config['browser'],
+            launch_options=launch_options,
+            context_options=test_config['context_options']
+        )
+    
+    def _run_loop_on_page(self, page, session_id: str, url: str, loop_index: int, variation: str) -> Dict:
+        """プールから払い出されたページで単一ループのテストを実行"""
+        bugs_found = []
+        pages_scanned = 0
+        ai_skipped = False
+        
+        try:
+            # プロファイルに従って不要なリクエストをブロックし、ページにアクセス
+            page_load = PageLoadProfile(self.load_profile)
+            page_load.apply(page)
+            response = page_load.goto(page, url, timeout=30000)
+            pages_scanned = 1
             
-            context = browser.new_context(**test_config['context_options'])
-            page = context.new_page()
+            # 初期スクリーンショット
+            screenshot = page.screenshot(full_page=True)
+            self._log_to_session(session_id, 'info', f'ループ{loop_index}: ページロード完了', {
+                'variation': variation,
+                'url': url,
+                'status_code': response.status if response else 'unknown',
+                'page_load': page_load.summary()
+            }, screenshot)
             
-            bugs_found = []
-            pages_scanned = 0
+            # バリエーション固有のテストを実行
+            if variation == "mobile_chrome":
+                bugs_found.extend(self._test_mobile_specific(page, url, session_id))
+            elif variation == "accessibility_focus":
+                bugs_found.extend(self._test_accessibility_comprehensive(page, url, session_id))
+            elif variation == "performance_focus":
+                bugs_found.extend(self._test_performance_comprehensive(page, url, session_id))
+            elif variation == "interaction_heavy":
+                bugs_found.extend(self._test_interactive_comprehensive(page, url, session_id))
+            elif variation == "form_validation":
+                bugs_found.extend(self._test_forms_comprehensive(page, url, session_id))
+            elif variation == "navigation_deep":
+                navigation_result = self._test_navigation_comprehensive(page, url, session_id)
+                bugs_found.extend(navigation_result['bugs'])
+                pages_scanned += navigation_result['pages_visited']
+            else:
+                # デフォルトテスト（基本的な機能テスト）
+                bugs_found.extend(self._test_basic_functionality(page, url, session_id))
             
-            try:
-                # ページにアクセス
-                response = page.goto(url, wait_until='networkidle', timeout=30000)
-                pages_scanned = 1
-                
-                # 初期スクリーンショット
-                screenshot = page.screenshot(full_page=True)
-                self._log_to_session(session_id, 'info', f'ループ{loop_index}: ページロード完了', {
-                    'variation': variation,
-                    'url': url,
-                    'status_code': response.status if response else 'unknown'
-                }, screenshot)
-                
-                # バリエーション固有のテストを実行
-                if variation == "mobile_chrome":
-                    bugs_found.extend(self._test_mobile_specific(page, url, session_id))
-                elif variation == "accessibility_focus":
-                    bugs_found.extend(self._test_accessibility_comprehensive(page, url, session_id))
-                elif variation == "performance_focus":
-                    bugs_found.extend(self._test_performance_comprehensive(page, url, session_id))
-                elif variation == "interaction_heavy":
-                    bugs_found.extend(self._test_interactive_comprehensive(page, url, session_id))
-                elif variation == "form_validation":
-                    bugs_found.extend(self._test_forms_comprehensive(page, url, session_id))
-                elif variation == "navigation_deep":
-                    navigation_result = self._test_navigation_comprehensive(page, url, session_id)
-                    bugs_found.extend(navigation_result['bugs'])
-                    pages_scanned += navigation_result['pages_visited']
-                else:
-                    # デフォルトテスト（基本的な機能テスト）
-                    bugs_found.extend(self._test_basic_functionality(page, url, session_id))
-                
-                # バリエーション共通のAI分析
-                ai_analysis = self._perform_ai_analysis(page, url, variation, session_id)
-                bugs_found.extend(ai_analysis.get('bugs', []))
-                
-                # 結果を保存
-                self._save_loop_results(session_id, loop_index, variation, bugs_found, pages_scanned)
-                
-            except Exception as e:
-                logger.error(f"Error in loop {loop_index}: {e}")
-                self._log_to_session(session_id, 'error', f'ループ{loop_index}でエラー発生', {
-                    'variation': variation,
-                    'error': str(e)
-                })
-                raise
-            finally:
-                browser.close()
+            # バリエーション共通のAI分析
+            ai_analysis = self._perform_ai_analysis(page, url, variation, session_id)
+            bugs_found.extend(ai_analysis.get('bugs', []))
+            ai_skipped = ai_analysis.get('ai_skipped', False)
+            
+            # 結果を保存
+            self._save_loop_results(session_id, loop_index, variation, bugs_found, pages_scanned, page_load.summary())
+            
+        except Exception as e:
+            logger.error(f"Error in loop {loop_index}: {e}")
+            self._log_to_session(session_id, 'error', f'ループ{loop_index}でエラー発生', {
+                'variation': variation,
+                'error': str(e)
+            })
+            raise
         
         return {
             'loop_index': loop_index,
             'variation': variation,
             'bugs': bugs_found,
             'pages_scanned': pages_scanned,
+            'ai_skipped': ai_skipped,
             'success': True
         }
     
@@ -688,13 +720,18 @@ class ContinuousTestExecutor:
     
     def _perform_ai_analysis(self, page, url: str, variation: str, session_id: str) -> Dict:
         """AI分析を実行"""
+        if not self.enhanced_executor.gemini.available():
+            # Gemini APIが不安定な間はAI分析を省く（他のチェックは続ける）
+            logger.warning(f"Skipping AI analysis for {variation}: Gemini circuit breaker is open")
+            return {'bugs': [], 'ai_skipped': True}
         try:
             # スクリーンショットを取得
             screenshot = page.screenshot(full_page=True)
             
             # 既存のEnhanced Executorの分析機能を使用
+            # 同じページ・同じバリエーションの結果は分析キャッシュから返る
             analysis_result = self.enhanced_executor._analyze_with_gemini(
-                url, page.title(), screenshot, page.content()
+                url, page.title(), screenshot, distill_page_sync(page), variation
             )
             
             bugs = []
@@ -714,90 +751,46 @@ class ContinuousTestExecutor:
             logger.error(f"AI analysis failed for {variation}: {e}")
             return {'bugs': []}
     
-    def _save_loop_results(self, session_id: str, loop_index: int, variation: str, bugs: List[Dict], pages_scanned: int):
-        """ループ結果をデータベースに保存"""
+    def _save_loop_results(self, session_id: str, loop_index: int, variation: str, bugs: List[Dict], pages_scanned: int,
+                           page_load: Dict):
+        """ループ結果をデータベースに保存（ループごとに1トランザクション）"""
         try:
-            import psycopg2
-            import uuid
-            
-            db_url = os.environ.get('DATABASE_ROOT_URL', '')
-            if '127.0.0.1' in db_url or 'localhost' in db_url:
-                db_url = db_url.replace('127.0.0.1', 'host.docker.internal').replace('localhost', 'host.docker.internal')
+            writer = self.result_writer
+            if writer is None or writer.session_id != session_id:
+                writer = self.result_writer = ResultBatchWriter(session_id)
             
-            conn = psycopg2.connect(db_url)
-            cursor = conn.cursor()
-            
-            # プロジェクトIDを取得
-            cursor.execute("""
-                SELECT ts.project_id FROM "TestSession" ts WHERE ts.id = %s
-            """, (session_id,))
-            result = cursor.fetchone()
-            
-            if result:
-                project_id = result[0]
-                
-                # 各バグをBugTicketとして保存
-                for bug in bugs:
-                    bug_ticket_id = str(uuid.uuid4())
-                    test_result_id = str(uuid.uuid4())
-                    
-                    # TestResultを作成
-                    cursor.execute("""
-                        INSERT INTO "TestResult" (id, test_session_id, url, status, execution_time, created_at, updated_at)
-                        VALUES (%s, %s, %s, %s, %s, NOW(), NOW())
-                    """, (test_result_id, session_id, bug.get('url', ''), "failed", 0))
-                    
-                    # BugTicketを作成
-                    cursor.execute("""
-                        INSERT INTO "BugTicket" (id, project_id, test_session_id, test_result_id, reported_by_id, 
-                            title, description, severity, bug_type, affected_url, reproduction_steps, 
-                            expected_behavior, actual_behavior, affected_components, 
-                            ai_confidence_score, created_at, updated_at)
-                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, NOW(), NOW())
-                    """, (
-                        bug_ticket_id, project_id, session_id, test_result_id, 'system',
-                        f"[Loop {loop_index}-{variation}] {bug.get('type', 'unknown')}",
-                        bug.get('error_message', ''),
-                        bug.get('severity', 'medium'),
-                        bug.get('type', 'unknown'),
-                        bug.get('url', ''),
-                        json.dumps({"steps": [f"Loop {loop_index} with {variation} variation"]}),
-                        "No errors should occur",
-                        bug.get('error_message', ''),
-                        '{' + bug.get('element', 'page') + '}',
-                        0.9
-                    ))
+            project_id = writer.project_id() if bugs else None
+            if not project_id:
+                return
             
-            conn.commit()
-            conn.close()
+            # 各バグをBugTicketとして保存
+            for bug in bugs:
+                test_result_id = new_id()
+                test_details = {
+                    "loop_index": loop_index,
+                    "variation": variation,
+                    "page_load": page_load,
+                    "bug_details": bug
+                }
+                writer.add({
+                    'TestResult': [test_result_row(
+                        session_id, bug.get('url', ''), "failed", test_details, result_id=test_result_id
+                    )],
+                    'BugTicket': [bug_ticket_row(
+                        new_id(), project_id, session_id, test_result_id, bug,
+                        title=f"[Loop {loop_index}-{variation}] {bug.get('type', 'unknown')}",
+                        url=bug.get('url', ''),
+                        steps=[f"Loop {loop_index} with {variation} variation"],
+                        expected_behavior="No errors should occur",
+                        confidence=0.9
+                    )]
+                })
+            writer.flush()
             
         except Exception as e:
             logger.error(f"Failed to save loop results: {e}")
     
-    def _log_to_session(self, session_id: str, level: str, message: str, metadata: Dict = None, screenshot: bytes = None):
-        """セッションログに記録"""
-        try:
-            import psycopg2
-            import base64
-            
-            db_url = os.environ.get('DATABASE_ROOT_URL', '')
-            if '127.0.0.1' in db_url or 'localhost' in db_url:
-                db_url = db_url.replace('127.0.0.1', 'host.docker.internal').replace('localhost', 'host.docker.internal')
-            
-            conn = psycopg2.connect(db_url)
-            cursor = conn.cursor()
-            
-            screenshot_b64 = None
-            if screenshot:
-                screenshot_b64 = base64.b64encode(screenshot).decode('utf-8')
-            
-            cursor.execute("""
-                INSERT INTO "TestSessionLog" (id, test_session_id, log_level, message, metadata, screenshot, created_at)
-                VALUES (gen_random_uuid(), %s, %s, %s, %s, %s, NOW())
-            """, (session_id, level, message, json.dumps(metadata or {}), screenshot_b64))
-            
-            conn.commit()
-            conn.close()
-            
-        except Exception as e:
-            logger.error(f"Failed to log to session: {e}")
\ No newline at end of file
+    def _log_to_session(self, session_id: str, level: str, message: str, metadata: Dict = None,
+                        screenshot: Union[bytes, str, None] = None):
+        """セッションログに記録（SessionLogSinkのキューに積むだけですぐに戻る）"""
+        self.log_sink.log(session_id, level, message, metadata, screenshot)
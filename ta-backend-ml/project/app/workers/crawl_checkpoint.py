@@ -0,0 +1,107 @@
+import hashlib
+import json
+import logging
+import uuid
+from typing import Dict, Optional
+
+from psycopg2.extras import RealDictCursor
+
+from ..db_pool import connection
+
+logger = logging.getLogger(__name__)
+
+
+def bug_fingerprint(bug: Dict) -> str:
+    """同じバグを再実行時に二重登録しないための指紋"""
+    key = '|'.join([
+        str(bug.get('type', '')),
+        str(bug.get('url', '')),
+        str(bug.get('element', '')),
+        str(bug.get('error_message', ''))
+    ])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+class CrawlCheckpointStore:
+    """CrawlCheckpointテーブルへのクロール状態の保存・読み込み
+
+    1テストセッションにつき1行を上書き保存し、クロールが最後まで終わったら削除する。
+    失敗したジョブが再実行されると、同じセッションIDの行から再開する。
+    """
+
+    def load(self, session_id: str) -> Optional[Dict]:
+        """チェックポイントを読み込む（存在しない場合はNone）"""
+        try:
+            with connection() as conn:
+                cursor = conn.cursor(cursor_factory=RealDictCursor)
+                cursor.execute("""
+                    SELECT frontier, visited_urls, page_results, bug_fingerprints, bugs,
+                           pages_scanned, dispatched, elapsed_seconds, updated_at
+                    FROM "CrawlCheckpoint" WHERE test_session_id = %s
+                """, (session_id,))
+                row = cursor.fetchone()
+            if not row:
+                return None
+            state = {
+                'frontier': row['frontier'],
+                'visited_urls': row['visited_urls'],
+                'page_results': row['page_results'],
+                'bug_fingerprints': row['bug_fingerprints'],
+                'bugs': row['bugs'],
+                'pages_scanned': row['pages_scanned'],
+                'elapsed_seconds': row['elapsed_seconds'],
+                'updated_at': row['updated_at'].isoformat() if row['updated_at'] else None
+            }
+            # 列を追加する前の行にはないので、その場合はエンジンが処理済みURLの件数で補う
+            if row['dispatched'] is not None:
+                state['dispatched'] = row['dispatched']
+            return state
+        except Exception as e:
+            logger.error(f"Failed to load crawl checkpoint for {session_id}: {e}")
+            return None
+
+    def save(self, session_id: str, state: Dict):
+        """チェックポイントを保存（既存の行は上書き）"""
+        try:
+            with connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    INSERT INTO "CrawlCheckpoint" (id, test_session_id, frontier, visited_urls, page_results,
+                        bug_fingerprints, bugs, pages_scanned, dispatched, elapsed_seconds, created_at, updated_at)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, NOW(), NOW())
+                    ON CONFLICT (test_session_id) DO UPDATE SET
+                        frontier = EXCLUDED.frontier,
+                        visited_urls = EXCLUDED.visited_urls,
+                        page_results = EXCLUDED.page_results,
+                        bug_fingerprints = EXCLUDED.bug_fingerprints,
+                        bugs = EXCLUDED.bugs,
+                        pages_scanned = EXCLUDED.pages_scanned,
+                        dispatched = EXCLUDED.dispatched,
+                        elapsed_seconds = EXCLUDED.elapsed_seconds,
+                        updated_at = NOW()
+                """, (
+                    str(uuid.uuid4()), session_id,
+                    json.dumps(state.get('frontier', [])),
+                    json.dumps(state.get('visited_urls', [])),
+                    json.dumps(state.get('page_results', {}), ensure_ascii=False),
+                    json.dumps(state.get('bug_fingerprints', [])),
+                    json.dumps(state.get('bugs', []), ensure_ascii=False),
+                    state.get('pages_scanned', 0),
+                    state.get('dispatched'),
+                    state.get('elapsed_seconds', 0.0)
+                ))
+                conn.commit()
+            logger.info(f"Saved crawl checkpoint for {session_id}: "
+                        f"{state.get('pages_scanned', 0)} pages, {len(state.get('frontier', []))} queued")
+        except Exception as e:
+            logger.error(f"Failed to save crawl checkpoint for {session_id}: {e}")
+
+    def delete(self, session_id: str):
+        """クロール完了後にチェックポイントを削除"""
+        try:
+            with connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('DELETE FROM "CrawlCheckpoint" WHERE test_session_id = %s', (session_id,))
+                conn.commit()
+        except Exception as e:
+            logger.error(f"Failed to delete crawl checkpoint for {session_id}: {e}")
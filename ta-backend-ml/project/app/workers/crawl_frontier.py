@@ -0,0 +1,175 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import re
+import time
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlparse
+
+from .url_canonicalizer import SeenUrlIndex
+
+logger = logging.getLogger(__name__)
+
+# パス中のID的なセグメント（数値、UUID、長い16進、数字混じりのslug）
+_ID_SEGMENT = re.compile(
+    r'^(\d+|[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}|[0-9a-f]{12,}|[\w-]*\d{3,}[\w-]*)$',
+    re.IGNORECASE
+)
+
+
+class CrawlFrontier(asyncio.Queue):
+    """優先度付きのクロールフロンティア
+
+    asyncio.PriorityQueueと同じく内部のヒープだけを差し替えたasyncio.Queueなので、
+    get()/task_done()/join()はそのまま使える。優先度は小さいほど先に処理される。
+      - 浅い深さを優先（depth * CRAWL_DEPTH_WEIGHT）
+      - Geminiのnavigation_suggestionsは CRAWL_SUGGESTION_BOOST だけ前に出す
+      - 同じURLテンプレート（/items/123 と /items/456 など）は既出件数に応じて後ろに回す
+    既出判定は正規化済みURLのSeenUrlIndexで行い、キューには正規化後のURLが入る。
+    セッションごとに最大ページ数と最大経過秒数の予算を持ち、
+    使い切った後はキューに残ったURLを処理せずに破棄する。
+    """
+
+    def __init__(self, max_depth: int = 5,
+                 max_pages: Optional[int] = None,
+                 max_seconds: Optional[float] = None,
+                 seen_index: Optional[SeenUrlIndex] = None):
+        super().__init__()
+        self.max_depth = max_depth
+        self.max_pages = max_pages or int(os.getenv('CRAWL_MAX_PAGES', '200'))
+        self.max_seconds = max_seconds or float(os.getenv('CRAWL_MAX_SECONDS', '240'))
+        self.depth_weight = float(os.getenv('CRAWL_DEPTH_WEIGHT', '10'))
+        self.suggestion_boost = float(os.getenv('CRAWL_SUGGESTION_BOOST', '15'))
+        self.template_penalty = float(os.getenv('CRAWL_TEMPLATE_PENALTY', '3'))
+        self.seen_index = seen_index if seen_index is not None else SeenUrlIndex()
+        self.template_counts: Dict[str, int] = {}
+        self.started_at = time.time()
+        self.dispatched = 0
+        self.stop_reason: Optional[str] = None
+        self._stats = {
+            'enqueued': 0,
+            'duplicates': 0,
+            'too_deep': 0,
+            'suggested': 0,
+            'budget_dropped': 0
+        }
+
+    # asyncio.Queueの内部ストレージをヒープに置き換える
+    def _init(self, maxsize):
+        self._queue = []
+        self._counter = itertools.count()
+
+    def _put(self, item):
+        heapq.heappush(self._queue, item)
+
+    def _get(self):
+        return heapq.heappop(self._queue)
+
+    def push(self, url: str, depth: int, suggested: bool = False) -> bool:
+        """URLをフロンティアに追加（既出・深さ超過・予算切れの場合はFalse）"""
+        if not url or self.stop_reason:
+            return False
+        if depth > self.max_depth:
+            self._stats['too_deep'] += 1
+            return False
+        canonical = self.seen_index.add(url)
+        if canonical is None:
+            self._stats['duplicates'] += 1
+            return False
+        url = canonical
+
+        template = self.url_template(url)
+        seen_count = self.template_counts.get(template, 0)
+        self.template_counts[template] = seen_count + 1
+
+        priority = depth * self.depth_weight + seen_count * self.template_penalty
+        if suggested:
+            priority -= self.suggestion_boost
+            self._stats['suggested'] += 1
+
+        self.put_nowait((priority, next(self._counter), url, depth))
+        self._stats['enqueued'] += 1
+        return True
+
+    async def next_url(self) -> Tuple[Optional[str], int]:
+        """次に処理するURLを取り出す
+
+        予算を使い切っている場合は (None, depth) を返す。
+        どちらの場合も呼び出し側は処理後にtask_done()を呼ぶこと。
+        """
+        _, _, url, depth = await self.get()
+        if self._check_budget():
+            self._stats['budget_dropped'] += 1
+            return None, depth
+        self.dispatched += 1
+        return url, depth
+
+    def snapshot(self, in_flight: Optional[Dict[str, int]] = None) -> List[List]:
+        """キューに残っているURLを [url, depth, priority] のリストで返す
+
+        処理中のURLも再開時にやり直すため、深さ相当の優先度で含める。
+        """
+        entries = [[url, depth, priority] for priority, _, url, depth in sorted(self._queue)]
+        for url, depth in (in_flight or {}).items():
+            entries.append([url, depth, depth * self.depth_weight])
+        return entries
+
+    def restore(self, entries: List[List], visited_urls: List[str], dispatched: int = 0):
+        """チェックポイントからフロンティアを復元する
+
+        ページ数の予算は前回までの処理分を引き継ぎ、経過秒数の予算は試行ごとに数え直す。
+        """
+        for url in visited_urls:
+            self.seen_index.add(url)
+        for url, depth, priority in entries:
+            canonical = self.seen_index.add(url)
+            if canonical is None:
+                continue
+            template = self.url_template(canonical)
+            self.template_counts[template] = self.template_counts.get(template, 0) + 1
+            self.put_nowait((priority, next(self._counter), canonical, depth))
+            self._stats['enqueued'] += 1
+        self.dispatched = dispatched
+        logger.info(f"Crawl frontier restored: {self.qsize()} queued, "
+                    f"{len(visited_urls)} visited, {dispatched} pages already dispatched")
+
+    def _check_budget(self) -> bool:
+        if self.stop_reason:
+            return True
+        if self.dispatched >= self.max_pages:
+            self.stop_reason = 'max_pages'
+        elif time.time() - self.started_at >= self.max_seconds:
+            self.stop_reason = 'max_seconds'
+        else:
+            return False
+        logger.info(f"Crawl budget exhausted ({self.stop_reason}): "
+                    f"{self.dispatched} pages in {time.time() - self.started_at:.1f}s, "
+                    f"{self.qsize()} queued URLs dropped")
+        return True
+
+    def stats(self) -> Dict:
+        """フロンティアの統計"""
+        stats = dict(self._stats)
+        stats['dispatched'] = self.dispatched
+        stats['url_templates'] = len(self.template_counts)
+        stats['max_pages'] = self.max_pages
+        stats['max_seconds'] = self.max_seconds
+        stats['stop_reason'] = self.stop_reason or 'exhausted'
+        stats['dedup'] = self.seen_index.stats()
+        return stats
+
+    @staticmethod
+    def url_template(url: str) -> str:
+        """ID的なパスセグメントとクエリ値を潰したURLテンプレート"""
+        parsed = urlparse(url)
+        segments = [
+            '{id}' if _ID_SEGMENT.match(segment) else segment
+            for segment in parsed.path.split('/')
+        ]
+        query_keys = sorted({key for key, _ in parse_qsl(parsed.query, keep_blank_values=True)})
+        template = f"{parsed.netloc}{'/'.join(segments)}"
+        if query_keys:
+            template += '?' + '&'.join(query_keys)
+        return template
@@ -0,0 +1,221 @@
+import logging
+import os
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# 表示中のページから、プロンプト用のアウトライン（ランドマーク・見出し・フォーム・操作可能な要素・本文）を
+# 1回のevaluateで取り出すスクリプト。各要素には再実行しても変わりにくいセレクタを付ける。
+DOM_OUTLINE_SCRIPT = r'''(limits) => {
+    const clip = (s, n) => {
+        s = (s || '').replace(/\s+/g, ' ').trim();
+        return s.length > n ? s.slice(0, n) + '…' : s;
+    };
+    const visible = (el) => {
+        const rect = el.getBoundingClientRect();
+        if (rect.width === 0 && rect.height === 0) return false;
+        const style = getComputedStyle(el);
+        return style.visibility !== 'hidden' && style.display !== 'none' && style.opacity !== '0';
+    };
+    const esc = (v) => (window.CSS && CSS.escape) ? CSS.escape(v) : v.replace(/["\\]/g, '\\$&');
+    const unique = (sel) => {
+        try { return document.querySelectorAll(sel).length === 1; } catch (e) { return false; }
+    };
+    const selectorFor = (el) => {
+        const tag = el.tagName.toLowerCase();
+        if (el.id && unique('#' + esc(el.id))) return '#' + esc(el.id);
+        for (const attr of ['data-testid', 'data-test', 'data-qa', 'name', 'aria-label', 'placeholder']) {
+            const value = el.getAttribute(attr);
+            if (value) {
+                const sel = tag + '[' + attr + '="' + esc(value) + '"]';
+                if (unique(sel)) return sel;
+            }
+        }
+        if (tag === 'a' && el.getAttribute('href')) {
+            const sel = 'a[href="' + esc(el.getAttribute('href')) + '"]';
+            if (unique(sel)) return sel;
+        }
+        // idを持つ祖先からのnth-of-typeのパス
+        const parts = [];
+        let node = el;
+        while (node && node.nodeType === 1 && node !== document.body && parts.length < 6) {
+            if (node !== el && node.id && unique('#' + esc(node.id))) {
+                parts.unshift('#' + esc(node.id));
+                break;
+            }
+            let part = node.tagName.toLowerCase();
+            const parent = node.parentElement;
+            if (parent) {
+                const same = Array.from(parent.children).filter(c => c.tagName === node.tagName);
+                if (same.length > 1) part += ':nth-of-type(' + (same.indexOf(node) + 1) + ')';
+            }
+            parts.unshift(part);
+            node = parent;
+        }
+        return parts.join(' > ');
+    };
+    const labelFor = (el) => {
+        if (el.labels && el.labels.length) return clip(el.labels[0].innerText, limits.maxText);
+        return clip(el.getAttribute('aria-label') || el.getAttribute('placeholder') || el.getAttribute('title') || '', limits.maxText);
+    };
+    const collect = (selector, map) => {
+        const items = [];
+        let total = 0;
+        for (const el of document.querySelectorAll(selector)) {
+            if (!visible(el)) continue;
+            const item = map(el);
+            if (!item) continue;
+            total += 1;
+            if (items.length < limits.maxItems) items.push(item);
+        }
+        return {items, total};
+    };
+
+    const landmarks = collect(
+        'header, nav, main, aside, footer, [role=banner], [role=navigation], [role=main], [role=search], [role=dialog], [role=contentinfo]',
+        el => ({role: el.getAttribute('role') || el.tagName.toLowerCase(), label: clip(el.getAttribute('aria-label'), limits.maxText), selector: selectorFor(el)})
+    );
+    const headings = collect('h1, h2, h3, h4', el => {
+        const text = clip(el.innerText, limits.maxText);
+        return text ? {level: el.tagName.toLowerCase(), text} : null;
+    });
+    const fieldSelector = 'input:not([type=hidden]), select, textarea';
+    const forms = collect('form', el => ({
+        selector: selectorFor(el),
+        method: (el.getAttribute('method') || 'get').toUpperCase(),
+        action: el.getAttribute('action') || '',
+        fields: Array.from(el.querySelectorAll(fieldSelector)).filter(visible).slice(0, limits.maxItems).map(f => ({
+            tag: f.tagName.toLowerCase(),
+            type: f.getAttribute('type') || '',
+            label: labelFor(f),
+            required: f.required,
+            selector: selectorFor(f)
+        }))
+    }));
+    // フォーム外の入力欄も操作対象として拾う
+    const seen = new Set();
+    const interactive = collect(
+        'a[href], button, summary, [role=button], [role=link], [role=tab], [role=menuitem], input[type=submit], input[type=button], ' + fieldSelector,
+        el => {
+            if (el.matches(fieldSelector) && el.closest('form') && !el.matches('[type=submit], [type=button]')) return null;
+            const selector = selectorFor(el);
+            if (seen.has(selector)) return null;
+            seen.add(selector);
+            return {
+                tag: el.tagName.toLowerCase(),
+                text: clip(el.innerText || el.value || el.getAttribute('aria-label') || el.getAttribute('title'), limits.maxText),
+                href: el.tagName === 'A' ? el.getAttribute('href') : '',
+                selector
+            };
+        }
+    );
+    const texts = new Set();
+    const textBlocks = collect('[role=alert], p, li, blockquote, td, dd, figcaption, pre', el => {
+        if (el.closest('nav')) return null;
+        // 子のブロックに同じテキストがある場合は外側を省く
+        if (el.querySelector('p, li, blockquote, td, dd, pre')) return null;
+        const text = clip(el.innerText, limits.maxText);
+        if (text.length < 2 || texts.has(text)) return null;
+        texts.add(text);
+        return {tag: el.getAttribute('role') === 'alert' ? 'alert' : el.tagName.toLowerCase(), text};
+    });
+    return {landmarks, headings, forms, interactive, text_blocks: textBlocks};
+}'''
+
+# アウトラインの各セクションに割り当てるトークン予算の割合（使い残しは次のセクションへ回す）
+_SECTIONS = (
+    ('landmarks', 'ランドマーク', 0.1),
+    ('headings', '見出し', 0.1),
+    ('forms', 'フォーム', 0.25),
+    ('interactive', '操作可能な要素', 0.3),
+    ('text_blocks', '本文', 0.25),
+)
+
+
+def outline_limits() -> Dict:
+    """DOM_OUTLINE_SCRIPTに渡す件数・文字数の上限"""
+    return {
+        'maxItems': int(os.getenv('DOM_OUTLINE_MAX_ITEMS', '60')),
+        'maxText': int(os.getenv('DOM_OUTLINE_MAX_TEXT', '160'))
+    }
+
+
+def estimate_tokens(text: str) -> int:
+    """トークン数の概算（ASCIIは4文字で1トークン、それ以外は1文字1トークン）"""
+    ascii_chars = sum(1 for c in text if ord(c) < 128)
+    return ascii_chars // 4 + (len(text) - ascii_chars) + 1
+
+
+def _format_item(section: str, item: Dict) -> List[str]:
+    if section == 'landmarks':
+        label = f' "{item["label"]}"' if item.get('label') else ''
+        return [f'- {item["role"]}{label} ({item["selector"]})']
+    if section == 'headings':
+        return [f'- {item["level"]} {item["text"]}']
+    if section == 'forms':
+        action = f' {item["action"]}' if item.get('action') else ''
+        lines = [f'- form ({item["selector"]}) {item["method"]}{action}']
+        for field in item.get('fields', []):
+            kind = f'{field["tag"]}[{field["type"]}]' if field.get('type') else field['tag']
+            required = ' 必須' if field.get('required') else ''
+            lines.append(f'  - {kind} "{field.get("label", "")}" ({field["selector"]}){required}')
+        return lines
+    if section == 'interactive':
+        href = f' -> {item["href"]}' if item.get('href') else ''
+        return [f'- {item["tag"]} "{item.get("text", "")}"{href} ({item["selector"]})']
+    return [f'- {item["tag"]}: {item["text"]}']
+
+
+def format_outline(outline: Optional[Dict], token_budget: Optional[int] = None) -> str:
+    """DOM_OUTLINE_SCRIPTの結果を、トークン予算内に収まるプロンプト用テキストにする"""
+    if not outline:
+        return '（ページ構造を取得できませんでした）'
+    budget = token_budget or int(os.getenv('DOM_OUTLINE_TOKEN_BUDGET', '1500'))
+    lines = []
+    omitted = []
+    carry = 0
+    for key, title, share in _SECTIONS:
+        section = outline.get(key) or {}
+        items = section.get('items') or []
+        allowance = int(budget * share) + carry
+        used = 0
+        shown = 0
+        section_lines = []
+        for item in items:
+            item_lines = _format_item(key, item)
+            cost = sum(estimate_tokens(line) for line in item_lines)
+            if used + cost > allowance:
+                break
+            section_lines.extend(item_lines)
+            used += cost
+            shown += 1
+        if section_lines:
+            lines.append(f'[{title}]')
+            lines.extend(section_lines)
+        carry = allowance - used
+        hidden = section.get('total', len(items)) - shown
+        if hidden > 0:
+            omitted.append(f'{title} {hidden}件')
+    if omitted:
+        lines.append(f'[省略] {", ".join(omitted)}')
+    return '\n'.join(lines) if lines else '（表示中の要素はありません）'
+
+
+async def distill_page(page, token_budget: Optional[int] = None) -> str:
+    """ページのアウトラインを取得してプロンプト用テキストにする（async Playwright）"""
+    try:
+        outline = await page.evaluate(DOM_OUTLINE_SCRIPT, outline_limits())
+    except Exception as e:
+        logger.warning(f"Failed to extract DOM outline: {e}")
+        outline = None
+    return format_outline(outline, token_budget)
+
+
+def distill_page_sync(page, token_budget: Optional[int] = None) -> str:
+    """distill_pageのsync Playwright版"""
+    try:
+        outline = page.evaluate(DOM_OUTLINE_SCRIPT, outline_limits())
+    except Exception as e:
+        logger.warning(f"Failed to extract DOM outline: {e}")
+        outline = None
+    return format_outline(outline, token_budget)
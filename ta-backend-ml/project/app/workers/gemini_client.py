@@ -0,0 +1,349 @@
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Deque, Dict, Optional, Tuple
+
+import google.generativeai as genai
+
+from .dom_distiller import estimate_tokens
+from .gemini_rate_limiter import RateLimitTimeout, estimate_request_tokens, get_gemini_rate_limiter, is_rate_limit_error
+from .llm_json import get_parse_stats, parse_llm_json
+from .llm_telemetry import get_llm_telemetry, image_bytes_of
+from .llm_transport import get_llm_transport
+
+logger = logging.getLogger(__name__)
+
+
+class GeminiUnavailable(Exception):
+    """サーキットブレーカーが開いているため呼び出さなかった"""
+
+
+class GeminiTimeout(Exception):
+    """呼び出しが期限までに終わらなかった"""
+
+
+def is_transient_error(error: Exception) -> bool:
+    """再試行すれば成功しうるエラー（429・5xx・タイムアウト・接続断）か"""
+    if isinstance(error, (GeminiTimeout, ConnectionError, TimeoutError)) or is_rate_limit_error(error):
+        return True
+    try:
+        from google.api_core import exceptions as api_exceptions
+        if isinstance(error, (api_exceptions.ServiceUnavailable, api_exceptions.InternalServerError,
+                              api_exceptions.DeadlineExceeded, api_exceptions.GatewayTimeout)):
+            return True
+    except ImportError:
+        pass
+    return getattr(error, 'code', None) in (500, 502, 503, 504)
+
+
+class GeminiResult:
+    """generate()の結果
+
+    latency_msは成功したリクエスト自体の所要時間、elapsed_msはレート制限の待ちと再試行を含めた全体の時間。
+    """
+
+    def __init__(self, response, latency_ms: int, elapsed_ms: int, attempts: int, hedged: bool):
+        self.response = response
+        self.latency_ms = latency_ms
+        self.elapsed_ms = elapsed_ms
+        self.attempts = attempts
+        self.hedged = hedged
+
+    @property
+    def text(self) -> str:
+        return self.response.text
+
+
+class CircuitBreaker:
+    """連続して失敗したらGEMINI_BREAKER_OPEN_SECONDS秒間呼び出しを止め、その後1件だけ試して復旧を確認する"""
+
+    def __init__(self, failure_threshold: int, open_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._probing = False
+        self.opens = 0
+
+    def state(self) -> str:
+        with self._lock:
+            return self._state()
+
+    def _state(self) -> str:
+        if self._opened_at is None:
+            return 'closed'
+        if time.monotonic() - self._opened_at < self.open_seconds:
+            return 'open'
+        return 'half_open'
+
+    def available(self) -> bool:
+        """今呼び出してよい状態か（half_openでは試行中の1件がなければ真）"""
+        with self._lock:
+            state = self._state()
+            return state == 'closed' or (state == 'half_open' and not self._probing)
+
+    def allow(self) -> bool:
+        with self._lock:
+            state = self._state()
+            if state == 'closed':
+                return True
+            if state == 'half_open' and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                logger.info("Gemini circuit breaker closed")
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def release(self):
+        """成否を判定できなかった試行（レート制限の待ちで諦めたなど）の後始末"""
+        with self._lock:
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._probing or (self._opened_at is None and self._failures >= self.failure_threshold):
+                self._opened_at = time.monotonic()
+                self.opens += 1
+                logger.warning(f"Gemini circuit breaker opened after {self._failures} consecutive failures "
+                               f"(retry in {self.open_seconds}s)")
+            self._probing = False
+
+
+class GeminiClient:
+    """全てのGemini呼び出しで共有するクライアント
+
+    - 呼び出しごとに期限（GEMINI_DEADLINE_SECONDS）を設け、ハングしたリクエストでワーカーを止めない
+    - 一時的なエラーはジッター付きの指数バックオフで期限内に再試行する（429はレートリミッターに共有）
+    - GEMINI_HEDGEが有効なら、直近のp95レイテンシを過ぎた呼び出しに同じリクエストをもう1つ送り、先に返った方を使う
+    - 連続して失敗したらサーキットブレーカーを開き、その間は呼び出さずにGeminiUnavailableを送出する
+      （呼び出し側はavailable()を見てAIを使わないチェックに切り替える）
+    """
+
+    def __init__(self, model_name: Optional[str] = None):
+        api_key = os.getenv('GEMINI_API_KEY')
+        if api_key:
+            genai.configure(api_key=api_key)
+        self.model_name = model_name or os.getenv('GEMINI_MODEL', 'gemini-2.0-flash-exp')
+        self.model = genai.GenerativeModel(self.model_name)
+        self.rate_limiter = get_gemini_rate_limiter()
+        # LLM_TRANSPORT_MODEでAPIを呼ばずに記録済み・合成の応答を返せる（オフラインのベンチマーク用）
+        self.transport = get_llm_transport()
+        self.deadline_seconds = float(os.getenv('GEMINI_DEADLINE_SECONDS', '90'))
+        self.attempt_timeout = float(os.getenv('GEMINI_ATTEMPT_TIMEOUT_SECONDS', '60'))
+        self.max_attempts = int(os.getenv('GEMINI_MAX_ATTEMPTS', '3'))
+        self.backoff_seconds = float(os.getenv('GEMINI_RETRY_BACKOFF_SECONDS', '1'))
+        self.hedge = os.getenv('GEMINI_HEDGE', 'false').lower() == 'true'
+        self.hedge_min_samples = int(os.getenv('GEMINI_HEDGE_MIN_SAMPLES', '20'))
+        self.structured_output = os.getenv('GEMINI_STRUCTURED_OUTPUT', 'true').lower() == 'true'
+        self.breaker = CircuitBreaker(
+            int(os.getenv('GEMINI_BREAKER_FAILURES', '5')),
+            float(os.getenv('GEMINI_BREAKER_OPEN_SECONDS', '60'))
+        )
+        self._executor = ThreadPoolExecutor(
+            max_workers=int(os.getenv('GEMINI_CLIENT_THREADS', '32')), thread_name_prefix='gemini-call'
+        )
+        self._lock = threading.Lock()
+        self._latencies: Deque[float] = deque(maxlen=500)
+        self._stats = {
+            'calls': 0,
+            'succeeded': 0,
+            'failed': 0,
+            'timeouts': 0,
+            'retries': 0,
+            'hedges_sent': 0,
+            'hedges_won': 0,
+            'short_circuited': 0
+        }
+
+    def available(self) -> bool:
+        """サーキットブレーカーが閉じている（AI分析を行ってよい）か"""
+        return self.breaker.available()
+
+    def generate(self, contents, deadline_seconds: Optional[float] = None, prompt_name: str = 'default',
+                 **kwargs) -> GeminiResult:
+        """model.generate_contentを期限・再試行・ヘッジ・サーキットブレーカー付きで呼ぶ
+
+        呼び出しごとにprompt_name・トークン数・画像バイト数・レイテンシ・結果をLLMTelemetryに記録する。
+        """
+        self._count('calls')
+        if not self.breaker.allow():
+            self._count('short_circuited')
+            self._record(prompt_name, contents, 0, 'unavailable')
+            raise GeminiUnavailable(f"Gemini {self.model_name} is temporarily disabled by the circuit breaker")
+
+        started = time.monotonic()
+        # 期限はレート制限の枠を取ってから数える（枠の待ちはGEMINI_RATE_LIMIT_MAX_WAIT_SECONDSで制限される）
+        deadline: Optional[float] = None
+        tokens = estimate_request_tokens(contents)
+        request_options = dict(kwargs.pop('request_options', None) or {})
+        last_error: Optional[Exception] = None
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                self.rate_limiter.acquire(self.model_name, tokens)
+                if deadline is None:
+                    deadline = time.monotonic() + (deadline_seconds or self.deadline_seconds)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise GeminiTimeout(f"Gemini call exceeded its {deadline_seconds or self.deadline_seconds}s deadline")
+                response, latency, hedged = self._attempt(contents, tokens, min(remaining, self.attempt_timeout),
+                                                       request_options, kwargs)
+                self.breaker.record_success()
+                self._count('succeeded')
+                with self._lock:
+                    self._latencies.append(latency)
+                self._record(prompt_name, contents, latency * 1000, 'ok', response)
+                return GeminiResult(response, int(latency * 1000), int((time.monotonic() - started) * 1000), attempt, hedged)
+            except Exception as e:
+                last_error = e
+                if isinstance(e, GeminiTimeout):
+                    self._count('timeouts')
+                if not is_transient_error(e) or attempt >= self.max_attempts:
+                    break
+                if is_rate_limit_error(e):
+                    delay = self.rate_limiter.report_throttled(self.model_name)
+                else:
+                    # フルジッターの指数バックオフ
+                    delay = random.uniform(0, self.backoff_seconds * 2 ** (attempt - 1))
+                if time.monotonic() + delay >= deadline:
+                    break
+                self._count('retries')
+                logger.warning(f"Gemini call failed ({e}), retrying in {delay:.1f}s "
+                               f"(attempt {attempt}/{self.max_attempts})")
+                time.sleep(delay)
+
+        self._count('failed')
+        self._record(prompt_name, contents, (time.monotonic() - started) * 1000, self._outcome(last_error))
+        if isinstance(last_error, RateLimitTimeout):
+            self.breaker.release()
+        elif last_error is None or is_transient_error(last_error):
+            self.breaker.record_failure()
+        else:
+            # プロンプト起因のエラーはAPI自体は応答しているので、ブレーカーでは成功として扱う
+            self.breaker.record_success()
+        raise last_error or GeminiTimeout(f"Gemini call exceeded its {deadline_seconds or self.deadline_seconds}s deadline")
+
+    def generate_json(self, contents, schema: Dict, prompt_name: str, expect: type = dict,
+                      **kwargs) -> Tuple[Optional[Any], GeminiResult]:
+        """response_schemaでJSON出力を指定して呼び、共通パーサーで読んだ値と結果を返す（読めなければ値はNone）
+
+        GEMINI_STRUCTURED_OUTPUT=falseの場合はスキーマを指定せず、プロンプトの指示だけでJSONを返させる。
+        """
+        generation_config = dict(kwargs.pop('generation_config', None) or {})
+        if self.structured_output:
+            generation_config.update(response_mime_type='application/json', response_schema=schema)
+        result = self.generate(contents, generation_config=generation_config, prompt_name=prompt_name, **kwargs)
+        try:
+            text = result.text
+        except ValueError as e:
+            # 安全性フィルターなどで候補が返らなかった
+            logger.warning(f"Gemini returned no text for {prompt_name}: {e}")
+            text = ''
+        return parse_llm_json(text, prompt_name, expect), result
+
+    def _attempt(self, contents, tokens: int, timeout: float, request_options: Dict, kwargs: Dict):
+        """1回分の呼び出し（必要ならヘッジ）。(レスポンス, 秒数, ヘッジが勝ったか)を返す"""
+        request_options = dict(request_options, timeout=timeout)
+
+        def call():
+            sent = time.monotonic()
+            response = self.transport.generate_content(self.model, self.model_name, contents, request_options, kwargs)
+            return response, time.monotonic() - sent
+
+        primary = self._executor.submit(call)
+        futures = {primary}
+        hedge_after = self._hedge_delay()
+        if hedge_after is not None and hedge_after < timeout:
+            done, _ = wait(futures, timeout=hedge_after)
+            # ヘッジのためにレート制限を待つことはしない（枠がなければ送らない）
+            if not done and self.rate_limiter.try_acquire(self.model_name, tokens):
+                self._count('hedges_sent')
+                futures.add(self._executor.submit(call))
+        end = time.monotonic() + timeout
+        while futures:
+            done, futures = wait(futures, timeout=max(0.0, end - time.monotonic()), return_when=FIRST_COMPLETED)
+            if not done:
+                raise GeminiTimeout(f"Gemini call did not finish within {timeout:.0f}s")
+            for future in done:
+                if future.exception() is None:
+                    response, latency = future.result()
+                    hedged = future is not primary
+                    if hedged:
+                        self._count('hedges_won')
+                    return response, latency, hedged
+            if not futures:
+                # 送った全てのリクエストが失敗した
+                raise next(iter(done)).exception()
+        raise GeminiTimeout(f"Gemini call did not finish within {timeout:.0f}s")
+
+    def _record(self, prompt_name: str, contents, latency_ms: float, outcome: str, response=None):
+        usage = getattr(response, 'usage_metadata', None)
+        input_tokens = getattr(usage, 'prompt_token_count', 0) if usage else 0
+        parts = contents if isinstance(contents, (list, tuple)) else [contents]
+        get_llm_telemetry().record(
+            'gemini', self.model_name, prompt_name, latency_ms, outcome,
+            # 応答にusage_metadataがなければ入力トークンは見積もりで記録する
+            input_tokens=input_tokens or sum(estimate_tokens(part) for part in parts if isinstance(part, str)),
+            output_tokens=getattr(usage, 'candidates_token_count', 0) if usage else 0,
+            total_tokens=getattr(usage, 'total_token_count', 0) if usage else 0,
+            image_bytes=image_bytes_of(contents)
+        )
+
+    @staticmethod
+    def _outcome(error: Optional[Exception]) -> str:
+        if error is None or isinstance(error, GeminiTimeout):
+            return 'timeout'
+        if isinstance(error, RateLimitTimeout):
+            return 'rate_limited'
+        if is_rate_limit_error(error):
+            return 'throttled'
+        return 'transient_error' if is_transient_error(error) else 'error'
+
+    def _hedge_delay(self) -> Optional[float]:
+        if not self.hedge:
+            return None
+        with self._lock:
+            if len(self._latencies) < self.hedge_min_samples:
+                return None
+            latencies = sorted(self._latencies)
+        return latencies[int(len(latencies) * 0.95) - 1]
+
+    def _count(self, name: str):
+        with self._lock:
+            self._stats[name] += 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            latencies = sorted(self._latencies)
+        stats['parse'] = get_parse_stats().stats()
+        stats['transport'] = self.transport.stats()
+        stats['breaker_state'] = self.breaker.state()
+        stats['breaker_opens'] = self.breaker.opens
+        for name, q in (('p50_latency_ms', 0.5), ('p95_latency_ms', 0.95)):
+            stats[name] = int(latencies[min(len(latencies) - 1, int(len(latencies) * q))] * 1000) if latencies else 0
+        return stats
+
+
+_clients: Dict[str, GeminiClient] = {}
+_clients_lock = threading.Lock()
+
+
+def get_gemini_client(model_name: Optional[str] = None) -> GeminiClient:
+    """プロセス共有のGeminiクライアントを取得（モデルごとに1つ）"""
+    name = model_name or os.getenv('GEMINI_MODEL', 'gemini-2.0-flash-exp')
+    with _clients_lock:
+        if name not in _clients:
+            _clients[name] = GeminiClient(name)
+        return _clients[name]
@@ -1,43 +1,123 @@
+import asyncio
 import json
 import logging
 import base64
 from typing import Dict, List, Optional, Tuple
+from typing import Union
 import google.generativeai as genai
-import PIL.Image
-import io
+from .analysis_cache import AnalysisCache, get_analysis_cache
+from .screenshot_preprocessor import PayloadStats, PreparedScreenshot, ensure_prepared
+from .gemini_client import get_gemini_client
 
 logger = logging.getLogger(__name__)
 
+# プロンプトを変えたら上げる（分析キャッシュのキーに含まれる）
+PAGE_ANALYSIS_PROMPT_VERSION = 'page-analysis-v5'
+
+# Geminiの構造化出力に渡すスキーマ（問題1件分は_analyze_with_geminiと共通）
+ISSUE_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'type': {'type': 'string'},
+        'description': {'type': 'string'},
+        'severity': {'type': 'string', 'enum': ['high', 'medium', 'low']},
+        'element': {'type': 'string'},
+        'visual': {'type': 'boolean'}
+    },
+    'required': ['type', 'description', 'severity']
+}
+
+PAGE_ANALYSIS_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'issues': {'type': 'array', 'items': ISSUE_SCHEMA},
+        'actions': {
+            'type': 'array',
+            'items': {
+                'type': 'object',
+                'properties': {
+                    'type': {'type': 'string', 'enum': ['click', 'fill', 'select', 'scroll', 'wait']},
+                    'selector': {'type': 'string'},
+                    'value': {'type': 'string', 'nullable': True},
+                    'description': {'type': 'string'},
+                    'priority': {'type': 'string', 'enum': ['high', 'medium', 'low']}
+                },
+                'required': ['type', 'selector', 'description']
+            }
+        },
+        'navigation_suggestions': {
+            'type': 'array',
+            'items': {
+                'type': 'object',
+                'properties': {'url': {'type': 'string'}, 'reason': {'type': 'string'}},
+                'required': ['url']
+            }
+        }
+    },
+    'required': ['issues', 'actions', 'navigation_suggestions']
+}
+
+
+def normalize_issues(issues) -> List[Dict]:
+    """問題のリストから、途中で切れて説明がないものなどを除く"""
+    if not isinstance(issues, list):
+        return []
+    return [issue for issue in issues if isinstance(issue, dict) and issue.get('description')]
+
 
 class GeminiPageAnalyzer:
     """Gemini APIを使用してページを分析し、次の操作を生成するクラス"""
     
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, payload_stats: Optional[PayloadStats] = None):
         genai.configure(api_key=api_key)
-        self.model = genai.GenerativeModel('gemini-2.0-flash-exp')
+        self.gemini = get_gemini_client()
+        self.cache = get_analysis_cache()
+        self.payload_stats = payload_stats or PayloadStats()
+        
+    def analyze_page(self,
+                     url: str,
+                     screenshot: Union[bytes, PreparedScreenshot],
+                     page_outline: str,
+                     page_title: str,
+                     variant: str = '') -> Dict:
+        """1回のリクエストで、ページの問題・次に実行すべきアクション・次に訪問すべきURLをまとめて取得
+
+        同じURL・DOM・見た目・variant（ビューポートなど）の結果はキャッシュから返す。
+        screenshotはprepare_screenshotで準備済みのものを渡せば、他の分析と縮小・エンコード結果を共有できる。
+        page_outlineはdistill_pageで取得したページ構造のテキスト。
+        プロンプトには、訪問済みページ数のようなクロールの進み方（並列実行時の完了順）で変わる値を入れない
+        （分析キャッシュのキーとLLM_TRANSPORT_MODE=replayの記録のキーが、同じページで一致するように）。
+        """
+        cache_key = AnalysisCache.make_key('page', PAGE_ANALYSIS_PROMPT_VERSION, url, page_outline, screenshot, variant)
+        cached = self.cache.get(cache_key)
+        if cached is not None:
+            logger.info(f"Gemini analysis cache hit for {url}")
+            return cached
         
-    def analyze_page_and_generate_actions(self, 
-                                        url: str,
-                                        screenshot: bytes,
-                                        page_content: str,
-                                        page_title: str,
-                                        current_state: Dict) -> Dict:
-        """ページを分析し、次に実行すべきアクションを生成"""
         try:
-            # 画像をGemini用に準備
-            image = PIL.Image.open(io.BytesIO(screenshot))
+            # 画像をGemini用に準備（縮小・分割・JPEG/WebP化）
+            prepared = ensure_prepared(screenshot)
             
             # マルチモーダルプロンプト
             prompt = f"""
-            あなたは優秀なQAエンジニアです。ウェブページを分析し、次に実行すべきテストアクションを提案してください。
+            あなたは優秀なQAエンジニアです。ウェブページを詳細に分析してバグや問題を見つけ、
+            次に実行すべきテストアクションを提案してください。
 
             現在のページ情報:
             - URL: {url}
             - タイトル: {page_title}
-            - 訪問済みページ数: {current_state.get('pages_visited', 0)}
-            - 現在の深さ: {current_state.get('depth', 0)}
+            - 添付画像: {prepared.describe()}
+
+            問題の分析項目：
+            1. レイアウトの崩れ（要素の重なり、配置の問題）
+            2. テキストの読みにくさ（フォントサイズ、色のコントラスト）
+            3. ボタンやリンクの問題（クリックできない、小さすぎる）
+            4. フォームの問題（ラベルがない、バリデーションエラー）
+            5. 画像の問題（表示されない、altテキストがない）
+            6. レスポンシブデザインの問題
+            7. 一般的なUI/UXの問題
 
-            以下の観点でページを分析してください：
+            アクションの提案項目：
             1. ログインフォームがある場合は、ログイン操作を提案
             2. ボタンやリンクのクリック操作
             3. フォームへの入力操作
@@ -45,8 +125,17 @@ class GeminiPageAnalyzer:
             5. タブやアコーディオンの展開
             6. スクロールが必要な要素の検出
 
-            次のJSON形式で、実行すべきアクションのリストを返してください：
+            次のJSON形式で返してください：
             {{
+                "issues": [
+                    {{
+                        "type": "問題の種類",
+                        "description": "詳細な説明",
+                        "severity": "high|medium|low",
+                        "element": "問題のある要素",
+                        "visual": true/false
+                    }}
+                ],
                 "actions": [
                     {{
                         "type": "click|fill|select|scroll|wait",
@@ -61,14 +150,6 @@ class GeminiPageAnalyzer:
                         "url": "推奨される次のURL",
                         "reason": "なぜこのURLを訪問すべきか"
                     }}
-                ],
-                "issues_found": [
-                    {{
-                        "type": "バグの種類",
-                        "description": "詳細な説明",
-                        "severity": "high|medium|low",
-                        "element": "問題のある要素"
-                    }}
                 ]
             }}
 
@@ -77,18 +158,26 @@ class GeminiPageAnalyzer:
             - テスト用の一般的な認証情報を使用: (例: test@example.com / password123)
             - 重要な機能（購入、送信、削除など）は慎重に扱ってください
             - 同じアクションを繰り返さないように注意してください
+            - selectorには、下のページ構造に書かれたセレクタをできるだけそのまま使ってください
 
-            HTMLコンテンツの一部:
-            {page_content[:3000]}
+            ページ構造（表示中のランドマーク・見出し・フォーム・操作可能な要素とセレクタ・本文）:
+            {page_outline}
             """
             
             # Gemini APIを呼び出し
-            response = self.model.generate_content([prompt, image])
+            contents = [prompt, *prepared.parts()]
+            data, response = self.gemini.generate_json(contents, PAGE_ANALYSIS_SCHEMA, 'page_analysis')
+            latency_ms = response.latency_ms
+            self.payload_stats.record(prepared, latency_ms)
+            logger.info(f"Gemini page analysis request for {url}: {prepared.payload_bytes} bytes "
+                        f"in {len(prepared.tiles)} image(s), {latency_ms}ms")
             
-            # レスポンスをパース
-            result = self._parse_gemini_response(response.text)
+            result = self._normalize_result(data)
+            if data is not None:
+                # 読めなかった応答はキャッシュしない
+                self.cache.set(cache_key, result)
             
-            logger.info(f"Gemini generated {len(result.get('actions', []))} actions")
+            logger.info(f"Gemini found {len(result['issues'])} issues and generated {len(result['actions'])} actions")
             return result
             
         except Exception as e:
@@ -96,33 +185,29 @@ class GeminiPageAnalyzer:
             return {
                 "actions": [],
                 "navigation_suggestions": [],
-                "issues_found": []
+                "issues": []
             }
     
-    def _parse_gemini_response(self, text: str) -> Dict:
-        """Geminiのレスポンスをパース"""
-        try:
-            # JSONブロックを抽出
-            start = text.find('{')
-            end = text.rfind('}') + 1
-            if start >= 0 and end > start:
-                json_str = text[start:end]
-                return json.loads(json_str)
-        except Exception as e:
-            logger.error(f"Failed to parse Gemini response: {e}")
-        
-        # フォールバック
-        return {
-            "actions": [],
-            "navigation_suggestions": [],
-            "issues_found": []
-        }
+    def _normalize_result(self, data: Optional[Dict]) -> Dict:
+        """解析済みの応答を整える（欠けているキーは空リストで補う）"""
+        result = dict(data or {})
+        # 旧形式のキー名にも対応
+        if 'issues' not in result and 'issues_found' in result:
+            result['issues'] = result.pop('issues_found')
+        for key in ('actions', 'navigation_suggestions', 'issues'):
+            if not isinstance(result.get(key), list):
+                result[key] = []
+        result['issues'] = normalize_issues(result['issues'])
+        result['actions'] = [a for a in result['actions'] if isinstance(a, dict) and a.get('type')]
+        return result
 
 
 class PlaywrightActionExecutor:
-    """Geminiが生成したアクションをPlaywrightで実行するクラス"""
+    """Geminiが生成したアクションをPlaywright（async API）で実行するクラス"""
     
-    def __init__(self):
+    def __init__(self, screenshot_store=None):
+        # 指定された場合、クリック後のスクリーンショットはbase64ではなくストアの参照で返す
+        self.screenshot_store = screenshot_store
         self.action_handlers = {
             'click': self._handle_click,
             'fill': self._handle_fill,
@@ -131,7 +216,7 @@ class PlaywrightActionExecutor:
             'wait': self._handle_wait
         }
     
-    def execute_actions(self, page, actions: List[Dict]) -> List[Dict]:
+    async def execute_actions(self, page, actions: List[Dict]) -> List[Dict]:
         """アクションリストを実行"""
         results = []
         
@@ -141,7 +226,7 @@ class PlaywrightActionExecutor:
                 handler = self.action_handlers.get(action_type)
                 
                 if handler:
-                    result = handler(page, action)
+                    result = await handler(page, action)
                     results.append({
                         'action': action,
                         'success': result['success'],
@@ -161,7 +246,7 @@ class PlaywrightActionExecutor:
         
         return results
     
-    def _handle_click(self, page, action: Dict) -> Dict:
+    async def _handle_click(self, page, action: Dict) -> Dict:
         """クリックアクションを処理"""
         try:
             selector = action.get('selector', '')
@@ -175,15 +260,20 @@ class PlaywrightActionExecutor:
             
             # 要素が見つかったらクリック
             if element:
-                element.wait_for(state='visible', timeout=5000)
-                element.click()
+                await element.wait_for(state='visible', timeout=5000)
+                await element.click()
                 
                 # クリック後のスクリーンショット
-                screenshot = page.screenshot()
+                screenshot = await page.screenshot()
+                
+                if self.screenshot_store:
+                    screenshot_ref = await asyncio.to_thread(self.screenshot_store.put, screenshot)
+                else:
+                    screenshot_ref = base64.b64encode(screenshot).decode('utf-8')
                 
                 return {
                     'success': True,
-                    'screenshot': base64.b64encode(screenshot).decode('utf-8')
+                    'screenshot': screenshot_ref
                 }
             else:
                 return {
@@ -197,7 +287,7 @@ class PlaywrightActionExecutor:
                 'error': str(e)
             }
     
-    def _handle_fill(self, page, action: Dict) -> Dict:
+    async def _handle_fill(self, page, action: Dict) -> Dict:
         """入力アクションを処理"""
         try:
             selector = action.get('selector', '')
@@ -205,8 +295,8 @@ class PlaywrightActionExecutor:
             
             element = page.locator(selector).first
             if element:
-                element.wait_for(state='visible', timeout=5000)
-                element.fill(value)
+                await element.wait_for(state='visible', timeout=5000)
+                await element.fill(value)
                 
                 return {'success': True}
             else:
@@ -221,7 +311,7 @@ class PlaywrightActionExecutor:
                 'error': str(e)
             }
     
-    def _handle_select(self, page, action: Dict) -> Dict:
+    async def _handle_select(self, page, action: Dict) -> Dict:
         """選択アクションを処理"""
         try:
             selector = action.get('selector', '')
@@ -229,8 +319,8 @@ class PlaywrightActionExecutor:
             
             element = page.locator(selector).first
             if element:
-                element.wait_for(state='visible', timeout=5000)
-                element.select_option(value)
+                await element.wait_for(state='visible', timeout=5000)
+                await element.select_option(value)
                 
                 return {'success': True}
             else:
@@ -245,7 +335,7 @@ class PlaywrightActionExecutor:
                 'error': str(e)
             }
     
-    def _handle_scroll(self, page, action: Dict) -> Dict:
+    async def _handle_scroll(self, page, action: Dict) -> Dict:
         """スクロールアクションを処理"""
         try:
             selector = action.get('selector')
@@ -254,10 +344,10 @@ class PlaywrightActionExecutor:
                 # 特定の要素までスクロール
                 element = page.locator(selector).first
                 if element:
-                    element.scroll_into_view_if_needed()
+                    await element.scroll_into_view_if_needed()
             else:
                 # ページ全体をスクロール
-                page.evaluate("window.scrollTo(0, document.body.scrollHeight)")
+                await page.evaluate("window.scrollTo(0, document.body.scrollHeight)")
             
             return {'success': True}
             
@@ -267,11 +357,11 @@ class PlaywrightActionExecutor:
                 'error': str(e)
             }
     
-    def _handle_wait(self, page, action: Dict) -> Dict:
+    async def _handle_wait(self, page, action: Dict) -> Dict:
         """待機アクションを処理"""
         try:
             duration = action.get('value', 1000)  # デフォルト1秒
-            page.wait_for_timeout(duration)
+            await page.wait_for_timeout(duration)
             
             return {'success': True}
             
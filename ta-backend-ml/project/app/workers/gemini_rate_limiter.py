@@ -0,0 +1,344 @@
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from contextvars import ContextVar
+from typing import Deque, Dict, List, Optional, Tuple
+
+from .dom_distiller import estimate_tokens
+from .redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+# 画像1枚あたりのトークン見積もり（1280x720のタイルは768px四方のクロップ4枚 x 258トークン相当）
+IMAGE_TOKENS = 258 * 4
+
+# 公平キューと呼び出しの記録で使う呼び出し元セッション（_process_pageなどのタスク単位で設定する）
+_current_session: ContextVar[str] = ContextVar('gemini_rate_limit_session', default='')
+
+
+def set_llm_session(session_id: Optional[str]):
+    """以降のLLM呼び出しを、このセッションの分として公平キューに並べ、記録する"""
+    _current_session.set(session_id or '')
+
+
+def get_llm_session() -> str:
+    """現在のタスクのLLM呼び出し元セッション（未設定なら空文字）"""
+    return _current_session.get()
+
+
+def estimate_request_tokens(contents) -> int:
+    """generate_contentに渡すcontentsの入力トークン数と、出力トークンの見積もりの合計"""
+    if not isinstance(contents, (list, tuple)):
+        contents = [contents]
+    tokens = int(os.getenv('GEMINI_OUTPUT_TOKEN_ESTIMATE', '1024'))
+    for part in contents:
+        if isinstance(part, str):
+            tokens += estimate_tokens(part)
+        else:
+            tokens += IMAGE_TOKENS
+    return tokens
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """Gemini APIの429（ResourceExhausted）かどうか"""
+    try:
+        from google.api_core import exceptions as api_exceptions
+        if isinstance(error, (api_exceptions.ResourceExhausted, api_exceptions.TooManyRequests)):
+            return True
+    except ImportError:
+        pass
+    return getattr(error, 'code', None) == 429 or '429' in str(error)[:200]
+
+
+class RateLimitTimeout(Exception):
+    """GEMINI_RATE_LIMIT_MAX_WAIT_SECONDS秒待ってもリクエスト枠を取得できなかった"""
+
+
+# トークンバケット（RPMとTPMの2つ）と公平キューをまとめて判定するスクリプト
+#   KEYS: バケット(hash), 待機中セッション(zset: 最後に枠を得た時刻), ハートビート(zset: 期限), 最終取得時刻(hash)
+#   ARGV: セッション, 見積もりトークン数, RPM, TPM, ハートビート秒数, 回復秒数, 待たない試行なら1
+# 戻り値: {取得できたら1, 次に試すまでの秒数（文字列）}
+_ACQUIRE_SCRIPT = '''
+if redis.replicate_commands then pcall(redis.replicate_commands) end
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local session = ARGV[1]
+local cost = tonumber(ARGV[2])
+local rpm = tonumber(ARGV[3])
+local tpm = tonumber(ARGV[4])
+local heartbeat = tonumber(ARGV[5])
+local recovery = tonumber(ARGV[6])
+local probe = ARGV[7] == '1'
+
+for _, s in ipairs(redis.call('ZRANGEBYSCORE', KEYS[3], '-inf', now)) do
+    redis.call('ZREM', KEYS[2], s)
+    redis.call('ZREM', KEYS[3], s)
+end
+redis.call('ZADD', KEYS[3], now + heartbeat, session)
+redis.call('ZADD', KEYS[2], 'NX', tonumber(redis.call('HGET', KEYS[4], session) or '0'), session)
+local head = redis.call('ZRANGE', KEYS[2], 0, 0)[1]
+
+local b = redis.call('HMGET', KEYS[1], 'req', 'tok', 'ts', 'factor', 'cooldown_until')
+local elapsed = math.max(0, now - (tonumber(b[3]) or now))
+local factor = math.min(1, (tonumber(b[4]) or 1) + elapsed / recovery)
+local req = math.min(rpm, (tonumber(b[1]) or rpm) + elapsed * rpm * factor / 60)
+local tok = math.min(tpm, (tonumber(b[2]) or tpm) + elapsed * tpm * factor / 60)
+local cooldown_until = tonumber(b[5]) or 0
+local need = math.min(cost, tpm)
+
+local wait = 0
+if cooldown_until > now then wait = cooldown_until - now end
+if req < 1 then wait = math.max(wait, (1 - req) * 60 / (rpm * factor)) end
+if tok < need then wait = math.max(wait, (need - tok) * 60 / (tpm * factor)) end
+local granted = 0
+if wait == 0 and head == session then
+    req = req - 1
+    tok = tok - need
+    granted = 1
+    redis.call('ZREM', KEYS[2], session)
+    redis.call('ZREM', KEYS[3], session)
+    redis.call('HSET', KEYS[4], session, tostring(now))
+end
+if granted == 0 and probe then
+    redis.call('ZREM', KEYS[2], session)
+    redis.call('ZREM', KEYS[3], session)
+end
+redis.call('HSET', KEYS[1], 'req', tostring(req), 'tok', tostring(tok), 'ts', tostring(now), 'factor', tostring(factor))
+for i = 1, 4 do redis.call('EXPIRE', KEYS[i], 3600) end
+if granted == 1 then return {1, '0'} end
+if wait == 0 then wait = 0.05 end
+return {0, tostring(wait)}
+'''
+
+# 429を受けたときにレートを下げてクールダウンを設定するスクリプト
+#   ARGV: 最小倍率, 基本クールダウン秒数, 最大クールダウン秒数
+_THROTTLED_SCRIPT = '''
+if redis.replicate_commands then pcall(redis.replicate_commands) end
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local b = redis.call('HMGET', KEYS[1], 'factor', 'strikes', 'last_throttled')
+local strikes = tonumber(b[2]) or 0
+if now - (tonumber(b[3]) or 0) > 60 then strikes = 0 end
+strikes = strikes + 1
+local factor = math.max(tonumber(ARGV[1]), (tonumber(b[1]) or 1) * 0.5)
+local cooldown = math.min(tonumber(ARGV[3]), tonumber(ARGV[2]) * 2 ^ (strikes - 1))
+redis.call('HSET', KEYS[1], 'factor', tostring(factor), 'strikes', strikes, 'last_throttled', tostring(now),
+           'cooldown_until', tostring(now + cooldown), 'req', '0')
+redis.call('EXPIRE', KEYS[1], 3600)
+return tostring(cooldown)
+'''
+
+
+class _LocalBuckets:
+    """Redisに接続できない場合のプロセス内の代替（_ACQUIRE_SCRIPTと同じ判定）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets: Dict[str, Dict] = {}
+        self._waiters: Dict[str, Dict[str, Tuple[float, float]]] = {}
+        self._served: Dict[str, Dict[str, float]] = {}
+
+    def acquire(self, model: str, session: str, cost: int, rpm: float, tpm: float,
+                heartbeat: float, recovery: float, probe: bool = False) -> Tuple[bool, float]:
+        now = time.time()
+        with self._lock:
+            waiters = self._waiters.setdefault(model, {})
+            served = self._served.setdefault(model, {})
+            for s in [s for s, (_, expires) in waiters.items() if expires <= now]:
+                del waiters[s]
+            score = waiters[session][0] if session in waiters else served.get(session, 0.0)
+            waiters[session] = (score, now + heartbeat)
+            head = min(waiters, key=lambda s: waiters[s][0])
+
+            b = self._buckets.setdefault(model, {'req': rpm, 'tok': tpm, 'ts': now, 'factor': 1.0, 'cooldown_until': 0.0})
+            elapsed = max(0.0, now - b['ts'])
+            b['factor'] = min(1.0, b['factor'] + elapsed / recovery)
+            b['req'] = min(rpm, b['req'] + elapsed * rpm * b['factor'] / 60)
+            b['tok'] = min(tpm, b['tok'] + elapsed * tpm * b['factor'] / 60)
+            b['ts'] = now
+            need = min(cost, tpm)
+            wait = max(0.0, b['cooldown_until'] - now)
+            if b['req'] < 1:
+                wait = max(wait, (1 - b['req']) * 60 / (rpm * b['factor']))
+            if b['tok'] < need:
+                wait = max(wait, (need - b['tok']) * 60 / (tpm * b['factor']))
+            if wait == 0 and head == session:
+                b['req'] -= 1
+                b['tok'] -= need
+                del waiters[session]
+                served[session] = now
+                return True, 0.0
+            if probe:
+                del waiters[session]
+            return False, wait or 0.05
+
+    def throttled(self, model: str, min_factor: float, base: float, maximum: float) -> float:
+        now = time.time()
+        with self._lock:
+            b = self._buckets.setdefault(model, {'req': 0.0, 'tok': 0.0, 'ts': now, 'factor': 1.0, 'cooldown_until': 0.0})
+            strikes = b.get('strikes', 0) if now - b.get('last_throttled', 0.0) <= 60 else 0
+            b['strikes'] = strikes + 1
+            b['last_throttled'] = now
+            b['factor'] = max(min_factor, b['factor'] * 0.5)
+            cooldown = min(maximum, base * 2 ** strikes)
+            b['cooldown_until'] = now + cooldown
+            b['req'] = 0.0
+            return cooldown
+
+
+class GeminiRateLimiter:
+    """全ワーカーで共有するGemini APIのレートリミッター
+
+    モデルごとにRPM（リクエスト数/分）とTPM（トークン数/分）のトークンバケットをRedisに置き、
+    Luaスクリプトで原子的に枠を取る。429を受けると、そのモデルのレートを半分に下げてクールダウンし
+    （連続すると指数的に延長）、時間とともにGEMINI_RATE_LIMIT_RECOVERY_SECONDSで元のレートへ戻す。
+    枠を待つリクエストは、最後に枠を得た時刻が古いセッションから順に通す（セッション間の公平キュー）。
+    Redisに接続できない場合はプロセス内のバケットで同じ制御を行う。
+    """
+
+    def __init__(self):
+        self.default_rpm = float(os.getenv('GEMINI_RPM', '60'))
+        self.default_tpm = float(os.getenv('GEMINI_TPM', '1000000'))
+        # モデルごとの上書き（例: gemini-2.0-flash-exp=10:4000000,gemini-1.5-pro=2:32000）
+        self.model_limits: Dict[str, Tuple[float, float]] = {}
+        for entry in os.getenv('GEMINI_RATE_LIMITS', '').split(','):
+            if '=' in entry and ':' in entry:
+                name, limits = entry.strip().split('=', 1)
+                rpm, tpm = limits.split(':', 1)
+                self.model_limits[name.strip()] = (float(rpm), float(tpm))
+        self.max_wait_seconds = float(os.getenv('GEMINI_RATE_LIMIT_MAX_WAIT_SECONDS', '300'))
+        self.max_throttle_retries = int(os.getenv('GEMINI_RATE_LIMIT_MAX_RETRIES', '4'))
+        self.recovery_seconds = float(os.getenv('GEMINI_RATE_LIMIT_RECOVERY_SECONDS', '60'))
+        self.min_factor = float(os.getenv('GEMINI_RATE_LIMIT_MIN_FACTOR', '0.1'))
+        self.cooldown_seconds = float(os.getenv('GEMINI_RATE_LIMIT_COOLDOWN_SECONDS', '2'))
+        self.max_cooldown_seconds = float(os.getenv('GEMINI_RATE_LIMIT_MAX_COOLDOWN_SECONDS', '60'))
+        self.heartbeat_seconds = 5.0
+        self.prefix = os.getenv('GEMINI_RATE_LIMIT_REDIS_PREFIX', 'qa3:gemini_rl:')
+        self.local = _LocalBuckets()
+        self.redis = None
+        try:
+            self.redis = get_redis()
+            self._acquire_script = self.redis.register_script(_ACQUIRE_SCRIPT)
+            self._throttled_script = self.redis.register_script(_THROTTLED_SCRIPT)
+        except Exception as e:
+            logger.warning(f"Gemini rate limiter falling back to per-process buckets: {e}")
+            self.redis = None
+        self._redis_retry_at = 0.0
+        self._lock = threading.Lock()
+        self._waits: Deque[float] = deque(maxlen=1000)
+        self._stats = {
+            'acquired': 0,
+            'wait_seconds_total': 0.0,
+            'max_wait_seconds': 0.0,
+            'throttled': 0,
+            'timeouts': 0,
+            'redis_errors': 0
+        }
+
+    def limits_for(self, model: str) -> Tuple[float, float]:
+        return self.model_limits.get(model, (self.default_rpm, self.default_tpm))
+
+    def _keys(self, model: str) -> List[str]:
+        base = f"{self.prefix}{model}:"
+        return [base + 'bucket', base + 'waiters', base + 'heartbeat', base + 'served']
+
+    def _use_redis(self) -> bool:
+        return self.redis is not None and time.monotonic() >= self._redis_retry_at
+
+    def _redis_failed(self, e: Exception):
+        # Redisの障害中は30秒間プロセス内のバケットで代替する
+        with self._lock:
+            self._stats['redis_errors'] += 1
+            if time.monotonic() < self._redis_retry_at:
+                return
+            self._redis_retry_at = time.monotonic() + 30
+        logger.warning(f"Gemini rate limiter Redis error, using per-process buckets for 30s: {e}")
+
+    def _try_acquire(self, model: str, session: str, cost: int, probe: bool = False) -> Tuple[bool, float]:
+        rpm, tpm = self.limits_for(model)
+        if self._use_redis():
+            try:
+                granted, wait = self._acquire_script(
+                    keys=self._keys(model),
+                    args=[session, cost, rpm, tpm, self.heartbeat_seconds, self.recovery_seconds, int(probe)]
+                )
+                return int(granted) == 1, float(wait)
+            except Exception as e:
+                self._redis_failed(e)
+        return self.local.acquire(model, session, cost, rpm, tpm, self.heartbeat_seconds, self.recovery_seconds, probe)
+
+    def acquire(self, model: str, tokens: int, session_id: Optional[str] = None) -> float:
+        """リクエスト1回分とtokens分の枠を取るまで待ち、待った秒数を返す"""
+        model = model.replace('models/', '')
+        session = session_id if session_id is not None else _current_session.get()
+        started = time.monotonic()
+        while True:
+            granted, wait = self._try_acquire(model, session or 'default', tokens)
+            waited = time.monotonic() - started
+            if granted:
+                self._record_wait(waited)
+                return waited
+            if waited + wait > self.max_wait_seconds:
+                with self._lock:
+                    self._stats['timeouts'] += 1
+                raise RateLimitTimeout(f"Waited {waited:.1f}s for a {model} request slot (next in {wait:.1f}s)")
+            # ハートビートが切れないよう1秒以内に再確認する
+            time.sleep(min(wait, 1.0) * random.uniform(0.8, 1.2))
+
+    def try_acquire(self, model: str, tokens: int) -> bool:
+        """待たずに枠を取れる場合だけ取る（ヘッジなど、送らなくてもよいリクエスト用）"""
+        model = model.replace('models/', '')
+        granted, _ = self._try_acquire(model, _current_session.get() or 'default', tokens, probe=True)
+        if granted:
+            self._record_wait(0.0)
+        return granted
+
+    def report_throttled(self, model: str) -> float:
+        """429を受けたことを全ワーカーに共有し、クールダウン秒数を返す"""
+        model = model.replace('models/', '')
+        with self._lock:
+            self._stats['throttled'] += 1
+        if self._use_redis():
+            try:
+                return float(self._throttled_script(
+                    keys=self._keys(model)[:1],
+                    args=[self.min_factor, self.cooldown_seconds, self.max_cooldown_seconds]
+                ))
+            except Exception as e:
+                self._redis_failed(e)
+        return self.local.throttled(model, self.min_factor, self.cooldown_seconds, self.max_cooldown_seconds)
+
+    def _record_wait(self, waited: float):
+        with self._lock:
+            self._stats['acquired'] += 1
+            self._stats['wait_seconds_total'] += waited
+            self._stats['max_wait_seconds'] = max(self._stats['max_wait_seconds'], waited)
+            self._waits.append(waited)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            waits = sorted(self._waits)
+        stats['backend'] = 'redis' if self._use_redis() else 'local'
+        stats['wait_seconds_total'] = round(stats['wait_seconds_total'], 3)
+        stats['max_wait_seconds'] = round(stats['max_wait_seconds'], 3)
+        # 直近1000回の待ち時間のパーセンタイル
+        for name, q in (('p50_wait_ms', 0.5), ('p95_wait_ms', 0.95), ('p99_wait_ms', 0.99)):
+            stats[name] = round(waits[min(len(waits) - 1, int(len(waits) * q))] * 1000, 1) if waits else 0.0
+        return stats
+
+
+_limiter: Optional[GeminiRateLimiter] = None
+_limiter_lock = threading.Lock()
+
+
+def get_gemini_rate_limiter() -> GeminiRateLimiter:
+    """プロセス共有のGeminiレートリミッターを取得"""
+    global _limiter
+    with _limiter_lock:
+        if _limiter is None:
+            _limiter = GeminiRateLimiter()
+        return _limiter
@@ -0,0 +1,125 @@
+import json
+import logging
+import re
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+_FENCE = re.compile(r'```(?:json)?\s*(.*?)(?:```|$)', re.DOTALL | re.IGNORECASE)
+_TRAILING_COMMA = re.compile(r',\s*([}\]])')
+_CLOSERS = {'{': '}', '[': ']'}
+_decoder = json.JSONDecoder()
+
+
+def _json_fragment(text: str) -> str:
+    """コードフェンスや前置きの文章を除いた、最初の{または[から後ろ"""
+    fence = _FENCE.search(text)
+    if fence and ('{' in fence.group(1) or '[' in fence.group(1)):
+        text = fence.group(1)
+    starts = [i for i in (text.find('{'), text.find('[')) if i >= 0]
+    return text[min(starts):] if starts else ''
+
+
+def _close_truncated(fragment: str) -> Optional[Any]:
+    """途中で切れたJSONを閉じて読む
+
+    文字列の外にある , { [ の位置を切り詰め候補として記録し、末尾から順に
+    「そこまでで切って開いている括弧を閉じた」ものを試す。最初に読めたものを返す。
+    """
+    stack: List[str] = []
+    cut_points: List[Tuple[int, str]] = []
+    in_string = False
+    escaped = False
+    for i, ch in enumerate(fragment):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == '\\':
+                escaped = True
+            elif ch == '"':
+                in_string = False
+            continue
+        if ch == '"':
+            in_string = True
+        elif ch in _CLOSERS:
+            stack.append(_CLOSERS[ch])
+            cut_points.append((i + 1, ''.join(reversed(stack))))
+        elif ch in '}]':
+            if stack:
+                stack.pop()
+            if not stack:
+                # 最上位の値が閉じた（切れていない）
+                return None
+        elif ch == ',':
+            cut_points.append((i, ''.join(reversed(stack))))
+
+    # 末尾の値をそのまま閉じる（文字列の途中ならまず文字列を閉じる）
+    tail = fragment + ('"' if in_string else '')
+    tail = tail.rstrip().rstrip(',:').rstrip()
+    candidates = [tail + ''.join(reversed(stack))]
+    candidates += [fragment[:pos] + closers for pos, closers in reversed(cut_points)]
+    for candidate in candidates:
+        try:
+            return json.loads(_TRAILING_COMMA.sub(r'\1', candidate))
+        except ValueError:
+            continue
+    return None
+
+
+class ParseStats:
+    """プロンプトごとのLLM応答の解析結果の集計（parsed: そのまま読めた / repaired: 修復して読めた / failed）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts: Dict[str, Dict[str, int]] = {}
+
+    def record(self, prompt_name: str, outcome: str):
+        with self._lock:
+            counts = self._counts.setdefault(prompt_name, {'parsed': 0, 'repaired': 0, 'failed': 0})
+            counts[outcome] += 1
+
+    def stats(self) -> Dict[str, Dict]:
+        with self._lock:
+            stats = {name: dict(counts) for name, counts in self._counts.items()}
+        for counts in stats.values():
+            total = counts['parsed'] + counts['repaired'] + counts['failed']
+            counts['failure_rate'] = round(counts['failed'] / total, 3) if total else 0.0
+        return stats
+
+
+_parse_stats = ParseStats()
+
+
+def get_parse_stats() -> ParseStats:
+    """プロセス共有の解析結果の集計を取得"""
+    return _parse_stats
+
+
+def parse_llm_json(text: Optional[str], prompt_name: str = 'default', expect: Optional[type] = None) -> Optional[Any]:
+    """LLMの応答からJSONを取り出す（読めなければNone）
+
+    そのまま読めなければ、コードフェンスや前後の文章を除き、末尾のカンマを取り、
+    途中で切れていれば閉じて読む。expectを指定した場合、その型でなければ失敗として扱う。
+    """
+    value, outcome = None, 'failed'
+    if text:
+        try:
+            value, outcome = json.loads(text), 'parsed'
+        except ValueError:
+            fragment = _json_fragment(text)
+            if fragment:
+                try:
+                    value, outcome = _decoder.raw_decode(fragment)[0], 'repaired'
+                except ValueError:
+                    try:
+                        value, outcome = _decoder.raw_decode(_TRAILING_COMMA.sub(r'\1', fragment))[0], 'repaired'
+                    except ValueError:
+                        value = _close_truncated(fragment)
+                        outcome = 'repaired' if value is not None else 'failed'
+    if value is not None and expect is not None and not isinstance(value, expect):
+        value, outcome = None, 'failed'
+    _parse_stats.record(prompt_name, outcome)
+    if outcome == 'failed':
+        logger.warning(f"Failed to parse LLM JSON for {prompt_name}: {(text or '')[:200]!r}")
+    return value
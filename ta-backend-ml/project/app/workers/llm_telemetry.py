@@ -0,0 +1,123 @@
+import logging
+import os
+import threading
+from collections import OrderedDict, deque
+from typing import Deque, Dict, Iterable, List, Optional
+
+from .gemini_rate_limiter import get_llm_session
+
+logger = logging.getLogger(__name__)
+
+_PERCENTILES = (('p50', 0.5), ('p95', 0.95), ('p99', 0.99))
+
+
+def image_bytes_of(contents) -> int:
+    """generate_contentに渡すcontentsに含まれる画像のバイト数"""
+    if not isinstance(contents, (list, tuple)):
+        contents = [contents]
+    total = 0
+    for part in contents:
+        if isinstance(part, dict) and isinstance(part.get('data'), (bytes, bytearray)):
+            total += len(part['data'])
+    return total
+
+
+def _percentiles(values: List[float]) -> Dict[str, int]:
+    if not values:
+        return {name: 0 for name, _ in _PERCENTILES}
+    values = sorted(values)
+    return {name: int(values[min(len(values) - 1, int(len(values) * q))]) for name, q in _PERCENTILES}
+
+
+def summarize(calls: Iterable[Dict]) -> Dict:
+    """呼び出しの記録を集計する（全体とプロンプト別。レイテンシはパーセンタイル付き）"""
+    by_prompt: Dict[str, List[Dict]] = {}
+    for call in calls:
+        by_prompt.setdefault(f"{call['provider']}:{call['prompt_name']}", []).append(call)
+
+    def aggregate(records: List[Dict]) -> Dict:
+        outcomes: Dict[str, int] = {}
+        for record in records:
+            outcomes[record['outcome']] = outcomes.get(record['outcome'], 0) + 1
+        latencies = [record['latency_ms'] for record in records]
+        return {
+            'calls': len(records),
+            'input_tokens': sum(record['input_tokens'] for record in records),
+            'output_tokens': sum(record['output_tokens'] for record in records),
+            'total_tokens': sum(record['total_tokens'] for record in records),
+            'image_bytes': sum(record['image_bytes'] for record in records),
+            'latency_ms_total': int(sum(latencies)),
+            'latency_ms': dict(_percentiles(latencies), max=int(max(latencies)) if latencies else 0),
+            'outcomes': outcomes
+        }
+
+    summary = aggregate([record for records in by_prompt.values() for record in records])
+    summary['by_prompt'] = {name: dict(aggregate(records), model=records[-1]['model'])
+                            for name, records in sorted(by_prompt.items())}
+    return summary
+
+
+class LLMTelemetry:
+    """GeminiとDifyの呼び出しごとの記録（モデル・プロンプト名・トークン数・画像バイト数・レイテンシ・結果）
+
+    記録はset_llm_sessionで指定したセッション（テストセッションや会話チケット）ごとに保持し、
+    session_summary()でTestSessionの結果やConversationProcessLogに書く集計を取り出す。
+    プロセス全体のプロンプト別の集計とパーセンタイルはstats()で取得できる。
+    """
+
+    def __init__(self):
+        self.max_sessions = int(os.getenv('LLM_TELEMETRY_MAX_SESSIONS', '1000'))
+        self.max_calls_per_session = int(os.getenv('LLM_TELEMETRY_MAX_CALLS_PER_SESSION', '20000'))
+        self._lock = threading.Lock()
+        self._sessions: 'OrderedDict[str, List[Dict]]' = OrderedDict()
+        self._recent: Deque[Dict] = deque(maxlen=int(os.getenv('LLM_TELEMETRY_WINDOW', '2000')))
+
+    def record(self, provider: str, model: str, prompt_name: str, latency_ms: float, outcome: str,
+               input_tokens: int = 0, output_tokens: int = 0, total_tokens: int = 0, image_bytes: int = 0,
+               session_id: Optional[str] = None):
+        call = {
+            'provider': provider,
+            'model': model,
+            'prompt_name': prompt_name,
+            'input_tokens': int(input_tokens or 0),
+            'output_tokens': int(output_tokens or 0),
+            'total_tokens': int(total_tokens or 0) or int(input_tokens or 0) + int(output_tokens or 0),
+            'image_bytes': int(image_bytes or 0),
+            'latency_ms': round(latency_ms, 1),
+            'outcome': outcome
+        }
+        session_id = session_id if session_id is not None else get_llm_session()
+        with self._lock:
+            self._recent.append(call)
+            if not session_id:
+                return
+            calls = self._sessions.get(session_id)
+            if calls is None:
+                calls = self._sessions[session_id] = []
+                # 集計を取り出されなかったセッションは古いものから捨てる
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+            else:
+                self._sessions.move_to_end(session_id)
+            if len(calls) < self.max_calls_per_session:
+                calls.append(call)
+
+    def session_summary(self, session_id: str, pop: bool = True) -> Dict:
+        """セッションの呼び出しの集計（pop=Trueなら記録を破棄する）"""
+        with self._lock:
+            calls = self._sessions.pop(session_id, []) if pop else list(self._sessions.get(session_id, []))
+        return summarize(calls)
+
+    def stats(self) -> Dict:
+        """プロセス全体の直近LLM_TELEMETRY_WINDOW件の集計"""
+        with self._lock:
+            calls = list(self._recent)
+        return summarize(calls)
+
+
+_telemetry = LLMTelemetry()
+
+
+def get_llm_telemetry() -> LLMTelemetry:
+    """プロセス共有のLLM呼び出しの記録を取得"""
+    return _telemetry
@@ -0,0 +1,500 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+from datetime import datetime
+from types import SimpleNamespace
+from typing import Any, Dict, Optional
+
+from .dom_distiller import estimate_tokens
+from .gemini_rate_limiter import get_llm_session
+from .llm_telemetry import get_llm_telemetry
+
+logger = logging.getLogger(__name__)
+
+MODES = ('live', 'record', 'replay', 'synthetic')
+_TOTAL_TOKENS = re.compile(rb'"total_tokens"\s*:\s*(\d+)')
+
+
+class ReplayMiss(LookupError):
+    """replayモードで記録済みの応答が見つからなかった"""
+
+
+def _normalize(value: Any) -> Any:
+    """リクエストのハッシュ用に、実行ごとに変わらない形へ変換する（バイナリはハッシュに置き換える）"""
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    if isinstance(value, (bytes, bytearray)):
+        return 'sha256:' + hashlib.sha256(value).hexdigest()
+    if isinstance(value, dict):
+        return {str(k): _normalize(v) for k, v in sorted(value.items(), key=lambda item: str(item[0]))}
+    if isinstance(value, (list, tuple)):
+        return [_normalize(v) for v in value]
+    if hasattr(value, 'tobytes'):
+        # PIL画像など
+        return 'sha256:' + hashlib.sha256(value.tobytes()).hexdigest()
+    if hasattr(type(value), 'to_dict'):
+        # proto-plusのメッセージ
+        return _normalize(type(value).to_dict(value))
+    if hasattr(value, '__dict__'):
+        return _normalize({k: v for k, v in vars(value).items() if not k.startswith('_')})
+    return str(value)
+
+
+def request_key(kind: str, payload: Any) -> str:
+    """リクエストの内容から記録のキーを作る"""
+    serialized = json.dumps([kind, _normalize(payload)], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+
+def synthesize_from_schema(schema: Dict) -> Any:
+    """response_schemaを満たす最小の値を作る（syntheticモード用）"""
+    schema_type = str(schema.get('type', 'string')).lower()
+    if schema.get('enum'):
+        return schema['enum'][0]
+    if schema_type == 'object':
+        return {name: synthesize_from_schema(prop) for name, prop in schema.get('properties', {}).items()}
+    if schema_type == 'array':
+        return [synthesize_from_schema(schema.get('items', {'type': 'string'}))]
+    if schema_type in ('integer', 'number'):
+        return 0
+    if schema_type == 'boolean':
+        return False
+    return 'synthetic'
+
+
+class ReplayedGeminiResponse:
+    """記録した（または合成した）generate_contentの応答"""
+
+    def __init__(self, text: Optional[str], usage: Optional[Dict] = None):
+        self._text = text
+        usage = usage or {}
+        self.usage_metadata = SimpleNamespace(
+            prompt_token_count=usage.get('prompt_token_count', 0),
+            candidates_token_count=usage.get('candidates_token_count', 0),
+            total_token_count=usage.get('total_token_count', 0)
+        )
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            # 記録時に候補が返らなかった（安全性フィルターなど）。本物と同じくValueErrorにする
+            raise ValueError("The recorded response did not contain any text")
+        return self._text
+
+
+class _RecordedContent:
+    """aiohttpのresponse.contentの代わり（iter_chunkedのみ）"""
+
+    def __init__(self, body: bytes, chunk_delay: float):
+        self._body = body
+        self._chunk_delay = chunk_delay
+
+    async def iter_chunked(self, size: int):
+        for start in range(0, len(self._body), size):
+            if self._chunk_delay:
+                await asyncio.sleep(self._chunk_delay)
+            yield self._body[start:start + size]
+
+
+class RecordedHTTPResponse:
+    """記録した（または合成した）Difyの応答。呼び出し側が使うaiohttpのレスポンスの機能だけを持つ"""
+
+    def __init__(self, status: int, headers: Dict[str, str], body: bytes, stream_seconds: float = 0.0):
+        self.status = status
+        self.headers = headers
+        self._body = body
+        chunks = max(1, -(-len(body) // 2048))
+        self.content = _RecordedContent(body, stream_seconds / chunks)
+
+    async def read(self) -> bytes:
+        return self._body
+
+    async def text(self) -> str:
+        return self._body.decode('utf-8', errors='replace')
+
+    async def json(self) -> Any:
+        return json.loads(self._body.decode('utf-8'))
+
+    def release(self):
+        pass
+
+
+class _PostContext:
+    """session.post()の戻り値の代わり（awaitでもasync withでも使える）"""
+
+    def __init__(self, coro):
+        self._coro = coro
+        self._response = None
+
+    def __await__(self):
+        return self._coro.__await__()
+
+    async def __aenter__(self):
+        self._response = await self._coro
+        return self._response
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if self._response is not None:
+            self._response.release()
+        return False
+
+
+class _DifyCall:
+    """Dify呼び出し1件の計測。応答を読み終えた（または捨てた）時点でLLMTelemetryに記録する"""
+
+    def __init__(self, prompt_name: str, payload: Dict):
+        self.prompt_name = prompt_name
+        self.input_tokens = estimate_tokens(json.dumps(payload.get('inputs') or {}, ensure_ascii=False))
+        self.session_id = get_llm_session()
+        self.sent = time.monotonic()
+        self.status: Optional[int] = None
+        self._done = False
+
+    def finish(self, body: Optional[bytes] = None, error: bool = False):
+        if self._done:
+            return
+        self._done = True
+        if error or self.status is None:
+            outcome = 'error'
+        elif self.status == 200:
+            outcome = 'ok'
+        elif self.status == 429:
+            outcome = 'throttled'
+        else:
+            outcome = f"http_{self.status}"
+        # ワークフローのトークン数は応答（ストリーミングならworkflow_finished）のtotal_tokensにある
+        matches = _TOTAL_TOKENS.findall(body or b'')
+        get_llm_telemetry().record(
+            'dify', 'dify-workflow', self.prompt_name, (time.monotonic() - self.sent) * 1000, outcome,
+            input_tokens=self.input_tokens, total_tokens=int(matches[-1]) if matches else 0,
+            session_id=self.session_id
+        )
+
+
+class _TimedContent:
+    """response.contentを包み、ストリームの終わりで呼び出しを記録する"""
+
+    _TAIL_BYTES = 16384
+
+    def __init__(self, content, call: _DifyCall):
+        self._content = content
+        self._call = call
+
+    async def iter_chunked(self, size: int):
+        tail = b''
+        try:
+            async for chunk in self._content.iter_chunked(size):
+                tail = (tail + chunk)[-self._TAIL_BYTES:]
+                yield chunk
+        except Exception:
+            self._call.finish(tail, error=True)
+            raise
+        self._call.finish(tail)
+
+    def __getattr__(self, name):
+        return getattr(self._content, name)
+
+
+class _TimedResponse:
+    """Difyの応答を包み、読み終わりでレイテンシ・トークン数・結果を記録する（それ以外はそのまま）"""
+
+    def __init__(self, response, call: _DifyCall):
+        self._response = response
+        self._call = call
+        call.status = response.status
+        self.content = _TimedContent(response.content, call)
+
+    async def read(self) -> bytes:
+        try:
+            body = await self._response.read()
+        except Exception:
+            self._call.finish(error=True)
+            raise
+        self._call.finish(body)
+        return body
+
+    async def text(self) -> str:
+        body = await self.read()
+        return body.decode('utf-8', errors='replace')
+
+    async def json(self) -> Any:
+        body = await self.read()
+        return json.loads(body.decode('utf-8'))
+
+    def release(self):
+        self._call.finish()
+        self._response.release()
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+
+class DifySession:
+    """aiohttp.ClientSessionを包み、postをLLMTransport経由にする（呼び出しはprompt_nameで記録する）"""
+
+    def __init__(self, session, transport: 'LLMTransport'):
+        self._session = session
+        self._transport = transport
+
+    def post(self, url: str, prompt_name: str = 'dify', **kwargs) -> _PostContext:
+        return _PostContext(self._transport.dify_post(self._session, url, kwargs, prompt_name))
+
+    def __getattr__(self, name):
+        return getattr(self._session, name)
+
+
+class LLMTransport:
+    """LLM呼び出し（GeminiとDify）の差し替え口
+
+    LLM_TRANSPORT_MODEで動作を切り替える:
+    - live: そのまま呼ぶ
+    - record: そのまま呼び、リクエストのハッシュ→応答（とレイテンシ）をLLM_CASSETTE_DIRに保存する
+    - replay: 保存した応答を返す。レイテンシは記録値（LLM_REPLAY_LATENCY_MSで固定値に上書き）に
+      LLM_REPLAY_JITTER_MSのゆらぎを加え、LLM_REPLAY_ERROR_RATE / LLM_REPLAY_THROTTLE_RATEの割合で
+      5xx / 429を注入する。記録がなければReplayMiss（LLM_REPLAY_ON_MISS=syntheticなら合成応答）
+    - synthetic: 記録なしで、response_schemaを満たす値（Difyは固定の出力）を返す
+    ゆらぎとエラー注入はLLM_REPLAY_SEEDとリクエストのハッシュ・出現回数から決まるので、同じ負荷なら同じ結果になる。
+    レート制限・期限・再試行はGeminiClient側で通常通り働くので、API抜きで処理全体のスループットを測れる。
+    """
+
+    def __init__(self):
+        self.mode = os.getenv('LLM_TRANSPORT_MODE', 'live').lower()
+        if self.mode not in MODES:
+            logger.warning(f"Unknown LLM_TRANSPORT_MODE {self.mode!r}, using live")
+            self.mode = 'live'
+        self.cassette_dir = os.getenv('LLM_CASSETTE_DIR', '/app/output/llm_cassettes')
+        latency = os.getenv('LLM_REPLAY_LATENCY_MS', '')
+        self.fixed_latency_ms = float(latency) if latency else None
+        self.jitter_ms = float(os.getenv('LLM_REPLAY_JITTER_MS', '0'))
+        self.error_rate = float(os.getenv('LLM_REPLAY_ERROR_RATE', '0'))
+        self.throttle_rate = float(os.getenv('LLM_REPLAY_THROTTLE_RATE', '0'))
+        self.seed = os.getenv('LLM_REPLAY_SEED', '0')
+        self.on_miss = os.getenv('LLM_REPLAY_ON_MISS', 'error').lower()
+        self.synthetic_text = os.getenv('LLM_SYNTHETIC_TEXT', 'synthetic response')
+        self.synthetic_dify_outputs = json.loads(os.getenv('LLM_SYNTHETIC_DIFY_OUTPUTS', '') or json.dumps({
+            'text': 'synthetic answer',
+            'resultCode': 'answered',
+            'title': 'synthetic title',
+            'keywords': ['synthetic']
+        }))
+        self._lock = threading.Lock()
+        self._occurrences: Dict[str, int] = {}
+        self._stats = {'live': 0, 'recorded': 0, 'replayed': 0, 'synthetic': 0, 'misses': 0,
+                       'injected_errors': 0, 'injected_throttles': 0}
+        if self.mode != 'live':
+            logger.info(f"LLM transport mode: {self.mode} (cassettes: {self.cassette_dir})")
+
+    # --- Gemini ---
+
+    def generate_content(self, model, model_name: str, contents, request_options: Dict, kwargs: Dict):
+        """model.generate_contentの代わり（GeminiClientのスレッドから呼ばれる）"""
+        if self.mode == 'live':
+            self._count('live')
+            return model.generate_content(contents, request_options=request_options, **kwargs)
+
+        key = request_key('gemini', {'model': model_name, 'contents': contents, 'config': kwargs})
+        if self.mode == 'record':
+            sent = time.monotonic()
+            response = model.generate_content(contents, request_options=request_options, **kwargs)
+            latency_ms = (time.monotonic() - sent) * 1000
+            try:
+                text = response.text
+            except ValueError:
+                text = None
+            self._save('gemini', key, {'text': text, 'usage': self._usage(response)}, latency_ms, contents)
+            return response
+
+        record = self._load('gemini', key)
+        rng = self._rng(key)
+        if record is None:
+            generation_config = kwargs.get('generation_config')
+            schema = generation_config.get('response_schema') if isinstance(generation_config, dict) else None
+            text = json.dumps(synthesize_from_schema(schema), ensure_ascii=False) if schema else self.synthetic_text
+            record = {'response': {'text': text, 'usage': {}}, 'latency_ms': 0}
+        time.sleep(self._latency_ms(record, rng) / 1000)
+        self._inject_gemini_error(rng)
+        response = record['response']
+        return ReplayedGeminiResponse(response.get('text'), response.get('usage'))
+
+    def _usage(self, response) -> Dict:
+        usage = getattr(response, 'usage_metadata', None)
+        return {name: getattr(usage, name, 0) or 0
+                for name in ('prompt_token_count', 'candidates_token_count', 'total_token_count')}
+
+    def _inject_gemini_error(self, rng: random.Random):
+        roll = rng.random()
+        if roll < self.throttle_rate:
+            self._count('injected_throttles')
+            try:
+                from google.api_core import exceptions as api_exceptions
+                raise api_exceptions.ResourceExhausted('429 injected by LLM_REPLAY_THROTTLE_RATE')
+            except ImportError:
+                raise ConnectionError('429 injected by LLM_REPLAY_THROTTLE_RATE')
+        if roll < self.throttle_rate + self.error_rate:
+            self._count('injected_errors')
+            try:
+                from google.api_core import exceptions as api_exceptions
+                raise api_exceptions.ServiceUnavailable('503 injected by LLM_REPLAY_ERROR_RATE')
+            except ImportError:
+                raise ConnectionError('503 injected by LLM_REPLAY_ERROR_RATE')
+
+    # --- Dify ---
+
+    def wrap_session(self, session) -> DifySession:
+        """aiohttp.ClientSessionを包む（postを計測し、live以外では記録・再生・合成に差し替える）"""
+        return DifySession(session, self)
+
+    async def dify_post(self, session, url: str, kwargs: Dict, prompt_name: str):
+        call = _DifyCall(prompt_name, kwargs.get('json') or {})
+        try:
+            if self.mode == 'live':
+                self._count('live')
+                response = await session.post(url, **kwargs)
+            else:
+                response = await self._dify_response(session, url, kwargs)
+        except Exception:
+            call.finish(error=True)
+            raise
+        return _TimedResponse(response, call)
+
+    async def _dify_response(self, session, url: str, kwargs: Dict) -> 'RecordedHTTPResponse':
+        # APIキーはハッシュにだけ含め、記録には残さない
+        authorization = (kwargs.get('headers') or {}).get('Authorization', '')
+        key = request_key('dify', {
+            'url': url,
+            'json': kwargs.get('json'),
+            'data': kwargs.get('data'),
+            'auth': hashlib.sha256(authorization.encode('utf-8')).hexdigest()
+        })
+        if self.mode == 'record':
+            sent = time.monotonic()
+            async with session.post(url, **kwargs) as response:
+                first_byte_ms = (time.monotonic() - sent) * 1000
+                body = await response.read()
+                status = response.status
+                headers = {'Content-Type': response.headers.get('Content-Type', '')}
+            latency_ms = (time.monotonic() - sent) * 1000
+            self._save('dify', key, {
+                'status': status,
+                'headers': headers,
+                'body': body.decode('utf-8', errors='replace'),
+                'first_byte_ms': first_byte_ms
+            }, latency_ms, kwargs.get('json'))
+            return RecordedHTTPResponse(status, headers, body)
+
+        record = self._load('dify', key)
+        rng = self._rng(key)
+        if record is None:
+            record = self._synthetic_dify(kwargs.get('json') or {})
+        latency_ms = self._latency_ms(record, rng)
+        response = record['response']
+        recorded_latency = record.get('latency_ms') or 0
+        first_byte_ms = latency_ms * (response.get('first_byte_ms', recorded_latency) / recorded_latency) \
+            if recorded_latency else latency_ms
+        await asyncio.sleep(first_byte_ms / 1000)
+
+        roll = rng.random()
+        if roll < self.throttle_rate:
+            self._count('injected_throttles')
+            return RecordedHTTPResponse(429, {'Content-Type': 'text/plain'}, b'429 injected by LLM_REPLAY_THROTTLE_RATE')
+        if roll < self.throttle_rate + self.error_rate:
+            self._count('injected_errors')
+            return RecordedHTTPResponse(503, {'Content-Type': 'text/plain'}, b'503 injected by LLM_REPLAY_ERROR_RATE')
+        return RecordedHTTPResponse(response['status'], response.get('headers', {}),
+                                    response['body'].encode('utf-8'), (latency_ms - first_byte_ms) / 1000)
+
+    def _synthetic_dify(self, payload: Dict) -> Dict:
+        outputs = self.synthetic_dify_outputs
+        if payload.get('response_mode') == 'streaming':
+            events = [{'event': 'text_chunk', 'data': {'text': outputs.get('text', '')}},
+                      {'event': 'workflow_finished', 'data': {'outputs': outputs}}]
+            body = ''.join(f"data: {json.dumps(event, ensure_ascii=False)}\n\n" for event in events)
+            headers = {'Content-Type': 'text/event-stream'}
+        else:
+            body = json.dumps({'data': {'outputs': outputs}}, ensure_ascii=False)
+            headers = {'Content-Type': 'application/json'}
+        return {'response': {'status': 200, 'headers': headers, 'body': body}, 'latency_ms': 0}
+
+    # --- 記録 ---
+
+    def _path(self, kind: str, key: str) -> str:
+        return os.path.join(self.cassette_dir, kind, key[:2], f"{key}.json")
+
+    def _save(self, kind: str, key: str, response: Dict, latency_ms: float, request: Any):
+        path = self._path(kind, key)
+        record = {
+            'kind': kind,
+            'key': key,
+            'request_preview': json.dumps(_normalize(request), ensure_ascii=False)[:500],
+            'response': response,
+            'latency_ms': round(latency_ms, 1),
+            'recorded_at': datetime.utcnow().isoformat()
+        }
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(record, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+            self._count('recorded')
+        except OSError as e:
+            logger.warning(f"Failed to record {kind} response {key[:12]}: {e}")
+
+    def _load(self, kind: str, key: str) -> Optional[Dict]:
+        """記録を読む。syntheticモードと、記録がなくLLM_REPLAY_ON_MISS=syntheticの場合はNone"""
+        if self.mode == 'synthetic':
+            self._count('synthetic')
+            return None
+        try:
+            with open(self._path(kind, key), encoding='utf-8') as f:
+                record = json.load(f)
+            self._count('replayed')
+            return record
+        except (OSError, ValueError):
+            self._count('misses')
+            if self.on_miss == 'synthetic':
+                self._count('synthetic')
+                return None
+            raise ReplayMiss(f"No recorded {kind} response for request {key[:12]} in {self.cassette_dir}")
+
+    def _rng(self, key: str) -> random.Random:
+        with self._lock:
+            occurrence = self._occurrences.get(key, 0)
+            self._occurrences[key] = occurrence + 1
+        return random.Random(f"{self.seed}:{key}:{occurrence}")
+
+    def _latency_ms(self, record: Dict, rng: random.Random) -> float:
+        base = self.fixed_latency_ms if self.fixed_latency_ms is not None else record.get('latency_ms', 0)
+        return max(0.0, base + rng.uniform(-self.jitter_ms, self.jitter_ms))
+
+    def _count(self, name: str):
+        with self._lock:
+            self._stats[name] += 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return dict(self._stats, mode=self.mode)
+
+
+_transport: Optional[LLMTransport] = None
+_transport_lock = threading.Lock()
+
+
+def get_llm_transport() -> LLMTransport:
+    """プロセス共有のLLMトランスポートを取得"""
+    global _transport
+    with _transport_lock:
+        if _transport is None:
+            _transport = LLMTransport()
+        return _transport
+
+
+def wrap_dify_session(session):
+    """DifyへのaiohttpセッションをLLM_TRANSPORT_MODEに応じて包む"""
+    return get_llm_transport().wrap_session(session)
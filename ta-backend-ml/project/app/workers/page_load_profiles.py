@@ -0,0 +1,173 @@
+import logging
+import os
+import time
+from typing import Dict, Optional
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+# 解析・広告・計測系のドメイン（サブドメインも含めてブロック）
+TRACKER_DOMAINS = (
+    'google-analytics.com', 'googletagmanager.com', 'googleadservices.com', 'googlesyndication.com',
+    'doubleclick.net', 'adservice.google.com', 'connect.facebook.net', 'facebook.net',
+    'hotjar.com', 'clarity.ms', 'segment.io', 'cdn.segment.com', 'mixpanel.com', 'amplitude.com',
+    'fullstory.com', 'nr-data.net', 'js-agent.newrelic.com', 'criteo.com', 'criteo.net', 'taboola.com',
+    'outbrain.com', 'amazon-adsystem.com', 'adnxs.com', 'scorecardresearch.com',
+    'ads-twitter.com', 'analytics.tiktok.com', 'bat.bing.com'
+)
+
+# ページロードのプロファイル
+#   block_resource_types: Playwrightのresource_type単位でブロック
+#   block_trackers: TRACKER_DOMAINSへのリクエストをブロック
+#   readiness: dom_quiescence（DOM変更が quiet_ms 途切れるまで、最大 max_wait_ms 待つ）/ load / networkidle
+PROFILES = {
+    'analysis': {
+        'block_resource_types': {'media', 'font'},
+        'block_trackers': True,
+        'readiness': 'dom_quiescence',
+        'quiet_ms': 500,
+        'max_wait_ms': 5000
+    },
+    'fidelity': {
+        'block_resource_types': set(),
+        'block_trackers': False,
+        'readiness': 'dom_quiescence',
+        'quiet_ms': 1000,
+        'max_wait_ms': 10000
+    },
+    'legacy': {
+        'block_resource_types': set(),
+        'block_trackers': False,
+        'readiness': 'networkidle',
+        'quiet_ms': 0,
+        'max_wait_ms': 0
+    }
+}
+
+_QUIESCENCE_SCRIPT = '''([quietMs, maxMs]) => new Promise(resolve => {
+    const start = performance.now();
+    let last = start;
+    const observer = new MutationObserver(() => { last = performance.now(); });
+    observer.observe(document.documentElement || document, {
+        childList: true, subtree: true, attributes: true, characterData: true
+    });
+    const tick = () => {
+        const now = performance.now();
+        if (now - last >= quietMs || now - start >= maxMs) {
+            observer.disconnect();
+            resolve({waited_ms: Math.round(now - start), quiescent: now - last >= quietMs});
+        } else {
+            setTimeout(tick, 50);
+        }
+    };
+    setTimeout(tick, 50);
+})'''
+
+
+def get_profile(name: Optional[str] = None) -> Dict:
+    """名前でプロファイルを取得（未指定ならCRAWL_PROFILE、不明な名前はanalysis）"""
+    name = name or os.getenv('CRAWL_PROFILE', 'analysis')
+    if name not in PROFILES:
+        logger.warning(f"Unknown page load profile '{name}', falling back to 'analysis'")
+        name = 'analysis'
+    return {'name': name, **PROFILES[name]}
+
+
+def _is_tracker(url: str) -> bool:
+    host = (urlparse(url).hostname or '').lower()
+    return any(host == domain or host.endswith('.' + domain) for domain in TRACKER_DOMAINS)
+
+
+def _should_block(profile: Dict, request) -> bool:
+    if request.resource_type in profile['block_resource_types']:
+        return True
+    return profile['block_trackers'] and _is_tracker(request.url)
+
+
+def _goto_wait_until(profile: Dict) -> str:
+    # DOM静止を待つ場合はDOMContentLoadedで戻り、その後スクリプトで待つ
+    return 'networkidle' if profile['readiness'] == 'networkidle' else (
+        'load' if profile['readiness'] == 'load' else 'domcontentloaded'
+    )
+
+
+class PageLoadProfile:
+    """ページに適用したプロファイルと、ブロックしたリクエスト数・準備完了までの待ち時間"""
+
+    def __init__(self, profile: Dict):
+        self.profile = profile
+        self.blocked_requests = 0
+        self.readiness: Dict = {}
+
+    def summary(self) -> Dict:
+        """TestResultのdetailsに記録する内容"""
+        return {
+            'load_profile': self.profile['name'],
+            'readiness_mode': self.profile['readiness'],
+            'readiness': self.readiness,
+            'blocked_requests': self.blocked_requests
+        }
+
+    # --- sync API（ContinuousTestExecutor用） ---
+
+    def apply(self, page):
+        """ページにリクエストのブロックを設定"""
+        if not self.profile['block_resource_types'] and not self.profile['block_trackers']:
+            return
+
+        def handle_route(route):
+            if _should_block(self.profile, route.request):
+                self.blocked_requests += 1
+                route.abort()
+            else:
+                route.continue_()
+
+        page.route('**/*', handle_route)
+
+    def goto(self, page, url: str, timeout: int = 30000):
+        """プロファイルの準備完了条件でページに移動し、レスポンスを返す"""
+        started = time.time()
+        response = page.goto(url, wait_until=_goto_wait_until(self.profile), timeout=timeout)
+        self.readiness = {'mode': self.profile['readiness']}
+        if self.profile['readiness'] == 'dom_quiescence':
+            try:
+                self.readiness.update(page.evaluate(
+                    _QUIESCENCE_SCRIPT, [self.profile['quiet_ms'], self.profile['max_wait_ms']]
+                ))
+            except Exception as e:
+                logger.warning(f"DOM quiescence wait failed for {url}: {e}")
+                self.readiness['error'] = str(e)
+        self.readiness['load_ms'] = int((time.time() - started) * 1000)
+        return response
+
+    # --- async API（EnhancedTestExecutor / AsyncCrawlEngine用） ---
+
+    async def apply_async(self, page):
+        """ページにリクエストのブロックを設定"""
+        if not self.profile['block_resource_types'] and not self.profile['block_trackers']:
+            return
+
+        async def handle_route(route):
+            if _should_block(self.profile, route.request):
+                self.blocked_requests += 1
+                await route.abort()
+            else:
+                await route.continue_()
+
+        await page.route('**/*', handle_route)
+
+    async def goto_async(self, page, url: str, timeout: int = 30000):
+        """プロファイルの準備完了条件でページに移動し、レスポンスを返す"""
+        started = time.time()
+        response = await page.goto(url, wait_until=_goto_wait_until(self.profile), timeout=timeout)
+        self.readiness = {'mode': self.profile['readiness']}
+        if self.profile['readiness'] == 'dom_quiescence':
+            try:
+                self.readiness.update(await page.evaluate(
+                    _QUIESCENCE_SCRIPT, [self.profile['quiet_ms'], self.profile['max_wait_ms']]
+                ))
+            except Exception as e:
+                logger.warning(f"DOM quiescence wait failed for {url}: {e}")
+                self.readiness['error'] = str(e)
+        self.readiness['load_ms'] = int((time.time() - started) * 1000)
+        return response
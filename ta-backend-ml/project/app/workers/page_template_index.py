@@ -0,0 +1,92 @@
+import hashlib
+import logging
+import os
+import threading
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# ページ本文の骨格（深さ・タグ・数字を除いたクラス名）を最大2000要素まで列挙するスクリプト
+DOM_SKELETON_SCRIPT = '''() => {
+    const tokens = [];
+    const walk = (el, depth, parent) => {
+        if (tokens.length >= 2000) return;
+        const classes = Array.from(el.classList || [])
+            .map(c => c.replace(/[0-9]+/g, ''))
+            .filter(c => c)
+            .sort()
+            .join('.');
+        const token = el.tagName.toLowerCase() + (classes ? '.' + classes : '');
+        tokens.push(depth + ':' + parent + '>' + token);
+        for (const child of el.children) {
+            if (!['SCRIPT', 'STYLE', 'NOSCRIPT', 'TEMPLATE'].includes(child.tagName)) {
+                walk(child, depth + 1, token);
+            }
+        }
+    };
+    if (document.body) walk(document.body, 0, '');
+    return tokens;
+}'''
+
+
+def simhash(tokens: List[str], bits: int = 64) -> int:
+    """トークン列のsimhash（似た構造のページほどハミング距離が小さくなる）"""
+    weights = [0] * bits
+    for token in tokens:
+        value = int.from_bytes(hashlib.blake2b(token.encode('utf-8'), digest_size=8).digest(), 'big')
+        for i in range(bits):
+            weights[i] += 1 if value >> i & 1 else -1
+    fingerprint = 0
+    for i in range(bits):
+        if weights[i] > 0:
+            fingerprint |= 1 << i
+    return fingerprint
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count('1')
+
+
+class PageTemplateIndex:
+    """DOM構造のsimhashでページをテンプレートにまとめ、テンプレートごとに分析するページ数を制限する
+
+    simhashのハミング距離がTEMPLATE_SIMHASH_DISTANCE以内なら同じテンプレートとみなす。
+    各テンプレートの最初のTEMPLATE_SAMPLE_SIZEページだけをフル分析の対象にする。
+    """
+
+    def __init__(self, sample_size: Optional[int] = None, max_distance: Optional[int] = None):
+        self.sample_size = sample_size if sample_size is not None else int(os.getenv('TEMPLATE_SAMPLE_SIZE', '3'))
+        self.max_distance = max_distance if max_distance is not None else int(os.getenv('TEMPLATE_SIMHASH_DISTANCE', '3'))
+        # [simhash, ページ数, 代表URL]
+        self._templates: List[List] = []
+        self._lock = threading.Lock()
+        self._stats = {'pages_full': 0, 'pages_sampled_out': 0}
+
+    def classify(self, tokens: List[str], url: str) -> Tuple[str, bool]:
+        """ページのテンプレートIDと、フル分析すべきかを返す"""
+        fingerprint = simhash(tokens)
+        with self._lock:
+            template = None
+            for candidate in self._templates:
+                if hamming_distance(candidate[0], fingerprint) <= self.max_distance:
+                    template = candidate
+                    break
+            if template is None:
+                template = [fingerprint, 0, url]
+                self._templates.append(template)
+            template[1] += 1
+            analyze = self.sample_size <= 0 or template[1] <= self.sample_size
+            self._stats['pages_full' if analyze else 'pages_sampled_out'] += 1
+        return f"{template[0]:016x}", analyze
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['templates'] = len(self._templates)
+            # ページ数の多いテンプレート上位5件
+            stats['largest_templates'] = [
+                {'template_id': f"{t[0]:016x}", 'pages': t[1], 'example_url': t[2]}
+                for t in sorted(self._templates, key=lambda t: -t[1])[:5]
+            ]
+        stats['sample_size'] = self.sample_size
+        return stats
@@ -0,0 +1,37 @@
+import logging
+import os
+import threading
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_redis():
+    """プロセス共有のRedisクライアントを取得（分析キャッシュとGeminiのレートリミッターで同じ接続設定を使う）
+
+    REDIS_URL（Celeryのブローカーと同じ）を使い、未設定ならREDIS_HOST/PORT/DB/PASSWORDから接続する。
+    応答しないRedisで呼び出し元を止めないよう、接続と読み書きにREDIS_SOCKET_TIMEOUT_SECONDSの期限を設ける。
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            import redis
+
+            timeout = float(os.getenv('REDIS_SOCKET_TIMEOUT_SECONDS', '2'))
+            url: Optional[str] = os.getenv('REDIS_URL')
+            if url:
+                _client = redis.Redis.from_url(url, socket_timeout=timeout, socket_connect_timeout=timeout)
+            else:
+                _client = redis.Redis(
+                    host=os.getenv('REDIS_HOST', 'localhost'),
+                    port=int(os.getenv('REDIS_PORT', '6379')),
+                    db=int(os.getenv('REDIS_DB', '0')),
+                    password=os.getenv('REDIS_PASSWORD') or None,
+                    socket_timeout=timeout,
+                    socket_connect_timeout=timeout
+                )
+            logger.info(f"Redis client configured from {'REDIS_URL' if url else 'REDIS_HOST/REDIS_PORT'}")
+        return _client
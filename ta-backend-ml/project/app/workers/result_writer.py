@@ -0,0 +1,248 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from typing import Callable, Dict, List, Optional, Tuple
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+from ..db_pool import PoolTimeout, get_pool
+
+logger = logging.getLogger(__name__)
+
+# テーブルごとの列とexecute_valuesのテンプレート（外部キーの順に書き込む）
+TABLES = {
+    'TestResult': (
+        'id, test_session_id, url, status, execution_time, screenshot, console_logs, network_logs, '
+        'user_actions, dom_snapshot, details, created_at, updated_at',
+        '(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, NOW(), NOW())'
+    ),
+    'BugTicket': (
+        'id, project_id, test_session_id, test_result_id, reported_by_id, title, description, severity, '
+        'bug_type, affected_url, reproduction_steps, expected_behavior, actual_behavior, screenshot, '
+        'affected_components, ai_confidence_score, created_at, updated_at',
+        '(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, NOW(), NOW())'
+    ),
+    'BugComment': (
+        'id, bug_ticket_id, account_id, comment, created_at, updated_at',
+        '(%s, %s, %s, %s, NOW(), NOW())'
+    ),
+    'ActivityLog': (
+        'id, account_id, action, resource_type, resource_id, metadata, screenshot, created_at',
+        '(%s, %s, %s, %s, %s, %s, %s, NOW())'
+    )
+}
+
+# 接続断やプールの待ち時間切れなど、同じバッチを再送すれば成功しうるエラー
+RETRYABLE_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError, PoolTimeout)
+
+
+class ResultBatchWriter:
+    """TestResult/BugTicket/BugComment/ActivityLogの行をメモリに溜めてまとめて書き込むライター
+
+    セッションのproject_idは最初に1度だけ取得する。flush()は溜まった行をテーブルごとに
+    execute_valuesで1文にまとめ、1トランザクションで書き込む。接続エラーの場合は
+    同じバッチをRESULT_WRITER_MAX_RETRIES回まで再送する。
+    制約違反などの再送しても直らないエラーの場合は、add()1回分の行ごとに別のトランザクションで
+    書き直し、失敗した分だけを破棄する（他のページやバグの行を巻き添えにしない）。
+    add()にon_commitを渡すと、その行がコミットされた後に呼ばれる。
+    """
+
+    def __init__(self, session_id: str, batch_size: Optional[int] = None, max_retries: Optional[int] = None):
+        self.session_id = session_id
+        # この行数を超えたらページの途中でもflushする
+        self.batch_size = batch_size or int(os.getenv('RESULT_WRITER_BATCH_SIZE', '200'))
+        self.max_retries = max_retries if max_retries is not None else int(os.getenv('RESULT_WRITER_MAX_RETRIES', '3'))
+        self._project_id: Optional[str] = None
+        self._project_loaded = False
+        # add()1回分の行（テーブル名 -> 行のリスト）とon_commit
+        self._groups: List[Tuple[Dict[str, List[Tuple]], Optional[Callable[[], None]]]] = []
+        self._pending_rows = 0
+        self._lock = threading.Lock()
+        self._stats = {
+            'rows_written': 0,
+            'flushes': 0,
+            'round_trips': 0,
+            'retries': 0,
+            'failed_batches': 0,
+            'split_batches': 0,
+            'rows_dropped': 0
+        }
+
+    def project_id(self) -> Optional[str]:
+        """セッションのproject_id（1度だけDBから取得してキャッシュ）"""
+        with self._lock:
+            if self._project_loaded:
+                return self._project_id
+        try:
+            with get_pool().connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('SELECT project_id FROM "TestSession" WHERE id = %s', (self.session_id,))
+                row = cursor.fetchone()
+            with self._lock:
+                self._project_id = row[0] if row else None
+                self._project_loaded = True
+                self._stats['round_trips'] += 1
+            if not row:
+                logger.error(f"TestSession not found for session_id: {self.session_id}")
+        except Exception as e:
+            # 次のadd時に再取得する
+            logger.error(f"Failed to look up project for session {self.session_id}: {e}")
+        return self._project_id
+
+    def add(self, rows: Dict[str, List[Tuple]], on_commit: Optional[Callable[[], None]] = None):
+        """テーブル名 -> 行のリストを追加（1つのバグのTestResult/BugTicket/BugCommentなどをまとめて渡す）"""
+        with self._lock:
+            self._groups.append((rows, on_commit))
+            self._pending_rows += sum(len(table_rows) for table_rows in rows.values())
+            should_flush = self._pending_rows >= self.batch_size
+        if should_flush:
+            self.flush()
+
+    def flush(self) -> bool:
+        """溜まった行を1トランザクションで書き込む（書き込む行がない場合もTrue）"""
+        with self._lock:
+            groups = self._groups
+            row_count = self._pending_rows
+            self._groups = []
+            self._pending_rows = 0
+        if row_count == 0:
+            return True
+
+        pending: Dict[str, List[Tuple]] = {table: [] for table in TABLES}
+        for rows, _ in groups:
+            for table, table_rows in rows.items():
+                pending[table].extend(table_rows)
+        try:
+            statements = self._write_with_retries(pending)
+        except RETRYABLE_ERRORS as e:
+            self._drop(row_count, e)
+            return False
+        except Exception as e:
+            # 制約違反などは再送しても失敗する。どの行が原因かわからないので、add()の単位で書き直す
+            logger.warning(f"Result batch write failed ({e}), writing {len(groups)} groups one at a time")
+            with self._lock:
+                self._stats['split_batches'] += 1
+            return self._flush_groups(groups)
+
+        self._committed(row_count, statements, [callback for _, callback in groups if callback])
+        logger.info(f"Flushed {row_count} result rows for session {self.session_id} in {statements} statements")
+        return True
+
+    def _flush_groups(self, groups: List[Tuple[Dict[str, List[Tuple]], Optional[Callable[[], None]]]]) -> bool:
+        """add()1回分ずつ別のトランザクションで書き込み、失敗した分だけ破棄する"""
+        written = True
+        for rows, callback in groups:
+            row_count = sum(len(table_rows) for table_rows in rows.values())
+            try:
+                statements = self._write_with_retries(rows)
+            except Exception as e:
+                self._drop(row_count, e)
+                written = False
+                continue
+            self._committed(row_count, statements, [callback] if callback else [])
+        return written
+
+    def _write_with_retries(self, pending: Dict[str, List[Tuple]]) -> int:
+        """接続エラーの場合は同じ行をRESULT_WRITER_MAX_RETRIES回まで再送する"""
+        attempt = 0
+        while True:
+            try:
+                return self._write(pending)
+            except RETRYABLE_ERRORS as e:
+                if attempt >= self.max_retries:
+                    raise
+                with self._lock:
+                    self._stats['retries'] += 1
+                logger.warning(f"Result batch write failed ({e}), retrying {attempt + 1}/{self.max_retries}")
+                time.sleep(0.5 * (2 ** attempt))
+                attempt += 1
+
+    def _committed(self, row_count: int, statements: int, callbacks: List[Callable[[], None]]):
+        with self._lock:
+            self._stats['rows_written'] += row_count
+            self._stats['flushes'] += 1
+            self._stats['round_trips'] += statements
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.warning(f"Result batch commit callback failed: {e}")
+
+    def _write(self, pending: Dict[str, List[Tuple]]) -> int:
+        statements = 0
+        with get_pool().connection() as conn:
+            cursor = conn.cursor()
+            for table, (columns, template) in TABLES.items():
+                rows = pending.get(table)
+                if not rows:
+                    continue
+                execute_values(
+                    cursor,
+                    f'INSERT INTO "{table}" ({columns}) VALUES %s',
+                    rows,
+                    template=template,
+                    page_size=self.batch_size
+                )
+                statements += (len(rows) + self.batch_size - 1) // self.batch_size
+            conn.commit()
+        # commit の分
+        return statements + 1
+
+    def _drop(self, row_count: int, error: Exception):
+        logger.error(f"Failed to write {row_count} result rows for session {self.session_id}: {error}")
+        with self._lock:
+            self._stats['failed_batches'] += 1
+            self._stats['rows_dropped'] += row_count
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return dict(self._stats)
+
+
+def new_id() -> str:
+    return str(uuid.uuid4())
+
+
+def test_result_row(session_id: str, url: str, status: str, details: Dict,
+                    screenshot: Optional[str] = None, console_logs: Optional[List] = None,
+                    network_logs: Optional[List] = None, user_actions: Optional[List] = None,
+                    dom_snapshot: str = '', execution_time: int = 0, result_id: Optional[str] = None) -> Tuple:
+    """TestResultの1行"""
+    return (
+        result_id or new_id(), session_id, url, status, execution_time, screenshot,
+        json.dumps(console_logs or []),
+        json.dumps(network_logs or []),
+        json.dumps(user_actions or []),
+        dom_snapshot,
+        json.dumps(details, ensure_ascii=False, default=str)
+    )
+
+
+def bug_ticket_row(ticket_id: str, project_id: str, session_id: str, test_result_id: str, bug: Dict,
+                   title: str, url: str, steps: List[str], expected_behavior: str,
+                   screenshot: Optional[str] = None, confidence: float = 0.8) -> Tuple:
+    """BugTicketの1行"""
+    return (
+        ticket_id, project_id, session_id, test_result_id, 'system',
+        title,
+        bug.get('error_message', ''),
+        bug.get('severity', 'medium'),
+        bug.get('type', 'unknown'),
+        url,
+        json.dumps({"steps": steps}, ensure_ascii=False),
+        expected_behavior,
+        bug.get('error_message', ''),
+        screenshot,
+        [bug.get('element') or 'page'],
+        confidence
+    )
+
+
+def activity_log_row(account_id: str, action: str, resource_type: str, resource_id: str,
+                     metadata: Optional[Dict] = None, screenshot: Optional[str] = None) -> Tuple:
+    """ActivityLogの1行（screenshotはスクリーンショットストアの参照）"""
+    return (new_id(), account_id, action, resource_type, resource_id, json.dumps(metadata or {}), screenshot)
@@ -2,21 +2,44 @@ import json
 import logging
 import os
 from typing import Dict, List
-import google.generativeai as genai
 from prisma import Prisma
-from playwright.sync_api import sync_playwright
+from .browser_pool import get_browser_pool
+from .gemini_client import get_gemini_client
+from .gemini_rate_limiter import set_llm_session
 
 logger = logging.getLogger(__name__)
 
+SCENARIO_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'name': {'type': 'string'},
+        'steps': {
+            'type': 'array',
+            'items': {
+                'type': 'object',
+                'properties': {
+                    'action': {'type': 'string', 'enum': ['click', 'fill', 'navigate', 'wait', 'assert']},
+                    'target': {'type': 'string'},
+                    'value': {'type': 'string', 'nullable': True},
+                    'description': {'type': 'string'}
+                },
+                'required': ['action', 'target', 'description']
+            }
+        },
+        'expected_results': {'type': 'array', 'items': {'type': 'string'}},
+        'tags': {'type': 'array', 'items': {'type': 'string'}}
+    },
+    'required': ['name', 'steps', 'expected_results', 'tags']
+}
+
 
 class ScenarioGenerator:
     """Generate test scenarios using AI based on user descriptions"""
     
     def __init__(self, prisma: Prisma):
         self.prisma = prisma
-        # Gemini APIの設定
-        genai.configure(api_key=os.getenv('GEMINI_API_KEY'))
-        self.model = genai.GenerativeModel('gemini-2.0-flash-exp')
+        # Gemini APIの設定（期限・再試行・レート制限付きの共有クライアント）
+        self.gemini = get_gemini_client()
     
     def generate(self, project_id: str, description: str, url: str) -> Dict:
         """
@@ -31,6 +54,7 @@ class ScenarioGenerator:
             Generated scenario information
         """
         logger.info(f"Generating scenario for project {project_id}")
+        set_llm_session(f"project:{project_id}")
         
         # Analyze the page structure
         page_analysis = self._analyze_page_structure(url)
@@ -65,57 +89,55 @@ class ScenarioGenerator:
         }
         
         try:
-            with sync_playwright() as p:
-                browser = p.chromium.launch(headless=True)
-                page = browser.new_page()
-                page.goto(url, wait_until='networkidle')
-                
-                # Find interactive elements
-                buttons = page.query_selector_all('button')
-                for button in buttons:
-                    page_info["elements"].append({
-                        "type": "button",
-                        "text": button.text_content(),
-                        "selector": self._get_selector(button)
-                    })
-                
-                # Find forms
-                forms = page.query_selector_all('form')
-                for form in forms:
-                    form_info = {
-                        "selector": self._get_selector(form),
-                        "inputs": []
-                    }
-                    
-                    inputs = form.query_selector_all('input, select, textarea')
-                    for input_elem in inputs:
-                        form_info["inputs"].append({
-                            "type": input_elem.get_attribute('type') or 'text',
-                            "name": input_elem.get_attribute('name'),
-                            "id": input_elem.get_attribute('id'),
-                            "placeholder": input_elem.get_attribute('placeholder')
-                        })
-                    
-                    page_info["forms"].append(form_info)
-                
-                # Find navigation links
-                links = page.query_selector_all('a[href]')
-                for link in links[:20]:  # Limit to 20 links
-                    href = link.get_attribute('href')
-                    if href and not href.startswith('#'):
-                        page_info["links"].append({
-                            "text": link.text_content(),
-                            "href": href,
-                            "selector": self._get_selector(link)
-                        })
-                
-                browser.close()
-                
+            get_browser_pool().run(self._collect_page_structure, url, page_info)
         except Exception as e:
             logger.error(f"Page analysis failed: {e}")
         
         return page_info
     
+    def _collect_page_structure(self, page, url: str, page_info: Dict):
+        """Collect interactive elements, forms and links (runs on a browser pool thread)"""
+        page.goto(url, wait_until='networkidle')
+        
+        # Find interactive elements
+        buttons = page.query_selector_all('button')
+        for button in buttons:
+            page_info["elements"].append({
+                "type": "button",
+                "text": button.text_content(),
+                "selector": self._get_selector(button)
+            })
+        
+        # Find forms
+        forms = page.query_selector_all('form')
+        for form in forms:
+            form_info = {
+                "selector": self._get_selector(form),
+                "inputs": []
+            }
+            
+            inputs = form.query_selector_all('input, select, textarea')
+            for input_elem in inputs:
+                form_info["inputs"].append({
+                    "type": input_elem.get_attribute('type') or 'text',
+                    "name": input_elem.get_attribute('name'),
+                    "id": input_elem.get_attribute('id'),
+                    "placeholder": input_elem.get_attribute('placeholder')
+                })
+            
+            page_info["forms"].append(form_info)
+        
+        # Find navigation links
+        links = page.query_selector_all('a[href]')
+        for link in links[:20]:  # Limit to 20 links
+            href = link.get_attribute('href')
+            if href and not href.startswith('#'):
+                page_info["links"].append({
+                    "text": link.text_content(),
+                    "href": href,
+                    "selector": self._get_selector(link)
+                })
+    
     def _generate_scenario_with_ai(self, description: str, url: str, page_analysis: Dict) -> Dict:
         """Use AI to generate scenario steps"""
         try:
@@ -155,18 +177,9 @@ class ScenarioGenerator:
             }}
             """
             
-            response = self.model.generate_content(prompt)
-            
-            # GeminiのレスポンスからJSON部分を抽出
-            response_text = response.text
-            # JSONブロックを探す
-            import re
-            json_match = re.search(r'\{[^{}]*\}', response_text, re.DOTALL)
-            if json_match:
-                scenario = json.loads(json_match.group())
-            else:
-                # JSONが見つからない場合は、テキストから情報を抽出
-                scenario = self._extract_scenario_from_text(response_text, description, url)
+            scenario, _ = self.gemini.generate_json(prompt, SCENARIO_SCHEMA, 'scenario')
+            if scenario is None:
+                raise ValueError("Gemini returned an unparseable scenario")
             
             # Ensure proper structure
             if "steps" not in scenario:
@@ -197,78 +210,6 @@ class ScenarioGenerator:
                 "tags": ["generated", "basic"]
             }
     
-    def _extract_scenario_from_text(self, text: str, description: str, url: str) -> Dict:
-        """テキストレスポンスからシナリオ情報を抽出"""
-        scenario = {
-            "name": description[:100],
-            "steps": [],
-            "expected_results": [],
-            "tags": ["generated"]
-        }
-        
-        lines = text.split('\n')
-        current_section = None
-        
-        for line in lines:
-            line = line.strip()
-            if not line:
-                continue
-                
-            # セクションの検出
-            if '名前' in line or 'name' in line.lower():
-                current_section = 'name'
-                if ':' in line:
-                    scenario["name"] = line.split(':', 1)[-1].strip()[:100]
-            elif 'ステップ' in line or 'step' in line.lower():
-                current_section = 'steps'
-            elif '期待' in line or 'expected' in line.lower():
-                current_section = 'expected'
-            elif 'タグ' in line or 'tag' in line.lower():
-                current_section = 'tags'
-            else:
-                # 各セクションのコンテンツを処理
-                if current_section == 'steps' and (line.startswith('-') or line.startswith('*') or line[0].isdigit()):
-                    # ステップの解析
-                    step_text = line.lstrip('-*0123456789. ')
-                    step = {
-                        "action": "click",  # デフォルト
-                        "target": "",
-                        "value": "",
-                        "description": step_text
-                    }
-                    
-                    # アクションタイプの検出
-                    if 'クリック' in step_text or 'click' in step_text.lower():
-                        step["action"] = "click"
-                    elif '入力' in step_text or 'fill' in step_text.lower() or 'type' in step_text.lower():
-                        step["action"] = "fill"
-                    elif 'ナビゲート' in step_text or 'navigate' in step_text.lower() or 'go to' in step_text.lower():
-                        step["action"] = "navigate"
-                    elif '待' in step_text or 'wait' in step_text.lower():
-                        step["action"] = "wait"
-                    elif '確認' in step_text or 'assert' in step_text.lower() or 'verify' in step_text.lower():
-                        step["action"] = "assert"
-                    
-                    scenario["steps"].append(step)
-                    
-                elif current_section == 'expected' and line:
-                    scenario["expected_results"].append(line.lstrip('-* '))
-                    
-                elif current_section == 'tags' and line:
-                    tags = line.split(',')
-                    scenario["tags"] = [tag.strip() for tag in tags]
-        
-        # 最低限のステップを確保
-        if not scenario["steps"]:
-            scenario["steps"] = [{
-                "action": "navigate",
-                "target": "",
-                "value": url,
-                "description": f"Navigate to {url}"
-            }]
-        
-        return scenario
-    
     def _validate_steps(self, url: str, steps: List[Dict]) -> List[Dict]:
         """Validate and refine generated steps"""
         validated_steps = []
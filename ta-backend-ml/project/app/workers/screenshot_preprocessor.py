@@ -0,0 +1,159 @@
+import io
+import logging
+import math
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+
+import PIL.Image
+
+logger = logging.getLogger(__name__)
+
+ENCODINGS = {
+    'jpeg': ('JPEG', 'image/jpeg'),
+    'webp': ('WEBP', 'image/webp')
+}
+
+
+def dhash(image: PIL.Image.Image) -> str:
+    """画像の知覚ハッシュ（dHash 64bit）
+
+    数ピクセルの描画差やPNGのエンコード差では変わらない。
+    """
+    small = image.convert('L').resize((9, 8), PIL.Image.LANCZOS)
+    pixels = list(small.getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return f"{bits:016x}"
+
+
+class PreparedScreenshot:
+    """LLMに送るために縮小・分割・再エンコードしたスクリーンショット
+
+    1ページにつき1度だけ作り、そのページの全ての分析で共有する。
+    """
+
+    def __init__(self, tiles: List[bytes], mime_type: str, phash: str, summary: Dict):
+        self.tiles = tiles
+        self.mime_type = mime_type
+        self.phash = phash
+        self.summary = summary
+
+    @property
+    def payload_bytes(self) -> int:
+        return sum(len(tile) for tile in self.tiles)
+
+    def parts(self) -> List[Dict]:
+        """generate_contentに渡す画像パート（上から順）"""
+        return [{'mime_type': self.mime_type, 'data': tile} for tile in self.tiles]
+
+    def describe(self) -> str:
+        """プロンプトに添える画像の説明"""
+        if len(self.tiles) == 1:
+            return 'ページ全体のスクリーンショット1枚'
+        note = f'ページ全体を上から順に{len(self.tiles)}枚に分割したスクリーンショット'
+        if self.summary.get('truncated'):
+            note += '（ページ下部は省略）'
+        return note
+
+
+def prepare_screenshot(screenshot: bytes) -> PreparedScreenshot:
+    """フルページのスクリーンショットをLLM用に準備する
+
+    幅をSCREENSHOT_LLM_MAX_WIDTHまで縮小し、総ピクセル数がSCREENSHOT_LLM_PIXEL_BUDGETを超える場合は
+    SCREENSHOT_LLM_MIN_WIDTHを下限にさらに縮小する。縦長のページはビューポートの縦横比のタイルに
+    分割し（モデル側で1枚の縦長画像として潰されないように）、予算に収まる枚数だけ上から送る。
+    """
+    started = time.time()
+    max_width = int(os.getenv('SCREENSHOT_LLM_MAX_WIDTH', '1280'))
+    min_width = int(os.getenv('SCREENSHOT_LLM_MIN_WIDTH', '768'))
+    pixel_budget = int(os.getenv('SCREENSHOT_LLM_PIXEL_BUDGET', '4000000'))
+    # タイルの縦横比（高さ/幅）。クロールのビューポート 1920x1080 に合わせる
+    tile_ratio = float(os.getenv('SCREENSHOT_LLM_TILE_RATIO', '0.5625'))
+    encoding = os.getenv('SCREENSHOT_LLM_FORMAT', 'jpeg').lower()
+    if encoding not in ENCODINGS:
+        encoding = 'jpeg'
+    quality = int(os.getenv('SCREENSHOT_LLM_QUALITY', '80'))
+    pil_format, mime_type = ENCODINGS[encoding]
+
+    image = PIL.Image.open(io.BytesIO(screenshot))
+    image.load()
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    width, height = image.size
+    phash = dhash(image)
+
+    scale = min(1.0, max_width / width)
+    if width * height * scale * scale > pixel_budget:
+        scale = min(scale, max(min_width / width, math.sqrt(pixel_budget / (width * height))))
+    new_width = max(1, round(width * scale))
+    new_height = max(1, round(height * scale))
+    if scale < 1.0:
+        image = image.resize((new_width, new_height), PIL.Image.LANCZOS)
+
+    tile_height = max(1, round(new_width * tile_ratio))
+    max_tiles = max(1, pixel_budget // (new_width * tile_height))
+    tile_count = math.ceil(new_height / tile_height)
+    if new_height <= tile_height * 1.5:
+        # ビューポート程度の高さなら分割せずに1枚で送る
+        boxes = [(0, 0, new_width, new_height)]
+    else:
+        boxes = [
+            (0, top, new_width, min(top + tile_height, new_height))
+            for top in range(0, new_height, tile_height)
+        ][:max_tiles]
+
+    tiles = []
+    for box in boxes:
+        buffer = io.BytesIO()
+        image.crop(box).save(buffer, format=pil_format, quality=quality)
+        tiles.append(buffer.getvalue())
+
+    summary = {
+        'original_size': [width, height],
+        'original_bytes': len(screenshot),
+        'sent_size': [new_width, new_height],
+        'tiles': len(tiles),
+        'truncated': len(boxes) < tile_count and len(boxes) > 1,
+        'format': encoding,
+        'payload_bytes': sum(len(tile) for tile in tiles),
+        'prepare_ms': int((time.time() - started) * 1000)
+    }
+    return PreparedScreenshot(tiles, mime_type, phash, summary)
+
+
+class PayloadStats:
+    """LLMリクエストの送信バイト数とレイテンシの集計（画素予算の調整用）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {'requests': 0, 'payload_bytes': 0, 'original_bytes': 0, 'tiles': 0, 'latency_ms_total': 0}
+        self._max_latency_ms = 0
+
+    def record(self, prepared: PreparedScreenshot, latency_ms: int):
+        with self._lock:
+            self._stats['requests'] += 1
+            self._stats['payload_bytes'] += prepared.payload_bytes
+            self._stats['original_bytes'] += prepared.summary.get('original_bytes', 0)
+            self._stats['tiles'] += len(prepared.tiles)
+            self._stats['latency_ms_total'] += latency_ms
+            self._max_latency_ms = max(self._max_latency_ms, latency_ms)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            requests = stats['requests']
+            stats['max_latency_ms'] = self._max_latency_ms
+        stats['avg_payload_bytes'] = stats['payload_bytes'] // requests if requests else 0
+        stats['avg_latency_ms'] = stats['latency_ms_total'] // requests if requests else 0
+        return stats
+
+
+def ensure_prepared(screenshot) -> Optional[PreparedScreenshot]:
+    """bytesならprepare_screenshotで準備し、準備済みならそのまま返す"""
+    if screenshot is None or isinstance(screenshot, PreparedScreenshot):
+        return screenshot
+    return prepare_screenshot(screenshot)
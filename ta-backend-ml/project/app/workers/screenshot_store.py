@@ -0,0 +1,272 @@
+import base64
+import hashlib
+import hmac
+import io
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Union
+
+import PIL.Image
+
+logger = logging.getLogger(__name__)
+
+# <sha256>.<拡張子> 形式のキー（ビューでのパス検証にも使う）
+SCREENSHOT_KEY_PATTERN = re.compile(r'^[0-9a-f]{64}\.(png|jpg|webp)$')
+
+CONTENT_TYPES = {
+    'png': 'image/png',
+    'jpg': 'image/jpeg',
+    'webp': 'image/webp'
+}
+
+# SCREENSHOT_STORE_FORMATの値 -> Pillowの保存形式
+ENCODINGS = {
+    'webp': 'WEBP',
+    'jpg': 'JPEG'
+}
+
+
+def screenshot_signature(key: str, organization_id: str, expires: int) -> str:
+    """画像URLの署名（フロントエンドのsignScreenshotUrlと同じ、SCREENSHOT_URL_SECRETでのHMAC-SHA256）"""
+    message = f"{key}:{organization_id}:{expires}".encode('utf-8')
+    return hmac.new(os.getenv('SCREENSHOT_URL_SECRET', '').encode('utf-8'), message, hashlib.sha256).hexdigest()
+
+
+def verify_screenshot_signature(key: str, organization_id: str, expires: str, signature: str) -> bool:
+    """署名が正しく、有効期限（UNIX秒）が切れていないか"""
+    if not os.getenv('SCREENSHOT_URL_SECRET'):
+        logger.error("SCREENSHOT_URL_SECRET is not set; refusing to serve screenshots")
+        return False
+    try:
+        expires_at = int(expires)
+    except (TypeError, ValueError):
+        return False
+    if expires_at < time.time():
+        return False
+    return hmac.compare_digest(screenshot_signature(key, organization_id, expires_at), signature)
+
+
+def _extension(data: bytes) -> str:
+    """マジックナンバーから拡張子を判定"""
+    if data[:4] == b'\x89PNG':
+        return 'png'
+    if data[:3] == b'\xff\xd8\xff':
+        return 'jpg'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'webp'
+    return 'png'
+
+
+class LocalScreenshotBackend:
+    """ローカルファイルシステムへの保存（web/workerコンテナで同じディレクトリを共有する想定）"""
+
+    def __init__(self, root: Optional[str] = None, public_base_url: Optional[str] = None):
+        self.root = root or os.getenv('SCREENSHOT_STORE_DIR', '/app/output/screenshots')
+        self.public_base_url = (public_base_url or os.getenv('SCREENSHOT_PUBLIC_BASE_URL', 'http://localhost:8000')).rstrip('/')
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, key: str) -> str:
+        # 1ディレクトリのファイル数が増えすぎないよう、ハッシュの先頭2文字で分ける
+        return os.path.join(self.root, key[:2], key)
+
+    def exists(self, key: str) -> bool:
+        return os.path.exists(self.path(key))
+
+    def write(self, key: str, data: bytes, content_type: str):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 書きかけのファイルが読まれないよう、一時ファイルに書いてからリネーム
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def read(self, key: str) -> Optional[bytes]:
+        try:
+            with open(self.path(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def url(self, key: str) -> str:
+        # 取得時は、行を返したAPI（フロントエンドのsignScreenshotUrl）が組織と有効期限の署名をクエリに付ける
+        return f"{self.public_base_url}/api/v1/screenshots/{key}"
+
+
+class S3ScreenshotBackend:
+    """S3互換ストレージへの保存（MinIOはSCREENSHOT_S3_ENDPOINTで指定）
+
+    バケットは公開しない。ブラウザへはローカル保存と同じくバックエンドのビューから返し、同じ署名と組織の確認を通す。
+    """
+
+    def __init__(self):
+        import boto3
+
+        self.bucket = os.getenv('SCREENSHOT_S3_BUCKET', 'qa3-screenshots')
+        self.prefix = os.getenv('SCREENSHOT_S3_PREFIX', 'screenshots').strip('/')
+        endpoint = os.getenv('SCREENSHOT_S3_ENDPOINT') or None
+        self.client = boto3.client(
+            's3',
+            endpoint_url=endpoint,
+            region_name=os.getenv('SCREENSHOT_S3_REGION', 'ap-northeast-1'),
+            aws_access_key_id=os.getenv('SCREENSHOT_S3_ACCESS_KEY') or None,
+            aws_secret_access_key=os.getenv('SCREENSHOT_S3_SECRET_KEY') or None
+        )
+        self.public_base_url = os.getenv('SCREENSHOT_PUBLIC_BASE_URL', 'http://localhost:8000').rstrip('/')
+
+    def _object_key(self, key: str) -> str:
+        return f"{self.prefix}/{key}" if self.prefix else key
+
+    def exists(self, key: str) -> bool:
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._object_key(key))
+            return True
+        except Exception:
+            return False
+
+    def write(self, key: str, data: bytes, content_type: str):
+        self.client.put_object(
+            Bucket=self.bucket,
+            Key=self._object_key(key),
+            Body=data,
+            ContentType=content_type,
+            # 内容アドレスなので同じキーの中身は変わらない（バケットを直接公開しないのでprivate）
+            CacheControl='private, max-age=31536000, immutable'
+        )
+
+    def read(self, key: str) -> Optional[bytes]:
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self._object_key(key))
+            return response['Body'].read()
+        except Exception:
+            return None
+
+    def url(self, key: str) -> str:
+        # バケットのURLではなくバックエンドのビューを指す（読み込みはread()を通す）
+        return f"{self.public_base_url}/api/v1/screenshots/{key}"
+
+
+class ScreenshotStore:
+    """内容のハッシュをキーにしたスクリーンショットストア
+
+    put()は画像をSCREENSHOT_STORE_FORMAT（webp/jpg、pngなら再エンコードしない）に再エンコードして1度だけ書き込み、
+    DBの screenshot 列に入れる参照（URL）を返す。キーは再エンコード後の内容のハッシュ。
+    同じ画像を何度putしても、ハッシュ計算以外の処理は初回だけ行われる。
+    SCREENSHOT_STORE=inline の場合は従来どおりbase64文字列を返す。
+    """
+
+    def __init__(self, backend: Optional[str] = None, memo_size: int = 4096):
+        self.backend_name = backend or os.getenv('SCREENSHOT_STORE', 'local')
+        self.format = os.getenv('SCREENSHOT_STORE_FORMAT', 'webp').lower()
+        self.quality = int(os.getenv('SCREENSHOT_STORE_QUALITY', '80'))
+        if self.backend_name == 's3':
+            self.backend = S3ScreenshotBackend()
+        elif self.backend_name == 'local':
+            self.backend = LocalScreenshotBackend()
+        else:
+            self.backend = None
+        self._memo: 'OrderedDict[str, str]' = OrderedDict()
+        self._memo_size = memo_size
+        self._lock = threading.Lock()
+        self._stats = {
+            'puts': 0,
+            'writes': 0,
+            'dedup_hits': 0,
+            'bytes_received': 0,
+            'bytes_written': 0,
+            'errors': 0
+        }
+
+    def put(self, data: Union[bytes, str, None]) -> Optional[str]:
+        """画像を保存して参照を返す（参照文字列を渡した場合はそのまま返す）"""
+        if not data:
+            return None
+        if isinstance(data, str):
+            return data
+        if self.backend is None:
+            return base64.b64encode(data).decode('utf-8')
+
+        # 再エンコード前の内容で重複を判定し、同じ画像を何度も再エンコードしない
+        digest = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            self._stats['puts'] += 1
+            ref = self._memo.get(digest)
+            if ref:
+                self._memo.move_to_end(digest)
+                self._stats['dedup_hits'] += 1
+                return ref
+
+        received = len(data)
+        data = self._compress(data)
+        ext = _extension(data)
+        key = f"{hashlib.sha256(data).hexdigest()}.{ext}"
+        try:
+            if self.backend.exists(key):
+                with self._lock:
+                    self._stats['dedup_hits'] += 1
+            else:
+                self.backend.write(key, data, CONTENT_TYPES[ext])
+                with self._lock:
+                    self._stats['writes'] += 1
+                    self._stats['bytes_received'] += received
+                    self._stats['bytes_written'] += len(data)
+        except Exception as e:
+            # ストアに書けない場合はDBにインラインで保存する
+            logger.error(f"Failed to store screenshot {key}: {e}")
+            with self._lock:
+                self._stats['errors'] += 1
+            return base64.b64encode(data).decode('utf-8')
+
+        ref = self.backend.url(key)
+        with self._lock:
+            self._memo[digest] = ref
+            if len(self._memo) > self._memo_size:
+                self._memo.popitem(last=False)
+        return ref
+
+    def _compress(self, data: bytes) -> bytes:
+        """SCREENSHOT_STORE_FORMATに再エンコードする（小さくならない・読めない場合は元のまま）"""
+        pil_format = ENCODINGS.get(self.format)
+        if pil_format is None or _extension(data) == self.format:
+            return data
+        try:
+            with PIL.Image.open(io.BytesIO(data)) as image:
+                # JPEGは透過を持てないので、RGBに変換してから保存する
+                if pil_format == 'JPEG' or image.mode not in ('RGB', 'RGBA'):
+                    image = image.convert('RGB')
+                buffer = io.BytesIO()
+                image.save(buffer, format=pil_format, quality=self.quality)
+        except Exception as e:
+            logger.warning(f"Failed to re-encode screenshot as {self.format}: {e}")
+            return data
+        compressed = buffer.getvalue()
+        return compressed if len(compressed) < len(data) else data
+
+    def get(self, key: str) -> Optional[bytes]:
+        """キーから画像を読み込む"""
+        if self.backend is None or not SCREENSHOT_KEY_PATTERN.match(key):
+            return None
+        return self.backend.read(key)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+        stats['backend'] = self.backend_name
+        return stats
+
+
+_store: Optional[ScreenshotStore] = None
+_store_lock = threading.Lock()
+
+
+def get_screenshot_store() -> ScreenshotStore:
+    """プロセス共有のスクリーンショットストアを取得"""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = ScreenshotStore()
+        return _store
@@ -0,0 +1,234 @@
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+from typing import Deque, Dict, Optional, Tuple, Union
+
+from psycopg2.extras import execute_values
+
+from ..db_pool import get_pool
+from .screenshot_store import get_screenshot_store
+
+logger = logging.getLogger(__name__)
+
+# 過負荷時に捨ててよいレベル（warning/errorは捨てない）
+DROPPABLE_LEVELS = ('debug', 'info')
+
+# (test_session_id, log_level, message, metadata, screenshot, created_at)
+# screenshotはライタースレッドがストアに書き込んで参照に置き換えるまで、画像のバイト列のまま持つ
+LogRecord = Tuple[str, str, str, str, Union[bytes, str, None], datetime]
+
+
+class SessionLogSink:
+    """TestSessionLogへの書き込みをバックグラウンドスレッドでまとめて行うシンク
+
+    log()はキューに積むだけで待たずに戻り（イベントループのスレッドから呼んでもよい）、
+    ライタースレッドがLOG_SINK_FLUSH_SECONDS秒ごと（またはLOG_SINK_BATCH_SIZE件たまるごと）に複数行INSERTで書き込む。
+    キューはLOG_SINK_MAX_RECORDS件までで、あふれそうな場合は次の方針で間引く（間引いた件数はstats()に出る）:
+      - 半分を超えたらdebugを捨てる
+      - 満杯ならinfoを捨てる
+      - warning/errorは古いdebug/infoを追い出して積む（追い出せなければ捨てる）
+    スクリーンショットのストアへの書き込みもライタースレッドで行う。キューに積んだ未書き込みの画像が
+    LOG_SINK_MAX_SCREENSHOT_BYTESを超える間は、ログは積むが画像は捨てる。
+    """
+
+    def __init__(self, max_records: Optional[int] = None, batch_size: Optional[int] = None,
+                 flush_seconds: Optional[float] = None, max_screenshot_bytes: Optional[int] = None):
+        self.max_records = max_records or int(os.getenv('LOG_SINK_MAX_RECORDS', '10000'))
+        self.batch_size = batch_size or int(os.getenv('LOG_SINK_BATCH_SIZE', '200'))
+        self.flush_seconds = flush_seconds if flush_seconds is not None else float(os.getenv('LOG_SINK_FLUSH_SECONDS', '0.5'))
+        self.max_screenshot_bytes = max_screenshot_bytes or int(os.getenv('LOG_SINK_MAX_SCREENSHOT_BYTES', str(64 * 1024 * 1024)))
+        self.screenshot_store = get_screenshot_store()
+        self._cond = threading.Condition()
+        self._pid = None
+        self._start()
+
+    def _start(self):
+        self._pid = os.getpid()
+        self._queue: Deque[LogRecord] = deque()
+        self._writing = 0
+        self._screenshot_bytes = 0
+        self._closed = False
+        self._stats = {
+            'enqueued': 0,
+            'written': 0,
+            'batches': 0,
+            'dropped_debug': 0,
+            'dropped_info': 0,
+            'dropped_overflow': 0,
+            'dropped_screenshots': 0,
+            'evicted': 0,
+            'write_errors': 0,
+            'max_queue_depth': 0
+        }
+        self._thread = threading.Thread(target=self._run, name='session-log-sink', daemon=True)
+        self._thread.start()
+
+    def _check_fork(self):
+        # fork後の子プロセスにはライタースレッドがないため作り直す
+        if self._pid != os.getpid():
+            self._cond = threading.Condition()
+            self._start()
+
+    def log(self, session_id: str, level: str, message: str, metadata: Optional[Dict] = None,
+            screenshot: Union[bytes, str, None] = None) -> bool:
+        """ログを積む（間引かれた場合はFalse）。待たずに戻る"""
+        self._check_fork()
+        with self._cond:
+            if not self._admit(level):
+                return False
+        metadata_json = json.dumps(metadata or {}, ensure_ascii=False, default=str)
+        created_at = datetime.now(timezone.utc).replace(tzinfo=None)
+        with self._cond:
+            if not self._make_room(level):
+                return False
+            if isinstance(screenshot, bytes):
+                if self._screenshot_bytes + len(screenshot) > self.max_screenshot_bytes:
+                    self._stats['dropped_screenshots'] += 1
+                    screenshot = None
+                else:
+                    self._screenshot_bytes += len(screenshot)
+            self._queue.append((session_id, level, message, metadata_json, screenshot or None, created_at))
+            self._stats['enqueued'] += 1
+            self._stats['max_queue_depth'] = max(self._stats['max_queue_depth'], len(self._queue))
+            if len(self._queue) >= self.batch_size:
+                self._cond.notify_all()
+        return True
+
+    def _admit(self, level: str) -> bool:
+        depth = len(self._queue)
+        if level == 'debug' and depth >= self.max_records // 2:
+            self._stats['dropped_debug'] += 1
+            return False
+        if level == 'info' and depth >= self.max_records:
+            self._stats['dropped_info'] += 1
+            return False
+        return True
+
+    def _make_room(self, level: str) -> bool:
+        if len(self._queue) < self.max_records:
+            return True
+        if level in DROPPABLE_LEVELS:
+            self._stats['dropped_debug' if level == 'debug' else 'dropped_info'] += 1
+            return False
+        # warning/error: 古いdebug/infoを追い出す
+        for record in self._queue:
+            if record[1] in DROPPABLE_LEVELS:
+                self._queue.remove(record)
+                self._release_screenshot(record)
+                self._stats['evicted'] += 1
+                return True
+        # キューが全てwarning/errorの場合も待たずに捨てる（呼び出し元はイベントループのこともある）
+        self._stats['dropped_overflow'] += 1
+        self._cond.notify_all()
+        logger.error(f"Session log queue full, dropping {level} record")
+        return False
+
+    def _release_screenshot(self, record: LogRecord):
+        if isinstance(record[4], bytes):
+            self._screenshot_bytes -= len(record[4])
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._queue and not self._closed:
+                    self._cond.wait(self.flush_seconds)
+                if not self._queue:
+                    if self._closed:
+                        return
+                    continue
+                batch = [self._queue.popleft() for _ in range(min(self.batch_size, len(self._queue)))]
+                self._writing += 1
+                self._cond.notify_all()
+            try:
+                self._write(self._store_screenshots(batch))
+            finally:
+                with self._cond:
+                    self._writing -= 1
+                    self._cond.notify_all()
+
+    def _store_screenshots(self, batch):
+        """ライタースレッドで画像をストアに書き込み、レコードの画像を参照に置き換える"""
+        stored = []
+        for record in batch:
+            screenshot = record[4]
+            if isinstance(screenshot, bytes):
+                try:
+                    screenshot = self.screenshot_store.put(screenshot)
+                except Exception as e:
+                    logger.error(f"Failed to store session log screenshot: {e}")
+                    screenshot = None
+                with self._cond:
+                    self._release_screenshot(record)
+            stored.append(record[:4] + (screenshot,) + record[5:])
+        return stored
+
+    def _write(self, batch):
+        for attempt in range(3):
+            try:
+                with get_pool().connection() as conn:
+                    cursor = conn.cursor()
+                    execute_values(cursor, """
+                        INSERT INTO "TestSessionLog" (id, test_session_id, log_level, message, metadata, screenshot, created_at)
+                        VALUES %s
+                    """, batch, template='(gen_random_uuid(), %s, %s, %s, %s, %s, %s)', page_size=self.batch_size)
+                    conn.commit()
+                with self._cond:
+                    self._stats['written'] += len(batch)
+                    self._stats['batches'] += 1
+                return
+            except Exception as e:
+                logger.warning(f"Failed to write {len(batch)} session logs (attempt {attempt + 1}/3): {e}")
+                time.sleep(0.5 * (2 ** attempt))
+        logger.error(f"Dropping {len(batch)} session logs after repeated write failures")
+        with self._cond:
+            self._stats['write_errors'] += len(batch)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """キューが空になり、書き込み中のバッチが終わるまで待つ"""
+        self._check_fork()
+        deadline = time.monotonic() + (timeout if timeout is not None else float(os.getenv('LOG_SINK_FLUSH_TIMEOUT', '30')))
+        with self._cond:
+            self._cond.notify_all()
+            while self._queue or self._writing:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    logger.warning(f"Session log flush timed out with {len(self._queue)} records queued")
+                    return False
+                self._cond.wait(min(remaining, self.flush_seconds))
+        return True
+
+    def close(self, timeout: Optional[float] = None):
+        """残りを書き込んでライタースレッドを止める"""
+        if self._pid != os.getpid():
+            return
+        self.flush(timeout)
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout=self.flush_seconds * 2)
+
+    def stats(self) -> Dict:
+        with self._cond:
+            stats = dict(self._stats)
+            stats['queue_depth'] = len(self._queue)
+            stats['queued_screenshot_bytes'] = self._screenshot_bytes
+        return stats
+
+
+_sink: Optional[SessionLogSink] = None
+_sink_lock = threading.Lock()
+
+
+def get_session_log_sink() -> SessionLogSink:
+    """プロセス共有のセッションログシンクを取得（プロセス終了時に残りを書き込む）"""
+    global _sink
+    with _sink_lock:
+        if _sink is None:
+            _sink = SessionLogSink()
+            atexit.register(_sink.close)
+        return _sink
@@ -5,8 +5,9 @@ import os
 from datetime import datetime
 from playwright.sync_api import sync_playwright
 from typing import Dict, List, Optional
-import google.generativeai as genai
 from prisma import Prisma
+from .gemini_client import get_gemini_client
+from .gemini_rate_limiter import set_llm_session
 
 logger = logging.getLogger(__name__)
 
@@ -16,9 +17,8 @@ class TestExecutor:
     
     def __init__(self, prisma: Prisma):
         self.prisma = prisma
-        # Gemini APIの設定
-        genai.configure(api_key=os.getenv('GEMINI_API_KEY'))
-        self.model = genai.GenerativeModel('gemini-2.0-flash-exp')  # 最新の高速モデル
+        # Gemini APIの設定（期限・再試行・レート制限付きの共有クライアント）
+        self.gemini = get_gemini_client()
     
     def execute(self, session_id: str, mode: str, url: str, scenario_id: Optional[str] = None) -> Dict:
         """
@@ -34,6 +34,7 @@ class TestExecutor:
             Test execution results
         """
         start_time = time.time()
+        set_llm_session(session_id)
         
         if mode == "omakase":
             result = self._execute_omakase_mode(session_id, url)
@@ -223,7 +224,7 @@ class TestExecutor:
             見つかった問題を簡潔にリストアップしてください。
             """
             
-            response = self.model.generate_content(prompt)
+            response = self.gemini.generate(prompt, prompt_name='page_review')
             
             return {
                 "analysis": response.text,
@@ -1,25 +1,51 @@
 import time
 import json
+import hashlib
 import logging
 import os
-import base64
 from datetime import datetime, timezone
-from playwright.sync_api import sync_playwright
-from typing import Dict, List, Optional, Tuple, Set
+from typing import Dict, List, Optional, Union
 import google.generativeai as genai
 from prisma import Prisma
-from concurrent.futures import ThreadPoolExecutor, as_completed
-import queue
+import asyncio
 import threading
-from urllib.parse import urljoin, urlparse
-from .gemini_page_analyzer import GeminiPageAnalyzer, PlaywrightActionExecutor
+from urllib.parse import urlparse
+from .gemini_page_analyzer import ISSUE_SCHEMA, GeminiPageAnalyzer, PlaywrightActionExecutor, normalize_issues
 from .activity_logger import ActivityLogger
-import psycopg2
-import uuid
-import traceback
+from .async_crawl_engine import AsyncCrawlEngine
+from .url_canonicalizer import SeenUrlIndex
+from .crawl_checkpoint import CrawlCheckpointStore, bug_fingerprint
+from .page_load_profiles import PageLoadProfile, get_profile
+from .screenshot_store import get_screenshot_store
+from ..db_pool import get_pool
+from .session_log_sink import get_session_log_sink
+from .analysis_cache import AnalysisCache, get_analysis_cache
+from .page_template_index import DOM_SKELETON_SCRIPT, PageTemplateIndex
+from .dom_distiller import distill_page
+from .gemini_client import get_gemini_client
+from .gemini_rate_limiter import get_gemini_rate_limiter, set_llm_session
+from .llm_telemetry import get_llm_telemetry
+from .screenshot_preprocessor import PayloadStats, PreparedScreenshot, ensure_prepared, prepare_screenshot
+from .result_writer import ResultBatchWriter, activity_log_row, bug_ticket_row, new_id, test_result_row
 
 logger = logging.getLogger(__name__)
 
+# _analyze_with_gemini のプロンプトを変えたら上げる（分析キャッシュのキーに含まれる）
+ISSUE_ANALYSIS_PROMPT_VERSION = 'issue-analysis-v4'
+
+ISSUE_ANALYSIS_SCHEMA = {
+    'type': 'object',
+    'properties': {'issues': {'type': 'array', 'items': ISSUE_SCHEMA}},
+    'required': ['issues']
+}
+
+# アクション前後でDOMが変わったかを判定するための指紋の元
+_DOM_SIGNATURE_SCRIPT = '''() => [
+    location.href,
+    document.getElementsByTagName('*').length,
+    document.body ? document.body.innerText : ''
+].join('\\n')'''
+
 
 class EnhancedTestExecutor:
     """Enhanced Test Executor with recursive crawling and parallel execution"""
@@ -32,21 +58,45 @@ class EnhancedTestExecutor:
             raise ValueError("GEMINI_API_KEY environment variable is not set")
         
         genai.configure(api_key=api_key)
-        self.model = genai.GenerativeModel('gemini-2.0-flash-exp')
+        # 期限・再試行・ヘッジ・サーキットブレーカー付きの共有クライアント
+        self.gemini = get_gemini_client()
         
         # 新しいアナライザー、エグゼキューター、アクティビティロガーを初期化
-        self.page_analyzer = GeminiPageAnalyzer(api_key)
-        self.action_executor = PlaywrightActionExecutor()
+        # LLMに送った画像のバイト数とレイテンシ（画素予算の調整用）
+        self.payload_stats = PayloadStats()
+        self.page_analyzer = GeminiPageAnalyzer(api_key, self.payload_stats)
+        self.analysis_cache = get_analysis_cache()
+        # 全ワーカーで共有するGeminiのレート制限
+        self.rate_limiter = get_gemini_rate_limiter()
+        self.screenshot_store = get_screenshot_store()
+        self.action_executor = PlaywrightActionExecutor(self.screenshot_store)
         self.activity_logger = ActivityLogger()
+        # TestSessionLogはバックグラウンドでまとめて書き込む
+        self.log_sink = get_session_log_sink()
         
-        # 並列実行の設定
-        self.max_workers = 8
+        # 並列実行の設定（同時に処理するページ数）
+        self.concurrency = int(os.getenv('CRAWL_CONCURRENCY', '16'))
         self.max_depth = 5
+        # セッションごとのクロール予算（ページ数と経過秒数）
+        self.max_pages = int(os.getenv('CRAWL_MAX_PAGES', '200'))
+        self.max_seconds = float(os.getenv('CRAWL_MAX_SECONDS', '240'))
+        # ページロードのプロファイル（リクエストのブロックと準備完了の判定方法）
+        self.load_profile = get_profile()
+        # クロール時のビューポート（分析キャッシュのキーにも含める）
+        self.viewport = {'width': 1920, 'height': 1080}
+        self.viewport_variant = f"{self.viewport['width']}x{self.viewport['height']}"
         self.visited_urls = set()
-        self.url_queue = queue.Queue()
+        self.seen_index = SeenUrlIndex()
+        self.template_index = PageTemplateIndex()
         self.bugs_found = []
+        self.ai_skipped_pages = 0
         self.lock = threading.Lock()
-        self.processed_urls = set()  # 処理済みURLを追跡
+        
+        # 再実行時に途中から再開するためのチェックポイント
+        self.checkpoint_store = CrawlCheckpointStore()
+        self.page_results = {}
+        self.saved_bug_fingerprints = set()
+        self.result_writer: Optional[ResultBatchWriter] = None
         
     def execute(self, session_id: str, mode: str, url: str, scenario_id: Optional[str] = None) -> Dict:
         """Execute enhanced test with recursive crawling and parallel execution"""
@@ -56,8 +106,11 @@ class EnhancedTestExecutor:
         self._log_to_session(session_id, 'info', 'テスト実行を開始します', {
             'url': url,
             'mode': mode,
-            'max_workers': self.max_workers,
-            'max_depth': self.max_depth
+            'concurrency': self.concurrency,
+            'max_depth': self.max_depth,
+            'max_pages': self.max_pages,
+            'max_seconds': self.max_seconds,
+            'load_profile': self.load_profile['name']
         })
         
         # テスト開始のアクティビティをログ
@@ -79,11 +132,14 @@ class EnhancedTestExecutor:
         
         duration = int(time.time() - start_time)
         result["duration"] = duration
+        # セッション中のLLM呼び出しの集計（プロンプト別のトークン数・画像バイト数・レイテンシのパーセンタイル）
+        result["llm"] = get_llm_telemetry().session_summary(session_id)
         
         self._log_to_session(session_id, 'info', 'テスト実行が完了しました', {
             'duration': duration,
             'pages_scanned': result.get('pages_scanned', 0),
-            'bugs_found': result.get('bugs_found', 0)
+            'bugs_found': result.get('bugs_found', 0),
+            'llm': result["llm"]
         })
         
         # テスト完了のアクティビティをログ
@@ -96,6 +152,8 @@ class EnhancedTestExecutor:
         except Exception as e:
             logger.warning(f"Failed to log test completed activity: {e}")
         
+        # キューに残っているログを書き込んでから終了
+        self.log_sink.flush()
         return result
     
     def _execute_enhanced_omakase_mode(self, session_id: str, url: str) -> Dict:
@@ -103,74 +161,98 @@ class EnhancedTestExecutor:
         logger.info(f"Executing enhanced omakase mode for session {session_id}")
         
         # 初期化
-        self.url_queue = queue.Queue()
         self.visited_urls.clear()
-        self.processed_urls.clear()
         self.bugs_found = []
+        # 正規化済みURLの既出インデックス（フロンティアとリンク抽出で共有）
+        self.seen_index = SeenUrlIndex()
+        # DOM構造が同じページはテンプレートごとにサンプル数だけフル分析する
+        self.template_index = PageTemplateIndex()
+        self.payload_stats = self.page_analyzer.payload_stats = PayloadStats()
+        self.ai_skipped_pages = 0
+        self.page_results = {}
+        self.saved_bug_fingerprints = set()
+        # TestResult/BugTicketなどの行はページ単位でまとめて書き込む
+        self.result_writer = ResultBatchWriter(session_id)
+        cache_stats_before = self.analysis_cache.stats(session_id)
+        
+        # 前回の試行のチェックポイントがあれば、そこから再開
+        resume_state = self.checkpoint_store.load(session_id)
+        if resume_state:
+            self.page_results = resume_state.get('page_results') or {}
+            self.saved_bug_fingerprints = set(resume_state.get('bug_fingerprints') or [])
+            self.bugs_found = list(resume_state.get('bugs') or [])
+            self._log_to_session(session_id, 'info', 'チェックポイントからクロールを再開', {
+                'pages_scanned': resume_state.get('pages_scanned', 0),
+                'queued_urls': len(resume_state.get('frontier') or []),
+                'bugs_found': len(self.bugs_found),
+                'checkpointed_at': resume_state.get('updated_at')
+            })
+        else:
+            self._log_to_session(session_id, 'info', '初期URLの処理を開始', {
+                'url': url.strip(),
+                'depth': 0
+            })
         
-        # 初期URLを必ず処理するように修正
-        initial_url = url.strip()
-        self.url_queue.put((initial_url, 0))  # (URL, depth)
-        
-        pages_scanned = 0
-        
-        # 並列実行用のThreadPoolExecutor
-        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-            futures = []
-            
-            # 初期URLを即座に処理開始
-            if not self.url_queue.empty():
-                url_info = self.url_queue.get()
-                future = executor.submit(self._process_page, session_id, url_info[0], url_info[1])
-                futures.append(future)
-                self.processed_urls.add(url_info[0])
-                
-                self._log_to_session(session_id, 'info', '初期URLの処理を開始', {
-                    'url': url_info[0],
-                    'depth': url_info[1]
-                })
-            
-            while futures or not self.url_queue.empty():
-                # 新しいURLがあれば処理を開始
-                while not self.url_queue.empty() and len(futures) < self.max_workers:
-                    try:
-                        url_info = self.url_queue.get_nowait()
-                        if url_info[0] not in self.processed_urls:
-                            future = executor.submit(self._process_page, session_id, url_info[0], url_info[1])
-                            futures.append(future)
-                            self.processed_urls.add(url_info[0])
-                    except queue.Empty:
-                        break
-                
-                # 完了したタスクを処理
-                if futures:
-                    done, futures = self._wait_for_any_complete(futures, timeout=1)
-                    for future in done:
-                        try:
-                            page_result = future.result()
-                            if page_result.get('processed', False):
-                                pages_scanned += 1
-                            
-                            # 発見されたURLをキューに追加
-                            for new_url in page_result.get('discovered_urls', []):
-                                if new_url not in self.processed_urls and new_url not in self.visited_urls:
-                                    depth = page_result.get('depth', 0) + 1
-                                    if depth <= self.max_depth:
-                                        self.url_queue.put((new_url, depth))
-                                        
-                        except Exception as e:
-                            logger.error(f"Error processing page: {e}")
-        
+        # 少数のブラウザ上で多数のページをasyncioで並行処理
+        engine = AsyncCrawlEngine(
+            page_handler=lambda page, page_url, depth: self._process_page(page, session_id, page_url, depth),
+            max_depth=self.max_depth,
+            concurrency=self.concurrency,
+            max_pages=self.max_pages,
+            max_seconds=self.max_seconds,
+            seen_index=self.seen_index,
+            checkpoint_callback=lambda state: self._save_checkpoint(session_id, state),
+            context_options={
+                'viewport': self.viewport,
+                'user_agent': 'QA3-Bot/1.0'
+            }
+        )
+        throughput = engine.run(url, resume_state=resume_state)
+        self.result_writer.flush()
+        throughput['screenshots'] = self.screenshot_store.stats()
+        throughput['result_writer'] = self.result_writer.stats()
+        throughput['db_pool'] = get_pool().stats()
+        throughput['session_log_sink'] = self.log_sink.stats()
+        throughput['analysis_cache'] = self.analysis_cache.stats_since(cache_stats_before, session_id)
+        throughput['templates'] = self.template_index.stats()
+        throughput['llm_payload'] = self.payload_stats.stats()
+        throughput['gemini_rate_limiter'] = self.rate_limiter.stats()
+        throughput['gemini_client'] = self.gemini.stats()
+        throughput['llm_telemetry'] = get_llm_telemetry().stats()
+        throughput['ai_skipped_pages'] = self.ai_skipped_pages
+        self._log_to_session(session_id, 'info', 'クロールのスループット', throughput)
+        
+        # 最後までクロールできたのでチェックポイントは不要
+        self.checkpoint_store.delete(session_id)
+        
+        pages_scanned = throughput['pages_scanned']
         return {
             "pages_scanned": pages_scanned,
             "bugs_found": len(self.bugs_found),
             "test_coverage": min(0.9, pages_scanned * 0.1),  # より現実的なカバレッジ計算
-            "bugs": self.bugs_found[:50]  # 最大50個のバグを返す
+            "bugs": self.bugs_found[:50],  # 最大50個のバグを返す
+            "pages_per_sec": throughput['pages_per_sec'],
+            "crawl_stop_reason": throughput['frontier']['stop_reason']
         }
     
-    def _process_page(self, session_id: str, url: str, depth: int) -> Dict:
-        """Process a single page with Playwright and Gemini"""
+    async def _save_checkpoint(self, session_id: str, state: Dict):
+        """エンジンのスナップショットにページ結果とバグを加えて保存"""
+        visited = set(state.get('visited_urls', []))
+        with self.lock:
+            state['page_results'] = dict(self.page_results)
+            state['bug_fingerprints'] = list(self.saved_bug_fingerprints)
+            # 処理中のページのバグは再開時に再検出されるため、処理済みページの分だけ残す
+            state['bugs'] = [
+                {k: v for k, v in bug.items() if k != 'screenshot'}
+                for bug in self.bugs_found if bug.get('url') in visited
+            ]
+        await asyncio.to_thread(self.checkpoint_store.save, session_id, state)
+    
+    async def _process_page(self, page, session_id: str, url: str, depth: int) -> Dict:
+        """Process a single page with Playwright and Gemini (runs on the crawl engine's event loop)"""
         logger.info(f"Processing page: {url} (depth: {depth})")
+        # このタスク（とto_threadで呼ぶ分析）のGemini呼び出しをセッション単位で公平に並べる
+        set_llm_session(session_id)
         
         # URLの正規化
         url = url.strip()
@@ -186,406 +268,388 @@ class EnhancedTestExecutor:
         })
         
         discovered_urls = []
+        suggested_urls = []
         page_bugs = []
+        template_id = None
+        analysis_mode = 'full'
         
-        with sync_playwright() as p:
-            browser = p.chromium.launch(headless=True)
-            context = browser.new_context(
-                viewport={'width': 1920, 'height': 1080},
-                user_agent='QA3-Bot/1.0'
-            )
-            page = context.new_page()
+        # 軽量チェック用にコンソールエラーを集める
+        console_errors = []
+        page.on('console', lambda msg: console_errors.append(msg.text) if msg.type == 'error' else None)
+        
+        try:
+            # プロファイルに従って不要なリクエストをブロックし、ページに移動
+            page_load = PageLoadProfile(self.load_profile)
+            await page_load.apply_async(page)
+            response = await page_load.goto_async(page, url, timeout=30000)
             
-            try:
-                # ページに移動
-                response = page.goto(url, wait_until='networkidle', timeout=30000)
-                
-                if response and response.status >= 400:
-                    bug = {
-                        "type": "http_error",
-                        "error_message": f"HTTP {response.status} エラー",
-                        "url": url,
-                        "severity": "high" if response.status >= 500 else "medium"
-                    }
-                    page_bugs.append(bug)
-                    self._add_bug(bug)
-                
-                # スクリーンショットを取得
-                screenshot = page.screenshot(full_page=True)
-                
-                # ページコンテンツを取得
-                page_content = page.content()
-                page_title = page.title()
-                
-                # ページロード時のスクリーンショットをログに保存
-                self._log_to_session(session_id, 'info', f'ページをロードしました: {url}', {
-                    'url': url,
-                    'title': page_title,
-                    'depth': depth
-                }, screenshot)
-                
-                # 現在の状態を準備
-                current_state = {
-                    'pages_visited': len(self.visited_urls),
-                    'depth': depth,
-                    'bugs_found': len(self.bugs_found)
+            if response and response.status >= 400:
+                bug = {
+                    "type": "http_error",
+                    "error_message": f"HTTP {response.status} エラー",
+                    "url": url,
+                    "severity": "high" if response.status >= 500 else "medium"
                 }
-                
-                # Gemini APIでページを分析し、アクションを生成
-                gemini_result = self.page_analyzer.analyze_page_and_generate_actions(
-                    url, screenshot, page_content, page_title, current_state
+                page_bugs.append(bug)
+                self._add_bug(bug)
+            
+            # 同じDOM構造のページを既に十分分析していれば、Geminiとインタラクションのテストは省く
+            template_id, full_analysis = await self._classify_template(page, url)
+            if not full_analysis:
+                await self._check_sampled_out_page(
+                    page, session_id, url, depth, template_id, console_errors, page_bugs, discovered_urls, page_load
                 )
+                return self._page_result(url, depth, discovered_urls, suggested_urls, page_bugs, template_id, 'template_sampled_out')
+            
+            # スクリーンショットを取得
+            screenshot = await page.screenshot(full_page=True)
+            # 画像はストアに1度だけ書き込み、以降のDB行には参照を入れる
+            screenshot_ref = await asyncio.to_thread(self.screenshot_store.put, screenshot)
+            # Gemini APIが不安定な間（サーキットブレーカーが開いている間）はAIを使わないチェックだけを行う
+            ai_available = self.gemini.available()
+            prepared_screenshot = None
+            page_outline = ''
+            if ai_available:
+                # LLM用の縮小・分割・再エンコードも1度だけ行い、このページの分析で共有する
+                prepared_screenshot = await asyncio.to_thread(prepare_screenshot, screenshot)
+                # ページ構造のアウトラインを取得（HTML全体はブラウザから転送しない）
+                page_outline = await distill_page(page)
+            page_title = await page.title()
+            
+            # ページロード時のスクリーンショットをログに保存
+            self._log_to_session(session_id, 'info', f'ページをロードしました: {url}', {
+                'url': url,
+                'title': page_title,
+                'depth': depth,
+                'llm_screenshot': prepared_screenshot.summary if prepared_screenshot else None
+            }, screenshot_ref)
+            
+            # 1回のGeminiリクエストで問題・アクション・ナビゲーション候補をまとめて取得
+            if ai_available:
+                gemini_result = await asyncio.to_thread(
+                    self.page_analyzer.analyze_page,
+                    url, prepared_screenshot, page_outline, page_title, self.viewport_variant
+                )
+            else:
+                gemini_result = {"issues": [], "actions": [], "navigation_suggestions": []}
+                analysis_mode = 'no_ai'
+                self._note_ai_unavailable(session_id, url)
+            analysis_result = {"issues": gemini_result.get('issues', [])}
+            logger.info(f"Gemini analysis result for {url}: {json.dumps(analysis_result, indent=2, ensure_ascii=False)}")
+            
+            # 分析結果からバグを抽出
+            issues = analysis_result['issues']
+            logger.info(f"Found {len(issues)} issues from Gemini analysis for {url}")
+            for issue in issues:
+                bug = {
+                    "type": issue.get('type', 'unknown'),
+                    "error_message": issue.get('description', ''),
+                    "url": url,
+                    "severity": issue.get('severity', 'medium'),
+                    "element": issue.get('element', ''),
+                    "screenshot": screenshot_ref if issue.get('visual', False) else None
+                }
+                page_bugs.append(bug)
+                self._add_bug(bug)
                 
-                # Geminiが提案したアクションを実行
-                if gemini_result.get('actions'):
-                    self._log_to_session(session_id, 'info', f'Geminiが{len(gemini_result["actions"])}個のアクションを生成', {
-                        'url': url,
-                        'actions': [a['description'] for a in gemini_result['actions'][:5]]  # 最初の5個のみログ
-                    })
-                    
-                    # アクションを実行
-                    action_results = self.action_executor.execute_actions(page, gemini_result['actions'])
-                    
-                    # アクション実行後に再度スクリーンショットを取得して分析
-                    if any(r['success'] for r in action_results):
-                        time.sleep(1)  # アクションの効果を待つ
-                        post_action_screenshot = page.screenshot(full_page=True)
-                        post_action_content = page.content()
-                        
-                        # アクション実行後のスクリーンショットをログに保存
-                        self._log_to_session(session_id, 'info', f'アクション実行後: {url}', {
-                            'url': url,
-                            'successful_actions': len([r for r in action_results if r['success']]),
-                            'failed_actions': len([r for r in action_results if not r['success']])
-                        }, post_action_screenshot)
-                        
-                        # アクション後の分析
-                        post_analysis = self._analyze_with_gemini(url, page.title(), post_action_screenshot, post_action_content)
-                        for issue in post_analysis.get('issues', []):
-                            bug = {
-                                "type": issue.get('type', 'unknown'),
-                                "error_message": f"[アクション後] {issue.get('description', '')}",
-                                "url": url,
-                                "severity": issue.get('severity', 'medium'),
-                                "element": issue.get('element', ''),
-                                "screenshot": base64.b64encode(post_action_screenshot).decode('utf-8') if issue.get('visual', False) else None
-                            }
-                            page_bugs.append(bug)
-                            self._add_bug(bug)
-                
-                # action_results変数を初期化
-                action_results = []
-                
-                # 初回分析結果も処理
-                analysis_result = self._analyze_with_gemini(url, page_title, screenshot, page_content)
-                logger.info(f"Gemini analysis result for {url}: {json.dumps(analysis_result, indent=2)}")
-                
-                # 分析結果からバグを抽出
-                issues = analysis_result.get('issues', [])
-                logger.info(f"Found {len(issues)} issues from Gemini analysis for {url}")
-                for issue in issues:
-                    bug = {
-                        "type": issue.get('type', 'unknown'),
-                        "error_message": issue.get('description', ''),
-                        "url": url,
-                        "severity": issue.get('severity', 'medium'),
-                        "element": issue.get('element', ''),
-                        "screenshot": base64.b64encode(screenshot).decode('utf-8') if issue.get('visual', False) else None
-                    }
-                    page_bugs.append(bug)
-                    self._add_bug(bug)
-                    
-                    # バグ発見時のスクリーンショットをログに保存
-                    self._log_to_session(session_id, 'warning', f'バグを発見: {issue.get("description", "")}', {
-                        'url': url,
-                        'bug_type': issue.get('type', 'unknown'),
-                        'severity': issue.get('severity', 'medium'),
-                        'element': issue.get('element', '')
-                    }, screenshot)
-                
-                # インタラクティブ要素のテスト
-                interactive_bugs = self._test_interactive_elements(page, url)
-                if interactive_bugs:
-                    logger.info(f"Found {len(interactive_bugs)} interactive bugs for {url}")
-                page_bugs.extend(interactive_bugs)
-                
-                # アクセシビリティチェック
-                accessibility_bugs = self._check_accessibility_enhanced(page, url)
-                if accessibility_bugs:
-                    logger.info(f"Found {len(accessibility_bugs)} accessibility bugs for {url}")
-                page_bugs.extend(accessibility_bugs)
-                
-                # パフォーマンスチェック
-                performance_bugs = self._check_performance(page, url)
-                if performance_bugs:
-                    logger.info(f"Found {len(performance_bugs)} performance bugs for {url}")
-                page_bugs.extend(performance_bugs)
+                # バグ発見時のスクリーンショットをログに保存
+                self._log_to_session(session_id, 'warning', f'バグを発見: {issue.get("description", "")}', {
+                    'url': url,
+                    'bug_type': issue.get('type', 'unknown'),
+                    'severity': issue.get('severity', 'medium'),
+                    'element': issue.get('element', '')
+                }, screenshot_ref)
+            
+            # Geminiが提案したアクションを実行
+            action_results = []
+            if gemini_result.get('actions'):
+                self._log_to_session(session_id, 'info', f'Geminiが{len(gemini_result["actions"])}個のアクションを生成', {
+                    'url': url,
+                    'actions': [a.get('description', '') for a in gemini_result['actions'][:5]]  # 最初の5個のみログ
+                })
                 
-                # 同一ドメイン内のリンクを収集
-                if depth < self.max_depth:
-                    links = self._extract_links(page, url)
-                    discovered_urls.extend(links)
-                    
-                    # Geminiが提案したナビゲーションも追加
-                    for nav in gemini_result.get('navigation_suggestions', []):
-                        nav_url = nav.get('url', '')
-                        if nav_url and self._is_same_domain(url, nav_url):
-                            discovered_urls.append(nav_url)
+                before_actions = await self._dom_signature(page)
+                action_results = await self.action_executor.execute_actions(page, gemini_result['actions'])
                 
-                # テスト結果を保存（バグがない場合も成功として保存）
-                try:
-                    db_url = os.environ.get('DATABASE_ROOT_URL', '')
-                    logger.info(f"Database URL (before modification): {db_url[:30]}...")
-                    if '127.0.0.1' in db_url or 'localhost' in db_url:
-                        db_url = db_url.replace('127.0.0.1', 'host.docker.internal').replace('localhost', 'host.docker.internal')
-                        logger.info(f"Database URL (after modification): {db_url[:30]}...")
-                    
-                    logger.info(f"Connecting to database...")
-                    conn = psycopg2.connect(db_url)
-                    logger.info(f"Database connection established")
-                    cursor = conn.cursor()
-                    
-                    # プロジェクトIDを取得
-                    cursor.execute("""
-                        SELECT ts.project_id FROM "TestSession" ts WHERE ts.id = %s
-                    """, (session_id,))
-                    result = cursor.fetchone()
-                    if not result:
-                        logger.error(f"TestSession not found for session_id: {session_id}")
-                        conn.close()
+                # アクションでDOMが変わった場合だけ、再度スクリーンショットを取得して分析
+                if any(r['success'] for r in action_results):
+                    await asyncio.sleep(1)  # アクションの効果を待つ
+                    if await self._dom_signature(page) == before_actions:
+                        logger.info(f"DOM unchanged after actions on {url}, skipping post-action analysis")
                     else:
-                        project_id = result[0]
-                        
-                        # バグがない場合でも成功のTestResultを作成
-                        if len(page_bugs) == 0:
-                            test_result_id = str(uuid.uuid4())
-                            result_screenshot = base64.b64encode(screenshot).decode('utf-8') if screenshot else None
-                            
-                            # テスト結果の詳細情報を準備
-                            test_details = {
-                                "gemini_analysis": analysis_result,
-                                "gemini_actions": gemini_result.get('actions', []),
-                                "action_results": action_results,
-                                "page_title": page_title,
-                                "test_type": "ai_analysis",
-                                "timestamp": datetime.now(timezone.utc).isoformat(),
-                                "status": "success",
-                                "message": "No issues found"
-                            }
-                            
-                            cursor.execute("""
-                                INSERT INTO "TestResult" (id, test_session_id, url, status, execution_time, screenshot, 
-                                    console_logs, network_logs, user_actions, dom_snapshot, details, created_at, updated_at)
-                                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, NOW(), NOW())
-                            """, (
-                                test_result_id, session_id, url, "passed", 0, result_screenshot,
-                                json.dumps([]),
-                                json.dumps([]),
-                                json.dumps([{"action": "page_analysis", "url": url}]),
-                                '',
-                                json.dumps(test_details, ensure_ascii=False)
-                            ))
-                            logger.info(f"Saved successful test result for {url}")
-                        
-                        conn.commit()
-                        conn.close()
-                
-                except Exception as e:
-                    logger.error(f"Failed to save test result without bugs: {e}")
-                    logger.error(f"Traceback: {traceback.format_exc()}")
-                    if 'conn' in locals():
-                        try:
-                            conn.close()
-                        except:
-                            pass
-                
-                # バグが存在する場合の処理
-                logger.info(f"Saving {len(page_bugs)} bugs to database for URL: {url}")
-                for i, bug in enumerate(page_bugs):
-                    try:
-                        # BugTicketテーブルに保存
-                        db_url = os.environ.get('DATABASE_ROOT_URL', '')
-                        logger.info(f"Database URL (before modification): {db_url[:30]}...")
-                        if '127.0.0.1' in db_url or 'localhost' in db_url:
-                            db_url = db_url.replace('127.0.0.1', 'host.docker.internal').replace('localhost', 'host.docker.internal')
-                            logger.info(f"Database URL (after modification): {db_url[:30]}...")
-                        
-                        logger.info(f"Connecting to database...")
-                        conn = psycopg2.connect(db_url)
-                        logger.info(f"Database connection established")
-                        cursor = conn.cursor()
-                        
-                        # まず、プロジェクトIDを取得
-                        cursor.execute("""
-                            SELECT ts.project_id FROM "TestSession" ts WHERE ts.id = %s
-                        """, (session_id,))
-                        result = cursor.fetchone()
-                        if not result:
-                            logger.error(f"TestSession not found for session_id: {session_id}")
-                            conn.close()
-                            continue
-                        if result:
-                            project_id = result[0]
-                            
-                            # TestResultを作成
-                            test_result_id = str(uuid.uuid4())
-                            
-                            # スクリーンショットを準備
-                            result_screenshot = bug.get("screenshot")
-                            if not result_screenshot and screenshot:
-                                result_screenshot = base64.b64encode(screenshot).decode('utf-8')
-                            
-                            # テスト結果の詳細情報を準備
-                            test_details = {
-                                "gemini_analysis": analysis_result,
-                                "gemini_actions": gemini_result.get('actions', []),
-                                "action_results": action_results if 'action_results' in locals() else [],
-                                "page_title": page_title,
-                                "bug_details": bug,
-                                "test_type": "ai_analysis",
-                                "timestamp": datetime.now(timezone.utc).isoformat()
-                            }
-                            
-                            cursor.execute("""
-                                INSERT INTO "TestResult" (id, test_session_id, url, status, execution_time, screenshot, 
-                                    console_logs, network_logs, user_actions, dom_snapshot, details, created_at, updated_at)
-                                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, NOW(), NOW())
-                            """, (
-                                test_result_id, session_id, url, "failed", 0, result_screenshot,
-                                json.dumps(bug.get('console_logs', [])),
-                                json.dumps(bug.get('network_logs', [])),
-                                json.dumps([{"action": "page_analysis", "url": url}]),
-                                bug.get('dom_snapshot', ''),
-                                json.dumps(test_details, ensure_ascii=False)
-                            ))
-                            
-                            # BugTicketを作成
-                            bug_screenshot = bug.get('screenshot')
-                            if not bug_screenshot and screenshot:
-                                bug_screenshot = base64.b64encode(screenshot).decode('utf-8')
-                            
-                            bug_ticket_id = str(uuid.uuid4())
-                            # バグチケットの詳細情報を準備
-                            bug_details = {
-                                "detection_method": "gemini_analysis",
-                                "analysis_result": analysis_result.get('issues', []),
-                                "action_executed": 'action_results' in locals(),
-                                "action_results": action_results if 'action_results' in locals() else [],
-                                "page_context": {
-                                    "title": page_title,
-                                    "url": url,
-                                    "timestamp": datetime.now(timezone.utc).isoformat()
-                                },
-                                "element_details": bug.get('element_details', {}),
-                                "visual_issue": bug.get('visual', False)
-                            }
-                            
-                            cursor.execute("""
-                                INSERT INTO "BugTicket" (id, project_id, test_session_id, test_result_id, reported_by_id, 
-                                    title, description, severity, bug_type, affected_url, reproduction_steps, 
-                                    expected_behavior, actual_behavior, screenshot, affected_components, 
-                                    ai_confidence_score, details, created_at, updated_at)
-                                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, NOW(), NOW())
-                            """, (
-                                bug_ticket_id, project_id, session_id, test_result_id, 'system',
-                                f"{bug.get('type', 'unknown')} - {url}",
-                                bug.get('error_message', ''),
-                                bug.get('severity', 'medium'),
-                                bug.get('type', 'unknown'),
-                                url,
-                                json.dumps({"steps": ["Navigate to URL", "Page analysis"]}),
-                                "Page should render without issues",
-                                bug.get('error_message', ''),
-                                bug_screenshot,
-                                '{' + bug.get('element', 'page') + '}',  # PostgreSQL配列形式
-                                0.8,
-                                json.dumps(bug_details, ensure_ascii=False)
-                            ))
-                            
-                            # バグコメントを作成
-                            if bug.get('error_message'):
-                                bug_comment_id = str(uuid.uuid4())
-                                cursor.execute("""
-                                    INSERT INTO "BugComment" (id, bug_ticket_id, author_id, content, created_at, updated_at)
-                                    VALUES (%s, %s, %s, %s, NOW(), NOW())
-                                """, (
-                                    bug_comment_id, bug_ticket_id, 'system',
-                                    f"AI検出結果: {bug.get('error_message', '')}\n要素: {bug.get('element', 'page')}\n信頼度: {bug.get('confidence', 0.8)}"
-                                ))
-                            
-                            # バグ報告のアクティビティをログ
-                            try:
-                                self.activity_logger.log_bug_reported('system', bug_ticket_id, {
-                                    'bug_type': bug.get('type', 'unknown'),
-                                    'severity': bug.get('severity', 'medium'),
-                                    'url': url
-                                }, screenshot)
-                            except Exception as e:
-                                logger.warning(f"Failed to log bug reported activity: {e}")
-                            
-                        conn.commit()
-                        logger.info(f"Successfully saved bug ticket {bug_ticket_id} for {url}")
-                        conn.close()
-                    except psycopg2.Error as db_err:
-                        logger.error(f"Database error while saving bug ticket: {db_err}")
-                        logger.error(f"Error code: {db_err.pgcode if hasattr(db_err, 'pgcode') else 'N/A'}")
-                        logger.error(f"Error detail: {db_err.pgerror if hasattr(db_err, 'pgerror') else 'N/A'}")
-                        logger.error(f"Bug data: {json.dumps(bug, indent=2)}")
-                        if 'conn' in locals():
-                            try:
-                                conn.rollback()
-                                conn.close()
-                            except:
-                                pass
-                    except Exception as e:
-                        logger.error(f"Failed to save bug ticket: {e}")
-                        logger.error(f"Exception type: {type(e).__name__}")
-                        logger.error(f"Bug data: {json.dumps(bug, indent=2)}")
-                        logger.error(f"Traceback: {traceback.format_exc()}")
-                        if 'conn' in locals():
-                            try:
-                                conn.close()
-                            except:
-                                pass
+                        await self._analyze_after_actions(page, session_id, url, action_results, page_bugs)
+            
+            # インタラクティブ要素のテスト
+            interactive_bugs = await self._test_interactive_elements(page, url)
+            if interactive_bugs:
+                logger.info(f"Found {len(interactive_bugs)} interactive bugs for {url}")
+            page_bugs.extend(interactive_bugs)
+            
+            # アクセシビリティチェック
+            accessibility_bugs = await self._check_accessibility_enhanced(page, url)
+            if accessibility_bugs:
+                logger.info(f"Found {len(accessibility_bugs)} accessibility bugs for {url}")
+            page_bugs.extend(accessibility_bugs)
+            
+            # パフォーマンスチェック
+            performance_bugs = await self._check_performance(page, url)
+            if performance_bugs:
+                logger.info(f"Found {len(performance_bugs)} performance bugs for {url}")
+            page_bugs.extend(performance_bugs)
+            
+            # 同一ドメイン内のリンクを収集
+            if depth < self.max_depth:
+                links = await self._extract_links(page, url)
+                discovered_urls.extend(links)
                 
-                self._log_to_session(session_id, 'info', f'ページ分析完了: {len(page_bugs)}個の問題を発見', {
+                # Geminiが提案したナビゲーションはフロンティアで優先される
+                for nav in gemini_result.get('navigation_suggestions', []):
+                    nav_url = nav.get('url', '')
+                    if nav_url and self._is_same_domain(url, nav_url):
+                        suggested_urls.append(nav_url)
+            
+            # テスト結果を保存（バグがない場合も成功として保存）
+            await asyncio.to_thread(
+                self._save_page_results, session_id, url, screenshot_ref, page_title,
+                page_bugs, analysis_result, gemini_result, action_results, page_load.summary()
+            )
+            
+            self._log_to_session(session_id, 'info', f'ページ分析完了: {len(page_bugs)}個の問題を発見', {
+                'url': url,
+                'bugs_found': len(page_bugs),
+                'links_discovered': len(discovered_urls) + len(suggested_urls)
+            }, screenshot_ref if len(page_bugs) > 0 else None)  # バグがある場合のみスクリーンショットを保存
+            
+        except Exception as e:
+            logger.error(f"Error processing page {url}: {e}")
+            self._log_to_session(session_id, 'error', f'ページ処理中にエラー: {url}', {
+                'error': str(e)
+            })
+            
+            # エラーのアクティビティをログ
+            try:
+                await asyncio.to_thread(self.activity_logger.log_activity, 'system', 'test_error', 'test_session', session_id, {
                     'url': url,
-                    'bugs_found': len(page_bugs),
-                    'links_discovered': len(discovered_urls)
-                }, screenshot if len(page_bugs) > 0 else None)  # バグがある場合のみスクリーンショットを保存
-                
-            except Exception as e:
-                logger.error(f"Error processing page {url}: {e}")
-                self._log_to_session(session_id, 'error', f'ページ処理中にエラー: {url}', {
                     'error': str(e)
                 })
-                
-                # エラーのアクティビティをログ
-                try:
-                    self.activity_logger.log_activity('system', 'test_error', 'test_session', session_id, {
-                        'url': url,
-                        'error': str(e)
-                    })
-                except Exception as activity_error:
-                    logger.warning(f"Failed to log error activity: {activity_error}")
-                
-            finally:
-                browser.close()
+            except Exception as activity_error:
+                logger.warning(f"Failed to log error activity: {activity_error}")
+            
+        return self._page_result(url, depth, discovered_urls, suggested_urls, page_bugs, template_id, analysis_mode)
+    
+    def _note_ai_unavailable(self, session_id: str, url: str):
+        """AI分析を省いたページを数え、セッションで最初の1回だけログに残す"""
+        with self.lock:
+            self.ai_skipped_pages += 1
+            first = self.ai_skipped_pages == 1
+        if first:
+            self._log_to_session(session_id, 'warning', 'Gemini APIが不安定なため、AIを使わないチェックに切り替えました', {
+                'url': url,
+                'gemini_client': self.gemini.stats()
+            })
+    
+    def _page_result(self, url: str, depth: int, discovered_urls: List[str], suggested_urls: List[str],
+                     page_bugs: List[Dict], template_id: Optional[str], analysis_mode: str) -> Dict:
+        """ページの処理結果を記録し、クロールエンジンに返す結果を作る"""
+        self.page_results[url] = {
+            'depth': depth,
+            'bugs': len(page_bugs),
+            'links': len(discovered_urls) + len(suggested_urls),
+            'template_id': template_id,
+            'analysis_mode': analysis_mode
+        }
         
         return {
             "discovered_urls": discovered_urls,
+            "suggested_urls": suggested_urls,
             "bugs": page_bugs,
             "depth": depth,
             "processed": True
         }
     
-    def _analyze_with_gemini(self, url: str, title: str, screenshot: bytes, content: str) -> Dict:
-        """Analyze page with Gemini multimodal API"""
+    async def _classify_template(self, page, url: str):
+        """DOM構造からページのテンプレートを判定し、(テンプレートID, フル分析するか) を返す"""
         try:
-            # 画像をGemini用に準備
-            import PIL.Image
-            import io
-            image = PIL.Image.open(io.BytesIO(screenshot))
+            skeleton = await page.evaluate(DOM_SKELETON_SCRIPT)
+        except Exception as e:
+            # 判定できない場合はフル分析する
+            logger.warning(f"Failed to extract DOM skeleton for {url}: {e}")
+            return None, True
+        if not skeleton:
+            return None, True
+        return self.template_index.classify(skeleton, url)
+    
+    async def _check_sampled_out_page(self, page, session_id: str, url: str, depth: int, template_id: str,
+                                      console_errors: List[str], page_bugs: List[Dict], discovered_urls: List[str],
+                                      page_load: PageLoadProfile):
+        """分析済みテンプレートのページの軽量チェック（HTTPステータス・コンソールエラー・リンク収集のみ）"""
+        for message in console_errors[:10]:
+            bug = {
+                "type": "console_error",
+                "error_message": f"コンソールエラー: {message[:500]}",
+                "url": url,
+                "severity": "medium",
+                "element": "console"
+            }
+            page_bugs.append(bug)
+            self._add_bug(bug)
+        
+        if depth < self.max_depth:
+            discovered_urls.extend(await self._extract_links(page, url))
+        
+        page_title = await page.title()
+        analysis_result = {"issues": [], "skipped": "template_sampled_out", "template_id": template_id}
+        await asyncio.to_thread(
+            self._save_page_results, session_id, url, None, page_title,
+            page_bugs, analysis_result, {}, [], page_load.summary()
+        )
+        
+        self._log_to_session(session_id, 'info', f'分析済みテンプレートのため軽量チェックのみ: {url}', {
+            'url': url,
+            'template_id': template_id,
+            'bugs_found': len(page_bugs),
+            'links_discovered': len(discovered_urls)
+        })
+    
+    async def _dom_signature(self, page) -> Optional[str]:
+        """URL・要素数・表示テキストから作るDOMの指紋（アクションで画面が変わったかの判定用）"""
+        try:
+            signature = await page.evaluate(_DOM_SIGNATURE_SCRIPT)
+            return hashlib.sha1(signature.encode('utf-8')).hexdigest()
+        except Exception as e:
+            # 判定できない場合は変化したものとして扱う
+            logger.warning(f"Failed to compute DOM signature: {e}")
+            return None
+    
+    async def _analyze_after_actions(self, page, session_id: str, url: str, action_results: List[Dict],
+                                     page_bugs: List[Dict]):
+        """アクション実行後の画面を分析し、見つかったバグをpage_bugsに追加"""
+        post_action_screenshot = await page.screenshot(full_page=True)
+        post_action_outline = await distill_page(page)
+        post_action_ref = await asyncio.to_thread(self.screenshot_store.put, post_action_screenshot)
+        post_action_prepared = await asyncio.to_thread(prepare_screenshot, post_action_screenshot)
+        
+        # アクション実行後のスクリーンショットをログに保存
+        self._log_to_session(session_id, 'info', f'アクション実行後: {url}', {
+            'url': url,
+            'successful_actions': len([r for r in action_results if r['success']]),
+            'failed_actions': len([r for r in action_results if not r['success']])
+        }, post_action_ref)
+        
+        post_analysis = await asyncio.to_thread(
+            self._analyze_with_gemini, url, await page.title(), post_action_prepared, post_action_outline,
+            f"{self.viewport_variant}:post_action"
+        )
+        for issue in post_analysis.get('issues', []):
+            bug = {
+                "type": issue.get('type', 'unknown'),
+                "error_message": f"[アクション後] {issue.get('description', '')}",
+                "url": url,
+                "severity": issue.get('severity', 'medium'),
+                "element": issue.get('element', ''),
+                "screenshot": post_action_ref if issue.get('visual', False) else None
+            }
+            page_bugs.append(bug)
+            self._add_bug(bug)
+    
+    def _save_page_results(self, session_id: str, url: str, screenshot: Optional[str], page_title: str,
+                           page_bugs: List[Dict], analysis_result: Dict, gemini_result: Dict,
+                           action_results: List[Dict], page_load: Dict):
+        """ページのTestResult/BugTicket/BugComment/ActivityLogをまとめて保存（ブロッキングI/Oのためスレッドで実行）
+
+        行はResultBatchWriterに溜め、ページごとに1トランザクションで書き込む。
+        screenshotはスクリーンショットストアの参照で、全ての行で同じ参照を共有する。
+        """
+        writer = self.result_writer
+        common_details = {
+            "gemini_analysis": analysis_result,
+            "gemini_actions": gemini_result.get('actions', []),
+            "action_results": action_results,
+            "page_title": page_title,
+            "page_load": page_load,
+            "test_type": "ai_analysis",
+            "timestamp": datetime.now(timezone.utc).isoformat()
+        }
+        user_actions = [{"action": "page_analysis", "url": url}]
+        
+        # バグがない場合でも成功のTestResultを作成
+        if len(page_bugs) == 0:
+            writer.add({'TestResult': [test_result_row(
+                session_id, url, "passed",
+                {**common_details, "status": "success", "message": "No issues found"},
+                screenshot=screenshot, user_actions=user_actions
+            )]})
+        
+        project_id = writer.project_id() if page_bugs else None
+        if page_bugs and not project_id:
+            logger.error(f"Skipping {len(page_bugs)} bugs for {url}: project not found for session {session_id}")
+            page_bugs = []
+        
+        logger.info(f"Queueing {len(page_bugs)} bugs for URL: {url}")
+        for bug in page_bugs:
+            # 前回の試行で保存済みのバグは登録しない
+            fingerprint = bug_fingerprint(bug)
+            if fingerprint in self.saved_bug_fingerprints:
+                continue
+            
+            test_result_id = new_id()
+            bug_ticket_id = new_id()
+            bug_screenshot = bug.get('screenshot') or screenshot
+            rows = {
+                'TestResult': [test_result_row(
+                    session_id, url, "failed", {**common_details, "bug_details": bug},
+                    screenshot=bug_screenshot,
+                    console_logs=bug.get('console_logs', []),
+                    network_logs=bug.get('network_logs', []),
+                    user_actions=user_actions,
+                    dom_snapshot=bug.get('dom_snapshot', ''),
+                    result_id=test_result_id
+                )],
+                'BugTicket': [bug_ticket_row(
+                    bug_ticket_id, project_id, session_id, test_result_id, bug,
+                    title=f"{bug.get('type', 'unknown')} - {url}",
+                    url=url,
+                    steps=["Navigate to URL", "Page analysis"],
+                    expected_behavior="Page should render without issues",
+                    screenshot=bug_screenshot
+                )],
+                # バグ報告のアクティビティも同じトランザクションで記録
+                'ActivityLog': [activity_log_row('system', 'bug_reported', 'bug_ticket', bug_ticket_id, {
+                    'bug_type': bug.get('type', 'unknown'),
+                    'severity': bug.get('severity', 'medium'),
+                    'url': url
+                }, screenshot)]
+            }
+            if bug.get('error_message'):
+                rows['BugComment'] = [(
+                    new_id(), bug_ticket_id, 'system',
+                    f"AI検出結果: {bug.get('error_message', '')}\n要素: {bug.get('element', 'page')}\n信頼度: {bug.get('confidence', 0.8)}"
+                )]
+            writer.add(rows, on_commit=lambda fingerprint=fingerprint: self._mark_bug_saved(fingerprint))
+        
+        # ページ単位で1トランザクション
+        writer.flush()
+    
+    def _mark_bug_saved(self, fingerprint: str):
+        with self.lock:
+            self.saved_bug_fingerprints.add(fingerprint)
+    
+    def _analyze_with_gemini(self, url: str, title: str, screenshot: Union[bytes, PreparedScreenshot], outline: str,
+                             variant: str = '') -> Dict:
+        """Analyze page with Gemini multimodal API (results are cached per URL, DOM, screenshot and variant)
+
+        screenshot may be raw PNG bytes or a PreparedScreenshot shared with other analyzers of the same page.
+        outline is the page structure text from distill_page.
+        """
+        cache_key = AnalysisCache.make_key('issues', ISSUE_ANALYSIS_PROMPT_VERSION, url, outline, screenshot, variant)
+        cached = self.analysis_cache.get(cache_key)
+        if cached is not None:
+            logger.info(f"Gemini issue analysis cache hit for {url}")
+            return cached
+        
+        try:
+            # 画像をGemini用に準備（縮小・分割・JPEG/WebP化）
+            prepared = ensure_prepared(screenshot)
             
             # マルチモーダルプロンプト
             prompt = f"""
@@ -593,6 +657,7 @@ class EnhancedTestExecutor:
 
             URL: {url}
             タイトル: {title}
+            添付画像: {prepared.describe()}
 
             分析項目：
             1. レイアウトの崩れ（要素の重なり、配置の問題）
@@ -616,86 +681,50 @@ class EnhancedTestExecutor:
                 ]
             }}
             
-            HTMLコンテンツの一部:
-            {content[:2000]}
+            ページ構造（表示中のランドマーク・見出し・フォーム・操作可能な要素とセレクタ・本文）:
+            {outline}
             """
             
             # Gemini APIを呼び出し
-            response = self.model.generate_content([prompt, image])
+            contents = [prompt, *prepared.parts()]
+            data, response = self.gemini.generate_json(contents, ISSUE_ANALYSIS_SCHEMA, 'issue_analysis')
+            latency_ms = response.latency_ms
+            self.payload_stats.record(prepared, latency_ms)
+            logger.info(f"Gemini issue analysis request for {url}: {prepared.payload_bytes} bytes "
+                        f"in {len(prepared.tiles)} image(s), {latency_ms}ms")
             
-            # レスポンスをパース
-            try:
-                # JSONブロックを抽出
-                text = response.text
-                start = text.find('{')
-                end = text.rfind('}') + 1
-                if start >= 0 and end > start:
-                    json_str = text[start:end]
-                    result = json.loads(json_str)
-                else:
-                    result = {"issues": []}
-            except:
-                # パースできない場合は、テキストから問題を抽出
-                result = self._extract_issues_from_text(response.text)
-            
-            logger.info(f"Gemini analysis found {len(result.get('issues', []))} issues")
+            result = {"issues": normalize_issues((data or {}).get('issues'))}
+            if data is not None:
+                # 読めなかった応答はキャッシュしない
+                self.analysis_cache.set(cache_key, result)
+            logger.info(f"Gemini analysis found {len(result['issues'])} issues")
             return result
             
         except Exception as e:
             logger.error(f"Gemini analysis failed: {e}")
             return {"issues": []}
     
-    def _extract_issues_from_text(self, text: str) -> Dict:
-        """テキストから問題を抽出（フォールバック）"""
-        issues = []
-        lines = text.split('\n')
-        
-        current_issue = None
-        for line in lines:
-            line = line.strip()
-            if not line:
-                continue
-                
-            # 問題の開始を検出
-            if any(keyword in line.lower() for keyword in ['問題', 'エラー', 'issue', 'error', 'bug']):
-                if current_issue:
-                    issues.append(current_issue)
-                current_issue = {
-                    "type": "unknown",
-                    "description": line,
-                    "severity": "medium",
-                    "visual": True
-                }
-            elif current_issue and line:
-                # 既存の問題に詳細を追加
-                current_issue["description"] += " " + line
-        
-        if current_issue:
-            issues.append(current_issue)
-        
-        return {"issues": issues}
-    
-    def _test_interactive_elements(self, page, url: str) -> List[Dict]:
+    async def _test_interactive_elements(self, page, url: str) -> List[Dict]:
         """Test interactive elements with enhanced checks"""
         bugs = []
         
         # ボタンのテスト
-        buttons = page.query_selector_all('button, input[type="submit"], input[type="button"]')
+        buttons = await page.query_selector_all('button, input[type="submit"], input[type="button"]')
         for i, button in enumerate(buttons[:30]):  # 最大30個のボタンをテスト
             try:
                 # ボタンが表示されているか確認
-                if not button.is_visible():
+                if not await button.is_visible():
                     continue
                 
                 # クリック可能か確認
-                button_text = button.text_content() or button.get_attribute('value') or f"Button {i+1}"
+                button_text = await button.text_content() or await button.get_attribute('value') or f"Button {i+1}"
                 
                 # ボタンをクリック
-                button.click(timeout=5000)
-                time.sleep(0.5)
+                await button.click(timeout=5000)
+                await asyncio.sleep(0.5)
                 
                 # エラーが表示されたか確認
-                error_elements = page.query_selector_all('.error, .alert-danger, [role="alert"]')
+                error_elements = await page.query_selector_all('.error, .alert-danger, [role="alert"]')
                 if error_elements:
                     bug = {
                         "type": "interaction_error",
@@ -720,19 +749,19 @@ class EnhancedTestExecutor:
                     self._add_bug(bug)
         
         # フォームのテスト
-        forms = page.query_selector_all('form')
+        forms = await page.query_selector_all('form')
         for form in forms[:15]:  # 最大15個のフォームをテスト
             try:
                 # 必須フィールドの確認
-                required_inputs = form.query_selector_all('input[required], select[required], textarea[required]')
+                required_inputs = await form.query_selector_all('input[required], select[required], textarea[required]')
                 for inp in required_inputs:
-                    if not inp.get_attribute('aria-label') and not form.query_selector(f'label[for="{inp.get_attribute("id")}"]'):
+                    if not await inp.get_attribute('aria-label') and not await form.query_selector(f'label[for="{await inp.get_attribute("id")}"]'):
                         bug = {
                             "type": "accessibility",
                             "error_message": "必須フィールドにラベルがありません",
                             "url": url,
                             "severity": "medium",
-                            "element": inp.get_attribute('name') or 'unnamed input'
+                            "element": await inp.get_attribute('name') or 'unnamed input'
                         }
                         bugs.append(bug)
                         self._add_bug(bug)
@@ -742,15 +771,15 @@ class EnhancedTestExecutor:
         
         return bugs
     
-    def _check_accessibility_enhanced(self, page, url: str) -> List[Dict]:
+    async def _check_accessibility_enhanced(self, page, url: str) -> List[Dict]:
         """Enhanced accessibility checks"""
         bugs = []
         
         # 画像のaltテキストチェック
-        images = page.query_selector_all('img')
+        images = await page.query_selector_all('img')
         for img in images:
-            if not img.get_attribute('alt'):
-                src = img.get_attribute('src') or 'unknown'
+            if not await img.get_attribute('alt'):
+                src = await img.get_attribute('src') or 'unknown'
                 bug = {
                     "type": "accessibility",
                     "error_message": "画像にalt属性がありません",
@@ -762,28 +791,28 @@ class EnhancedTestExecutor:
                 self._add_bug(bug)
         
         # 見出しの階層チェック
-        headings = page.query_selector_all('h1, h2, h3, h4, h5, h6')
+        headings = await page.query_selector_all('h1, h2, h3, h4, h5, h6')
         prev_level = 0
         for heading in headings:
-            level = int(heading.tag_name[1])
+            level = int((await heading.evaluate('el => el.tagName'))[1])
             if prev_level > 0 and level > prev_level + 1:
                 bug = {
                     "type": "accessibility",
                     "error_message": f"見出しレベルがスキップされています (h{prev_level} → h{level})",
                     "url": url,
                     "severity": "low",
-                    "element": heading.text_content()[:50]
+                    "element": (await heading.text_content() or '')[:50]
                 }
                 bugs.append(bug)
                 self._add_bug(bug)
             prev_level = level
         
         # コントラスト比のチェック（簡易版）
-        elements_with_text = page.query_selector_all('p, span, div, a, button')
+        elements_with_text = await page.query_selector_all('p, span, div, a, button')
         for elem in elements_with_text[:50]:  # 最大50要素をチェック
             try:
-                color = elem.evaluate('el => window.getComputedStyle(el).color')
-                bg_color = elem.evaluate('el => window.getComputedStyle(el).backgroundColor')
+                color = await elem.evaluate('el => window.getComputedStyle(el).color')
+                bg_color = await elem.evaluate('el => window.getComputedStyle(el).backgroundColor')
                 
                 # 透明な背景の場合はスキップ
                 if bg_color == 'rgba(0, 0, 0, 0)':
@@ -791,12 +820,13 @@ class EnhancedTestExecutor:
                     
                 # ここで本来はコントラスト比を計算すべきだが、簡易的にチェック
                 if color == bg_color:
+                    text = await elem.text_content()
                     bug = {
                         "type": "accessibility",
                         "error_message": "テキストと背景が同じ色です",
                         "url": url,
                         "severity": "high",
-                        "element": elem.text_content()[:50] if elem.text_content() else 'unknown'
+                        "element": text[:50] if text else 'unknown'
                     }
                     bugs.append(bug)
                     self._add_bug(bug)
@@ -806,13 +836,13 @@ class EnhancedTestExecutor:
         
         return bugs
     
-    def _check_performance(self, page, url: str) -> List[Dict]:
+    async def _check_performance(self, page, url: str) -> List[Dict]:
         """Check performance issues"""
         bugs = []
         
         try:
             # ページロード時間を測定
-            metrics = page.evaluate('''() => {
+            metrics = await page.evaluate('''() => {
                 const perf = window.performance;
                 return {
                     loadTime: perf.timing.loadEventEnd - perf.timing.navigationStart,
@@ -848,27 +878,28 @@ class EnhancedTestExecutor:
         
         return bugs
     
-    def _extract_links(self, page, base_url: str) -> List[str]:
-        """Extract links from the same domain"""
+    async def _extract_links(self, page, base_url: str) -> List[str]:
+        """Extract canonicalized links from the same domain"""
         links = []
-        base_domain = urlparse(base_url).netloc
+        canonicalizer = self.seen_index.canonicalizer
+        base_domain = urlparse(canonicalizer.canonicalize(base_url)).netloc
         
         try:
-            anchors = page.query_selector_all('a[href]')
-            for anchor in anchors[:100]:  # 最大100リンク
-                href = anchor.get_attribute('href')
-                if href:
-                    # 相対URLを絶対URLに変換
-                    absolute_url = urljoin(base_url, href)
-                    parsed = urlparse(absolute_url)
-                    
-                    # 同一ドメインのHTTP/HTTPSリンクのみ
-                    if parsed.netloc == base_domain and parsed.scheme in ['http', 'https']:
-                        # フラグメント（#）を除去
-                        clean_url = absolute_url.split('#')[0]
-                        if clean_url not in self.visited_urls and clean_url not in links:
-                            links.append(clean_url)
-                            
+            # a.hrefはブラウザが<base>も考慮して解決した絶対URL（1回のevaluateで全件取得）
+            hrefs = await page.evaluate(
+                "() => Array.from(document.querySelectorAll('a[href]'), a => a.href)"
+            )
+            for href in hrefs:
+                if not href:
+                    continue
+                clean_url = canonicalizer.canonicalize(href)
+                parsed = urlparse(clean_url)
+                
+                # 同一ドメインのHTTP/HTTPSリンクのみ
+                if parsed.netloc == base_domain and parsed.scheme in ['http', 'https']:
+                    if clean_url not in self.seen_index and clean_url not in links:
+                        links.append(clean_url)
+                        
         except Exception as e:
             logger.warning(f"Error extracting links: {e}")
         
@@ -879,50 +910,13 @@ class EnhancedTestExecutor:
         with self.lock:
             self.bugs_found.append(bug)
     
-    def _log_to_session(self, session_id: str, level: str, message: str, metadata: Dict = None, screenshot: bytes = None):
-        """Log to TestSessionLog table with optional screenshot"""
-        try:
-            # Prismaの代わりに直接SQLを使用
-            import psycopg2
-            db_url = os.environ.get('DATABASE_ROOT_URL', '')
-            if '127.0.0.1' in db_url or 'localhost' in db_url:
-                db_url = db_url.replace('127.0.0.1', 'host.docker.internal').replace('localhost', 'host.docker.internal')
-            
-            conn = psycopg2.connect(db_url)
-            cursor = conn.cursor()
-            
-            # スクリーンショットをbase64でエンコード
-            screenshot_b64 = None
-            if screenshot:
-                screenshot_b64 = base64.b64encode(screenshot).decode('utf-8')
-            
-            cursor.execute("""
-                INSERT INTO "TestSessionLog" (id, test_session_id, log_level, message, metadata, screenshot, created_at)
-                VALUES (gen_random_uuid(), %s, %s, %s, %s, %s, NOW())
-            """, (session_id, level, message, json.dumps(metadata or {}), screenshot_b64))
-            conn.commit()
-            conn.close()
-        except Exception as e:
-            logger.error(f"Failed to log to session: {e}")
-    
-    def _wait_for_any_complete(self, futures: List, timeout: float = None) -> Tuple[Set, List]:
-        """Wait for any future to complete and return completed and pending futures"""
-        done = set()
-        pending = list(futures)
-        
-        if not futures:
-            return done, pending
-        
-        # as_completedを使って最初に完了したものを取得
-        try:
-            for future in as_completed(futures, timeout=timeout):
-                done.add(future)
-                pending.remove(future)
-                break  # 最初の1つだけ処理
-        except TimeoutError:
-            pass
-        
-        return done, pending
+    def _log_to_session(self, session_id: str, level: str, message: str, metadata: Dict = None,
+                        screenshot: Union[bytes, str, None] = None):
+        """Queue a TestSessionLog record with optional screenshot (bytes or a screenshot store reference)
+
+        書き込みはSessionLogSinkのスレッドがまとめて行うため、クロール中でもブロックしない。
+        """
+        self.log_sink.log(session_id, level, message, metadata, screenshot)
     
     def _is_same_domain(self, base_url: str, target_url: str) -> bool:
         """Check if two URLs are from the same domain"""
@@ -0,0 +1,355 @@
+import asyncio
+import atexit
+import itertools
+import json
+import logging
+import os
+import queue
+import resource
+import signal
+import tempfile
+import threading
+import time
+import traceback
+from typing import Dict, Optional, Tuple
+
+import billiard
+
+logger = logging.getLogger(__name__)
+
+PRELOAD_MODULE = 'app.workers.test_executor_preload'
+
+
+class TestExecutionError(Exception):
+    """ワーカープロセス内でテストの実行が失敗した"""
+
+
+def _pack_result(result: Dict, spool_dir: str, inline_bytes: int) -> Tuple[str, object]:
+    """結果をパイプで送れる形にする（大きい結果はファイルに書き、パスだけを送る）"""
+    data = json.dumps(result).encode('utf-8')
+    if len(data) <= inline_bytes:
+        return 'inline', data
+    fd, path = tempfile.mkstemp(prefix='test-result-', suffix='.json', dir=spool_dir)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    return 'file', path
+
+
+def _unpack_result(packed: Tuple[str, object]) -> Tuple[Dict, int]:
+    """_pack_resultの逆（ファイルは読んだら消す）。結果とバイト数を返す"""
+    kind, value = packed
+    if kind == 'file':
+        try:
+            with open(value, 'rb') as f:
+                data = f.read()
+        finally:
+            try:
+                os.unlink(value)
+            except OSError:
+                pass
+    else:
+        data = value
+    return json.loads(data), len(data)
+
+
+def _max_rss_mb() -> float:
+    # Linuxのru_maxrssはKB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _worker_main(conn, spool_dir: str, inline_bytes: int):
+    """ワーカープロセスの本体
+
+    重いモジュールとPrismaの接続は起動時に一度だけ用意し、以降はパイプで受け取ったテストを順に実行する。
+    テストごとに新しいEnhancedTestExecutorを作る（クロールの状態はインスタンスに持つため）。
+    """
+    loop = None
+    prisma = None
+    try:
+        import importlib
+        preload = importlib.import_module(PRELOAD_MODULE)
+        loop = asyncio.new_event_loop()
+        prisma = preload.Prisma()
+        loop.run_until_complete(prisma.connect())
+        conn.send(('ready', os.getpid()))
+    except BaseException:
+        conn.send(('failed', traceback.format_exc()))
+        return
+
+    try:
+        while True:
+            try:
+                message = conn.recv()
+            except EOFError:
+                break
+            if message is None:
+                break
+            task_id, session_id, mode, url, scenario_id = message
+            try:
+                executor = preload.EnhancedTestExecutor(prisma)
+                result = executor.execute(session_id, mode, url, scenario_id)
+                conn.send(('ok', task_id, _pack_result(result, spool_dir, inline_bytes), _max_rss_mb()))
+            except Exception as e:
+                conn.send(('error', task_id, f"{type(e).__name__}: {e}", traceback.format_exc(), _max_rss_mb()))
+    finally:
+        try:
+            loop.run_until_complete(prisma.disconnect())
+            loop.close()
+        except Exception:
+            pass
+
+
+class _ExecutorWorker:
+    """パイプでつながったワーカープロセス1つと、実行したテスト数"""
+
+    def __init__(self, ctx, spool_dir: str, inline_bytes: int):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_main, args=(child_conn, spool_dir, inline_bytes),
+                                   name='test-executor-worker', daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.ready = False
+        self.tasks = 0
+
+    def wait_ready(self, timeout: float):
+        if self.ready:
+            return
+        if not self.conn.poll(timeout):
+            raise TimeoutError(f"Test executor worker did not start within {timeout}s")
+        message = self.conn.recv()
+        if message[0] != 'ready':
+            raise TestExecutionError(f"Test executor worker failed to start: {message[1]}")
+        self.ready = True
+
+    def stop(self, timeout: float = 5, graceful: bool = True):
+        """ワーカーを止める（gracefulでなければ、応答しないワーカーとして終了を待たずにSIGKILLを送る）"""
+        try:
+            if graceful and self.process.is_alive():
+                self.conn.send(None)
+                self.process.join(timeout)
+        except (OSError, EOFError):
+            pass
+        if self.process.is_alive():
+            # billiardのProcessにはkill()がないので、PIDにSIGKILLを送る
+            try:
+                os.kill(self.process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            self.process.join(timeout)
+        self.conn.close()
+
+
+class TestExecutorPool:
+    """EnhancedTestExecutorを実行する起動済みのワーカープロセスのプール
+
+    テストごとにPythonを起動し直すと、インタプリタの起動、Django・Prisma・Gemini・Playwrightのimport、
+    DB接続をテストのたびに払うことになるため、ワーカーを起動したままにしてパイプでテストを渡す。
+    ワーカーはforkserver（既定）から作るので、重いモジュールはforkserverが一度だけ読み込む。
+    Celeryのprefork子プロセスはdaemonで、multiprocessingではそこから子プロセスを作れないため、
+    Celeryと同じbilliardでプロセスを作る。
+    結果はTEST_EXECUTOR_POOL_INLINE_BYTESを超えるとファイル経由で受け渡す。
+    ワーカーはNテスト実行後、最大RSSが上限を超えた時、タイムアウト・クラッシュ時に作り直す。
+    """
+
+    def __init__(self, size: Optional[int] = None, max_tasks_per_worker: Optional[int] = None,
+                 max_rss_mb: Optional[float] = None, timeout: Optional[float] = None):
+        self.size = size or int(os.getenv('TEST_EXECUTOR_POOL_SIZE', '1'))
+        # 1にするとテストごとにワーカーを作り直す（比較計測用）
+        self.max_tasks_per_worker = max_tasks_per_worker or int(os.getenv('TEST_EXECUTOR_POOL_MAX_TASKS', '20'))
+        self.max_rss_mb = max_rss_mb if max_rss_mb is not None else float(os.getenv('TEST_EXECUTOR_POOL_MAX_RSS_MB', '0'))
+        self.timeout = timeout or float(os.getenv('TEST_EXECUTOR_POOL_TIMEOUT', '300'))
+        self.start_timeout = float(os.getenv('TEST_EXECUTOR_POOL_START_TIMEOUT', '120'))
+        # 空いているワーカーを待つ上限（既定は他のテストのタイムアウトとワーカーの起動を待つ分）
+        self.acquire_timeout = float(os.getenv('TEST_EXECUTOR_POOL_ACQUIRE_TIMEOUT')
+                                     or self.timeout + self.start_timeout)
+        self.inline_bytes = int(os.getenv('TEST_EXECUTOR_POOL_INLINE_BYTES', '65536'))
+        self.spool_dir = os.getenv('TEST_EXECUTOR_POOL_SPOOL_DIR') or tempfile.gettempdir()
+        start_method = os.getenv('TEST_EXECUTOR_POOL_START_METHOD', 'forkserver')
+        self._ctx = billiard.get_context(start_method)
+        if start_method == 'forkserver':
+            self._ctx.set_forkserver_preload([PRELOAD_MODULE])
+        self._idle: 'queue.Queue[_ExecutorWorker]' = queue.Queue()
+        self._workers = set()
+        self._lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._spawning = 0
+        self._task_ids = itertools.count(1)
+        self._started = False
+        self._stats = {
+            'tasks': 0,
+            'failures': 0,
+            'spawns': 0,
+            'recycles': 0,
+            'crashes': 0,
+            'timeouts': 0,
+            'spooled_results': 0,
+            'result_bytes': 0,
+            'task_seconds': 0.0,
+            'wait_seconds': 0.0
+        }
+
+    def start(self):
+        """ワーカープロセスを起動する（importとPrismaの接続はワーカー側で並行して進む）
+
+        1つでも起動できなければ起動済みのワーカーを止めて例外を送出し、未起動のままにする。
+        """
+        with self._start_lock:
+            if self._started:
+                return
+            spawned = []
+            try:
+                for _ in range(self.size):
+                    spawned.append(self._spawn())
+            except Exception:
+                for worker in spawned:
+                    self._retire(worker)
+                raise
+            for worker in spawned:
+                self._idle.put(worker)
+            self._started = True
+
+    def run(self, session_id: str, mode: str, url: str, scenario_id: Optional[str] = None,
+            timeout: Optional[float] = None) -> Dict:
+        """空いているワーカーでテストを実行し、結果を返す（ワーカーが空くまで待つ）"""
+        self.start()
+        timeout = timeout or self.timeout
+        wait_started = time.monotonic()
+        worker = self._acquire()
+        started = time.monotonic()
+        replace = False
+        hung = False
+        try:
+            worker.wait_ready(self.start_timeout)
+            task_id = next(self._task_ids)
+            worker.conn.send((task_id, session_id, mode, url, scenario_id))
+            if not worker.conn.poll(timeout):
+                replace = True
+                hung = True
+                self._count('timeouts')
+                raise TimeoutError(f"Test execution timed out after {timeout}s")
+            message = worker.conn.recv()
+            worker.tasks += 1
+            rss_mb = message[-1]
+            if worker.tasks >= self.max_tasks_per_worker or (self.max_rss_mb and rss_mb >= self.max_rss_mb):
+                replace = True
+                self._count('recycles')
+            if message[0] == 'error':
+                self._count('failures')
+                logger.error(f"Test execution failed in worker {worker.process.pid}: {message[3]}")
+                raise TestExecutionError(message[2])
+            result, size = _unpack_result(message[2])
+            with self._lock:
+                self._stats['tasks'] += 1
+                self._stats['result_bytes'] += size
+                self._stats['spooled_results'] += message[2][0] == 'file'
+            return result
+        except (TimeoutError, TestExecutionError):
+            if not worker.ready:
+                replace = True
+            raise
+        except (EOFError, OSError) as e:
+            # ワーカーが落ちた（OOMなど）。作り直して、このテストは失敗にする
+            replace = True
+            self._count('crashes')
+            worker.process.join(1)
+            raise TestExecutionError(
+                f"Test executor worker {worker.process.pid} exited (exit code {worker.process.exitcode})"
+            ) from e
+        finally:
+            with self._lock:
+                self._stats['task_seconds'] += time.monotonic() - started
+                self._stats['wait_seconds'] += started - wait_started
+            if replace:
+                # タイムアウトしたワーカーはテストを実行中で停止の指示を読まないので、待たずに止める
+                self._retire(worker, graceful=not hung)
+                try:
+                    self._idle.put(self._spawn())
+                except Exception as e:
+                    # 次の_acquireで補充する
+                    logger.error(f"Failed to respawn test executor worker: {e}")
+            else:
+                self._idle.put(worker)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['workers'] = len(self._workers)
+        stats['task_seconds'] = round(stats['task_seconds'], 2)
+        stats['wait_seconds'] = round(stats['wait_seconds'], 2)
+        return stats
+
+    def shutdown(self):
+        """ワーカーを停止する"""
+        with self._lock:
+            workers = list(self._workers)
+            self._workers.clear()
+        for worker in workers:
+            worker.stop()
+
+    def _acquire(self) -> _ExecutorWorker:
+        """空いているワーカーを取り出す（足りなければ補充し、acquire_timeout秒で諦める）"""
+        deadline = time.monotonic() + self.acquire_timeout
+        while True:
+            try:
+                return self._idle.get(timeout=min(1.0, max(0.0, deadline - time.monotonic())))
+            except queue.Empty:
+                pass
+            # 作り直しに失敗して減ったワーカーを補充する
+            with self._lock:
+                refill = len(self._workers) + self._spawning < self.size
+                if refill:
+                    self._spawning += 1
+            if refill:
+                try:
+                    return self._spawn()
+                except Exception as e:
+                    raise TestExecutionError(f"Failed to start a test executor worker: {e}") from e
+                finally:
+                    with self._lock:
+                        self._spawning -= 1
+            if time.monotonic() >= deadline:
+                raise TestExecutionError(
+                    f"No test executor worker became available within {self.acquire_timeout}s"
+                )
+
+    def _spawn(self) -> _ExecutorWorker:
+        worker = _ExecutorWorker(self._ctx, self.spool_dir, self.inline_bytes)
+        with self._lock:
+            self._workers.add(worker)
+            self._stats['spawns'] += 1
+        return worker
+
+    def _retire(self, worker: _ExecutorWorker, graceful: bool = True):
+        with self._lock:
+            self._workers.discard(worker)
+        worker.stop(graceful=graceful)
+
+    def _count(self, key: str):
+        with self._lock:
+            self._stats[key] += 1
+
+
+_pool: Optional[TestExecutorPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_test_executor_pool() -> TestExecutorPool:
+    """プロセス共有のテスト実行ワーカープールを取得（初回呼び出し時に起動）"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            pool = TestExecutorPool()
+            # 起動に失敗したプールは共有しない（次の呼び出しで作り直す）
+            pool.start()
+            atexit.register(pool.shutdown)
+            _pool = pool
+        return _pool
+
+
+def shutdown_test_executor_pool():
+    """プロセス共有のテスト実行ワーカープールを停止"""
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool:
+        pool.shutdown()
@@ -0,0 +1,22 @@
+"""
+テスト実行ワーカープロセスで事前に読み込むモジュール
+
+TestExecutorPoolのforkserverがこのモジュールを一度だけimportし、ワーカーはそこからforkされるので、
+Django・Prisma・Gemini・Playwright・EnhancedTestExecutorのimportはワーカーを作り直しても繰り返さない。
+"""
+import os
+import sys
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+if PROJECT_DIR not in sys.path:
+    sys.path.insert(0, PROJECT_DIR)
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'project.settings')
+
+import django  # noqa: E402
+django.setup()
+
+import google.generativeai  # noqa: E402,F401
+from playwright.sync_api import sync_playwright  # noqa: E402,F401
+from prisma import Prisma  # noqa: E402,F401
+
+from app.workers.test_executor_enhanced import EnhancedTestExecutor  # noqa: E402,F401
@@ -0,0 +1,158 @@
+import logging
+import os
+import re
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+logger = logging.getLogger(__name__)
+
+# 広告・解析用のトラッキングパラメータ（utm_* は接頭辞で判定）
+TRACKING_PARAM_PREFIXES = ('utm_',)
+TRACKING_PARAMS = {
+    'gclid', 'dclid', 'gbraid', 'wbraid', 'fbclid', 'msclkid', 'yclid', 'twclid',
+    'mc_cid', 'mc_eid', '_ga', '_gl', '_hsenc', '_hsmi', 'igshid', 'ref_src'
+}
+# セッションIDなど、ページの内容を変えないパラメータ（CRAWL_IGNORED_PARAMSで上書き可能）
+DEFAULT_IGNORED_PARAMS = 'jsessionid,phpsessid,sid,sessionid,session_id,aspsessionid,cfid,cftoken'
+
+# /path;jsessionid=XXX のようなパスパラメータ形式のセッションID
+_SESSION_PATH_PARAM = re.compile(r';(jsessionid|phpsessid|sid|sessionid)=[^/?#]*', re.IGNORECASE)
+_DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+class UrlCanonicalizer:
+    """クロール対象URLの正規化
+
+    同じページを指すURLを1つの文字列にまとめる。状態を持たないので複数スレッドから使える。
+    """
+
+    RULES = (
+        'fragment', 'case', 'default_port', 'session_path_param',
+        'tracking_params', 'ignored_params', 'query_order', 'trailing_slash'
+    )
+
+    def __init__(self, ignored_params: Optional[Iterable[str]] = None,
+                 lowercase_path: Optional[bool] = None,
+                 strip_trailing_slash: Optional[bool] = None):
+        if ignored_params is None:
+            ignored_params = os.getenv('CRAWL_IGNORED_PARAMS', DEFAULT_IGNORED_PARAMS).split(',')
+        self.ignored_params = {p.strip().lower() for p in ignored_params if p.strip()}
+        if lowercase_path is None:
+            lowercase_path = os.getenv('CRAWL_LOWERCASE_PATH', 'false').lower() == 'true'
+        self.lowercase_path = lowercase_path
+        if strip_trailing_slash is None:
+            strip_trailing_slash = os.getenv('CRAWL_STRIP_TRAILING_SLASH', 'true').lower() == 'true'
+        self.strip_trailing_slash = strip_trailing_slash
+
+    def canonicalize(self, url: str) -> str:
+        """URLを正規化して返す（http/https以外はそのまま返す）"""
+        return self.canonicalize_with_rules(url)[0]
+
+    def canonicalize_with_rules(self, url: str) -> Tuple[str, List[str]]:
+        """正規化したURLと、書き換えに使ったルールの一覧を返す"""
+        url = (url or '').strip()
+        parsed = urlsplit(url)
+        scheme = parsed.scheme.lower()
+        if scheme not in _DEFAULT_PORTS or not parsed.netloc:
+            return url, []
+
+        applied = []
+
+        if parsed.fragment:
+            applied.append('fragment')
+
+        netloc = parsed.netloc
+        path = parsed.path or '/'
+        if scheme != parsed.scheme or netloc != netloc.lower() or (self.lowercase_path and path != path.lower()):
+            applied.append('case')
+        netloc = netloc.lower()
+        if self.lowercase_path:
+            path = path.lower()
+
+        host, _, port = netloc.rpartition(':') if ':' in netloc.split('@')[-1] else (netloc, '', '')
+        if port and port.isdigit() and int(port) == _DEFAULT_PORTS[scheme]:
+            netloc = host
+            applied.append('default_port')
+
+        cleaned_path = _SESSION_PATH_PARAM.sub('', path)
+        if cleaned_path != path:
+            applied.append('session_path_param')
+            path = cleaned_path
+
+        params = parse_qsl(parsed.query, keep_blank_values=True)
+        kept = []
+        for key, value in params:
+            lowered = key.lower()
+            if lowered in TRACKING_PARAMS or lowered.startswith(TRACKING_PARAM_PREFIXES):
+                if 'tracking_params' not in applied:
+                    applied.append('tracking_params')
+                continue
+            if lowered in self.ignored_params:
+                if 'ignored_params' not in applied:
+                    applied.append('ignored_params')
+                continue
+            kept.append((key, value))
+        sorted_params = sorted(kept)
+        if sorted_params != kept:
+            applied.append('query_order')
+
+        if self.strip_trailing_slash and len(path) > 1 and path.endswith('/'):
+            path = path.rstrip('/') or '/'
+            applied.append('trailing_slash')
+
+        canonical = urlunsplit((scheme, netloc, path, urlencode(sorted_params), ''))
+        return canonical, applied
+
+
+class SeenUrlIndex:
+    """正規化済みURLの既出インデックス
+
+    フロンティアと、リンク抽出時の事前フィルタで共有する。
+    登録時にルールごとの書き換え件数を数え、既出と判定されたURLのうち
+    正規化で書き換わっていたものは、そのルールが重複をまとめた件数として数える。
+    """
+
+    def __init__(self, canonicalizer: Optional[UrlCanonicalizer] = None):
+        self.canonicalizer = canonicalizer or UrlCanonicalizer()
+        self._seen = set()
+        self._lock = threading.Lock()
+        self._rewritten = {rule: 0 for rule in UrlCanonicalizer.RULES}
+        self._collapsed = {rule: 0 for rule in UrlCanonicalizer.RULES}
+        self._exact_duplicates = 0
+        self._added = 0
+
+    def __contains__(self, url: str) -> bool:
+        return self.canonicalizer.canonicalize(url) in self._seen
+
+    def __len__(self) -> int:
+        return len(self._seen)
+
+    def add(self, url: str) -> Optional[str]:
+        """URLを登録し、新規なら正規化済みURLを、既出ならNoneを返す"""
+        canonical, applied = self.canonicalizer.canonicalize_with_rules(url)
+        with self._lock:
+            self._added += 1
+            for rule in applied:
+                self._rewritten[rule] += 1
+            if canonical not in self._seen:
+                self._seen.add(canonical)
+                return canonical
+            if applied:
+                for rule in applied:
+                    self._collapsed[rule] += 1
+            else:
+                self._exact_duplicates += 1
+        return None
+
+    def stats(self) -> Dict:
+        """既出URL数と、ルールごとにまとめた重複件数"""
+        with self._lock:
+            stats = {
+                'urls_added': self._added,
+                'unique_urls': len(self._seen),
+                'exact_duplicates': self._exact_duplicates
+            }
+            stats.update({f'rewritten_by_{rule}': count for rule, count in self._rewritten.items()})
+            stats.update({f'collapsed_by_{rule}': count for rule, count in self._collapsed.items()})
+        return stats
@@ -1,6 +1,8 @@
+import logging
 import os
 from celery import Celery
 from celery.schedules import crontab
+from celery.signals import worker_process_init, worker_process_shutdown
 
 # Set the default Django settings module for the 'celery' program.
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'project.settings')
@@ -18,13 +20,63 @@ app.autodiscover_tasks()
 app.conf.beat_schedule = {
     'poll-job-queue': {
         'task': 'app.job_queue_sync.process_job_queue',
-        'schedule': 10.0,  # 10秒ごとに実行
+        # 通常はrun_job_dispatcherがNOTIFYを受けて即時に起動するので、これは取りこぼしを拾う低頻度のポーリング
+        'schedule': float(os.getenv('JOB_QUEUE_POLL_SECONDS', '120')),
         'options': {
-            'expires': 5,  # タスクの有効期限（秒）
+            'expires': 30,  # タスクの有効期限（秒）
+        }
+    },
+    'reap-stuck-jobs': {
+        'task': 'app.job_queue_sync.reap_stuck_jobs',
+        # ハートビートが途絶えたジョブの回収
+        'schedule': float(os.getenv('JOB_REAPER_INTERVAL_SECONDS', '60')),
+        'options': {
+            'expires': 30,
         }
     },
 }
 
+
+@worker_process_init.connect
+def start_browser_pool(**kwargs):
+    """連続テストを処理するワーカーでは、プロセス起動時にブラウザプールを立ち上げておく
+
+    子プロセスごとにBROWSER_POOL_SIZE個のブラウザが起動するので、既定では立ち上げず（初回利用時に起動）、
+    continuous_testキューのワーカーでだけBROWSER_POOL_WARMUP=trueにする。
+    """
+    if os.getenv('BROWSER_POOL_WARMUP', 'false').lower() != 'true':
+        return
+    from app.workers.browser_pool import get_browser_pool
+    get_browser_pool()
+
+
+@worker_process_init.connect
+def start_test_executor_pool(**kwargs):
+    """test_executionを処理するワーカーでは、テスト実行ワーカーのimportと接続を先に済ませておく"""
+    if os.getenv('TEST_EXECUTOR_POOL_WARMUP', 'false').lower() != 'true':
+        return
+    from app.workers.test_executor_pool import get_test_executor_pool
+    try:
+        get_test_executor_pool()
+    except Exception as e:
+        # 起動できなくてもワーカーは止めない（最初のテスト実行時に再度起動を試みる）
+        logging.getLogger(__name__).error(f"Failed to warm up test executor pool: {e}")
+
+
+@worker_process_shutdown.connect
+def stop_browser_pool(**kwargs):
+    """ワーカープロセス終了時にブラウザを閉じる"""
+    from app.workers.browser_pool import shutdown_browser_pool
+    shutdown_browser_pool()
+
+
+@worker_process_shutdown.connect
+def stop_test_executor_pool(**kwargs):
+    """ワーカープロセス終了時にテスト実行ワーカーを停止する"""
+    from app.workers.test_executor_pool import shutdown_test_executor_pool
+    shutdown_test_executor_pool()
+
+
 @app.task(bind=True)
 def debug_task(self):
     print(f'Request: {self.request!r}')
\ No newline at end of file
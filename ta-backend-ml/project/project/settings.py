@@ -210,6 +210,10 @@ CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = 'UTC'
 CELERY_ENABLE_UTC = True
 CELERY_BROKER_CONNECTION_RETRY_ON_STARTUP = True
+# ブラウザプールを使う連続テストは、ブラウザを立ち上げておく専用のワーカーで処理する
+CELERY_TASK_ROUTES = {
+    'app.workers.continuous_test_celery_task.execute_continuous_test': {'queue': 'continuous_test'},
+}
 
 # Redis Configuration
 REDIS_HOST = os.getenv('REDIS_HOST', 'localhost')
@@ -2,19 +2,13 @@
 """
 シンプルなJobQueue処理スクリプト
 asyncioの問題を回避してテストを実行
+
+Celeryを介さずに、保留中のジョブをこのプロセスで処理する（ジョブの取得・実行はapp.job_queue_syncのrun_jobs）。
+引数にジョブタイプを指定するとそのタイプだけを処理する（省略時はtest_execution）。
 """
 import os
 import sys
-import json
-import psycopg2
-import time
-import traceback
-import subprocess
-import base64
 from datetime import datetime
-from psycopg2.extras import RealDictCursor
-from concurrent.futures import ThreadPoolExecutor, as_completed
-import threading
 
 # Django設定
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
@@ -23,359 +17,17 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'project.settings')
 import django
 django.setup()
 
-
-def log_to_session(cursor, session_id, log_level, message, metadata=None, screenshot=None):
-    """TestSessionLogテーブルにログを記録（スクリーンショット付き）"""
-    try:
-        # スクリーンショットをbase64でエンコード
-        screenshot_b64 = None
-        if screenshot:
-            if isinstance(screenshot, bytes):
-                import base64
-                screenshot_b64 = base64.b64encode(screenshot).decode('utf-8')
-            else:
-                screenshot_b64 = screenshot  # 既に文字列の場合
-        
-        cursor.execute("""
-            INSERT INTO "TestSessionLog" (id, test_session_id, log_level, message, metadata, screenshot, created_at)
-            VALUES (gen_random_uuid(), %s, %s, %s, %s, %s, NOW())
-        """, (session_id, log_level, message, json.dumps(metadata or {}), screenshot_b64))
-    except Exception as e:
-        print(f"[{datetime.now().isoformat()}] Failed to log to session: {e}")
-
-
-def execute_test_with_executor(session_id, mode, url, cursor, conn):
-    """実際のTestExecutorを使用してテストを実行"""
-    print(f"[{datetime.now().isoformat()}] EnhancedTestExecutorを使用してテストを実行中...")
-    
-    # 別プロセスでTestExecutorを実行（asyncioの問題を回避）
-    code = f'''
-import sys
-sys.path.insert(0, "/app/project")
-import json
-import asyncio
-from app.workers.test_executor_enhanced import EnhancedTestExecutor
-from prisma import Prisma
-
-async def main():
-    prisma = Prisma()
-    await prisma.connect()
-    
-    try:
-        executor = EnhancedTestExecutor(prisma)
-        result = executor.execute("{session_id}", "{mode}", "{url}")
-        print(json.dumps(result))
-    finally:
-        await prisma.disconnect()
-
-if __name__ == "__main__":
-    asyncio.run(main())
-'''
-    
-    try:
-        # サブプロセスで実行
-        log_to_session(cursor, session_id, 'info', 'Playwrightを起動してページをクローリング中...', {'url': url})
-        conn.commit()
-        
-        # 環境変数をチェック
-        env_vars = {**os.environ, 'PYTHONPATH': '/app/project'}
-        
-        # GEMINI_API_KEYが設定されているか確認
-        if 'GEMINI_API_KEY' not in env_vars:
-            log_to_session(cursor, session_id, 'warning', 'GEMINI_API_KEYが設定されていません', {})
-            conn.commit()
-        
-        proc = subprocess.run(
-            [sys.executable, '-c', code],
-            capture_output=True,
-            text=True,
-            cwd="/app/project",
-            env=env_vars,
-            timeout=300  # 5分のタイムアウト
-        )
-        
-        if proc.returncode != 0:
-            error_msg = f"Test execution failed: {proc.stderr}"
-            print(f"[{datetime.now().isoformat()}] {error_msg}")
-            print(f"[{datetime.now().isoformat()}] STDOUT: {proc.stdout}")
-            log_to_session(cursor, session_id, 'error', 'テスト実行中にエラーが発生しました', {'error': proc.stderr, 'stdout': proc.stdout})
-            conn.commit()
-            
-            # stdoutに部分的な結果があるか確認
-            try:
-                if proc.stdout:
-                    partial_result = json.loads(proc.stdout)
-                    if partial_result.get("pages_scanned", 0) > 0:
-                        return partial_result
-            except:
-                pass
-            
-            # フォールバックとしてダミー結果を返す
-            return {
-                "pages_scanned": 0,
-                "bugs_found": 0,
-                "test_coverage": 0.0,
-                "bugs": [],
-                "error": error_msg
-            }
-        
-        # 結果をパース
-        result = json.loads(proc.stdout)
-        
-        # 詳細なログを記録
-        log_to_session(cursor, session_id, 'info', f'{result["pages_scanned"]}ページをスキャンしました', 
-                      {'pages_scanned': result['pages_scanned']})
-        
-        if result['bugs_found'] > 0:
-            log_to_session(cursor, session_id, 'warning', f'{result["bugs_found"]}件のバグを発見しました', 
-                          {'bugs': result['bugs']})
-        else:
-            log_to_session(cursor, session_id, 'info', 'バグは見つかりませんでした', None)
-        
-        log_to_session(cursor, session_id, 'info', f'テストカバレッジ: {result["test_coverage"]*100:.1f}%', 
-                      {'test_coverage': result['test_coverage']})
-        conn.commit()
-        
-        return result
-        
-    except Exception as e:
-        error_msg = f"Failed to execute test: {str(e)}"
-        print(f"[{datetime.now().isoformat()}] {error_msg}")
-        traceback.print_exc()
-        
-        # フォールバックとしてシミュレーション結果を返す
-        return simulate_test_execution(session_id, url, cursor, conn)
-
-
-def simulate_test_execution(session_id, url, cursor, conn):
-    """テスト実行のシミュレーション（フォールバック）"""
-    print(f"[{datetime.now().isoformat()}] テスト実行をシミュレート中...")
-    
-    # シミュレーションの詳細ログ
-    steps = [
-        ('ページをクローリング中...', 2),
-        ('インタラクティブ要素を検出中...', 1),
-        ('Gemini APIでページを分析中...', 3),
-        ('アクセシビリティチェックを実行中...', 1),
-        ('テスト結果を集計中...', 1)
-    ]
-    
-    for step_msg, duration in steps:
-        log_to_session(cursor, session_id, 'info', step_msg, {'url': url})
-        conn.commit()
-        time.sleep(duration)
-    
-    # ダミー結果
-    result = {
-        "pages_scanned": 1,
-        "bugs_found": 2,
-        "test_coverage": 0.75,
-        "bugs": [
-            {
-                "type": "accessibility",
-                "error_message": "画像にalt属性がありません",
-                "element": "/images/logo.png",
-                "severity": "medium"
-            },
-            {
-                "type": "broken_link",
-                "error_message": "リンクが404を返します",
-                "element": "お問い合わせ",
-                "severity": "high"
-            }
-        ],
-        "duration": 8
-    }
-    
-    log_to_session(cursor, session_id, 'warning', f'{result["bugs_found"]}件のバグを発見しました', 
-                  {'bugs': result['bugs']})
-    log_to_session(cursor, session_id, 'info', 'テスト実行が完了しました', 
-                  {'test_coverage': result['test_coverage'], 'bugs_found': result['bugs_found']})
-    conn.commit()
-    
-    return result
+from app.job_queue_sync import run_jobs
 
 
 def main():
     """メイン処理"""
-    print(f"[{datetime.now().isoformat()}] ジョブ処理スクリプトを開始")
-    db_url = os.environ.get('DATABASE_ROOT_URL', '')
-    
-    # Docker内からホストのPostgreSQLに接続する場合の処理
-    if '127.0.0.1' in db_url or 'localhost' in db_url:
-        db_url = db_url.replace('127.0.0.1', 'host.docker.internal').replace('localhost', 'host.docker.internal')
-    
-    conn = psycopg2.connect(db_url)
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    
-    # pendingなジョブを1つ取得
-    print(f"[{datetime.now().isoformat()}] pendingなジョブを検索中...")
-    cursor.execute("""
-        SELECT * FROM "JobQueue" 
-        WHERE status = 'pending' AND type = 'test_execution'
-        ORDER BY priority ASC, created_at ASC
-        LIMIT 1
-    """)
-    job = cursor.fetchone()
-    
-    if not job:
-        print(f"[{datetime.now().isoformat()}] pendingなジョブが見つかりません")
-        return
-    
-    print(f"[{datetime.now().isoformat()}] ジョブを処理開始: {job['id']}")
-    print(f"[{datetime.now().isoformat()}] ジョブタイプ: {job['type']}, 優先度: {job['priority']}")
-    
-    # ジョブをprocessing状態に更新
-    print(f"[{datetime.now().isoformat()}] ジョブステータスを'processing'に更新中...")
-    cursor.execute("""
-        UPDATE "JobQueue" 
-        SET status = 'processing', started_at = NOW()
-        WHERE id = %s
-    """, (job['id'],))
-    conn.commit()
-    print(f"[{datetime.now().isoformat()}] ジョブステータスを更新しました")
-    
-    try:
-        # payloadから情報を取得
-        print(f"[{datetime.now().isoformat()}] ペイロードを解析中...")
-        payload = job['payload'] if isinstance(job['payload'], dict) else json.loads(job['payload'])
-        session_id = payload.get('sessionId') or payload.get('session_id')
-        print(f"[{datetime.now().isoformat()}] セッションID: {session_id}")
-        print(f"[{datetime.now().isoformat()}] ペイロード内容: {json.dumps(payload, indent=2)}")
-        
-        # TestSessionLogにログを記録
-        log_to_session(cursor, session_id, 'info', 'テスト実行を開始しました', {'job_id': job['id']})
-        conn.commit()
-        
-        # TestConfigからmodeを取得
-        test_config_id = payload.get('testConfigId') or payload.get('test_config_id')
-        project_id = payload.get('projectId') or payload.get('project_id')
-        url = payload.get('url')
-        mode = payload.get('mode', 'omakase')
-        
-        # URLが指定されていない場合、TestConfigまたはProjectから取得
-        if not url:
-            if test_config_id:
-                cursor.execute("""
-                    SELECT tc.mode, p.url as project_url
-                    FROM "TestConfig" tc
-                    LEFT JOIN "Project" p ON tc.project_id = p.id
-                    WHERE tc.id = %s
-                """, (test_config_id,))
-                result = cursor.fetchone()
-                if result:
-                    mode = mode or result['mode'] or 'omakase'
-                    url = result['project_url']
-            elif project_id:
-                cursor.execute("""
-                    SELECT url FROM "Project" WHERE id = %s
-                """, (project_id,))
-                result = cursor.fetchone()
-                if result:
-                    url = result['url']
-        
-        # それでもURLが取得できない場合は、セッションから取得を試みる
-        if not url and session_id:
-            cursor.execute("""
-                SELECT p.url
-                FROM "TestSession" ts
-                JOIN "Project" p ON ts.project_id = p.id
-                WHERE ts.id = %s
-            """, (session_id,))
-            result = cursor.fetchone()
-            if result:
-                url = result['url']
-        
-        # 最終的なフォールバック
-        if not url:
-            url = 'https://example.com'
-            log_to_session(cursor, session_id, 'warning', 'URLが指定されていないため、デフォルトURLを使用します', {'url': url})
-            conn.commit()
-        
-        print(f"[{datetime.now().isoformat()}] テスト実行を開始...")
-        print(f"[{datetime.now().isoformat()}] URL: {url}, Mode: {mode}")
-        log_to_session(cursor, session_id, 'info', 'テスト環境をセットアップ中...', {'url': url, 'mode': mode})
-        conn.commit()
-        
-        # 実際のテスト実行
-        result = execute_test_with_executor(session_id, mode, url, cursor, conn)
-        
-        # 最終結果のスクリーンショットを取得（シミュレーション）
-        final_screenshot = None
-        try:
-            import base64
-            # ダミースクリーンショット（小さな1x1ピクセルのPNG）
-            dummy_png = b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01\x08\x06\x00\x00\x00\x1f\x15\xc4\x89\x00\x00\x00\rIDATx\xdac\xf8\x0f\x00\x00\x01\x00\x01\x00\x18\xdd\x8d\xb4\x1c\x00\x00\x00\x00IEND\xaeB`\x82'
-            final_screenshot = base64.b64encode(dummy_png).decode('utf-8')
-        except:
-            pass
-        
-        # TestSessionを更新
-        print(f"[{datetime.now().isoformat()}] TestSessionのステータスを更新中...")
-        cursor.execute("""
-            UPDATE "TestSession" 
-            SET 
-                status = 'completed',
-                started_at = COALESCE(started_at, NOW()),
-                completed_at = NOW(),
-                bugs_found = %s,
-                test_coverage = %s
-            WHERE id = %s
-        """, (result.get('bugs_found', 0), result.get('test_coverage', 0.0), session_id))
-        
-        # JobQueueを完了に更新（スクリーンショット付き）
-        print(f"[{datetime.now().isoformat()}] ジョブを完了状態に更新中...")
-        result_data = {
-            "status": "success",
-            "session_id": session_id,
-            "bugs_found": result.get('bugs_found', 0),
-            "test_coverage": result.get('test_coverage', 0.0),
-            "pages_scanned": result.get('pages_scanned', 0),
-            "completed_at": datetime.now().isoformat()
-        }
-        cursor.execute("""
-            UPDATE "JobQueue" 
-            SET 
-                status = 'completed',
-                completed_at = NOW(),
-                result = %s,
-                screenshot = %s
-            WHERE id = %s
-        """, (
-            json.dumps(result_data),
-            final_screenshot,
-            job['id']
-        ))
-        
-        log_to_session(cursor, session_id, 'info', 'ジョブ処理が正常に完了しました', {'result': result_data})
-        conn.commit()
-        
-        print(f"[{datetime.now().isoformat()}] ジョブ {job['id']} の処理が完了しました (セッション: {session_id})")
-        print(f"[{datetime.now().isoformat()}] 結果: {json.dumps(result_data, indent=2)}")
-        
-    except Exception as e:
-        print(f"[{datetime.now().isoformat()}] エラーが発生しました: {e}")
-        import traceback
-        traceback.print_exc()
-        
-        # エラーログを記録
-        if 'session_id' in locals() and session_id:
-            log_to_session(cursor, session_id, 'error', f'ジョブ処理中にエラーが発生しました: {str(e)}', 
-                          {'error_type': type(e).__name__, 'job_id': job['id']})
-        
-        cursor.execute("""
-            UPDATE "JobQueue" 
-            SET status = 'failed', error = %s, completed_at = NOW()
-            WHERE id = %s
-        """, (str(e), job['id']))
-        conn.commit()
-    
-    finally:
-        print(f"[{datetime.now().isoformat()}] データベース接続をクローズします")
-        cursor.close()
-        conn.close()
-        print(f"[{datetime.now().isoformat()}] ジョブ処理スクリプトを終了")
+    job_type = sys.argv[1] if len(sys.argv) > 1 else 'test_execution'
+    print(f"[{datetime.now().isoformat()}] ジョブ処理スクリプトを開始 (タイプ: {job_type})")
+    processed_count = run_jobs(job_type, max_jobs=1, hand_off=False)
+    print(f"[{datetime.now().isoformat()}] {processed_count}件のジョブを処理しました")
+    print(f"[{datetime.now().isoformat()}] ジョブ処理スクリプトを終了")
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
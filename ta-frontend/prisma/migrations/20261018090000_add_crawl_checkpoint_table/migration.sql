@@ -0,0 +1,22 @@
+-- CreateTable
+CREATE TABLE "CrawlCheckpoint" (
+    "id" TEXT NOT NULL,
+    "test_session_id" TEXT NOT NULL,
+    "frontier" JSONB NOT NULL,
+    "visited_urls" JSONB NOT NULL,
+    "page_results" JSONB NOT NULL,
+    "bug_fingerprints" JSONB NOT NULL,
+    "bugs" JSONB NOT NULL,
+    "pages_scanned" INTEGER NOT NULL DEFAULT 0,
+    "elapsed_seconds" DOUBLE PRECISION NOT NULL DEFAULT 0,
+    "created_at" TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    "updated_at" TIMESTAMP(3) NOT NULL,
+
+    CONSTRAINT "CrawlCheckpoint_pkey" PRIMARY KEY ("id")
+);
+
+-- CreateIndex
+CREATE UNIQUE INDEX "CrawlCheckpoint_test_session_id_key" ON "CrawlCheckpoint"("test_session_id");
+
+-- AddForeignKey
+ALTER TABLE "CrawlCheckpoint" ADD CONSTRAINT "CrawlCheckpoint_test_session_id_fkey" FOREIGN KEY ("test_session_id") REFERENCES "TestSession"("id") ON DELETE CASCADE ON UPDATE CASCADE;
@@ -0,0 +1,9 @@
+-- AlterTable
+ALTER TABLE "JobQueue" ADD COLUMN     "lease_expires_at" TIMESTAMP(3),
+ADD COLUMN     "worker_id" TEXT;
+
+-- CreateIndex
+CREATE INDEX "JobQueue_status_priority_created_at_idx" ON "JobQueue"("status", "priority", "created_at");
+
+-- CreateIndex
+CREATE INDEX "JobQueue_status_lease_expires_at_idx" ON "JobQueue"("status", "lease_expires_at");
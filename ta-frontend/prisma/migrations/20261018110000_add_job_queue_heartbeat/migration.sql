@@ -0,0 +1,2 @@
+-- AlterTable
+ALTER TABLE "JobQueue" ADD COLUMN     "heartbeat_at" TIMESTAMP(3);
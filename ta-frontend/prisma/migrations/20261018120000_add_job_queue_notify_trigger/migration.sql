@@ -0,0 +1,21 @@
+-- CreateFunction
+CREATE OR REPLACE FUNCTION "notify_job_queue"() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('job_queue', json_build_object('id', NEW.id, 'type', NEW.type)::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- CreateTrigger
+CREATE TRIGGER "JobQueue_notify_insert"
+    AFTER INSERT ON "JobQueue"
+    FOR EACH ROW
+    WHEN (NEW.status = 'pending')
+    EXECUTE FUNCTION "notify_job_queue"();
+
+-- CreateTrigger
+CREATE TRIGGER "JobQueue_notify_requeue"
+    AFTER UPDATE OF status ON "JobQueue"
+    FOR EACH ROW
+    WHEN (NEW.status = 'pending' AND OLD.status IS DISTINCT FROM 'pending')
+    EXECUTE FUNCTION "notify_job_queue"();
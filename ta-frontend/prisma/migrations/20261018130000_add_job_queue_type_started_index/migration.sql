@@ -0,0 +1,2 @@
+-- CreateIndex
+CREATE INDEX "JobQueue_type_started_at_idx" ON "JobQueue"("type", "started_at");
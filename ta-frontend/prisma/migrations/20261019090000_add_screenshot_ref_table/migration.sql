@@ -0,0 +1,92 @@
+-- CreateTable
+CREATE TABLE "ScreenshotRef" (
+    "key" TEXT NOT NULL,
+    "organization_id" TEXT NOT NULL,
+    "created_at" TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP,
+
+    CONSTRAINT "ScreenshotRef_pkey" PRIMARY KEY ("key","organization_id")
+);
+
+-- CreateFunction
+-- screenshot列の参照（.../<sha256>.<拡張子>）からスクリーンショットストアのキーを取り出す（base64などはNULL）
+CREATE OR REPLACE FUNCTION "screenshot_key"(ref TEXT) RETURNS TEXT AS $$
+    SELECT substring(ref from '([0-9a-f]{64}\.(?:png|jpg|webp))$');
+$$ LANGUAGE sql IMMUTABLE;
+
+-- CreateFunction
+-- 行が参照するスクリーンショットを、その行が属する組織のものとして記録する
+-- （RLSの有効なアプリユーザーからの書き込みでも記録できるようにSECURITY DEFINERにする）
+CREATE OR REPLACE FUNCTION "record_screenshot_ref"() RETURNS trigger AS $$
+DECLARE
+    ref_key TEXT := "screenshot_key"(NEW.screenshot);
+BEGIN
+    IF ref_key IS NULL THEN
+        RETURN NULL;
+    END IF;
+    IF TG_TABLE_NAME = 'ActivityLog' THEN
+        INSERT INTO "ScreenshotRef" ("key", "organization_id")
+        SELECT ref_key, a.organization_id FROM "Account" a WHERE a.id = NEW.account_id
+        ON CONFLICT DO NOTHING;
+    ELSE
+        INSERT INTO "ScreenshotRef" ("key", "organization_id")
+        SELECT ref_key, p.organization_id
+        FROM "TestSession" s JOIN "Project" p ON p.id = s.project_id
+        WHERE s.id = NEW.test_session_id
+        ON CONFLICT DO NOTHING;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql SECURITY DEFINER;
+
+-- CreateTrigger
+CREATE TRIGGER "TestSessionLog_screenshot_ref"
+    AFTER INSERT OR UPDATE OF screenshot ON "TestSessionLog"
+    FOR EACH ROW WHEN (NEW.screenshot IS NOT NULL)
+    EXECUTE FUNCTION "record_screenshot_ref"();
+
+-- CreateTrigger
+CREATE TRIGGER "TestResult_screenshot_ref"
+    AFTER INSERT OR UPDATE OF screenshot ON "TestResult"
+    FOR EACH ROW WHEN (NEW.screenshot IS NOT NULL)
+    EXECUTE FUNCTION "record_screenshot_ref"();
+
+-- CreateTrigger
+CREATE TRIGGER "BugTicket_screenshot_ref"
+    AFTER INSERT OR UPDATE OF screenshot ON "BugTicket"
+    FOR EACH ROW WHEN (NEW.screenshot IS NOT NULL)
+    EXECUTE FUNCTION "record_screenshot_ref"();
+
+-- CreateTrigger
+CREATE TRIGGER "JobQueue_screenshot_ref"
+    AFTER INSERT OR UPDATE OF screenshot ON "JobQueue"
+    FOR EACH ROW WHEN (NEW.screenshot IS NOT NULL)
+    EXECUTE FUNCTION "record_screenshot_ref"();
+
+-- CreateTrigger
+CREATE TRIGGER "ActivityLog_screenshot_ref"
+    AFTER INSERT OR UPDATE OF screenshot ON "ActivityLog"
+    FOR EACH ROW WHEN (NEW.screenshot IS NOT NULL)
+    EXECUTE FUNCTION "record_screenshot_ref"();
+
+-- Backfill
+INSERT INTO "ScreenshotRef" ("key", "organization_id")
+SELECT DISTINCT refs.key, p.organization_id
+FROM (
+    SELECT "screenshot_key"(screenshot) AS key, test_session_id FROM "TestSessionLog" WHERE screenshot IS NOT NULL
+    UNION
+    SELECT "screenshot_key"(screenshot), test_session_id FROM "TestResult" WHERE screenshot IS NOT NULL
+    UNION
+    SELECT "screenshot_key"(screenshot), test_session_id FROM "BugTicket" WHERE screenshot IS NOT NULL
+    UNION
+    SELECT "screenshot_key"(screenshot), test_session_id FROM "JobQueue" WHERE screenshot IS NOT NULL
+) refs
+JOIN "TestSession" s ON s.id = refs.test_session_id
+JOIN "Project" p ON p.id = s.project_id
+WHERE refs.key IS NOT NULL
+ON CONFLICT DO NOTHING;
+
+INSERT INTO "ScreenshotRef" ("key", "organization_id")
+SELECT DISTINCT "screenshot_key"(l.screenshot), a.organization_id
+FROM "ActivityLog" l JOIN "Account" a ON a.id = l.account_id
+WHERE "screenshot_key"(l.screenshot) IS NOT NULL
+ON CONFLICT DO NOTHING;
@@ -0,0 +1,2 @@
+-- AlterTable
+ALTER TABLE "CrawlCheckpoint" ADD COLUMN "dispatched" INTEGER;
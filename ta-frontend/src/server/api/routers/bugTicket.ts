@@ -2,6 +2,8 @@ import { TRPCError } from "@trpc/server";
 import { z } from "zod";
 import { Prisma } from "@prisma/client";
 
+import { withSignedScreenshot } from "@/server/screenshotUrl";
+
 import { 
   createTRPCRouter, 
   protectedUserProcedure,
@@ -92,7 +94,10 @@ export const bugTicketRouter = createTRPCRouter({
         });
       }
 
-      return bugTicket;
+      return {
+        ...withSignedScreenshot(bugTicket, ctx.organizationId),
+        testResult: bugTicket.testResult && withSignedScreenshot(bugTicket.testResult, ctx.organizationId),
+      };
     }),
 
   // Get all bug tickets with filters
@@ -195,7 +200,7 @@ export const bugTicketRouter = createTRPCRouter({
       });
 
       return {
-        tickets: result.tickets,
+        tickets: result.tickets.map((ticket) => withSignedScreenshot(ticket, ctx.organizationId)),
         total: result.total,
         hasMore: result.total > input.offset + input.limit
       };
@@ -1,6 +1,7 @@
 import { z } from "zod";
 import { createTRPCRouter, protectedUserProcedure } from "../trpc";
 import { TRPCError } from "@trpc/server";
+import { withSignedScreenshot } from "@/server/screenshotUrl";
 
 export const jobQueueRouter = createTRPCRouter({
   // Get job queue status for test session
@@ -43,7 +44,7 @@ export const jobQueueRouter = createTRPCRouter({
         orderBy: { createdAt: "desc" }
       });
 
-      return jobs;
+      return jobs.map((job) => withSignedScreenshot(job, account.organizationId));
     }),
 
   // Get all pending jobs (admin only)
@@ -1,5 +1,7 @@
 import { z } from "zod";
 
+import { withSignedScreenshot } from "@/server/screenshotUrl";
+
 import { createTRPCRouter, protectedUserProcedure } from "../trpc";
 
 export const testResultRouter = createTRPCRouter({
@@ -34,7 +36,7 @@ export const testResultRouter = createTRPCRouter({
       ]);
 
       return {
-        results,
+        results: results.map((result) => withSignedScreenshot(result, ctx.organizationId)),
         total,
         hasMore: total > input.offset + input.limit,
       };
@@ -1,6 +1,8 @@
 import { TRPCError } from "@trpc/server";
 import { z } from "zod";
 
+import { withSignedScreenshot } from "@/server/screenshotUrl";
+
 import { 
   createTRPCRouter, 
   protectedUserProcedure,
@@ -70,7 +72,10 @@ export const testSessionRouter = createTRPCRouter({
         });
       }
 
-      return testSession;
+      return {
+        ...testSession,
+        bugTickets: testSession.bugTickets.map((bug) => withSignedScreenshot(bug, ctx.organizationId)),
+      };
     }),
 
   // Get all test sessions for a project
@@ -568,12 +573,14 @@ export const testSessionRouter = createTRPCRouter({
         });
       }
 
-      return ctx.db.testSessionLog.findMany({
+      const logs = await ctx.db.testSessionLog.findMany({
         where: { testSessionId: input.sessionId },
         orderBy: { createdAt: "asc" },
         take: input.limit,
         skip: input.offset,
       });
+
+      return logs.map((log) => withSignedScreenshot(log, ctx.organizationId));
     }),
 
   // Debug endpoint to check raw data
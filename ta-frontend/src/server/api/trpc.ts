@@ -99,6 +99,7 @@ const authenticatedUserMiddleware = t.middleware(async ({ ctx, next }) => {
     ctx: {
       db: rlsDb,
       session: { ...ctx.session, user: ctx.session.user },
+      organizationId: account.organizationId,
     },
   });
 });
@@ -132,6 +133,7 @@ const authenticatedTenantAdminMiddleware = t.middleware(
       ctx: {
         db: rlsDb,
         session: { ...ctx.session, user: ctx.session.user },
+        organizationId: account.organizationId,
       },
     });
   },
@@ -0,0 +1,59 @@
+import { createHmac } from "crypto";
+
+// スクリーンショットストアのキー（<sha256>.<拡張子>）。screenshot列の参照URLの末尾にある
+const SCREENSHOT_KEY_PATTERN = /([0-9a-f]{64}\.(?:png|jpg|webp))$/;
+const SCREENSHOT_API_PATH = "/api/v1/screenshots/";
+
+/**
+ * スクリーンショットの参照URLに、組織と有効期限の署名を付ける
+ *
+ * バックエンドの /api/v1/screenshots/<key> は、SCREENSHOT_URL_SECRETでの署名が正しく、
+ * 有効期限内で、その組織の行が画像を参照している場合だけ画像を返す。
+ * 行へのアクセス権を確認したAPIだけがこの関数でURLを作る。
+ * 有効期限はSCREENSHOT_URL_TTL_SECONDS単位に切り上げ、ポーリングで取り直してもURLが変わらない（ブラウザのキャッシュが効く）ようにする。
+ * @param value screenshot列の値（base64の場合はそのまま返す）
+ * @param organizationId 行が属する組織のID
+ * @returns 署名付きのURL
+ */
+export function signScreenshotUrl(value: string, organizationId: string): string;
+export function signScreenshotUrl(value: string | null, organizationId: string): string | null;
+export function signScreenshotUrl(value: string | null, organizationId: string): string | null {
+  const secret = process.env.SCREENSHOT_URL_SECRET;
+  const key = value?.match(SCREENSHOT_KEY_PATTERN)?.[1];
+  if (!value || !key || !secret || !/^https?:\/\//.test(value)) {
+    return value;
+  }
+
+  const ttl = Number(process.env.SCREENSHOT_URL_TTL_SECONDS ?? "3600");
+  const expires = Math.ceil((Date.now() / 1000 + ttl) / ttl) * ttl;
+  const signature = createHmac("sha256", secret)
+    .update(`${key}:${organizationId}:${expires}`)
+    .digest("hex");
+
+  // バックエンドを経由しないURL（以前のS3の公開URL）も、SCREENSHOT_API_BASE_URLがあればバックエンドから取得する
+  const baseUrl = value.includes(SCREENSHOT_API_PATH)
+    ? value.slice(0, value.indexOf(SCREENSHOT_API_PATH))
+    : process.env.SCREENSHOT_API_BASE_URL;
+  if (!baseUrl) {
+    return value;
+  }
+  const params = new URLSearchParams({
+    organization_id: organizationId,
+    expires: String(expires),
+    signature,
+  });
+  return `${baseUrl}${SCREENSHOT_API_PATH}${key}?${params.toString()}`;
+}
+
+/**
+ * 行のscreenshotを署名付きのURLに置き換える
+ * @param row screenshot列を持つ行
+ * @param organizationId 行が属する組織のID
+ * @returns screenshotを置き換えた行
+ */
+export function withSignedScreenshot<T extends { screenshot: string | null }>(
+  row: T,
+  organizationId: string,
+): T {
+  return { ...row, screenshot: signScreenshotUrl(row.screenshot, organizationId) };
+}
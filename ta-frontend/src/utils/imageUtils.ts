@@ -1,3 +1,12 @@
+/**
+ * スクリーンショットストアの参照（URL）かどうかを判定する
+ * @param value screenshot列の値
+ * @returns URLの場合true
+ */
+export function isImageUrl(value: string): boolean {
+  return value.startsWith("http://") || value.startsWith("https://");
+}
+
 /**
  * Base64画像データからData URLを生成する
  * @param base64Data Base64エンコードされた画像データ（プレフィックスなし）
@@ -5,8 +14,8 @@
  * @returns Data URL形式の文字列
  */
 export function createImageDataUrl(base64Data: string, mimeType: string = "image/png"): string {
-  // 既にdata:プレフィックスがある場合はそのまま返す
-  if (base64Data.startsWith("data:")) {
+  // 既にdata:プレフィックスがある場合やURLの場合はそのまま返す
+  if (base64Data.startsWith("data:") || isImageUrl(base64Data)) {
     return base64Data;
   }
   
@@ -24,8 +33,8 @@ export function isValidImageData(base64Data: string | null | undefined): boolean
     return false;
   }
   
-  // data:で始まっている場合
-  if (base64Data.startsWith("data:")) {
+  // data:で始まっている場合、またはスクリーンショットストアのURLの場合
+  if (base64Data.startsWith("data:") || isImageUrl(base64Data)) {
     return true;
   }
   